@@ -2,8 +2,9 @@
 Answer to a question on a text using RAG
 
 Requirements:
-- Create the text embeddings with create_embeddings.py. It is necessary a CSV file with "text" and "embeddings"
-  column. Each row corresponds to a sentence or any text unit of the original document.
+- Create the text embeddings with create_embeddings.py. It is necessary an embedding store directory
+  (or a legacy CSV file with "text" and "embeddings" columns).
+  Each row corresponds to a sentence or any text unit of the original document.
 
 The default arguments loads the Wikipedia 2022 events embeddings.
 
@@ -16,17 +17,69 @@ Expected output:
 
 Example with another embeddings dataframe:
     python answer_question.py \
-    --input_embeddings ./data/wiki_it_castelnuovo_garfagnana_embeddings.csv \
+    --input_embeddings ./data/wiki_it_castelnuovo_garfagnana_embeddings \
     --question "Qual è il monumento simbolo di Castelnuovo di Garfagnana?"
+
+Example of batch mode, the questions file is a JSONL file with a "question" field (and optional "id")
+or a CSV file with a "question" column:
+    python answer_question.py \
+    --questions_file ./rag/data/test_questions.jsonl \
+    --output_answers_filepath ./rag/data/test_answers.jsonl
+
+Each output JSONL line has the question, the initial and RAG answers, the row ids used as context
+and the timings of each step.
+
+Example as a thin client of a running query_service.py (the embeddings are already loaded by the service):
+    python answer_question.py --service_url http://127.0.0.1:8080 --question "Who is the owner of Twitter?"
 """
 import argparse
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Optional, Tuple, Union
 
 import numpy as np
-import openai
 import pandas as pd
-from openai.embeddings_utils import distances_from_embeddings, get_embedding
 
-from utils.openai_utils import count_tokens, set_openai_vocareum_key
+from utils.ann_index import IVF_INDEX_FILENAME, IVFIndex
+from utils.embedding_backends import get_embedding_backend
+from utils.embedding_cache import EmbeddingCache
+from utils.answer_cache import AnswerCache
+from utils.embedding_store import (
+    EmbeddingStore,
+    get_embeddings_rows,
+    get_embeddings_version,
+    is_legacy_csv,
+    load_embeddings,
+)
+from utils.context_packing import (
+    PACKING_MODES,
+    PREFIX_TOKEN_COUNT_COLUMN,
+    TOKEN_COUNT_COLUMN,
+    dedup_rows,
+    pack_context,
+    pack_grouped_context,
+)
+from utils.lexical_index import LEXICAL_INDEX_FILENAME, RETRIEVAL_MODES, BM25Index, HybridRetriever
+from utils.metrics import (
+    add_metrics_arguments,
+    add_timing,
+    configure_metrics,
+    count,
+    metrics_enabled,
+    timer,
+)
+from utils.openai_utils import (
+    count_tokens,
+    count_tokens_batch,
+    get_tokenizer,
+    set_openai_vocareum_key,
+)
+from utils.quantization import QUANTIZER_FILENAME, QuantizedRetriever, load_quantized_codes
+from utils.retrieval import ExactRetriever, normalize_rows
+from utils.sharded_retrieval import ShardedRetriever
 
 # Prompt template to get an answer to the question
 PROMPT_TEMPLATE = \
@@ -43,44 +96,686 @@ Question: {}
 Answer:
 """
 
-def get_rows_sorted_by_relevance(
-    question: str, df: pd.DataFrame, embedding_model_name: str
+COMPLETION_MODEL_NAME = "gpt-3.5-turbo-instruct"
+
+# Answer fields saved in the semantic answer cache and written to the batch mode output
+CACHED_ANSWER_FIELDS = ("initial_answer", "rag_answer", "context", "context_row_ids")
+BATCH_OUTPUT_FIELDS = ("initial_answer", "rag_answer", "context_row_ids", "cached_question")
+# Answer settings sent with each question to query_service.py, the other query arguments
+# (embeddings, index and caches) are the ones of the service
+SERVICE_REQUEST_OPTIONS = (
+    "top_k",
+    "max_prompt_tokens",
+    "context_packing",
+    "group_context_prefixes",
+    "context_dedup_threshold",
+    "max_answer_tokens",
+    "skip_initial_answer",
+)
+DenseRetriever = Union[ExactRetriever, IVFIndex, QuantizedRetriever, ShardedRetriever]
+Retriever = Union[DenseRetriever, HybridRetriever]
+
+
+def get_dense_retriever(
+    store: EmbeddingStore,
+    input_embeddings: str,
+    n_probe: int,
+    exact_search: bool,
+    num_shard_workers: int = 0,
+    rescore_factor: int = 4,
+) -> DenseRetriever:
+    """
+    Retriever of the embeddings, see get_retriever
+    """
+    if store.is_sharded:
+        return ShardedRetriever(
+            input_embeddings,
+            store.shard_offsets,
+            num_workers=num_shard_workers,
+            n_probe=n_probe,
+            exact_search=exact_search,
+            rescore_factor=rescore_factor,
+        )
+    retriever = ExactRetriever(store.embeddings, normalized=store.normalized)
+    if exact_search or is_legacy_csv(input_embeddings):
+        return retriever
+    if os.path.exists(os.path.join(input_embeddings, IVF_INDEX_FILENAME)):
+        return IVFIndex.load(input_embeddings, retriever.matrix, n_probe=n_probe)
+    if os.path.exists(os.path.join(input_embeddings, QUANTIZER_FILENAME)):
+        quantizer, codes = load_quantized_codes(input_embeddings)
+        return QuantizedRetriever(quantizer, codes, retriever.matrix, rescore_factor=rescore_factor)
+    return retriever
+
+
+def get_retriever(
+    store: EmbeddingStore,
+    input_embeddings: str,
+    n_probe: int,
+    exact_search: bool,
+    num_shard_workers: int = 0,
+    rescore_factor: int = 4,
+    retrieval_mode: str = "dense",
+    lexical_candidates: int = 1000,
+) -> Retriever:
+    """
+    Use the IVF approximate index when it is available in the embedding store, then the quantized codes
+    with full precision rescoring, the exact search otherwise.
+    The queries on a sharded store fan out to a pool of processes, each shard is searched the same way.
+    With the prefilter and hybrid retrieval modes the dense retriever is combined with the BM25 index.
+    """
+    dense_retriever = get_dense_retriever(
+        store, input_embeddings, n_probe, exact_search, num_shard_workers, rescore_factor
+    )
+    if retrieval_mode == "dense":
+        return dense_retriever
+    if is_legacy_csv(input_embeddings) or not os.path.exists(
+        os.path.join(input_embeddings, LEXICAL_INDEX_FILENAME)
+    ):
+        print(
+            f"WARNING: no BM25 index in {input_embeddings}, build it with create_embeddings.py --lexical_index. "
+            f"Using the dense retrieval instead of {retrieval_mode}"
+        )
+        return dense_retriever
+    return HybridRetriever(
+        dense_retriever,
+        BM25Index.load(input_embeddings),
+        store,
+        mode=retrieval_mode,
+        num_candidates=lexical_candidates,
+    )
+
+
+def check_embedding_model_name(store: EmbeddingStore, embedding_model_name: str):
+    if store.embedding_model_name not in (None, embedding_model_name):
+        print(
+            f"WARNING: the embeddings were created with {store.embedding_model_name}, "
+            f"the questions are embedded with {embedding_model_name}"
+        )
+
+
+def get_most_relevant_rows(
+    question_embeddings: np.ndarray,
+    store: EmbeddingStore,
+    retriever: Retriever,
+    top_k: int,
+    question: str = "",
 ) -> pd.DataFrame:
     """
-    Function that takes in input a question string, a dataframe and an embedding model name.
-    Each dataframe row includes a text and the associated embeddings vector.
+    Function that takes in input the question embeddings, an embedding store with its retriever
+    and the number of rows to retrieve.
+    Each store row includes a text and the associated embeddings vector.
+    The question text is needed by the BM25 index of the prefilter and hybrid retrieval modes.
+
+    Returns:
+        The store metadata of the top_k rows sorted by descending question relevance,
+        with the cosine "distances" column
+    """
+    # Score all the rows with a single matrix-vector product and select only the top_k
+    # (shorter distance = more relevant, the rows are returned in ascending distance order)
+    with timer("retrieval"):
+        if isinstance(retriever, HybridRetriever):
+            indices, similarities = retriever.search(
+                question_embeddings, top_k=top_k, query_text=question
+            )
+        else:
+            indices, similarities = retriever.search(question_embeddings, top_k=top_k)
+    df_top_k = store.metadata.iloc[indices].copy()
+    df_top_k["distances"] = 1.0 - similarities
+    return df_top_k
+
+
+def get_answer_settings_version(args: argparse.Namespace) -> str:
+    """
+    The cached answers are read only with the same answer settings, the embeddings version is checked separately
+    """
+    settings = {
+        "embedding_model_name": args.embedding_model_name,
+        "completion_model_name": COMPLETION_MODEL_NAME,
+        "prompt_template": PROMPT_TEMPLATE,
+        "top_k": args.top_k,
+        "n_probe": args.n_probe,
+        "exact_search": args.exact_search,
+        "rescore_factor": args.rescore_factor,
+        "retrieval_mode": args.retrieval_mode,
+        "lexical_candidates": args.lexical_candidates,
+        "max_prompt_tokens": args.max_prompt_tokens,
+        "max_answer_tokens": args.max_answer_tokens,
+        "context_packing": args.context_packing,
+        "group_context_prefixes": args.group_context_prefixes,
+        "context_dedup_threshold": args.context_dedup_threshold,
+        "skip_initial_answer": args.skip_initial_answer,
+    }
+    return hashlib.sha256(json.dumps(settings, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def get_questions_embeddings(
+    questions: List[str],
+    embedding_model_name: str,
+    request_size: int,
+    embedding_cache: Optional[EmbeddingCache] = None,
+) -> np.ndarray:
+    """
+    Get the embeddings of many questions sending request_size questions for each embedding backend call
+    (Embedding.create for the OpenAI models, see utils/embedding_backends.py).
+    The repeated questions are embedded once and the ones found in the embeddings cache are not sent to the backend.
+
+    Returns:
+        (number of questions, embeddings size) float32 matrix
+    """
+    unique_questions = list(dict.fromkeys(questions))
+    if embedding_cache is not None:
+        embeddings = embedding_cache.get_many(embedding_model_name, unique_questions)
+    else:
+        embeddings = [None] * len(unique_questions)
+    missing_positions = [position for position, vector in enumerate(embeddings) if vector is None]
+    for i in range(0, len(missing_positions), request_size):
+        batch_positions = missing_positions[i : i + request_size]
+        batch_questions = [unique_questions[position] for position in batch_positions]
+        with timer("question_embedding_request"):
+            batch_embeddings = get_embedding_backend(embedding_model_name).embed(batch_questions)
+        for position, vector in zip(batch_positions, batch_embeddings):
+            embeddings[position] = vector
+        if embedding_cache is not None:
+            embedding_cache.put_many(embedding_model_name, batch_questions, batch_embeddings)
+    unique_positions = {question: position for position, question in enumerate(unique_questions)}
+    return np.array(embeddings, dtype=np.float32)[[unique_positions[question] for question in questions]]
+
+
+def get_row_token_counts(rows: pd.DataFrame) -> np.ndarray:
+    """
+    Number of tokens of each row, precomputed by create_embeddings.py or counted now for older stores
+    """
+    if TOKEN_COUNT_COLUMN in rows.columns:
+        return rows[TOKEN_COUNT_COLUMN].values
+    with timer("token_counting"):
+        return np.array(count_tokens_batch(rows["text"].tolist()), dtype=np.int64)
+
+
+def get_row_prefix_token_counts(rows: pd.DataFrame) -> Optional[np.ndarray]:
+    """
+    Number of tokens of the heading (or date) prefix of each row, precomputed by create_embeddings.py,
+    None for older stores (the prefixes are counted while packing the context)
+    """
+    if PREFIX_TOKEN_COUNT_COLUMN in rows.columns:
+        return rows[PREFIX_TOKEN_COUNT_COLUMN].values
+    return None
+
+
+def get_row_sections(rows: pd.DataFrame) -> Optional[List[Optional[str]]]:
+    """
+    Returns:
+        the headings key of each row (None for the missing ones), None when the rows have no "section" column
+    """
+    if "section" not in rows.columns:
+        return None
+    return rows["section"].where(rows["section"].notna(), None).tolist()
+
+
+def get_context(
+    texts: List[str],
+    token_counts: np.ndarray,
+    question: str,
+    max_prompt_tokens: int,
+    packing_mode: str = "truncate",
+    group_prefixes: bool = False,
+    embeddings: Optional[np.ndarray] = None,
+    dedup_threshold: float = 0.0,
+    sections: Optional[List[Optional[str]]] = None,
+    prefix_token_counts: Optional[np.ndarray] = None,
+) -> Tuple[List[str], List[int]]:
+    """
+    Add the texts (sorted by relevance) to the context until max_prompt_tokens is reached
+
+    Args:
+        texts: texts sorted by relevance
+        token_counts: number of tokens of each text
+        question: question added to the prompt
+        max_prompt_tokens: maximum number of tokens of the prompt
+        packing_mode: "truncate" stops at the first text exceeding the limit,
+            "fill" skips it and keeps adding the next texts that fit
+        group_prefixes: group the texts by heading (or date) prefix and write each prefix once
+        embeddings: L2 normalized embeddings of the texts, needed to drop the near-duplicates
+        dedup_threshold: cosine similarity from which a text is dropped as a duplicate of a more relevant one,
+            0 to keep all the texts
+        sections: headings key of each text when known, to split the prefixes with group_prefixes
+        prefix_token_counts: number of tokens of the prefix of each text, counted now with group_prefixes when None
+
+    Returns:
+        the context texts (one block for each prefix with group_prefixes) and the positions
+        of the texts added to the context
+    """
+    # We want to exploit the available number of tokens for the model, but setting a limit,
+    # because we are charged based on the number of tokens
+    with timer("token_counting"):
+        base_token_count = count_tokens(PROMPT_TEMPLATE) + count_tokens(question)
+
+    candidate_positions = list(range(len(texts)))
+    if embeddings is not None and dedup_threshold > 0:
+        with timer("context_dedup"):
+            candidate_positions = dedup_rows(embeddings, dedup_threshold)
+    candidate_texts = [texts[position] for position in candidate_positions]
+    candidate_token_counts = np.asarray(token_counts)[candidate_positions]
+
+    # Add context until max tokens, the counts are precomputed so this is only arithmetic
+    with timer("context_packing"):
+        if group_prefixes:
+            context, positions = pack_grouped_context(
+                candidate_texts,
+                candidate_token_counts,
+                budget=max_prompt_tokens - base_token_count,
+                mode=packing_mode,
+                sections=[sections[position] for position in candidate_positions] if sections is not None else None,
+                prefix_token_counts=(
+                    np.asarray(prefix_token_counts)[candidate_positions]
+                    if prefix_token_counts is not None
+                    else None
+                ),
+            )
+        else:
+            positions = pack_context(
+                candidate_token_counts, budget=max_prompt_tokens - base_token_count, mode=packing_mode
+            )
+            context = [candidate_texts[position] for position in positions]
+    return context, [candidate_positions[position] for position in positions]
+
+
+def build_prompt(context: List[str], question: str) -> str:
+    # Create the prompt with the context in a specific format to highlight each line (event)
+    return PROMPT_TEMPLATE.format("\n\n###\n\n".join(context), question)
+
+
+def stream_completion(
+    prompt: str,
+    max_answer_tokens: int,
+    on_token: Optional[Callable[[str], None]] = None,
+    stage: str = "completion",
+) -> Tuple[str, float, float]:
+    """
+    Get the completion with stream=True, on_token is called with each text chunk as soon as it arrives.
+    The time and the tokens are counted in the metrics under the stage name.
 
     Returns:
-        Copy of the input dataframe sorted by descending question relevance
+        the completion text, the time to the first token and the total time in seconds
     """
-    # Get embeddings for the question text
-    question_embeddings = get_embedding(question, engine=embedding_model_name)
+    import openai
+
+    # From the documentation: the token count of your prompt plus max_tokens
+    # (maximum number of tokens that can be generated in the completion)
+    # cannot exceed the model's context length.
+    start = time.perf_counter()
+    first_token_time_s = None
+    chunks = []
+    num_chunks = 0
+    for chunk in openai.Completion.create(
+        model=COMPLETION_MODEL_NAME, prompt=prompt, max_tokens=max_answer_tokens, stream=True
+    ):
+        text = chunk["choices"][0]["text"]
+        num_chunks += 1
+        if first_token_time_s is None:
+            first_token_time_s = time.perf_counter() - start
+        # Skip the whitespace/newlines chunks at the beginning of the completion
+        if not chunks and not text.strip():
+            continue
+        chunks.append(text)
+        if on_token is not None:
+            on_token(text)
+    total_time_s = time.perf_counter() - start
+    if metrics_enabled():
+        add_timing(f"{stage}.first_token", first_token_time_s or total_time_s)
+        add_timing(stage, total_time_s)
+        count(f"api_calls.{stage}")
+        count(f"tokens_sent.{stage}", count_tokens(prompt))
+        # Each streamed chunk is a token
+        count(f"tokens_received.{stage}", num_chunks)
+    return "".join(chunks).strip(), first_token_time_s or total_time_s, total_time_s
 
-    # Make a copy of the dataframe and add a "distances" column containing
-    # the cosine distances between each row's embeddings and the
-    # embeddings of the question
-    df_copy = df.copy()
-    df_copy["distances"] = distances_from_embeddings(
-        question_embeddings, df_copy["embeddings"].values, distance_metric="cosine"
+
+def get_context_rows_embeddings(
+    store: EmbeddingStore, rows: pd.DataFrame, args: argparse.Namespace
+) -> Optional[np.ndarray]:
+    """
+    Returns:
+        the L2 normalized embeddings of the retrieved rows when the context near-duplicates are dropped,
+        otherwise None
+    """
+    if args.context_dedup_threshold <= 0:
+        return None
+    # The metadata index is the position of the rows in the store
+    embeddings = get_embeddings_rows(store, rows.index.values)
+    return embeddings if store.normalized else normalize_rows(embeddings)
+
+
+def answer_from_rows(
+    question: str,
+    rows: pd.DataFrame,
+    args: argparse.Namespace,
+    on_rag_token: Optional[Callable[[str], None]] = None,
+    embeddings: Optional[np.ndarray] = None,
+) -> dict:
+    """
+    Build the context from the retrieved rows (sorted by relevance) and get the answers without and with context.
+    The two completions run concurrently, the answer without context is skipped with args.skip_initial_answer.
+
+    Args:
+        on_rag_token: called with each RAG answer chunk as soon as it arrives
+        embeddings: L2 normalized embeddings of the rows, to drop the near-duplicates (args.context_dedup_threshold)
+
+    Returns:
+        dict with the answers, the prompt, the context texts and row ids and the timings of each step
+    """
+    timings = {}
+    start = time.perf_counter()
+    context, context_positions = get_context(
+        rows["text"].tolist(),
+        get_row_token_counts(rows),
+        question,
+        args.max_prompt_tokens,
+        packing_mode=args.context_packing,
+        group_prefixes=args.group_context_prefixes,
+        embeddings=embeddings,
+        dedup_threshold=args.context_dedup_threshold,
+        sections=get_row_sections(rows),
+        prefix_token_counts=get_row_prefix_token_counts(rows),
     )
+    prompt = build_prompt(context, question)
+    timings["context_s"] = time.perf_counter() - start
 
-    # Sort the copied dataframe by the distances and return it
-    # (shorter distance = more relevant so we sort in ascending order)
-    df_copy.sort_values("distances", ascending=True, inplace=True)
-    return df_copy
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        # Answer without using the context, in background
+        initial_answer_future = None
+        if not args.skip_initial_answer:
+            initial_answer_future = executor.submit(
+                stream_completion, question, args.max_answer_tokens, stage="completion.initial"
+            )
 
+        # Answer using the context
+        rag_answer, timings["rag_answer_ttft_s"], timings["rag_answer_s"] = stream_completion(
+            prompt, args.max_answer_tokens, on_token=on_rag_token, stage="completion.rag"
+        )
 
-def do_parsing():
-    parser = argparse.ArgumentParser(
-        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
-        description="Answer question on text embeddings in CSV format",
+        initial_answer = None
+        if initial_answer_future is not None:
+            (
+                initial_answer,
+                timings["initial_answer_ttft_s"],
+                timings["initial_answer_s"],
+            ) = initial_answer_future.result()
+
+    return {
+        "initial_answer": initial_answer,
+        "rag_answer": rag_answer,
+        "prompt": prompt,
+        "context": context,
+        "context_row_ids": rows["row_id"].values[context_positions].tolist(),
+        "timings": timings,
+    }
+
+
+def cache_answer(
+    answer_cache: AnswerCache, question: str, question_embeddings: np.ndarray, result: dict
+):
+    answer_cache.put(
+        question,
+        question_embeddings,
+        {field: result[field] for field in CACHED_ANSWER_FIELDS},
+    )
+
+
+def answer_question(
+    question: str,
+    question_embeddings: np.ndarray,
+    store: EmbeddingStore,
+    retriever: Retriever,
+    args: argparse.Namespace,
+    answer_cache: Optional[AnswerCache] = None,
+    indices: Optional[np.ndarray] = None,
+    on_rag_token: Optional[Callable[[str], None]] = None,
+) -> dict:
+    """
+    Answer a question from its embeddings: semantic answer cache lookup, retrieval, context and completions.
+    The new answers are added to the answer cache.
+
+    Args:
+        indices: store rows already retrieved for the question (e.g. in batch), the retrieval is skipped
+        on_rag_token: called with each RAG answer chunk as soon as it arrives, not called for the cached answers
+
+    Returns:
+        dict with the answers, the context row ids and the timings, from answer_from_rows or from the cache
+    """
+    timings = {}
+    if answer_cache is not None:
+        start = time.perf_counter()
+        cached_answer = answer_cache.get(question_embeddings)
+        timings["answer_cache_s"] = time.perf_counter() - start
+        if cached_answer is not None:
+            cached_answer["timings"] = timings
+            return cached_answer
+
+    if indices is None:
+        start = time.perf_counter()
+        rows = get_most_relevant_rows(
+            question_embeddings, store, retriever, args.top_k, question=question
+        )
+        timings["retrieval_s"] = time.perf_counter() - start
+    else:
+        rows = store.metadata.iloc[indices]
+    result = answer_from_rows(
+        question,
+        rows,
+        args,
+        on_rag_token=on_rag_token,
+        embeddings=get_context_rows_embeddings(store, rows, args),
+    )
+    result["timings"] = {**timings, **result["timings"]}
+
+    if answer_cache is not None:
+        cache_answer(answer_cache, question, question_embeddings, result)
+    return result
+
+
+def open_embedding_cache(args: argparse.Namespace) -> Optional[EmbeddingCache]:
+    if args.no_embedding_cache:
+        return None
+    return EmbeddingCache(
+        args.embedding_cache_filepath,
+        max_disk_bytes=int(args.embedding_cache_max_mb * 1024**2),
+    )
+
+
+def open_answer_cache(args: argparse.Namespace) -> Optional[AnswerCache]:
+    if args.no_answer_cache:
+        return None
+    return AnswerCache(
+        args.answer_cache_filepath,
+        corpus_version=get_embeddings_version(args.input_embeddings),
+        settings_version=get_answer_settings_version(args),
+        similarity_threshold=args.answer_cache_threshold,
+        ttl_s=args.answer_cache_ttl_hours * 3600,
+        max_entries=args.answer_cache_max_entries,
+    )
+
+
+def get_service_options(args: argparse.Namespace) -> dict:
+    return {name: getattr(args, name) for name in SERVICE_REQUEST_OPTIONS}
+
+
+def ask_service(
+    service_url: str,
+    question: str,
+    on_token: Optional[Callable[[str], None]] = None,
+    options: Optional[dict] = None,
+) -> dict:
+    """
+    Send the question to a running query_service.py
+
+    Args:
+        on_token: called with each RAG answer chunk streamed by the service
+        options: answer settings of this question (SERVICE_REQUEST_OPTIONS), the service ones by default
+
+    Returns:
+        the answer dict computed by the service
+    """
+    import requests
+
+    response = requests.post(
+        f"{service_url.rstrip('/')}/answer",
+        json={"question": question, "stream": on_token is not None, "options": options or {}},
+        stream=on_token is not None,
+    )
+    if response.status_code != 200:
+        raise RuntimeError(f"Query service error {response.status_code}: {response.text}")
+    if on_token is None:
+        return response.json()
+    # JSON lines: {"token": ...} for each chunk, {"result": ...} at the end
+    # chunk_size=None yields the data as soon as it arrives
+    for line in response.iter_lines(chunk_size=None):
+        if not line:
+            continue
+        message = json.loads(line)
+        if "error" in message:
+            raise RuntimeError(f"Query service error: {message['error']}")
+        if "token" in message:
+            on_token(message["token"])
+        else:
+            return message["result"]
+    raise RuntimeError("Query service stream ended without a result")
+
+
+def load_questions(questions_filepath: str) -> List[dict]:
+    """
+    Load the questions from a JSONL file with a "question" field or from a CSV file with a "question" column
+
+    Returns:
+        list of dicts with "id" and "question" keys, the id defaults to the question position
+    """
+    if questions_filepath.lower().endswith(".csv"):
+        records = pd.read_csv(questions_filepath, keep_default_na=False).to_dict("records")
+    else:
+        with open(questions_filepath, "r") as in_fp:
+            records = [json.loads(line) for line in in_fp if line.strip()]
+    return [
+        {"id": record.get("id", position), "question": record["question"]}
+        for position, record in enumerate(records)
+    ]
+
+
+def answer_questions_file(
+    args: argparse.Namespace,
+    store: EmbeddingStore,
+    retriever: Retriever,
+    embedding_cache: Optional[EmbeddingCache] = None,
+    answer_cache: Optional[AnswerCache] = None,
+):
+    """
+    Answer all the questions of args.questions_file and write the results to args.output_answers_filepath
+
+    The questions are embedded with batched requests, retrieved together with a single
+    matrix-matrix product and the completions run concurrently on a bounded thread pool.
+    The questions similar to one in the answer cache get the cached answer without completions.
+    """
+    questions = load_questions(args.questions_file)
+    questions_texts = [question["question"] for question in questions]
+    print(f"{len(questions)} questions loaded from '{args.questions_file}'")
+
+    start = time.perf_counter()
+    questions_embeddings = get_questions_embeddings(
+        questions_texts,
+        args.embedding_model_name,
+        args.embedding_request_size,
+        embedding_cache=embedding_cache,
+    )
+    embedding_time_s = time.perf_counter() - start
+
+    start = time.perf_counter()
+    with timer("retrieval"):
+        if isinstance(retriever, HybridRetriever):
+            all_indices, _ = retriever.search_batch(
+                questions_embeddings, top_k=args.top_k, query_texts=questions_texts
+            )
+        else:
+            all_indices, _ = retriever.search_batch(questions_embeddings, top_k=args.top_k)
+    retrieval_time_s = time.perf_counter() - start
+    print(
+        f"Questions embeddings in {embedding_time_s:.2f} s, retrieval in {retrieval_time_s:.3f} s"
+    )
+
+    def answer_one(question_position: int) -> dict:
+        question = questions[question_position]
+        indices = all_indices[question_position]
+        # IVF results are padded with -1 when the probed lists have less than top_k rows
+        indices = indices[indices >= 0]
+        result = answer_question(
+            question["question"],
+            questions_embeddings[question_position],
+            store,
+            retriever,
+            args,
+            answer_cache=answer_cache,
+            indices=indices,
+        )
+        record = {"id": question["id"], "question": question["question"]}
+        record.update({field: result[field] for field in BATCH_OUTPUT_FIELDS if field in result})
+        record["timings"] = {
+            # The batched steps are amortized over the questions
+            "embedding_s": embedding_time_s / len(questions),
+            "retrieval_s": retrieval_time_s / len(questions),
+            **result["timings"],
+        }
+        return record
+
+    os.makedirs(os.path.dirname(args.output_answers_filepath) or ".", exist_ok=True)
+    start = time.perf_counter()
+    # The thread pool size bounds the number of completion requests in flight,
+    # map returns the results in the questions order
+    with ThreadPoolExecutor(
+        max_workers=args.max_concurrent_completions
+    ) as executor, open(args.output_answers_filepath, "w") as out_fp:
+        for result in executor.map(answer_one, range(len(questions))):
+            out_fp.write(json.dumps(result, ensure_ascii=False) + "\n")
+    print(
+        f"{len(questions)} answers saved to '{args.output_answers_filepath}' "
+        f"in {time.perf_counter() - start:.2f} s"
+    )
+
+
+def ask_service_questions_file(args: argparse.Namespace):
+    """
+    Batch mode as a client of the query service: the questions are sent concurrently,
+    the service batches their embeddings requests
+    """
+    questions = load_questions(args.questions_file)
+    print(f"{len(questions)} questions loaded from '{args.questions_file}'")
+
+    def ask_one(question: dict) -> dict:
+        result = ask_service(args.service_url, question["question"], options=get_service_options(args))
+        record = {"id": question["id"], "question": question["question"]}
+        record.update({field: result[field] for field in BATCH_OUTPUT_FIELDS if field in result})
+        record["timings"] = result["timings"]
+        return record
+
+    os.makedirs(os.path.dirname(args.output_answers_filepath) or ".", exist_ok=True)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(
+        max_workers=args.max_concurrent_completions
+    ) as executor, open(args.output_answers_filepath, "w") as out_fp:
+        for result in executor.map(ask_one, questions):
+            out_fp.write(json.dumps(result, ensure_ascii=False) + "\n")
+    print(
+        f"{len(questions)} answers saved to '{args.output_answers_filepath}' "
+        f"in {time.perf_counter() - start:.2f} s"
     )
+
+
+def add_query_arguments(parser: argparse.ArgumentParser):
+    """
+    Arguments to load the embeddings and to answer the questions, shared with query_service.py
+    """
     parser.add_argument(
         "--input_embeddings",
         required=False,
         type=str,
-        default="./rag/data/wiki_2022_embeddings.csv",
-        help="Input dataset embeddings CSV",
+        default="./rag/data/wiki_2022_embeddings",
+        help="Input embedding store directory or legacy embeddings CSV",
     )
     parser.add_argument(
         "--embedding_model_name",
@@ -89,14 +784,113 @@ def do_parsing():
         default="text-embedding-ada-002",  # embeddings size 1536
         help="Embeddings model used to create the dataset embeddings. "
         "It is necessary to re-use the same embeddings model used to process all the input_embeddings. "
-        "Check OpenAI documentation about available embedding models.",
+        "Check OpenAI documentation about available embedding models, or pass local-hashing-<embeddings size> "
+        "for the local CPU model (see utils/embedding_backends.py).",
     )
-    parser.add_argument("--question", required=True, type=str, help="Question to ask")
     parser.add_argument(
-        "--closest_sentences_output_filepath",
+        "--embedding_cache_filepath",
         required=False,
         type=str,
-        help="Pass it to save the intermediate dataframe with the closest sentences to the question",
+        default="./rag/data/embeddings_cache.sqlite",
+        help="Persistent embeddings cache SQLite file, shared with create_embeddings.py",
+    )
+    parser.add_argument(
+        "--embedding_cache_max_mb",
+        required=False,
+        type=float,
+        default=1024,
+        help="Maximum size of the embeddings cache, the least recently used embeddings are evicted",
+    )
+    parser.add_argument(
+        "--no_embedding_cache",
+        action="store_true",
+        help="Don't use the persistent embeddings cache for the questions",
+    )
+    parser.add_argument(
+        "--answer_cache_filepath",
+        required=False,
+        type=str,
+        default="./rag/data/answers_cache.sqlite",
+        help="Semantic answer cache SQLite file",
+    )
+    parser.add_argument(
+        "--answer_cache_threshold",
+        required=False,
+        type=float,
+        default=0.97,
+        help="Minimum cosine similarity with a cached question to reuse its answer",
+    )
+    parser.add_argument(
+        "--answer_cache_ttl_hours",
+        required=False,
+        type=float,
+        default=24 * 7,
+        help="Lifetime of the cached answers",
+    )
+    parser.add_argument(
+        "--answer_cache_max_entries",
+        required=False,
+        type=int,
+        default=10000,
+        help="Maximum number of cached answers, the least recently used are evicted",
+    )
+    parser.add_argument(
+        "--no_answer_cache",
+        action="store_true",
+        help="Don't use the semantic answer cache",
+    )
+    parser.add_argument(
+        "--top_k",
+        required=False,
+        type=int,
+        default=100,
+        help="Number of most relevant rows to retrieve, the context is filled from these rows",
+    )
+    parser.add_argument(
+        "--n_probe",
+        required=False,
+        type=int,
+        default=8,
+        help="Number of IVF lists to search when the embedding store has an approximate index, "
+        "higher values increase the recall and the latency",
+    )
+    parser.add_argument(
+        "--exact_search",
+        action="store_true",
+        help="Score all the rows even if the embedding store has an approximate index or quantized codes",
+    )
+    parser.add_argument(
+        "--rescore_factor",
+        required=False,
+        type=int,
+        default=4,
+        help="With quantized embeddings, rows rescored at full precision for each retrieved row "
+        "(rescore_factor * top_k rows), 0 to use the approximate scores of the codes",
+    )
+    parser.add_argument(
+        "--retrieval_mode",
+        required=False,
+        type=str,
+        choices=RETRIEVAL_MODES,
+        default="dense",
+        help="dense scores the embeddings only, prefilter scores only the rows matching the question keywords "
+        "in the BM25 index, hybrid fuses the dense and BM25 rankings (create the index with "
+        "create_embeddings.py --lexical_index)",
+    )
+    parser.add_argument(
+        "--lexical_candidates",
+        required=False,
+        type=int,
+        default=1000,
+        help="BM25 rows scored with the embeddings (prefilter) or fused with as many dense rows (hybrid)",
+    )
+    parser.add_argument(
+        "--num_shard_workers",
+        required=False,
+        type=int,
+        default=0,
+        help="Processes searching the shards of a sharded embedding store, 0 for one per shard "
+        "up to the number of cores",
     )
     parser.add_argument(
         "--max_prompt_tokens",
@@ -105,6 +899,28 @@ def do_parsing():
         default=1000,
         help="Maximum number of tokens to use in the prompt",
     )
+    parser.add_argument(
+        "--context_packing",
+        required=False,
+        type=str,
+        choices=PACKING_MODES,
+        default="truncate",
+        help="'truncate' stops adding context rows at the first one exceeding --max_prompt_tokens, "
+        "'fill' skips the rows that don't fit and keeps filling the prompt with the next ones",
+    )
+    parser.add_argument(
+        "--group_context_prefixes",
+        action="store_true",
+        help="Group the context rows by their heading (or date) prefix and write each prefix once",
+    )
+    parser.add_argument(
+        "--context_dedup_threshold",
+        required=False,
+        type=float,
+        default=0.0,
+        help="Drop the context rows with a cosine similarity to a more relevant row from this value "
+        "(e.g. 0.97), 0 to keep all the rows",
+    )
     parser.add_argument(
         "--max_answer_tokens",
         required=False,
@@ -112,75 +928,247 @@ def do_parsing():
         default=150,
         help="Maximum number of tokens to use in the answer",
     )
+    parser.add_argument(
+        "--skip_initial_answer",
+        action="store_true",
+        help="Don't ask the question without context, otherwise the two completions run concurrently",
+    )
+
+
+class RAGAnswerPrinter:
+    """
+    Print the RAG answer chunks to stdout as soon as they arrive
+    """
+
+    def __init__(self):
+        self.started = False
+
+    def __call__(self, token: str):
+        if not self.started:
+            # The completion starts with whitespace (e.g. " Elon" or "\n\n"), like the stripped non-streamed answer
+            token = token.lstrip()
+            if not token:
+                return
+            print("RAG answer: ", end="")
+            self.started = True
+        print(token, end="", flush=True)
+
+
+def print_answers(result: dict, streamed: bool):
+    """
+    Print the answers, the RAG answer only if it was not already streamed
+    """
+    if streamed:
+        # End the streamed line
+        print()
+    print(f"Context row ids: {result['context_row_ids']}")
+    if result["initial_answer"] is not None:
+        print(f"Initial answer: {result['initial_answer']}")
+    if not streamed:
+        print(f"RAG answer: {result['rag_answer']}")
+    timings = result.get("timings", {})
+    if "rag_answer_ttft_s" in timings:
+        print(
+            f"RAG answer time to first token {timings['rag_answer_ttft_s']:.2f} s, "
+            f"total {timings['rag_answer_s']:.2f} s"
+        )
+
+
+def do_parsing():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description="Answer question on text embeddings",
+    )
+    questions_group = parser.add_mutually_exclusive_group(required=True)
+    questions_group.add_argument("--question", type=str, help="Question to ask")
+    questions_group.add_argument(
+        "--questions_file",
+        type=str,
+        help="JSONL file with a 'question' field or CSV file with a 'question' column, "
+        "to answer many questions in batch mode",
+    )
+    parser.add_argument(
+        "--output_answers_filepath",
+        required=False,
+        type=str,
+        default="./rag/data/answers.jsonl",
+        help="Output JSONL with the answers in batch mode",
+    )
+    parser.add_argument(
+        "--embedding_request_size",
+        required=False,
+        type=int,
+        default=100,
+        help="Number of questions embedded with a single request in batch mode",
+    )
+    parser.add_argument(
+        "--max_concurrent_completions",
+        required=False,
+        type=int,
+        default=8,
+        help="Maximum number of questions answered concurrently in batch mode, "
+        "each one has up to two completion requests in flight",
+    )
+    parser.add_argument(
+        "--service_url",
+        required=False,
+        type=str,
+        help="URL of a running query_service.py (e.g. http://127.0.0.1:8080), "
+        "the questions are sent to the service instead of loading the embeddings in this process. "
+        "The answer settings (--top_k, --max_prompt_tokens, --context_packing, --group_context_prefixes, "
+        "--context_dedup_threshold, --max_answer_tokens, --skip_initial_answer) are sent with each question",
+    )
+    parser.add_argument(
+        "--closest_sentences_output_filepath",
+        required=False,
+        type=str,
+        help="Pass it to save the intermediate dataframe with the closest sentences to the question",
+    )
+    add_query_arguments(parser)
+    add_metrics_arguments(parser)
     args = parser.parse_args()
+    if args.service_url:
+        check_service_client_arguments(parser, args)
     return args
 
 
+def check_service_client_arguments(parser: argparse.ArgumentParser, args: argparse.Namespace):
+    """
+    With --service_url only the SERVICE_REQUEST_OPTIONS are sent to the service,
+    the other query arguments are the ones the service was started with: reject them
+    """
+    query_parser = argparse.ArgumentParser()
+    add_query_arguments(query_parser)
+    service_arguments = [
+        name
+        for name, default in vars(query_parser.parse_args([])).items()
+        if name not in SERVICE_REQUEST_OPTIONS and getattr(args, name) != default
+    ]
+    if service_arguments:
+        parser.error(
+            f"--{', --'.join(service_arguments)} can't be used with --service_url, "
+            f"pass them to query_service.py"
+        )
+
+
+def get_question_embeddings_at_startup(
+    args: argparse.Namespace, embedding_cache: Optional[EmbeddingCache]
+) -> np.ndarray:
+    # Create the embeddings for the question using under the hood openai.Embedding.create (or a local model)
+    set_openai_vocareum_key()
+    return get_questions_embeddings(
+        [args.question],
+        args.embedding_model_name,
+        request_size=1,
+        embedding_cache=embedding_cache,
+    )[0]
+
+
 def main():
     args = do_parsing()
     print(args)
+    configure_metrics(args)
 
-    # Init OpenAI
-    set_openai_vocareum_key()
+    if args.service_url:
+        # Thin client, the service has already loaded the embeddings
+        if args.questions_file:
+            ask_service_questions_file(args)
+            return
+        on_token = RAGAnswerPrinter()
+        result = ask_service(
+            args.service_url, args.question, on_token=on_token, options=get_service_options(args)
+        )
+        if "cached_question" in result:
+            print(
+                f"Answer from cache, similar question: '{result['cached_question']}' "
+                f"(similarity {result['cache_similarity']:.3f})"
+            )
+        print_answers(result, streamed=on_token.started)
+        return
 
-    # Retrieve the embeddings for the WikiPedia 2022 events
-    df_embed = pd.read_csv(args.input_embeddings, index_col=0)
+    embedding_cache = open_embedding_cache(args)
+    answer_cache = open_answer_cache(args)
 
-    # Convert embeddings to numpy array
-    df_embed["embeddings"] = df_embed["embeddings"].apply(eval).apply(np.array)
+    startup_executor = None
+    if args.questions_file:
+        # Init OpenAI
+        set_openai_vocareum_key()
+    else:
+        # The question embeddings request (with the openai import) and the tokenizer loading
+        # run in background while the embeddings and the index are loaded
+        startup_executor = ThreadPoolExecutor(max_workers=2)
+        question_embeddings_future = startup_executor.submit(
+            get_question_embeddings_at_startup, args, embedding_cache
+        )
+        startup_executor.submit(get_tokenizer)
 
-    # Create the embeddings for the question using under the hood openai.Embedding.create
-    df_sorted_distances = get_rows_sorted_by_relevance(
-        question=args.question,
-        df=df_embed,
-        embedding_model_name=args.embedding_model_name,
-    )
+    # Retrieve the embeddings for the WikiPedia 2022 events,
+    # the store matrix is memory-mapped (no parsing and no copy)
+    with timer("load_embeddings"):
+        store = load_embeddings(args.input_embeddings)
+    check_embedding_model_name(store, args.embedding_model_name)
+    with timer("load_index"):
+        retriever = get_retriever(
+            store,
+            args.input_embeddings,
+            n_probe=args.n_probe,
+            exact_search=args.exact_search,
+            num_shard_workers=args.num_shard_workers,
+            rescore_factor=args.rescore_factor,
+            retrieval_mode=args.retrieval_mode,
+            lexical_candidates=args.lexical_candidates,
+        )
 
-    if args.closest_sentences_output_filepath:
-        df_sorted_distances.to_csv(args.closest_sentences_output_filepath)
-
-    # We want to exploit the available number of tokens for the model, but setting a limit,
-    # because we are charged based on the number of tokens
-    current_token_count = count_tokens(PROMPT_TEMPLATE) + count_tokens(args.question)
-    print(f"Prompt template + question number of tokens: {current_token_count}")
+    if args.questions_file:
+        answer_questions_file(args, store, retriever, embedding_cache, answer_cache)
+        if embedding_cache is not None:
+            print(f"Embeddings cache: {embedding_cache.stats()}")
+        if answer_cache is not None:
+            print(f"Answer cache: {answer_cache.stats()}")
+        return
 
-    # Add context until max tokens (which can be exceeded with the last step)
-    context = []
-    for text in df_sorted_distances["text"].values:
+    question_embeddings = question_embeddings_future.result()
+    startup_executor.shutdown()
 
-        # Increase the counter based on the number of tokens in this row
-        text_token_count = count_tokens(text)
-        current_token_count += text_token_count
+    if answer_cache is not None:
+        cached_answer = answer_cache.get(question_embeddings)
+        if cached_answer is not None:
+            print(
+                f"Answer from cache, similar question: '{cached_answer['cached_question']}' "
+                f"(similarity {cached_answer['cache_similarity']:.3f})"
+            )
+            print_answers(cached_answer, streamed=False)
+            return
 
-        # Add the row of text to the list if we haven't exceeded the max.
-        # The last step can exceed max_prompt_tokens
-        if current_token_count <= args.max_prompt_tokens:
-            context.append(text)
-        else:
-            break
+    df_sorted_distances = get_most_relevant_rows(
+        question_embeddings=question_embeddings,
+        store=store,
+        retriever=retriever,
+        top_k=args.top_k,
+        question=args.question,
+    )
 
-    # Create the prompt with the context in a specific format to highlight each line (event)
-    prompt = PROMPT_TEMPLATE.format("\n\n###\n\n".join(context), args.question)
-    print(f"Prompt: {prompt}")
-    print(f"Prompt tokens: {count_tokens(prompt)}")
+    if args.closest_sentences_output_filepath:
+        df_sorted_distances.to_csv(args.closest_sentences_output_filepath)
 
-    # From the documentation: the token count of your prompt plus max_tokens
-    # (maximum number of tokens that can be generated in the completion)
-    # cannot exceed the model's context length.
+    print(
+        "Prompt template + question number of tokens: "
+        f"{count_tokens(PROMPT_TEMPLATE) + count_tokens(args.question)}"
+    )
+    on_token = RAGAnswerPrinter()
+    result = answer_from_rows(
+        args.question,
+        df_sorted_distances,
+        args,
+        on_rag_token=on_token,
+        embeddings=get_context_rows_embeddings(store, df_sorted_distances, args),
+    )
+    print_answers(result, streamed=on_token.started)
+    print(f"Prompt: {result['prompt']}")
+    print(f"Prompt tokens: {count_tokens(result['prompt'])}")
 
-    # Answer without using the context
-    initial_answer = openai.Completion.create(
-        model="gpt-3.5-turbo-instruct",
-        prompt=args.question,
-        max_tokens=args.max_answer_tokens,
-    )["choices"][0]["text"].strip()
-    print(f"Initial answer: {initial_answer}")
-
-    # Answer using the context
-    answer_with_context = openai.Completion.create(
-        model="gpt-3.5-turbo-instruct", prompt=prompt, max_tokens=args.max_answer_tokens
-    )["choices"][0]["text"].strip()
-    print(f"RAG answer: {answer_with_context}")
+    if answer_cache is not None:
+        cache_answer(answer_cache, args.question, question_embeddings, result)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,170 @@
+"""
+Recall@k versus latency report of the IVF index against the exact search
+
+Run it on an embedding store (the queries are sampled close to the store rows)
+or on synthetic clustered embeddings.
+
+Example (run this from the repository root):
+    python -m benchmarks.ann_recall_report \
+    --synthetic_num_rows 200000 --n_lists 512 --n_probe 1 2 4 8 16 32 \
+    --output_report_filepath ./rag/data/ann_recall_report.json
+"""
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+
+from benchmarks.synthetic_data import make_clustered_embeddings, make_queries
+from utils.ann_index import IVF_INDEX_FILENAME, IVFIndex
+from utils.embedding_store import load_embeddings
+from utils.retrieval import ExactRetriever
+
+
+def measure_latency_ms(search_fn, queries: np.ndarray, top_k: int):
+    """
+    Returns:
+        the search results for each query and the latency of each query in milliseconds
+    """
+    results = []
+    latencies_ms = []
+    for query in queries:
+        start = time.perf_counter()
+        results.append(search_fn(query, top_k)[0])
+        latencies_ms.append((time.perf_counter() - start) * 1000.0)
+    return results, np.array(latencies_ms)
+
+
+def recall_at_k(approximate_results, exact_results) -> float:
+    recalls = [
+        len(np.intersect1d(approximate, exact)) / max(len(exact), 1)
+        for approximate, exact in zip(approximate_results, exact_results)
+    ]
+    return float(np.mean(recalls))
+
+
+def do_parsing():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description="Measure the IVF index recall@k and latency against the exact search",
+    )
+    parser.add_argument(
+        "--input_embeddings",
+        required=False,
+        type=str,
+        help="Embedding store directory, if it already has an IVF index it is used as it is",
+    )
+    parser.add_argument(
+        "--synthetic_num_rows",
+        required=False,
+        type=int,
+        default=100000,
+        help="Number of synthetic rows, used when --input_embeddings is not passed",
+    )
+    parser.add_argument(
+        "--synthetic_embeddings_size",
+        required=False,
+        type=int,
+        default=1536,
+        help="Synthetic embeddings size",
+    )
+    parser.add_argument(
+        "--n_lists",
+        required=False,
+        type=int,
+        default=256,
+        help="Number of IVF lists when the index is built by this script",
+    )
+    parser.add_argument(
+        "--n_probe",
+        required=False,
+        nargs="+",
+        type=int,
+        default=[1, 2, 4, 8, 16, 32],
+        help="Number of probed lists to evaluate",
+    )
+    parser.add_argument("--top_k", required=False, type=int, default=10, help="k of recall@k")
+    parser.add_argument(
+        "--num_queries", required=False, type=int, default=200, help="Number of queries"
+    )
+    parser.add_argument(
+        "--output_report_filepath",
+        required=False,
+        type=str,
+        help="Pass it to save the report as JSON",
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = do_parsing()
+    print(args)
+
+    if args.input_embeddings:
+        store = load_embeddings(args.input_embeddings)
+        matrix = store.embeddings if store.normalized else ExactRetriever(store.embeddings).matrix
+    else:
+        matrix = make_clustered_embeddings(
+            args.synthetic_num_rows, embeddings_size=args.synthetic_embeddings_size
+        )
+    queries, _ = make_queries(matrix, args.num_queries)
+
+    build_start = time.perf_counter()
+    if args.input_embeddings and os.path.exists(
+        os.path.join(args.input_embeddings, IVF_INDEX_FILENAME)
+    ):
+        ivf_index = IVFIndex.load(args.input_embeddings, matrix)
+    else:
+        ivf_index = IVFIndex.build(matrix, n_lists=args.n_lists)
+    build_time_s = time.perf_counter() - build_start
+    print(f"IVF index with {ivf_index.n_lists} lists ready in {build_time_s:.2f} s")
+
+    exact_retriever = ExactRetriever(matrix, normalized=True)
+    exact_results, exact_latencies_ms = measure_latency_ms(
+        exact_retriever.search, queries, args.top_k
+    )
+    report = {
+        "num_rows": len(matrix),
+        "embeddings_size": int(matrix.shape[1]),
+        "n_lists": ivf_index.n_lists,
+        "top_k": args.top_k,
+        "num_queries": args.num_queries,
+        "index_build_time_s": build_time_s,
+        "exact": {
+            "latency_ms_p50": float(np.percentile(exact_latencies_ms, 50)),
+            "latency_ms_p99": float(np.percentile(exact_latencies_ms, 99)),
+        },
+        "ivf": [],
+    }
+    print(
+        f"exact: p50 {report['exact']['latency_ms_p50']:.3f} ms, "
+        f"p99 {report['exact']['latency_ms_p99']:.3f} ms"
+    )
+
+    for n_probe in args.n_probe:
+        ivf_index.n_probe = n_probe
+        ivf_results, ivf_latencies_ms = measure_latency_ms(
+            ivf_index.search, queries, args.top_k
+        )
+        ivf_report = {
+            "n_probe": n_probe,
+            f"recall_at_{args.top_k}": recall_at_k(ivf_results, exact_results),
+            "latency_ms_p50": float(np.percentile(ivf_latencies_ms, 50)),
+            "latency_ms_p99": float(np.percentile(ivf_latencies_ms, 99)),
+        }
+        report["ivf"].append(ivf_report)
+        print(
+            f"n_probe {n_probe}: recall@{args.top_k} {ivf_report[f'recall_at_{args.top_k}']:.3f}, "
+            f"p50 {ivf_report['latency_ms_p50']:.3f} ms, p99 {ivf_report['latency_ms_p99']:.3f} ms"
+        )
+
+    if args.output_report_filepath:
+        os.makedirs(os.path.dirname(args.output_report_filepath) or ".", exist_ok=True)
+        with open(args.output_report_filepath, "w") as out_fp:
+            json.dump(report, out_fp, indent=2)
+        print(f"Report saved to '{args.output_report_filepath}'")
+
+
+if __name__ == "__main__":
+    main()
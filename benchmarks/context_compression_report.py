@@ -0,0 +1,264 @@
+"""
+Prompt tokens saved by the context prefix grouping and the near-duplicates removal of answer_question.py
+
+For each embedding store, the questions are sampled close to random rows (like benchmarks/ann_recall_report.py)
+and the context of the top-k rows is packed with each mode:
+- none: the rows as they are
+- prefix: the rows grouped by heading (or date) prefix, each prefix written once (--group_context_prefixes)
+- dedup: the near-duplicate rows dropped (--context_dedup_threshold)
+- prefix_dedup: both
+The report has, for each mode, the mean prompt tokens and context rows within the same --max_prompt_tokens,
+and the tokens saved on the same context rows of the "none" mode.
+
+The default stores are the ones of the README examples (Wikipedia 2022 events and the Castelnuovo di Garfagnana
+page), the missing ones are skipped. Without stores a synthetic corpus with both prefix formats is used:
+its embeddings are random, only the injected near-duplicates are dropped.
+
+Example (run this from the repository root):
+    python -m benchmarks.context_compression_report \
+    --output_report_filepath ./rag/data/context_compression_report.json
+"""
+import argparse
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from answer_question import (
+    build_prompt,
+    get_context,
+    get_row_prefix_token_counts,
+    get_row_sections,
+    get_row_token_counts,
+)
+from benchmarks.synthetic_data import make_queries
+from utils.context_packing import PACKING_MODES, count_prefix_tokens
+from utils.embedding_store import EmbeddingStore, load_embeddings
+from utils.openai_utils import count_tokens, count_tokens_batch
+from utils.retrieval import ExactRetriever, normalize_rows
+
+COMPRESSION_MODES = ("none", "prefix", "dedup", "prefix_dedup")
+MONTHS = ("January", "February", "March", "April", "May", "June")
+HEADINGS = ("Storia", "Storia - Età_moderna", "Geografia", "Monumenti e luoghi d'interesse", "Cultura - Eventi")
+
+
+def make_synthetic_corpus(
+    num_groups: int, rows_per_group: int, embeddings_size: int, duplicate_rate: float, seed: int = 0
+) -> EmbeddingStore:
+    """
+    Rows "<date> – <event>" and "<headings key> - <sentence>" like the 2022 events and the Wikipedia pages,
+    the rows of a prefix are close in the embeddings space. duplicate_rate of the rows are near-duplicates
+    of another row of the same prefix (almost the same embeddings, slightly changed text)
+    """
+    rng = np.random.default_rng(seed)
+    texts = []
+    group_ids = []
+    for group_id in range(num_groups):
+        if group_id % 2 == 0:
+            prefix = f"{MONTHS[group_id // 2 % len(MONTHS)]} {group_id // 2 + 1} –"
+        else:
+            prefix = f"Paese {group_id // 2} - {HEADINGS[group_id // 2 % len(HEADINGS)]} -"
+        for row in range(rows_per_group):
+            texts.append(f"{prefix} synthetic fact {row} of the group {group_id} with some more words")
+            group_ids.append(group_id)
+    group_ids = np.array(group_ids)
+    centers = rng.standard_normal((num_groups, embeddings_size), dtype=np.float32)
+    noise = rng.standard_normal((len(texts), embeddings_size), dtype=np.float32)
+    embeddings = normalize_rows(centers[group_ids] + 0.7 * noise)
+
+    duplicate_positions = rng.choice(len(texts), size=int(duplicate_rate * len(texts)), replace=False)
+    for position in duplicate_positions:
+        group_start = group_ids[position] * rows_per_group
+        source = group_start + rng.integers(0, rows_per_group)
+        if source == position:
+            continue
+        texts[position] = texts[source].replace("synthetic fact", "synthetic fact, as reported,")
+        embeddings[position] = normalize_rows(
+            embeddings[source] + 0.01 * rng.standard_normal(embeddings_size, dtype=np.float32)
+        )
+    metadata = pd.DataFrame(
+        {
+            "row_id": np.arange(len(texts)),
+            "text": texts,
+            "n_tokens": count_tokens_batch(texts),
+            "n_prefix_tokens": count_prefix_tokens(texts),
+        }
+    )
+    return EmbeddingStore(embeddings, metadata, {"normalized": True})
+
+
+def pack(rows: pd.DataFrame, embeddings: np.ndarray, question: str, mode: str, args: argparse.Namespace):
+    return get_context(
+        rows["text"].tolist(),
+        get_row_token_counts(rows),
+        question,
+        args.max_prompt_tokens,
+        packing_mode=args.context_packing,
+        group_prefixes=mode in ("prefix", "prefix_dedup"),
+        embeddings=embeddings,
+        dedup_threshold=args.context_dedup_threshold if mode in ("dedup", "prefix_dedup") else 0.0,
+        sections=get_row_sections(rows),
+        prefix_token_counts=get_row_prefix_token_counts(rows),
+    )
+
+
+def benchmark_store(store: EmbeddingStore, args: argparse.Namespace) -> dict:
+    retriever = ExactRetriever(store.embeddings, normalized=store.normalized)
+    queries, source_ids = make_queries(retriever.matrix, args.num_queries, noise_scale=args.query_noise_scale)
+    indices, _ = retriever.search_batch(queries, top_k=args.top_k)
+    results = {mode: {"prompt_tokens": [], "context_rows": []} for mode in COMPRESSION_MODES}
+    same_rows_tokens_saved = []
+    for query_indices, source_id in zip(indices, source_ids):
+        rows = store.metadata.iloc[query_indices]
+        embeddings = retriever.matrix[query_indices]
+        question = store.texts[source_id]
+        for mode in COMPRESSION_MODES:
+            context, positions = pack(rows, embeddings, question, mode, args)
+            results[mode]["prompt_tokens"].append(count_tokens(build_prompt(context, question)))
+            results[mode]["context_rows"].append(len(positions))
+            if mode == "none":
+                baseline_rows = rows.iloc[positions]
+                baseline_tokens = results[mode]["prompt_tokens"][-1]
+        # The same rows of the "none" context with the prefixes written once
+        grouped_context, _ = get_context(
+            baseline_rows["text"].tolist(),
+            get_row_token_counts(baseline_rows),
+            question,
+            max_prompt_tokens=10**9,
+            group_prefixes=True,
+            sections=get_row_sections(baseline_rows),
+            prefix_token_counts=get_row_prefix_token_counts(baseline_rows),
+        )
+        same_rows_tokens_saved.append(baseline_tokens - count_tokens(build_prompt(grouped_context, question)))
+
+    report = {
+        "num_rows": len(store),
+        "same_rows_tokens_saved_mean": float(np.mean(same_rows_tokens_saved)),
+        "modes": {},
+    }
+    for mode in COMPRESSION_MODES:
+        report["modes"][mode] = {
+            "prompt_tokens_mean": float(np.mean(results[mode]["prompt_tokens"])),
+            "context_rows_mean": float(np.mean(results[mode]["context_rows"])),
+            "prompt_tokens_per_row": float(
+                np.sum(results[mode]["prompt_tokens"]) / max(np.sum(results[mode]["context_rows"]), 1)
+            ),
+        }
+    return report
+
+
+def do_parsing():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description="Measure the prompt tokens saved by the context prefix grouping and deduplication",
+    )
+    parser.add_argument(
+        "--input_embeddings",
+        required=False,
+        nargs="*",
+        type=str,
+        default=[
+            "./rag/data/wiki_2022_embeddings",
+            "./rag/data/wiki_it_castelnuovo_garfagnana_embeddings",
+        ],
+        help="Embedding stores (or legacy CSV files), the missing ones are skipped",
+    )
+    parser.add_argument(
+        "--synthetic_num_groups",
+        required=False,
+        type=int,
+        default=200,
+        help="Prefixes of the synthetic corpus, used when none of the --input_embeddings exists",
+    )
+    parser.add_argument(
+        "--synthetic_rows_per_group", required=False, type=int, default=20, help="Synthetic rows of each prefix"
+    )
+    parser.add_argument(
+        "--synthetic_embeddings_size", required=False, type=int, default=256, help="Synthetic embeddings size"
+    )
+    parser.add_argument(
+        "--synthetic_duplicate_rate",
+        required=False,
+        type=float,
+        default=0.1,
+        help="Fraction of near-duplicate synthetic rows",
+    )
+    parser.add_argument(
+        "--query_noise_scale",
+        required=False,
+        type=float,
+        default=0.3,
+        help="Noise of the question embeddings around the source row",
+    )
+    parser.add_argument("--top_k", required=False, type=int, default=100, help="Retrieved rows of each question")
+    parser.add_argument(
+        "--max_prompt_tokens", required=False, type=int, default=1000, help="Maximum number of prompt tokens"
+    )
+    parser.add_argument(
+        "--context_packing",
+        required=False,
+        type=str,
+        choices=PACKING_MODES,
+        default="truncate",
+        help="Packing mode of the context"
+    )
+    parser.add_argument(
+        "--context_dedup_threshold",
+        required=False,
+        type=float,
+        default=0.97,
+        help="Cosine similarity from which a row is a near-duplicate",
+    )
+    parser.add_argument("--num_queries", required=False, type=int, default=200, help="Number of questions")
+    parser.add_argument(
+        "--output_report_filepath",
+        required=False,
+        type=str,
+        help="Pass it to save the report as JSON",
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = do_parsing()
+    print(args)
+
+    stores = {}
+    for path in args.input_embeddings:
+        if os.path.exists(path):
+            stores[path] = load_embeddings(path)
+        else:
+            print(f"WARNING: '{path}' not found, skipped")
+    if not stores:
+        stores["synthetic"] = make_synthetic_corpus(
+            args.synthetic_num_groups,
+            args.synthetic_rows_per_group,
+            args.synthetic_embeddings_size,
+            args.synthetic_duplicate_rate,
+        )
+
+    report = {"top_k": args.top_k, "max_prompt_tokens": args.max_prompt_tokens, "stores": {}}
+    for name, store in stores.items():
+        store_report = benchmark_store(store, args)
+        report["stores"][name] = store_report
+        print(
+            f"{name} ({store_report['num_rows']} rows): "
+            f"{store_report['same_rows_tokens_saved_mean']:.1f} tokens saved per question on the same rows"
+        )
+        for mode, mode_report in store_report["modes"].items():
+            print(
+                f"  {mode}: {mode_report['prompt_tokens_mean']:.1f} prompt tokens, "
+                f"{mode_report['context_rows_mean']:.1f} context rows, "
+                f"{mode_report['prompt_tokens_per_row']:.1f} prompt tokens per row"
+            )
+
+    if args.output_report_filepath:
+        os.makedirs(os.path.dirname(args.output_report_filepath) or ".", exist_ok=True)
+        with open(args.output_report_filepath, "w") as out_fp:
+            json.dump(report, out_fp, indent=2)
+        print(f"Report saved to '{args.output_report_filepath}'")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,188 @@
+"""
+Throughput of the embedding backends: the OpenAI API (the local fake server, with a configurable latency)
+against the local hashing model of utils/embedding_backends.py with a growing number of threads
+
+The texts are embedded with utils/embedding_extraction.py, the same batched and concurrent path of
+create_embeddings.py. The report has the texts per second of each run and, for the local model, the rate
+of questions with typos (swapped characters) that retrieve their source text in the top-k rows.
+The fake server embeddings are random, their retrieval quality is not measured.
+
+Example (run this from the repository root):
+    python -m benchmarks.embedding_backends_report --num_texts 20000 --threads 1 2 4 \
+    --output_report_filepath ./rag/data/embedding_backends_report.json
+"""
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+
+from benchmarks.fake_openai_server import get_api_base, start_fake_openai_server
+from benchmarks.lexical_retrieval_report import make_place_name, source_hit_rate
+from utils.embedding_backends import HASHING_MODEL_PREFIX, get_embedding_backend
+from utils.embedding_extraction import extract_embeddings
+from utils.openai_utils import count_tokens_batch, set_openai_vocareum_key
+from utils.retrieval import ExactRetriever
+
+
+def make_texts(num_texts: int) -> list:
+    return [
+        f"{make_place_name(row_id)} is a synthetic place described in the sentence {row_id} of the corpus"
+        for row_id in range(num_texts)
+    ]
+
+
+def add_typos(text: str, num_typos: int, rng: np.random.Generator) -> str:
+    """
+    Swap num_typos pairs of adjacent characters
+    """
+    characters = list(text)
+    for position in rng.integers(0, len(characters) - 1, size=num_typos):
+        characters[position], characters[position + 1] = characters[position + 1], characters[position]
+    return "".join(characters)
+
+
+def measure_throughput(
+    texts: list, token_counts: list, embedding_model_name: str, num_threads: int, args: argparse.Namespace
+):
+    """
+    Returns:
+        the embeddings and the texts per second
+    """
+    start = time.perf_counter()
+    embeddings = extract_embeddings(
+        texts,
+        token_counts=token_counts,
+        embedding_model_name=embedding_model_name,
+        max_request_tokens=args.max_request_tokens,
+        max_request_rows=args.request_size,
+        max_concurrent_requests=num_threads,
+    )
+    return embeddings, len(texts) / (time.perf_counter() - start)
+
+
+def do_parsing():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description="Compare the throughput of the OpenAI API and of the local embedding model",
+    )
+    parser.add_argument("--num_texts", required=False, type=int, default=20000, help="Number of texts to embed")
+    parser.add_argument(
+        "--embeddings_size",
+        required=False,
+        type=int,
+        default=1536,
+        help="Embeddings size of the local model and of the fake server",
+    )
+    parser.add_argument(
+        "--threads",
+        required=False,
+        nargs="+",
+        type=int,
+        default=[1, 2, 4],
+        help="Numbers of threads of the local model runs",
+    )
+    parser.add_argument(
+        "--max_concurrent_requests",
+        required=False,
+        type=int,
+        default=4,
+        help="Requests in flight of the API run",
+    )
+    parser.add_argument(
+        "--api_latency_ms",
+        required=False,
+        type=float,
+        default=200.0,
+        help="Latency of each fake server request",
+    )
+    parser.add_argument(
+        "--skip_api",
+        action="store_true",
+        help="Measure only the local model",
+    )
+    parser.add_argument(
+        "--request_size", required=False, type=int, default=2048, help="Maximum number of texts in a request"
+    )
+    parser.add_argument(
+        "--max_request_tokens",
+        required=False,
+        type=int,
+        default=50000,
+        help="Maximum number of tokens in a request",
+    )
+    parser.add_argument("--num_queries", required=False, type=int, default=200, help="Questions with typos")
+    parser.add_argument("--num_typos", required=False, type=int, default=3, help="Typos of each question")
+    parser.add_argument("--top_k", required=False, type=int, default=10, help="Rows retrieved for each question")
+    parser.add_argument(
+        "--output_report_filepath",
+        required=False,
+        type=str,
+        help="Pass it to save the report as JSON",
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = do_parsing()
+    print(args)
+
+    texts = make_texts(args.num_texts)
+    token_counts = count_tokens_batch(texts)
+    local_model_name = f"{HASHING_MODEL_PREFIX}{args.embeddings_size}"
+    report = {"num_texts": args.num_texts, "embeddings_size": args.embeddings_size, "runs": []}
+
+    embeddings = None
+    for num_threads in args.threads:
+        embeddings, texts_per_s = measure_throughput(texts, token_counts, local_model_name, num_threads, args)
+        report["runs"].append({"backend": local_model_name, "threads": num_threads, "texts_per_s": texts_per_s})
+        print(f"{local_model_name} with {num_threads} threads: {texts_per_s:.0f} texts/s")
+
+    if not args.skip_api:
+        server = start_fake_openai_server(latency_ms=args.api_latency_ms, embeddings_size=args.embeddings_size)
+        os.environ["OPENAI_API_BASE"] = get_api_base(server)
+        os.environ["OPENAI_API_KEY"] = "fake"
+        set_openai_vocareum_key()
+        try:
+            _, texts_per_s = measure_throughput(
+                texts, token_counts, "text-embedding-ada-002", args.max_concurrent_requests, args
+            )
+        finally:
+            server.shutdown()
+            server.server_close()
+        report["runs"].append(
+            {
+                "backend": "openai_fake_server",
+                "api_latency_ms": args.api_latency_ms,
+                "threads": args.max_concurrent_requests,
+                "texts_per_s": texts_per_s,
+            }
+        )
+        print(
+            f"OpenAI API (fake server, {args.api_latency_ms:.0f} ms latency) with "
+            f"{args.max_concurrent_requests} requests in flight: {texts_per_s:.0f} texts/s"
+        )
+
+    if embeddings is not None:
+        rng = np.random.default_rng(0)
+        source_ids = rng.integers(0, len(texts), size=args.num_queries)
+        queries = get_embedding_backend(local_model_name).embed(
+            [add_typos(texts[source_id], args.num_typos, rng) for source_id in source_ids]
+        )
+        indices, _ = ExactRetriever(embeddings, normalized=True).search_batch(queries, top_k=args.top_k)
+        report["local_source_hit_rate"] = source_hit_rate(indices, source_ids)
+        print(
+            f"{local_model_name}: {report['local_source_hit_rate']:.3f} of the questions with "
+            f"{args.num_typos} typos retrieve their source text in the top {args.top_k}"
+        )
+
+    if args.output_report_filepath:
+        os.makedirs(os.path.dirname(args.output_report_filepath) or ".", exist_ok=True)
+        with open(args.output_report_filepath, "w") as out_fp:
+            json.dump(report, out_fp, indent=2)
+        print(f"Report saved to '{args.output_report_filepath}'")
+
+
+if __name__ == "__main__":
+    main()
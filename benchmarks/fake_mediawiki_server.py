@@ -0,0 +1,283 @@
+"""
+Local mock of the MediaWiki API used by the Wikipedia ingestion scripts, to run them without network
+
+It answers the two queries used by utils/wikipedia_utils.py like the real API (formatversion=2):
+- prop=extracts: deterministic HTML pages (intro, h2/h3 sections, paragraphs and lists) generated from the title,
+  one full page extract per response and the others with the continuation, like the real API.
+  The titles starting with "Missing" don't exist
+- list=categorymembers: the category "Category:Fake <N>" has N pages titled "Fake page <i>", paginated
+
+Start it (run this from the repository root):
+    python -m benchmarks.fake_mediawiki_server --port 8767 --latency_ms 20
+
+Then point the scripts to it:
+    python get_wikipedia_pages.py --category "Fake 100" --api_url http://127.0.0.1:8767/w/api.php ...
+"""
+import argparse
+import hashlib
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List, Tuple
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+
+# Words of the fake sentences
+FAKE_WORDS = (
+    "the town castle river was built in century by family and people market church bridge valley "
+    "mountain festival museum school railway station population economy during war after"
+).split()
+
+
+def get_page_id(title: str) -> int:
+    return int.from_bytes(hashlib.sha256(title.encode("utf-8")).digest()[:4], "little")
+
+
+def make_fake_sentence(rng: np.random.Generator, num_words: int) -> str:
+    words = [FAKE_WORDS[i] for i in rng.integers(0, len(FAKE_WORDS), size=num_words)]
+    return " ".join(words).capitalize() + "."
+
+
+def make_fake_page_elements(
+    title: str, num_sections: int = 5, paragraphs_per_section: int = 3
+) -> List[Tuple]:
+    """
+    Deterministic page with the structure of the real ones: intro paragraph, h2/h3 headings,
+    paragraphs, lists introduced by a sentence ending with ":" and standalone lists
+
+    Returns:
+        elements ("p", text), ("h2" or "h3", anchor, heading) and ("ul", items)
+    """
+    rng = np.random.default_rng(get_page_id(title))
+    elements = [("p", f"{title} {make_fake_sentence(rng, 12)}")]
+    for section in range(num_sections):
+        anchor = f"Section_{section}"
+        elements.append(("h2", anchor, f"Section {section}"))
+        for paragraph in range(paragraphs_per_section):
+            elements.append(("p", f"{make_fake_sentence(rng, 20)} {make_fake_sentence(rng, 15)}"))
+            if paragraph == 0:
+                elements.append(("p", f"{make_fake_sentence(rng, 6)[:-1]}:"))
+                elements.append(("ul", [f"{make_fake_sentence(rng, 4)[:-1]}," for _ in range(3)]))
+        elements.append(("h3", f"{anchor}_details", f"Section {section} details"))
+        elements.append(("p", make_fake_sentence(rng, 18)))
+        elements.append(("ul", [make_fake_sentence(rng, 8) for _ in range(2)]))
+    elements.append(("h2", "External_links", "External links"))
+    elements.append(("ul", ["Official website"]))
+    return elements
+
+
+def make_fake_page_html(title: str, num_sections: int = 5, paragraphs_per_section: int = 3) -> str:
+    """
+    HTML extract of the fake page, the headings have data-mw-anchor like the real extracts
+    """
+    parts = []
+    for element in make_fake_page_elements(title, num_sections, paragraphs_per_section):
+        if element[0] == "p":
+            parts.append(f"<p>{element[1]}</p>")
+        elif element[0] == "ul":
+            parts.append("<ul>" + "".join(f"<li>{item}</li>" for item in element[1]) + "</ul>")
+        else:
+            parts.append(f'<{element[0]} data-mw-anchor="{element[1]}">{element[2]}</{element[0]}>')
+    return "\n".join(parts)
+
+
+def make_fake_page_wikitext(
+    title: str, num_sections: int = 5, paragraphs_per_section: int = 3
+) -> str:
+    """
+    Wikitext of the fake page as stored in the dumps, with some markup removed by the parsing:
+    infobox, bold, links, references and categories
+    """
+    parts = ["{{Infobox settlement\n| name = " + title + "\n| population = {{formatnum:1234}}\n}}"]
+    for element in make_fake_page_elements(title, num_sections, paragraphs_per_section):
+        if element[0] == "p":
+            words = element[1].split(" ")
+            parts.append(
+                f"'''{words[0]}''' [[{words[1]}]] {' '.join(words[2:])}<ref>Fake source</ref>"
+            )
+        elif element[0] == "ul":
+            parts.append("\n".join(f"* {item}" for item in element[1]))
+        else:
+            marks = "=" * int(element[0][1])
+            parts.append(f"{marks} {element[2]} {marks}")
+    parts.append("[[Category:Fake pages]]")
+    return "\n\n".join(parts)
+
+
+class FakeMediaWikiHandler(BaseHTTPRequestHandler):
+    # Set by make_fake_mediawiki_server on the handler subclass
+    config: dict = {}
+    stats: dict = {}
+    stats_lock = threading.Lock()
+
+    def log_message(self, format, *args):
+        # Keep the benchmarks output clean
+        pass
+
+    def send_json(self, status: int, payload: dict):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def count(self, name: str, amount: int = 1):
+        with self.stats_lock:
+            self.stats[name] = self.stats.get(name, 0) + amount
+
+    def do_GET(self):
+        params = {key: values[0] for key, values in parse_qs(urlparse(self.path).query).items()}
+        self.count("requests")
+        time.sleep(self.config["latency_ms"] / 1000.0)
+        if params.get("action") != "query":
+            self.send_json(200, {"error": {"code": "badvalue", "info": "Only action=query is mocked"}})
+        elif params.get("prop") == "extracts":
+            self.handle_extracts(params)
+        elif params.get("list") == "categorymembers":
+            self.handle_category_members(params)
+        else:
+            self.send_json(200, {"error": {"code": "badvalue", "info": "Query not mocked"}})
+
+    def handle_extracts(self, params: dict):
+        titles: List[str] = params["titles"].split("|")
+        if len(titles) > 50:
+            self.send_json(200, {"error": {"code": "toomanyvalues", "info": "Too many titles"}})
+            return
+        # Full page extracts: only one per response, the next one with the continuation
+        extract_position = int(params.get("excontinue", 0))
+        pages = []
+        for position, title in enumerate(titles):
+            if title.startswith("Missing"):
+                pages.append({"ns": 0, "title": title, "missing": True})
+                continue
+            page_dict = {"pageid": get_page_id(title), "ns": 0, "title": title}
+            if position == extract_position:
+                page_dict["extract"] = make_fake_page_html(
+                    title,
+                    num_sections=self.config["num_sections"],
+                    paragraphs_per_section=self.config["paragraphs_per_section"],
+                )
+                self.count("extracts")
+            pages.append(page_dict)
+        response = {"batchcomplete": True, "query": {"pages": pages}}
+        if extract_position + 1 < len(titles):
+            response["continue"] = {"excontinue": extract_position + 1, "continue": "||"}
+        self.send_json(200, response)
+
+    def handle_category_members(self, params: dict):
+        category = params["cmtitle"]
+        try:
+            num_members = int(category.rsplit(" ", 1)[-1])
+        except ValueError:
+            num_members = 0
+        offset = int(params.get("cmcontinue", 0))
+        end = min(offset + self.config["category_page_size"], num_members)
+        members = [
+            {"pageid": get_page_id(f"Fake page {i}"), "ns": 0, "title": f"Fake page {i}"}
+            for i in range(offset, end)
+        ]
+        response = {"batchcomplete": True, "query": {"categorymembers": members}}
+        if end < num_members:
+            response["continue"] = {"cmcontinue": str(end), "continue": "-||"}
+        self.send_json(200, response)
+
+
+def make_fake_mediawiki_server(
+    host: str = "127.0.0.1",
+    port: int = 0,
+    latency_ms: float = 0.0,
+    num_sections: int = 5,
+    paragraphs_per_section: int = 3,
+    category_page_size: int = 500,
+) -> ThreadingHTTPServer:
+    """
+    Create the server, port 0 picks a free port (read it from server.server_address)
+    """
+    handler_class = type(
+        "ConfiguredFakeMediaWikiHandler",
+        (FakeMediaWikiHandler,),
+        {
+            "config": {
+                "latency_ms": latency_ms,
+                "num_sections": num_sections,
+                "paragraphs_per_section": paragraphs_per_section,
+                "category_page_size": category_page_size,
+            },
+            "stats": {},
+            "stats_lock": threading.Lock(),
+        },
+    )
+    server = ThreadingHTTPServer((host, port), handler_class)
+    server.daemon_threads = True
+    return server
+
+
+def start_fake_mediawiki_server(**kwargs) -> ThreadingHTTPServer:
+    """
+    Start the server in a daemon thread, stop it with server.shutdown()
+    """
+    server = make_fake_mediawiki_server(**kwargs)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def get_api_url(server: ThreadingHTTPServer) -> str:
+    host, port = server.server_address[:2]
+    return f"http://{host}:{port}/w/api.php"
+
+
+def do_parsing():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description="Local fake MediaWiki API server",
+    )
+    parser.add_argument("--host", required=False, type=str, default="127.0.0.1", help="Host")
+    parser.add_argument("--port", required=False, type=int, default=8767, help="Port")
+    parser.add_argument(
+        "--latency_ms", required=False, type=float, default=0.0, help="Latency added to each request"
+    )
+    parser.add_argument(
+        "--num_sections", required=False, type=int, default=5, help="Sections of each page"
+    )
+    parser.add_argument(
+        "--paragraphs_per_section",
+        required=False,
+        type=int,
+        default=3,
+        help="Paragraphs of each section, increase it to get long pages",
+    )
+    parser.add_argument(
+        "--category_page_size",
+        required=False,
+        type=int,
+        default=500,
+        help="Category members returned by each request",
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = do_parsing()
+    print(args)
+    server = make_fake_mediawiki_server(
+        host=args.host,
+        port=args.port,
+        latency_ms=args.latency_ms,
+        num_sections=args.num_sections,
+        paragraphs_per_section=args.paragraphs_per_section,
+        category_page_size=args.category_page_size,
+    )
+    print(f"Fake MediaWiki API listening on {get_api_url(server)}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
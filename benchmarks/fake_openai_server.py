@@ -0,0 +1,320 @@
+"""
+Local stand-in of the OpenAI embeddings and completions API, to run the scripts without a key and without network
+
+The embeddings are deterministic pseudo-random unit vectors seeded by the text hash, so the same text
+always gets the same vector. The completions are deterministic pseudo-random words, streamed one token
+per chunk with stream=True. The server can add latency (per request and per generated token), enforce
+requests per minute and tokens per minute limits (HTTP 429 like the real API) and fail a fraction
+of the requests (HTTP 500) to exercise the retries.
+
+Start it (run this from the repository root):
+    python -m benchmarks.fake_openai_server --port 8765 --latency_ms 50 --requests_per_minute 600
+
+Then point the scripts to it with environment variables:
+    OPENAI_API_BASE=http://127.0.0.1:8765/v1 OPENAI_API_KEY=fake python create_embeddings.py ...
+"""
+import argparse
+import hashlib
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List, Optional
+
+import numpy as np
+
+from utils.rate_limit import TokenBucket
+
+
+# Words of the fake completions
+FAKE_WORDS = (
+    "the event was held in during year after new first government city people announced world record "
+    "election president"
+).split()
+
+
+def get_text_seed(text: str) -> int:
+    return int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
+
+
+def get_fake_embedding(text: str, embeddings_size: int) -> List[float]:
+    vector = np.random.default_rng(get_text_seed(text)).standard_normal(embeddings_size)
+    return (vector / np.linalg.norm(vector)).tolist()
+
+
+def get_fake_completion_tokens(prompt: str, num_tokens: int) -> List[str]:
+    rng = np.random.default_rng(get_text_seed(prompt))
+    return [" " + FAKE_WORDS[i] for i in rng.integers(0, len(FAKE_WORDS), size=num_tokens)]
+
+
+def count_fake_tokens(texts: List[str]) -> int:
+    # Whitespace tokens, close enough to size the tokens per minute limit
+    return sum(len(text.split()) for text in texts)
+
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    # Set by make_fake_openai_server on the handler subclass
+    config: dict = {}
+    requests_bucket: Optional[TokenBucket] = None
+    tokens_bucket: Optional[TokenBucket] = None
+    stats: dict = {}
+    stats_lock = threading.Lock()
+    # Needed for the chunked transfer encoding of the streamed completions
+    protocol_version = "HTTP/1.1"
+    # Send each small chunk immediately
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        # Keep the benchmarks output clean
+        pass
+
+    def send_json(self, status: int, payload: dict, headers: Optional[dict] = None):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def count(self, name: str):
+        with self.stats_lock:
+            self.stats[name] = self.stats.get(name, 0) + 1
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        request = json.loads(body or b"{}")
+        self.count("requests")
+
+        texts = request.get("input", request.get("prompt", ""))
+        if isinstance(texts, str):
+            texts = [texts]
+        for bucket, amount, limit_type in (
+            (self.requests_bucket, 1, "requests"),
+            (self.tokens_bucket, count_fake_tokens(texts), "tokens"),
+        ):
+            if bucket is None:
+                continue
+            wait_s = bucket.try_acquire(amount)
+            if wait_s > 0:
+                self.count("rate_limited")
+                self.send_json(
+                    429,
+                    {"error": {"message": f"Rate limit reached for {limit_type}", "type": limit_type}},
+                    headers={"Retry-After": f"{wait_s:.3f}"},
+                )
+                return
+        if random.random() < self.config["failure_rate"]:
+            self.count("failed")
+            self.send_json(500, {"error": {"message": "Fake server error", "type": "server_error"}})
+            return
+        time.sleep(self.config["latency_ms"] / 1000.0)
+
+        if self.path.rstrip("/").endswith("/embeddings"):
+            self.handle_embeddings(request)
+        elif self.path.rstrip("/").endswith("/completions"):
+            self.handle_completions(request)
+        else:
+            self.send_json(404, {"error": {"message": f"Unknown path {self.path}", "type": "invalid_request_error"}})
+
+    def handle_embeddings(self, request: dict):
+        texts = request["input"]
+        if isinstance(texts, str):
+            texts = [texts]
+        self.count("embedded_texts")
+        self.send_json(
+            200,
+            {
+                "object": "list",
+                "model": request.get("model") or request.get("engine"),
+                "data": [
+                    {
+                        "object": "embedding",
+                        "index": i,
+                        "embedding": get_fake_embedding(text, self.config["embeddings_size"]),
+                    }
+                    for i, text in enumerate(texts)
+                ],
+                "usage": {"prompt_tokens": sum(len(text.split()) for text in texts)},
+            },
+        )
+
+
+    def handle_completions(self, request: dict):
+        prompt = request["prompt"]
+        num_tokens = min(self.config["completion_tokens"], request.get("max_tokens") or 16)
+        tokens = get_fake_completion_tokens(prompt, num_tokens)
+        self.count("completions")
+        usage = {
+            "prompt_tokens": count_fake_tokens([prompt]),
+            "completion_tokens": num_tokens,
+            "total_tokens": count_fake_tokens([prompt]) + num_tokens,
+        }
+        model = request.get("model")
+        if not request.get("stream"):
+            time.sleep(num_tokens * self.config["token_latency_ms"] / 1000.0)
+            self.send_json(
+                200,
+                {
+                    "object": "text_completion",
+                    "model": model,
+                    "choices": [{"text": "".join(tokens), "index": 0, "finish_reason": "length"}],
+                    "usage": usage,
+                },
+            )
+            return
+        # Server-sent events, one token per event (and per HTTP chunk) like the real API
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for position, token in enumerate(tokens):
+            time.sleep(self.config["token_latency_ms"] / 1000.0)
+            chunk = {
+                "object": "text_completion",
+                "model": model,
+                "choices": [
+                    {
+                        "text": token,
+                        "index": 0,
+                        "finish_reason": "length" if position == len(tokens) - 1 else None,
+                    }
+                ],
+            }
+            self.write_chunk(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+        self.write_chunk(b"data: [DONE]\n\n")
+        # Last empty chunk
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+    def write_chunk(self, data: bytes):
+        self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+
+def make_fake_openai_server(
+    host: str = "127.0.0.1",
+    port: int = 0,
+    latency_ms: float = 0.0,
+    requests_per_minute: Optional[float] = None,
+    tokens_per_minute: Optional[float] = None,
+    failure_rate: float = 0.0,
+    embeddings_size: int = 1536,
+    completion_tokens: int = 20,
+    token_latency_ms: float = 0.0,
+) -> ThreadingHTTPServer:
+    """
+    Create the server, port 0 picks a free port (read it from server.server_address)
+    """
+    handler_class = type(
+        "ConfiguredFakeOpenAIHandler",
+        (FakeOpenAIHandler,),
+        {
+            "config": {
+                "latency_ms": latency_ms,
+                "failure_rate": failure_rate,
+                "embeddings_size": embeddings_size,
+                "completion_tokens": completion_tokens,
+                "token_latency_ms": token_latency_ms,
+            },
+            "requests_bucket": TokenBucket(requests_per_minute) if requests_per_minute else None,
+            "tokens_bucket": TokenBucket(tokens_per_minute) if tokens_per_minute else None,
+            "stats": {},
+            "stats_lock": threading.Lock(),
+        },
+    )
+    server = ThreadingHTTPServer((host, port), handler_class)
+    server.daemon_threads = True
+    return server
+
+
+def start_fake_openai_server(**kwargs) -> ThreadingHTTPServer:
+    """
+    Start the server in a daemon thread, stop it with server.shutdown()
+    """
+    server = make_fake_openai_server(**kwargs)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def get_api_base(server: ThreadingHTTPServer) -> str:
+    host, port = server.server_address[:2]
+    return f"http://{host}:{port}/v1"
+
+
+def do_parsing():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description="Local fake OpenAI API server",
+    )
+    parser.add_argument("--host", required=False, type=str, default="127.0.0.1", help="Host")
+    parser.add_argument("--port", required=False, type=int, default=8765, help="Port")
+    parser.add_argument(
+        "--latency_ms", required=False, type=float, default=0.0, help="Latency added to each request"
+    )
+    parser.add_argument(
+        "--requests_per_minute",
+        required=False,
+        type=float,
+        help="Requests per minute limit, the exceeding requests get HTTP 429",
+    )
+    parser.add_argument(
+        "--tokens_per_minute",
+        required=False,
+        type=float,
+        help="Input tokens per minute limit, the exceeding requests get HTTP 429",
+    )
+    parser.add_argument(
+        "--failure_rate",
+        required=False,
+        type=float,
+        default=0.0,
+        help="Fraction of requests failing with HTTP 500",
+    )
+    parser.add_argument(
+        "--embeddings_size", required=False, type=int, default=1536, help="Embeddings size"
+    )
+    parser.add_argument(
+        "--completion_tokens",
+        required=False,
+        type=int,
+        default=20,
+        help="Number of tokens of each completion (at most the request max_tokens)",
+    )
+    parser.add_argument(
+        "--token_latency_ms",
+        required=False,
+        type=float,
+        default=0.0,
+        help="Latency of each generated completion token",
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = do_parsing()
+    print(args)
+    server = make_fake_openai_server(
+        host=args.host,
+        port=args.port,
+        latency_ms=args.latency_ms,
+        requests_per_minute=args.requests_per_minute,
+        tokens_per_minute=args.tokens_per_minute,
+        failure_rate=args.failure_rate,
+        embeddings_size=args.embeddings_size,
+        completion_tokens=args.completion_tokens,
+        token_latency_ms=args.token_latency_ms,
+    )
+    print(f"Fake OpenAI API listening on {get_api_base(server)}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+"""
+Write a fake Wikipedia pages-articles XML dump, to run get_wikipedia_dump.py on large dumps without downloading them
+
+The articles are the fake pages of benchmarks/fake_mediawiki_server.py in wikitext format,
+so their sentences are the same of the HTML extracts served by the fake API. Every 10 pages a redirect and
+a page outside the articles namespace are added, get_wikipedia_dump.py skips them.
+
+Example (run this from the repository root):
+    python -m benchmarks.fake_wikipedia_dump --num_pages 20000 --paragraphs_per_section 10 \
+    --output_dump_filepath ./rag/data/fake-pages-articles.xml.bz2
+    python get_wikipedia_dump.py --dump_filepath ./rag/data/fake-pages-articles.xml.bz2 \
+    --num_workers 8 --output_data_filepath ./rag/data/wiki_fake_dump.csv
+"""
+import argparse
+import bz2
+import os
+import time
+from xml.sax.saxutils import escape
+
+from benchmarks.fake_mediawiki_server import get_page_id, make_fake_page_wikitext
+
+DUMP_HEADER = (
+    '<mediawiki xmlns="http://www.mediawiki.org/xml/export-0.10/" version="0.10" xml:lang="en">\n'
+    "  <siteinfo>\n    <sitename>Fakepedia</sitename>\n    <dbname>fakewiki</dbname>\n  </siteinfo>\n"
+)
+DUMP_FOOTER = "</mediawiki>\n"
+
+
+def make_dump_page(page_id: int, title: str, namespace: int, wikitext: str, redirect: str = None) -> str:
+    redirect_element = f'    <redirect title="{escape(redirect)}" />\n' if redirect else ""
+    return (
+        f"  <page>\n    <title>{escape(title)}</title>\n    <ns>{namespace}</ns>\n    <id>{page_id}</id>\n"
+        f"{redirect_element}"
+        f"    <revision>\n      <id>{page_id}</id>\n      <model>wikitext</model>\n      <format>text/x-wiki</format>\n"
+        f'      <text bytes="{len(wikitext.encode("utf-8"))}" xml:space="preserve">{escape(wikitext)}</text>\n'
+        f"    </revision>\n  </page>\n"
+    )
+
+
+def write_fake_dump(
+    dump_filepath: str, num_pages: int, num_sections: int = 5, paragraphs_per_section: int = 3
+):
+    """
+    Write the dump page by page, .bz2 filepaths are compressed
+    """
+    opener = bz2.open if dump_filepath.endswith(".bz2") else open
+    with opener(dump_filepath, "wt", encoding="utf-8") as out_fp:
+        out_fp.write(DUMP_HEADER)
+        for i in range(num_pages):
+            title = f"Fake page {i}"
+            out_fp.write(
+                make_dump_page(
+                    get_page_id(title),
+                    title,
+                    0,
+                    make_fake_page_wikitext(title, num_sections, paragraphs_per_section),
+                )
+            )
+            if i % 10 == 0:
+                out_fp.write(
+                    make_dump_page(
+                        get_page_id(f"Fake redirect {i}"), f"Fake redirect {i}", 0, f"#REDIRECT [[{title}]]", title
+                    )
+                )
+                out_fp.write(
+                    make_dump_page(
+                        get_page_id(f"Template:Fake {i}"), f"Template:Fake {i}", 10, "{{{1}}} template"
+                    )
+                )
+        out_fp.write(DUMP_FOOTER)
+
+
+def do_parsing():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description="Write a fake Wikipedia XML dump",
+    )
+    parser.add_argument(
+        "--output_dump_filepath",
+        required=True,
+        type=str,
+        help="Output dump, compressed when it ends with .bz2",
+    )
+    parser.add_argument(
+        "--num_pages", required=False, type=int, default=1000, help="Number of articles"
+    )
+    parser.add_argument(
+        "--num_sections", required=False, type=int, default=5, help="Sections of each article"
+    )
+    parser.add_argument(
+        "--paragraphs_per_section",
+        required=False,
+        type=int,
+        default=3,
+        help="Paragraphs of each section, increase it to get long articles",
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = do_parsing()
+    print(args)
+    os.makedirs(os.path.dirname(args.output_dump_filepath) or ".", exist_ok=True)
+    start = time.perf_counter()
+    write_fake_dump(
+        args.output_dump_filepath,
+        args.num_pages,
+        num_sections=args.num_sections,
+        paragraphs_per_section=args.paragraphs_per_section,
+    )
+    print(
+        f"Dump with {args.num_pages} articles saved to '{args.output_dump_filepath}' "
+        f"({os.path.getsize(args.output_dump_filepath) / 1e6:.1f} MB) in {time.perf_counter() - start:.2f} s"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,210 @@
+"""
+Latency and recall report of the BM25 prefilter and of the hybrid retrieval against the dense only retrieval
+
+The synthetic corpus has a unique made-up place name in each text, like the proper nouns of the Wikipedia
+pages, and each question asks about the place of a random row: its embeddings are sampled close to
+the row embeddings with a large noise, so the dense retrieval alone sometimes misses the row.
+The report has, for each retrieval mode:
+- recall@k against the dense only results
+- the rate of questions with their source row in the top-k results
+
+On an embedding store (--input_embeddings) the question texts are the texts of the source rows.
+
+Example (run this from the repository root):
+    python -m benchmarks.lexical_retrieval_report --synthetic_num_rows 200000 --synthetic_embeddings_size 384 \
+    --output_report_filepath ./rag/data/lexical_retrieval_report.json
+"""
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+from benchmarks.ann_recall_report import measure_latency_ms, recall_at_k
+from benchmarks.synthetic_data import make_clustered_embeddings, make_queries
+from utils.embedding_store import EmbeddingStore, load_embeddings
+from utils.lexical_index import LEXICAL_INDEX_FILENAME, BM25Index, HybridRetriever
+from utils.retrieval import ExactRetriever
+
+NAME_SYLLABLES = (
+    "ba", "ca", "da", "fa", "ga", "la", "ma", "na", "pa", "ra",
+    "sa", "ta", "ve", "lo", "ri", "no", "tu", "gi", "co", "se",
+)
+
+
+def make_place_name(row_id: int) -> str:
+    """
+    Returns:
+        a made-up name unique for each row id, e.g. "Bacadafa"
+    """
+    syllables = []
+    for _ in range(4):
+        row_id, syllable = divmod(row_id, len(NAME_SYLLABLES))
+        syllables.append(NAME_SYLLABLES[syllable])
+    while row_id > 0:
+        row_id, syllable = divmod(row_id, len(NAME_SYLLABLES))
+        syllables.append(NAME_SYLLABLES[syllable])
+    return "".join(syllables).capitalize()
+
+
+def make_synthetic_corpus(num_rows: int, embeddings_size: int) -> EmbeddingStore:
+    embeddings = make_clustered_embeddings(num_rows, embeddings_size=embeddings_size)
+    metadata = pd.DataFrame(
+        {
+            "row_id": np.arange(num_rows),
+            "text": [
+                f"{make_place_name(row_id)} is a synthetic place described in the sentence {row_id} of the corpus"
+                for row_id in range(num_rows)
+            ],
+        }
+    )
+    return EmbeddingStore(embeddings, metadata, {"normalized": True})
+
+
+def do_parsing():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description="Measure the latency and the recall of the BM25 prefilter and hybrid retrieval",
+    )
+    parser.add_argument(
+        "--input_embeddings",
+        required=False,
+        type=str,
+        help="Embedding store directory, if it already has a BM25 index it is used as it is",
+    )
+    parser.add_argument(
+        "--synthetic_num_rows",
+        required=False,
+        type=int,
+        default=100000,
+        help="Number of synthetic rows, used when --input_embeddings is not passed",
+    )
+    parser.add_argument(
+        "--synthetic_embeddings_size",
+        required=False,
+        type=int,
+        default=1536,
+        help="Synthetic embeddings size",
+    )
+    parser.add_argument(
+        "--query_noise_scale",
+        required=False,
+        type=float,
+        default=2.0,
+        help="Noise of the question embeddings around the source row, higher values make the dense retrieval harder",
+    )
+    parser.add_argument(
+        "--lexical_candidates",
+        required=False,
+        nargs="+",
+        type=int,
+        default=[100, 1000],
+        help="Numbers of BM25 candidates to evaluate",
+    )
+    parser.add_argument("--top_k", required=False, type=int, default=10, help="k of recall@k")
+    parser.add_argument(
+        "--num_queries", required=False, type=int, default=200, help="Number of queries"
+    )
+    parser.add_argument(
+        "--output_report_filepath",
+        required=False,
+        type=str,
+        help="Pass it to save the report as JSON",
+    )
+    return parser.parse_args()
+
+
+def source_hit_rate(results, source_ids: np.ndarray) -> float:
+    return float(np.mean([source_id in result for result, source_id in zip(results, source_ids)]))
+
+
+def main():
+    args = do_parsing()
+    print(args)
+
+    if args.input_embeddings:
+        store = load_embeddings(args.input_embeddings)
+    else:
+        store = make_synthetic_corpus(args.synthetic_num_rows, args.synthetic_embeddings_size)
+    dense_retriever = ExactRetriever(store.embeddings, normalized=store.normalized)
+    queries, source_ids = make_queries(
+        dense_retriever.matrix, args.num_queries, noise_scale=args.query_noise_scale
+    )
+    if args.input_embeddings:
+        query_texts = [store.texts[source_id] for source_id in source_ids]
+    else:
+        # The common words match all the rows, the BM25 candidates are ranked by the place name
+        query_texts = [
+            f"What is known about the place {make_place_name(source_id)} of the corpus?"
+            for source_id in source_ids
+        ]
+
+    build_start = time.perf_counter()
+    if args.input_embeddings and os.path.exists(
+        os.path.join(args.input_embeddings, LEXICAL_INDEX_FILENAME)
+    ):
+        lexical_index = BM25Index.load(args.input_embeddings)
+    else:
+        lexical_index = BM25Index.build(store.texts)
+    build_time_s = time.perf_counter() - build_start
+    print(f"BM25 index with {len(lexical_index.terms)} terms ready in {build_time_s:.2f} s")
+
+    dense_results, dense_latencies_ms = measure_latency_ms(
+        dense_retriever.search, queries, args.top_k
+    )
+    report = {
+        "num_rows": len(store),
+        "top_k": args.top_k,
+        "num_queries": args.num_queries,
+        "index_build_time_s": build_time_s,
+        "dense": {
+            "source_hit_rate": source_hit_rate(dense_results, source_ids),
+            "latency_ms_p50": float(np.percentile(dense_latencies_ms, 50)),
+            "latency_ms_p99": float(np.percentile(dense_latencies_ms, 99)),
+        },
+        "lexical": [],
+    }
+    print(
+        f"dense: source hit rate {report['dense']['source_hit_rate']:.3f}, "
+        f"p50 {report['dense']['latency_ms_p50']:.3f} ms, p99 {report['dense']['latency_ms_p99']:.3f} ms"
+    )
+
+    for mode in ("prefilter", "hybrid"):
+        for num_candidates in args.lexical_candidates:
+            retriever = HybridRetriever(
+                dense_retriever, lexical_index, store, mode=mode, num_candidates=num_candidates
+            )
+            # measure_latency_ms passes only the embeddings, the text of each query is taken in order
+            query_texts_iterator = iter(query_texts)
+            results, latencies_ms = measure_latency_ms(
+                lambda query, top_k: retriever.search(query, top_k, next(query_texts_iterator)),
+                queries,
+                args.top_k,
+            )
+            mode_report = {
+                "mode": mode,
+                "lexical_candidates": num_candidates,
+                f"recall_at_{args.top_k}_vs_dense": recall_at_k(results, dense_results),
+                "source_hit_rate": source_hit_rate(results, source_ids),
+                "latency_ms_p50": float(np.percentile(latencies_ms, 50)),
+                "latency_ms_p99": float(np.percentile(latencies_ms, 99)),
+            }
+            report["lexical"].append(mode_report)
+            print(
+                f"{mode} ({num_candidates} candidates): "
+                f"recall@{args.top_k} vs dense {mode_report[f'recall_at_{args.top_k}_vs_dense']:.3f}, "
+                f"source hit rate {mode_report['source_hit_rate']:.3f}, "
+                f"p50 {mode_report['latency_ms_p50']:.3f} ms, p99 {mode_report['latency_ms_p99']:.3f} ms"
+            )
+
+    if args.output_report_filepath:
+        os.makedirs(os.path.dirname(args.output_report_filepath) or ".", exist_ok=True)
+        with open(args.output_report_filepath, "w") as out_fp:
+            json.dump(report, out_fp, indent=2)
+        print(f"Report saved to '{args.output_report_filepath}'")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,176 @@
+"""
+Memory and recall@k report of the quantized embeddings against the float32 exact search
+
+For each quantization mode the codes are built in memory (the store is not modified), then the queries
+are searched with the approximate scores only (rescore factor 0) and with the full precision rescoring
+of rescore_factor * top_k rows.
+
+Run it on an embedding store (the queries are sampled close to the store rows)
+or on synthetic clustered embeddings.
+
+Example (run this from the repository root):
+    python -m benchmarks.quantization_report \
+    --synthetic_num_rows 200000 --synthetic_embeddings_size 768 --pq_num_subspaces 96 \
+    --output_report_filepath ./rag/data/quantization_report.json
+"""
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+
+from benchmarks.ann_recall_report import measure_latency_ms, recall_at_k
+from benchmarks.synthetic_data import make_clustered_embeddings, make_queries
+from utils.embedding_store import load_embeddings
+from utils.quantization import QUANTIZATION_MODES, QuantizedRetriever, train_quantizer
+from utils.retrieval import ExactRetriever
+
+
+def do_parsing():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description="Measure the memory and the recall@k of the quantized embeddings against the exact search",
+    )
+    parser.add_argument(
+        "--input_embeddings",
+        required=False,
+        type=str,
+        help="Embedding store directory",
+    )
+    parser.add_argument(
+        "--synthetic_num_rows",
+        required=False,
+        type=int,
+        default=100000,
+        help="Number of synthetic rows, used when --input_embeddings is not passed",
+    )
+    parser.add_argument(
+        "--synthetic_embeddings_size",
+        required=False,
+        type=int,
+        default=1536,
+        help="Synthetic embeddings size",
+    )
+    parser.add_argument(
+        "--modes",
+        required=False,
+        nargs="+",
+        type=str,
+        choices=QUANTIZATION_MODES[1:],
+        default=list(QUANTIZATION_MODES[1:]),
+        help="Quantization modes to evaluate",
+    )
+    parser.add_argument(
+        "--pq_num_subspaces",
+        required=False,
+        type=int,
+        default=96,
+        help="Sub-vectors of the product quantization, it must divide the embeddings size",
+    )
+    parser.add_argument(
+        "--rescore_factor",
+        required=False,
+        nargs="+",
+        type=int,
+        default=[0, 1, 4, 10],
+        help="Rescore factors to evaluate, 0 for the approximate scores only",
+    )
+    parser.add_argument("--top_k", required=False, type=int, default=10, help="k of recall@k")
+    parser.add_argument(
+        "--num_queries", required=False, type=int, default=200, help="Number of queries"
+    )
+    parser.add_argument(
+        "--output_report_filepath",
+        required=False,
+        type=str,
+        help="Pass it to save the report as JSON",
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = do_parsing()
+    print(args)
+
+    if args.input_embeddings:
+        store = load_embeddings(args.input_embeddings)
+        matrix = store.embeddings if store.normalized else ExactRetriever(store.embeddings).matrix
+    else:
+        matrix = make_clustered_embeddings(
+            args.synthetic_num_rows, embeddings_size=args.synthetic_embeddings_size
+        )
+    queries, _ = make_queries(matrix, args.num_queries)
+
+    exact_retriever = ExactRetriever(matrix, normalized=True)
+    exact_results, exact_latencies_ms = measure_latency_ms(
+        exact_retriever.search, queries, args.top_k
+    )
+    float32_bytes = len(matrix) * matrix.shape[1] * np.dtype(np.float32).itemsize
+    report = {
+        "num_rows": len(matrix),
+        "embeddings_size": int(matrix.shape[1]),
+        "top_k": args.top_k,
+        "num_queries": args.num_queries,
+        "exact": {
+            "memory_mb": float32_bytes / 1e6,
+            "latency_ms_p50": float(np.percentile(exact_latencies_ms, 50)),
+            "latency_ms_p99": float(np.percentile(exact_latencies_ms, 99)),
+        },
+        "quantized": [],
+    }
+    print(
+        f"exact: {report['exact']['memory_mb']:.1f} MB, "
+        f"p50 {report['exact']['latency_ms_p50']:.3f} ms, "
+        f"p99 {report['exact']['latency_ms_p99']:.3f} ms"
+    )
+
+    for mode in args.modes:
+        build_start = time.perf_counter()
+        quantizer = train_quantizer(matrix, mode, pq_num_subspaces=args.pq_num_subspaces)
+        codes = quantizer.encode(matrix)
+        build_time_s = time.perf_counter() - build_start
+        # The query time memory: the codes and the quantizer parameters, the float32 rows are read
+        # from the memory-mapped matrix only for the rescored shortlists
+        quantized_bytes = codes.nbytes + sum(
+            param.nbytes for param in quantizer.get_params().values()
+        )
+        mode_report = {
+            "mode": mode,
+            "build_time_s": build_time_s,
+            "memory_mb": quantized_bytes / 1e6,
+            "memory_saved_mb": (float32_bytes - quantized_bytes) / 1e6,
+            "compression_ratio": float32_bytes / quantized_bytes,
+            "rescoring": [],
+        }
+        print(
+            f"{mode}: {mode_report['memory_mb']:.1f} MB "
+            f"({mode_report['compression_ratio']:.1f}x smaller), built in {build_time_s:.2f} s"
+        )
+        for rescore_factor in args.rescore_factor:
+            retriever = QuantizedRetriever(quantizer, codes, matrix, rescore_factor=rescore_factor)
+            results, latencies_ms = measure_latency_ms(retriever.search, queries, args.top_k)
+            rescoring_report = {
+                "rescore_factor": rescore_factor,
+                f"recall_at_{args.top_k}": recall_at_k(results, exact_results),
+                "latency_ms_p50": float(np.percentile(latencies_ms, 50)),
+                "latency_ms_p99": float(np.percentile(latencies_ms, 99)),
+            }
+            mode_report["rescoring"].append(rescoring_report)
+            print(
+                f"  rescore factor {rescore_factor}: "
+                f"recall@{args.top_k} {rescoring_report[f'recall_at_{args.top_k}']:.3f}, "
+                f"p50 {rescoring_report['latency_ms_p50']:.3f} ms, "
+                f"p99 {rescoring_report['latency_ms_p99']:.3f} ms"
+            )
+        report["quantized"].append(mode_report)
+
+    if args.output_report_filepath:
+        os.makedirs(os.path.dirname(args.output_report_filepath) or ".", exist_ok=True)
+        with open(args.output_report_filepath, "w") as out_fp:
+            json.dump(report, out_fp, indent=2)
+        print(f"Report saved to '{args.output_report_filepath}'")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,479 @@
+"""
+Benchmark suite on synthetic corpora, without the OpenAI API
+
+For each corpus size it measures:
+- the embedding store and index load time
+- the retrieval latency (p50/p99 of single queries) and throughput (batched queries)
+- the context packing latency
+and on the smallest corpus the end-to-end performance of the scripts against the local fake OpenAI server
+(benchmarks/fake_openai_server.py): create_embeddings.py rows per second, answer_question.py latency
+with one process per question and questions per second in batch mode.
+
+The synthetic stores are written once in --work_dirpath and reused by the next runs.
+The results are saved as JSON, pass a previous results file with --baseline_results_filepath
+to print the relative changes.
+
+Example (run this from the repository root):
+    python -m benchmarks.run_benchmarks --num_rows 1000 10000 100000 1000000 \
+    --output_results_filepath ./rag/data/benchmark_results.json
+
+The 10M rows corpus with 1536 dimensions needs 61 GB of disk, reduce the embeddings size to benchmark it:
+    python -m benchmarks.run_benchmarks --num_rows 10000000 --embeddings_size 256 --skip_end_to_end
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from answer_question import (
+    PROMPT_TEMPLATE,
+    get_context,
+    get_most_relevant_rows,
+    get_retriever,
+    get_row_token_counts,
+)
+from benchmarks.ann_recall_report import measure_latency_ms
+from benchmarks.fake_openai_server import get_api_base, start_fake_openai_server
+from benchmarks.synthetic_data import make_queries, make_synthetic_texts, write_synthetic_store
+from utils.ann_index import IVFIndex
+from utils.context_packing import PACKING_MODES
+from utils.embedding_store import STORE_INFO_FILENAME, load_embeddings
+
+REPOSITORY_DIRPATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def get_latency_summary(latencies_ms: np.ndarray) -> dict:
+    return {
+        "p50_ms": float(np.percentile(latencies_ms, 50)),
+        "p99_ms": float(np.percentile(latencies_ms, 99)),
+        "mean_ms": float(np.mean(latencies_ms)),
+    }
+
+
+def get_environment() -> dict:
+    try:
+        git_commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=REPOSITORY_DIRPATH,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        git_commit = None
+    return {
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "git_commit": git_commit,
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+    }
+
+
+def get_synthetic_store(args: argparse.Namespace, num_rows: int) -> str:
+    """
+    Returns:
+        the synthetic store directory, written only if it doesn't exist with the same settings
+    """
+    store_dirpath = os.path.join(
+        args.work_dirpath, f"synthetic_{num_rows}_rows_{args.embeddings_size}_dims"
+    )
+    if os.path.exists(os.path.join(store_dirpath, STORE_INFO_FILENAME)):
+        return store_dirpath
+    print(f"Writing the synthetic store {store_dirpath}")
+    start = time.perf_counter()
+    write_synthetic_store(store_dirpath, num_rows, embeddings_size=args.embeddings_size)
+    if args.ivf_n_lists > 0 and num_rows >= args.ivf_min_rows:
+        store = load_embeddings(store_dirpath)
+        IVFIndex.build(store.embeddings, n_lists=args.ivf_n_lists).save(store_dirpath)
+    print(f"Synthetic store written in {time.perf_counter() - start:.1f} s")
+    return store_dirpath
+
+
+def benchmark_load(store_dirpath: str, args: argparse.Namespace) -> dict:
+    """
+    Load time of the store and of the index, the first query pays the page faults of the memory-mapped matrix
+    """
+    load_times_s = []
+    for _ in range(args.load_repeats):
+        start = time.perf_counter()
+        store = load_embeddings(store_dirpath)
+        get_retriever(store, store_dirpath, n_probe=args.n_probe, exact_search=False)
+        load_times_s.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    store = load_embeddings(store_dirpath)
+    retriever = get_retriever(store, store_dirpath, n_probe=args.n_probe, exact_search=False)
+    query, _ = make_queries(store.embeddings, 1)
+    retriever.search(query[0], top_k=args.top_k)
+    return {
+        "load_s_median": float(np.median(load_times_s)),
+        "load_and_first_query_s": time.perf_counter() - start,
+    }
+
+
+def benchmark_retrieval(store, retriever, queries: np.ndarray, args: argparse.Namespace) -> dict:
+    _, latencies_ms = measure_latency_ms(retriever.search, queries, args.top_k)
+    start = time.perf_counter()
+    for batch_start in range(0, len(queries), args.query_batch_size):
+        retriever.search_batch(
+            queries[batch_start : batch_start + args.query_batch_size], top_k=args.top_k
+        )
+    batch_time_s = time.perf_counter() - start
+    return {
+        "retriever": type(retriever).__name__,
+        "single_query": get_latency_summary(latencies_ms),
+        "single_query_qps": float(len(queries) / (np.sum(latencies_ms) / 1000.0)),
+        "batch_qps": len(queries) / batch_time_s,
+    }
+
+
+def benchmark_context_packing(store, retriever, queries: np.ndarray, args: argparse.Namespace) -> dict:
+    latencies_ms = []
+    num_context_rows = []
+    for query in queries:
+        rows = get_most_relevant_rows(query, store, retriever, args.top_k)
+        start = time.perf_counter()
+        context, _ = get_context(
+            rows["text"].tolist(),
+            get_row_token_counts(rows),
+            "synthetic question",
+            args.max_prompt_tokens,
+            packing_mode=args.context_packing,
+        )
+        PROMPT_TEMPLATE.format("\n\n###\n\n".join(context), "synthetic question")
+        latencies_ms.append((time.perf_counter() - start) * 1000.0)
+        num_context_rows.append(len(context))
+    return {
+        **get_latency_summary(np.array(latencies_ms)),
+        "mean_context_rows": float(np.mean(num_context_rows)),
+    }
+
+
+def run_script(script_args: List[str], env: dict) -> float:
+    """
+    Run a repository script in a new process
+
+    Returns:
+        the wall time in seconds
+    """
+    start = time.perf_counter()
+    subprocess.run(
+        [sys.executable] + script_args,
+        cwd=REPOSITORY_DIRPATH,
+        env=env,
+        check=True,
+        stdout=subprocess.DEVNULL,
+    )
+    return time.perf_counter() - start
+
+
+def read_metrics_summary(metrics_filepath: str) -> Optional[dict]:
+    """
+    Returns:
+        the last summary written by a script run with --metrics_filepath
+    """
+    summary = None
+    with open(metrics_filepath, "r") as in_fp:
+        for line in in_fp:
+            event = json.loads(line)
+            if event["event"] == "summary":
+                summary = event
+    return summary
+
+
+def benchmark_end_to_end(store_dirpath: str, args: argparse.Namespace) -> dict:
+    """
+    Run the scripts against the fake OpenAI server, the caches are disabled to measure the full pipeline
+    """
+    server = start_fake_openai_server(
+        latency_ms=args.api_latency_ms,
+        token_latency_ms=args.api_token_latency_ms,
+        requests_per_minute=args.api_requests_per_minute,
+        embeddings_size=args.embeddings_size,
+    )
+    env = dict(os.environ, OPENAI_API_BASE=get_api_base(server), OPENAI_API_KEY="fake")
+    end_to_end_dirpath = os.path.join(args.work_dirpath, "end_to_end")
+    os.makedirs(end_to_end_dirpath, exist_ok=True)
+    results = {}
+    try:
+        # create_embeddings.py rows per second
+        data_filepath = os.path.join(end_to_end_dirpath, "data.csv")
+        row_ids = np.arange(args.end_to_end_num_rows)
+        with open(data_filepath, "w") as out_fp:
+            out_fp.write(",text\n")
+            for row_id, text in zip(row_ids, make_synthetic_texts(row_ids, row_ids % 100)):
+                out_fp.write(f"{row_id},{text}\n")
+        metrics_filepath = os.path.join(end_to_end_dirpath, "create_embeddings_metrics.jsonl")
+        if os.path.exists(metrics_filepath):
+            os.remove(metrics_filepath)
+        create_time_s = run_script(
+            [
+                "create_embeddings.py",
+                "--input_data_filepath", data_filepath,
+                "--output_embeddings_filepath", os.path.join(end_to_end_dirpath, "embeddings"),
+                "--no_embedding_cache",
+                "--no_reuse",
+                "--metrics_filepath", metrics_filepath,
+            ],
+            env,
+        )
+        results["create_embeddings"] = {
+            "num_rows": args.end_to_end_num_rows,
+            "time_s": create_time_s,
+            "rows_per_s": args.end_to_end_num_rows / create_time_s,
+            "metrics": read_metrics_summary(metrics_filepath),
+        }
+
+        query_args = [
+            "--input_embeddings", store_dirpath,
+            "--top_k", str(args.top_k),
+            "--n_probe", str(args.n_probe),
+            "--max_prompt_tokens", str(args.max_prompt_tokens),
+            "--no_embedding_cache",
+            "--no_answer_cache",
+        ]
+        # answer_question.py with one process per question
+        single_times_s = [
+            run_script(
+                ["answer_question.py", "--question", f"synthetic question {i}"] + query_args, env
+            )
+            for i in range(args.end_to_end_single_questions)
+        ]
+        results["answer_question_single"] = {
+            "time_s_median": float(np.median(single_times_s)),
+            "qps": 1.0 / float(np.median(single_times_s)),
+        }
+
+        # answer_question.py batch mode
+        questions_filepath = os.path.join(end_to_end_dirpath, "questions.jsonl")
+        with open(questions_filepath, "w") as out_fp:
+            for i in range(args.end_to_end_num_questions):
+                out_fp.write(json.dumps({"id": i, "question": f"synthetic question {i}"}) + "\n")
+        metrics_filepath = os.path.join(end_to_end_dirpath, "answer_question_metrics.jsonl")
+        if os.path.exists(metrics_filepath):
+            os.remove(metrics_filepath)
+        batch_time_s = run_script(
+            [
+                "answer_question.py",
+                "--questions_file", questions_filepath,
+                "--output_answers_filepath", os.path.join(end_to_end_dirpath, "answers.jsonl"),
+                "--metrics_filepath", metrics_filepath,
+            ]
+            + query_args,
+            env,
+        )
+        results["answer_question_batch"] = {
+            "num_questions": args.end_to_end_num_questions,
+            "time_s": batch_time_s,
+            "qps": args.end_to_end_num_questions / batch_time_s,
+            "metrics": read_metrics_summary(metrics_filepath),
+        }
+        results["fake_server_stats"] = dict(server.RequestHandlerClass.stats)
+    finally:
+        server.shutdown()
+        server.server_close()
+    return results
+
+
+def flatten_numbers(results: dict, prefix: str = "") -> Dict[str, float]:
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten_numbers(value, f"{prefix}{key}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[f"{prefix}{key}"] = value
+    return flat
+
+
+def print_comparison(baseline_results: dict, results: dict):
+    """
+    Print the relative change of every number present in both results
+    """
+    baseline = flatten_numbers(baseline_results["results"])
+    current = flatten_numbers(results["results"])
+    print(f"Comparison with the baseline of {baseline_results['environment']['timestamp']}:")
+    for key in sorted(baseline.keys() & current.keys()):
+        if baseline[key] == 0:
+            continue
+        change = (current[key] - baseline[key]) / abs(baseline[key]) * 100.0
+        print(f"  {key}: {baseline[key]:.6g} -> {current[key]:.6g} ({change:+.1f}%)")
+
+
+def do_parsing():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description="Benchmark the load, retrieval, context packing and end-to-end performance",
+    )
+    parser.add_argument(
+        "--num_rows",
+        required=False,
+        nargs="+",
+        type=int,
+        default=[1000, 10000, 100000],
+        help="Number of rows of each synthetic corpus, e.g. 1000 10000 100000 1000000 10000000",
+    )
+    parser.add_argument(
+        "--embeddings_size", required=False, type=int, default=1536, help="Embeddings size"
+    )
+    parser.add_argument(
+        "--work_dirpath",
+        required=False,
+        type=str,
+        default="./rag/data/benchmarks",
+        help="Directory of the synthetic stores, reused by the next runs",
+    )
+    parser.add_argument(
+        "--ivf_n_lists",
+        required=False,
+        type=int,
+        default=1024,
+        help="Number of IVF lists of the synthetic stores with at least --ivf_min_rows rows, 0 to disable",
+    )
+    parser.add_argument(
+        "--ivf_min_rows",
+        required=False,
+        type=int,
+        default=1000000,
+        help="Minimum number of rows to build the IVF index",
+    )
+    parser.add_argument("--n_probe", required=False, type=int, default=8, help="IVF lists to probe")
+    parser.add_argument("--top_k", required=False, type=int, default=100, help="Rows to retrieve")
+    parser.add_argument(
+        "--num_queries", required=False, type=int, default=200, help="Number of queries"
+    )
+    parser.add_argument(
+        "--query_batch_size",
+        required=False,
+        type=int,
+        default=32,
+        help="Queries per search_batch call in the throughput benchmark",
+    )
+    parser.add_argument(
+        "--load_repeats", required=False, type=int, default=3, help="Load time measurements"
+    )
+    parser.add_argument(
+        "--max_prompt_tokens", required=False, type=int, default=1000, help="Prompt tokens budget"
+    )
+    parser.add_argument(
+        "--context_packing",
+        required=False,
+        type=str,
+        choices=PACKING_MODES,
+        default="truncate",
+        help="Context packing mode",
+    )
+    parser.add_argument(
+        "--skip_end_to_end",
+        action="store_true",
+        help="Don't run the scripts against the fake OpenAI server",
+    )
+    parser.add_argument(
+        "--end_to_end_num_rows",
+        required=False,
+        type=int,
+        default=2000,
+        help="Rows embedded by create_embeddings.py",
+    )
+    parser.add_argument(
+        "--end_to_end_num_questions",
+        required=False,
+        type=int,
+        default=50,
+        help="Questions answered by answer_question.py in batch mode",
+    )
+    parser.add_argument(
+        "--end_to_end_single_questions",
+        required=False,
+        type=int,
+        default=3,
+        help="answer_question.py runs with a single question",
+    )
+    parser.add_argument(
+        "--api_latency_ms",
+        required=False,
+        type=float,
+        default=100.0,
+        help="Fake OpenAI server latency of each request",
+    )
+    parser.add_argument(
+        "--api_token_latency_ms",
+        required=False,
+        type=float,
+        default=10.0,
+        help="Fake OpenAI server latency of each completion token",
+    )
+    parser.add_argument(
+        "--api_requests_per_minute",
+        required=False,
+        type=float,
+        help="Fake OpenAI server requests per minute limit",
+    )
+    parser.add_argument(
+        "--output_results_filepath",
+        required=False,
+        type=str,
+        default="./rag/data/benchmark_results.json",
+        help="Output JSON results",
+    )
+    parser.add_argument(
+        "--baseline_results_filepath",
+        required=False,
+        type=str,
+        help="Results of a previous run to compare with",
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = do_parsing()
+    print(args)
+
+    results = {"environment": get_environment(), "config": vars(args), "results": {}}
+    for num_rows in args.num_rows:
+        store_dirpath = get_synthetic_store(args, num_rows)
+        size_results = {"load": benchmark_load(store_dirpath, args)}
+        store = load_embeddings(store_dirpath)
+        retriever = get_retriever(store, store_dirpath, n_probe=args.n_probe, exact_search=False)
+        queries, _ = make_queries(store.embeddings, args.num_queries)
+        size_results["retrieval"] = benchmark_retrieval(store, retriever, queries, args)
+        size_results["context_packing"] = benchmark_context_packing(store, retriever, queries, args)
+        results["results"][f"{num_rows}_rows"] = size_results
+        print(
+            f"{num_rows} rows: load {size_results['load']['load_s_median']:.3f} s, "
+            f"retrieval p50 {size_results['retrieval']['single_query']['p50_ms']:.3f} ms "
+            f"p99 {size_results['retrieval']['single_query']['p99_ms']:.3f} ms, "
+            f"batch {size_results['retrieval']['batch_qps']:.0f} QPS, "
+            f"context packing p50 {size_results['context_packing']['p50_ms']:.3f} ms"
+        )
+
+    if not args.skip_end_to_end:
+        smallest_store_dirpath = get_synthetic_store(args, min(args.num_rows))
+        results["results"]["end_to_end"] = benchmark_end_to_end(smallest_store_dirpath, args)
+        end_to_end = results["results"]["end_to_end"]
+        print(
+            f"End to end: create_embeddings {end_to_end['create_embeddings']['rows_per_s']:.0f} rows/s, "
+            f"answer_question single {end_to_end['answer_question_single']['time_s_median']:.2f} s, "
+            f"batch {end_to_end['answer_question_batch']['qps']:.1f} QPS"
+        )
+
+    os.makedirs(os.path.dirname(args.output_results_filepath) or ".", exist_ok=True)
+    with open(args.output_results_filepath, "w") as out_fp:
+        json.dump(results, out_fp, indent=2)
+    print(f"Results saved to '{args.output_results_filepath}'")
+
+    if args.baseline_results_filepath:
+        with open(args.baseline_results_filepath, "r") as in_fp:
+            print_comparison(json.load(in_fp), results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,223 @@
+"""
+Throughput of the streaming sectionizer (utils/wikipedia_sectionizer.py) against the BeautifulSoup parser
+it replaced
+
+The pages are fake extracts of benchmarks/fake_mediawiki_server.py (increase --paragraphs_per_section
+to get large pages) and, optionally, the real extracts cached by get_wikipedia_pages.py.
+The outputs of the two parsers are compared by tests/test_wikipedia_sectionizer.py.
+
+Example (run this from the repository root):
+    python -m benchmarks.sectionizer_report \
+    --num_pages 20 --paragraphs_per_section 200 \
+    --http_cache_dirpath ./rag/data/wikipedia_http_cache \
+    --output_report_filepath ./rag/data/sectionizer_report.json
+"""
+import argparse
+import glob
+import json
+import os
+import time
+from collections import defaultdict
+from typing import Callable, Dict, List, Tuple
+
+import bs4
+import numpy as np
+from bs4 import BeautifulSoup
+
+from benchmarks.fake_mediawiki_server import make_fake_page_html
+from utils.wikipedia_sectionizer import get_dict_key_from_headings
+from utils.wikipedia_utils import parse_page_html
+
+
+def get_cleaned_text(element) -> str:
+    """
+    Strip text and remove '\n' inside the paragraph
+    """
+    return element.get_text().strip().replace(u"\xa0", " ").replace("\n", " ")
+
+
+def parse_page_html_reference(html_text: str, title: str) -> Dict[str, List[str]]:
+    """
+    The previous BeautifulSoup implementation of utils.wikipedia_utils.parse_page_html, the golden output
+    of tests/test_wikipedia_sectionizer.py
+    """
+    soup = BeautifulSoup(html_text, "html.parser")
+
+    sentences_dict = defaultdict(list)
+    last_h2_level_paragraph = None
+    last_h3_level_paragraph = None
+    last_h4_level_paragraph = None
+    last_element_type = None
+    for element in soup:
+        if type(element) == bs4.Tag:
+            if element.name == "p" and last_h2_level_paragraph is None:
+                sentences_dict[title].append(get_cleaned_text(element))
+            elif element.name == "h2":
+                last_h2_level_paragraph = element.attrs["data-mw-anchor"]
+                last_h3_level_paragraph = None
+                last_h4_level_paragraph = None
+            elif element.name == "h3":
+                last_h3_level_paragraph = element.attrs["data-mw-anchor"]
+                last_h4_level_paragraph = None
+            elif element.name == "h4":
+                last_h4_level_paragraph = element.attrs["data-mw-anchor"]
+            elif element.name == "p":
+                key = get_dict_key_from_headings(
+                    last_h2_level_paragraph,
+                    last_h3_level_paragraph,
+                    last_h4_level_paragraph,
+                )
+                for p_children in element.children:
+                    if type(p_children) == bs4.Tag and p_children.name == "ul":
+                        raise ValueError("List <ul> inside a <p> not supported")
+                sentences_dict[key].append(get_cleaned_text(element))
+            elif element.name == "ul" or element.name == "dl":
+                list_content_str = ""
+                for list_element in element.children:
+                    if (
+                        list_element.name == "li"
+                        or list_element.name == "dd"
+                        or list_element.name == "dt"
+                    ):
+                        list_content_str += get_cleaned_text(list_element) + "\n"
+                list_content_str = (
+                    list_content_str.replace("\n", "; ")
+                    .replace(",;", ";")
+                    .replace(";;", ";")
+                    .replace(".;", ";")[: -len(", ")]
+                )
+                key = get_dict_key_from_headings(
+                    last_h2_level_paragraph,
+                    last_h3_level_paragraph,
+                    last_h4_level_paragraph,
+                )
+                last_sentence_for_key = (
+                    sentences_dict[key][-1] if len(sentences_dict[key]) > 0 else ""
+                )
+                if last_sentence_for_key.endswith(":"):
+                    sentences_dict[key][-1] += " " + list_content_str
+                elif last_element_type == "ul" or last_element_type == "dl":
+                    sentences_dict[key][-1] += "; " + list_content_str
+                else:
+                    sentences_dict[key].extend(list_content_str.split("; "))
+            else:
+                raise ValueError(f"Tag {element.name} not supported")
+            last_element_type = element.name
+    return sentences_dict
+
+
+def load_cached_pages(http_cache_dirpath: str) -> List[Tuple[str, str]]:
+    """
+    Returns:
+        (title, HTML extract) of the pages in the cached API responses
+    """
+    pages = {}
+    for filepath in sorted(glob.glob(os.path.join(http_cache_dirpath, "*", "*.json"))):
+        with open(filepath, "r") as in_fp:
+            response_dict = json.load(in_fp)
+        query_pages = response_dict.get("query", {}).get("pages", [])
+        if isinstance(query_pages, dict):
+            # formatversion=1 responses
+            query_pages = query_pages.values()
+        for page_dict in query_pages:
+            if page_dict.get("extract"):
+                pages[page_dict["title"]] = page_dict["extract"]
+    return list(pages.items())
+
+
+def measure_throughput(parse_fn: Callable, pages: List[Tuple[str, str]], repeats: int) -> dict:
+    num_bytes = sum(len(html_text.encode("utf-8")) for _, html_text in pages)
+    times_s = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for title, html_text in pages:
+            parse_fn(html_text, title)
+        times_s.append(time.perf_counter() - start)
+    best_s = min(times_s)
+    return {
+        "best_time_s": best_s,
+        "pages_per_s": len(pages) / best_s,
+        "mb_per_s": num_bytes / best_s / 1e6,
+    }
+
+
+def do_parsing():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description="Compare the streaming sectionizer with the BeautifulSoup parser of the Wikipedia pages",
+    )
+    parser.add_argument(
+        "--num_pages", required=False, type=int, default=20, help="Number of fake pages"
+    )
+    parser.add_argument(
+        "--num_sections", required=False, type=int, default=10, help="Sections of each fake page"
+    )
+    parser.add_argument(
+        "--paragraphs_per_section",
+        required=False,
+        type=int,
+        default=100,
+        help="Paragraphs of each fake page section, increase it to get large pages",
+    )
+    parser.add_argument(
+        "--http_cache_dirpath",
+        required=False,
+        type=str,
+        help="Directory of the API responses cached by get_wikipedia_pages.py, their pages are added",
+    )
+    parser.add_argument(
+        "--repeats", required=False, type=int, default=3, help="Timed runs, the best one is reported"
+    )
+    parser.add_argument(
+        "--output_report_filepath", required=False, type=str, help="JSON report output filepath"
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = do_parsing()
+    print(args)
+
+    fake_pages = [
+        (
+            f"Fake page {i}",
+            make_fake_page_html(
+                f"Fake page {i}",
+                num_sections=args.num_sections,
+                paragraphs_per_section=args.paragraphs_per_section,
+            ),
+        )
+        for i in range(args.num_pages)
+    ]
+    cached_pages = load_cached_pages(args.http_cache_dirpath) if args.http_cache_dirpath else []
+    print(
+        f"{len(fake_pages)} fake pages (mean {np.mean([len(html) for _, html in fake_pages]) / 1e3:.1f} kB), "
+        f"{len(cached_pages)} cached pages"
+    )
+
+    report = {"num_pages": len(fake_pages) + len(cached_pages), "throughput": {}}
+    for name, pages in [("fake", fake_pages), ("cached", cached_pages)]:
+        if not pages:
+            continue
+        reference = measure_throughput(parse_page_html_reference, pages, args.repeats)
+        streaming = measure_throughput(parse_page_html, pages, args.repeats)
+        report["throughput"][name] = {
+            "beautifulsoup": reference,
+            "streaming": streaming,
+            "speedup": reference["best_time_s"] / streaming["best_time_s"],
+        }
+        print(
+            f"{name} pages: beautifulsoup {reference['mb_per_s']:.2f} MB/s "
+            f"({reference['pages_per_s']:.1f} pages/s), streaming {streaming['mb_per_s']:.2f} MB/s "
+            f"({streaming['pages_per_s']:.1f} pages/s), speedup {report['throughput'][name]['speedup']:.2f}x"
+        )
+
+    if args.output_report_filepath:
+        os.makedirs(os.path.dirname(args.output_report_filepath) or ".", exist_ok=True)
+        with open(args.output_report_filepath, "w") as out_fp:
+            json.dump(report, out_fp, indent=2)
+        print(f"Report saved to '{args.output_report_filepath}'")
+
+
+if __name__ == "__main__":
+    main()
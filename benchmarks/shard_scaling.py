@@ -0,0 +1,175 @@
+"""
+Retrieval latency and throughput against the number of shards of the embedding store
+
+A synthetic store is split in 1, 2, 4, ... shards, the queries fan out to the worker processes
+(utils/sharded_retrieval.py) and the results are compared with the single process exact search,
+which is also the baseline of the timings.
+
+Example (run this from the repository root):
+    python -m benchmarks.shard_scaling --num_rows 2000000 --embeddings_size 768 --num_shards 1 2 4 8 \
+    --output_results_filepath ./rag/data/shard_scaling_results.json
+"""
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+
+from benchmarks.ann_recall_report import measure_latency_ms, recall_at_k
+from benchmarks.run_benchmarks import get_environment, get_latency_summary
+from benchmarks.synthetic_data import make_queries, write_synthetic_store
+from utils.embedding_store import STORE_INFO_FILENAME, load_embeddings, save_embedding_store
+from utils.retrieval import ExactRetriever
+from utils.sharded_retrieval import ShardedRetriever
+
+
+def get_sharded_store(args: argparse.Namespace, num_shards: int) -> str:
+    """
+    Returns:
+        the synthetic store directory split in num_shards, written only if it doesn't exist
+    """
+    store_dirpath = os.path.join(
+        args.work_dirpath, f"synthetic_{args.num_rows}_rows_{args.embeddings_size}_dims"
+    )
+    if not os.path.exists(os.path.join(store_dirpath, STORE_INFO_FILENAME)):
+        print(f"Writing the synthetic store {store_dirpath}")
+        write_synthetic_store(store_dirpath, args.num_rows, embeddings_size=args.embeddings_size)
+    if num_shards == 1:
+        return store_dirpath
+    sharded_store_dirpath = f"{store_dirpath}_{num_shards}_shards"
+    if not os.path.exists(os.path.join(sharded_store_dirpath, STORE_INFO_FILENAME)):
+        print(f"Writing the sharded store {sharded_store_dirpath}")
+        store = load_embeddings(store_dirpath)
+        save_embedding_store(
+            sharded_store_dirpath,
+            store.metadata.set_index("row_id"),
+            store.embeddings,
+            embedding_model_name=store.embedding_model_name,
+            normalize=False,
+            num_shards=num_shards,
+        )
+    return sharded_store_dirpath
+
+
+def benchmark_retriever(retriever, queries: np.ndarray, exact_indices: np.ndarray, args) -> dict:
+    results, latencies_ms = measure_latency_ms(retriever.search, queries, args.top_k)
+    start = time.perf_counter()
+    for batch_start in range(0, len(queries), args.query_batch_size):
+        retriever.search_batch(
+            queries[batch_start : batch_start + args.query_batch_size], top_k=args.top_k
+        )
+    batch_time_s = time.perf_counter() - start
+    return {
+        "single_query": get_latency_summary(latencies_ms),
+        "batch_qps": len(queries) / batch_time_s,
+        # The scores of the matrix-vector and matrix-matrix products can differ in the last bits,
+        # the order of near ties is not compared
+        f"recall_at_{args.top_k}": recall_at_k(results, exact_indices),
+    }
+
+
+def do_parsing():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description="Measure the retrieval latency against the number of shards",
+    )
+    parser.add_argument(
+        "--num_rows", required=False, type=int, default=1000000, help="Synthetic corpus rows"
+    )
+    parser.add_argument(
+        "--embeddings_size", required=False, type=int, default=384, help="Synthetic embeddings size"
+    )
+    parser.add_argument(
+        "--num_shards",
+        required=False,
+        type=int,
+        nargs="+",
+        default=[1, 2, 4, 8],
+        help="Numbers of shards to benchmark",
+    )
+    parser.add_argument(
+        "--num_workers",
+        required=False,
+        type=int,
+        default=0,
+        help="Worker processes, 0 for one per shard up to the number of cores",
+    )
+    parser.add_argument(
+        "--num_queries", required=False, type=int, default=200, help="Number of queries"
+    )
+    parser.add_argument(
+        "--top_k", required=False, type=int, default=100, help="Rows retrieved for each query"
+    )
+    parser.add_argument(
+        "--query_batch_size",
+        required=False,
+        type=int,
+        default=32,
+        help="Queries of each batch in the throughput measure",
+    )
+    parser.add_argument(
+        "--work_dirpath",
+        required=False,
+        type=str,
+        default="./rag/data/benchmarks",
+        help="Directory of the synthetic stores, reused by the next runs",
+    )
+    parser.add_argument(
+        "--output_results_filepath", required=False, type=str, help="JSON results output filepath"
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = do_parsing()
+    print(args)
+
+    store = load_embeddings(get_sharded_store(args, num_shards=1))
+    queries, _ = make_queries(store.embeddings, args.num_queries)
+    exact_retriever = ExactRetriever(store.embeddings, normalized=True)
+    # Touch the whole matrix once, all the runs read it from the page cache
+    exact_retriever.search(queries[0], args.top_k)
+    exact_indices, _ = exact_retriever.search_batch(queries, args.top_k)
+
+    results = {
+        "environment": get_environment(),
+        "config": vars(args),
+        "single_process": benchmark_retriever(exact_retriever, queries, exact_indices, args),
+        "sharded": [],
+    }
+    print(
+        f"single process: p50 {results['single_process']['single_query']['p50_ms']:.2f} ms, "
+        f"batch {results['single_process']['batch_qps']:.1f} QPS"
+    )
+    for num_shards in args.num_shards:
+        store_dirpath = get_sharded_store(args, num_shards)
+        sharded_store = load_embeddings(store_dirpath)
+        retriever = ShardedRetriever(
+            store_dirpath, sharded_store.shard_offsets, num_workers=args.num_workers
+        )
+        retriever.search_batch(queries, args.top_k)
+        shard_results = {
+            "num_shards": num_shards,
+            "num_workers": retriever.num_workers,
+            **benchmark_retriever(retriever, queries, exact_indices, args),
+        }
+        retriever.close()
+        results["sharded"].append(shard_results)
+        print(
+            f"{num_shards} shards ({shard_results['num_workers']} workers): "
+            f"p50 {shard_results['single_query']['p50_ms']:.2f} ms, "
+            f"p99 {shard_results['single_query']['p99_ms']:.2f} ms, "
+            f"batch {shard_results['batch_qps']:.1f} QPS, "
+            f"recall@{args.top_k} {shard_results[f'recall_at_{args.top_k}']:.3f}"
+        )
+
+    if args.output_results_filepath:
+        os.makedirs(os.path.dirname(args.output_results_filepath) or ".", exist_ok=True)
+        with open(args.output_results_filepath, "w") as out_fp:
+            json.dump(results, out_fp, indent=2)
+        print(f"Results saved to '{args.output_results_filepath}'")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,234 @@
+"""
+Startup time of the query path: import time of the scripts and time to the first answer of answer_question.py
+
+The import time is measured with `python -X importtime` in a new process for each run, the slowest modules
+and the heavy optional dependencies imported at startup are listed. The time to the first answer runs
+answer_question.py on a small synthetic store against the local fake OpenAI server, from the process start
+to the first RAG answer token on stdout.
+
+Pass --max_import_ms to fail (exit code 1) when the answer_question.py import time exceeds the budget,
+so a new eager import of a heavy module is noticed, and --baseline_results_filepath to compare with a
+previous run.
+
+Example (run this from the repository root):
+    python -m benchmarks.startup_report --max_import_ms 600 \
+    --output_results_filepath ./rag/data/startup_results.json
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from benchmarks.fake_openai_server import get_api_base, start_fake_openai_server
+from benchmarks.run_benchmarks import REPOSITORY_DIRPATH, get_environment, print_comparison
+from benchmarks.synthetic_data import write_synthetic_store
+from utils.embedding_store import STORE_INFO_FILENAME
+
+# Modules only needed by some paths (API calls, token counting, service client)
+# or not needed at all, they should not be imported by the query scripts at startup
+HEAVY_MODULES = ("openai", "aiohttp", "requests", "tiktoken", "scipy", "sklearn", "matplotlib", "plotly")
+
+
+def parse_importtime(stderr: str, module_name: str) -> Dict[str, Dict[str, int]]:
+    """
+    Args:
+        stderr: `python -X importtime` output
+        module_name: top level module imported by the command
+
+    Returns:
+        self and cumulative import time in microseconds of module_name and of each module imported by it
+        (the modules imported before it at the interpreter startup, e.g. by sitecustomize, are excluded)
+    """
+    modules = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:") :].split("|")
+        modules[name.strip()] = {"self_us": int(self_us), "cumulative_us": int(cumulative_us)}
+        # The output is in post order, a top level module comes after the modules it imports
+        if not name[1:].startswith(" "):
+            if name.strip() == module_name:
+                return modules
+            modules = {}
+    raise ValueError(f"{module_name} not found in the import time output")
+
+
+def measure_import_time(module_name: str, num_runs: int) -> dict:
+    import_times_ms = []
+    for _ in range(num_runs):
+        process = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", f"import {module_name}"],
+            cwd=REPOSITORY_DIRPATH,
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        modules = parse_importtime(process.stderr, module_name)
+        import_times_ms.append(modules[module_name]["cumulative_us"] / 1000.0)
+    slowest_modules = sorted(modules.items(), key=lambda item: item[1]["self_us"], reverse=True)[:10]
+    return {
+        "import_ms_median": float(np.median(import_times_ms)),
+        "import_ms_min": float(np.min(import_times_ms)),
+        "heavy_modules_imported": [
+            heavy_module for heavy_module in HEAVY_MODULES if heavy_module in modules
+        ],
+        "slowest_modules_self_ms": {
+            name: times["self_us"] / 1000.0 for name, times in slowest_modules
+        },
+    }
+
+
+def measure_time_to_first_answer(script_args: List[str], env: dict) -> dict:
+    """
+    Returns:
+        seconds from the process start to the first RAG answer token and to the process end
+    """
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, "-u"] + script_args,
+        cwd=REPOSITORY_DIRPATH,
+        env=env,
+        stdout=subprocess.PIPE,
+        text=True,
+    )
+    first_answer_s = None
+    for line in process.stdout:
+        if first_answer_s is None and line.startswith("RAG answer"):
+            first_answer_s = time.perf_counter() - start
+    if process.wait() != 0:
+        raise RuntimeError(f"{script_args[0]} failed with exit code {process.returncode}")
+    total_s = time.perf_counter() - start
+    return {"first_answer_s": first_answer_s or total_s, "total_s": total_s}
+
+
+def benchmark_first_answer(args: argparse.Namespace) -> dict:
+    store_dirpath = os.path.join(args.work_dirpath, f"startup_{args.num_rows}_rows")
+    if not os.path.exists(os.path.join(store_dirpath, STORE_INFO_FILENAME)):
+        write_synthetic_store(store_dirpath, args.num_rows, embeddings_size=args.embeddings_size)
+    server = start_fake_openai_server(embeddings_size=args.embeddings_size)
+    env = dict(os.environ, OPENAI_API_BASE=get_api_base(server), OPENAI_API_KEY="fake")
+    try:
+        runs = [
+            measure_time_to_first_answer(
+                [
+                    "answer_question.py",
+                    "--question", f"synthetic question {i}",
+                    "--input_embeddings", store_dirpath,
+                    "--skip_initial_answer",
+                    "--no_embedding_cache",
+                    "--no_answer_cache",
+                ],
+                env,
+            )
+            for i in range(args.num_runs)
+        ]
+    finally:
+        server.shutdown()
+        server.server_close()
+    return {
+        "num_rows": args.num_rows,
+        "first_answer_s_median": float(np.median([run["first_answer_s"] for run in runs])),
+        "total_s_median": float(np.median([run["total_s"] for run in runs])),
+    }
+
+
+def do_parsing():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description="Measure the import time of the scripts and the time to the first answer",
+    )
+    parser.add_argument(
+        "--modules",
+        required=False,
+        nargs="+",
+        type=str,
+        default=["answer_question", "query_service", "create_embeddings"],
+        help="Modules of the import time measure",
+    )
+    parser.add_argument(
+        "--num_runs", required=False, type=int, default=5, help="Runs of each measure, the median is reported"
+    )
+    parser.add_argument(
+        "--num_rows", required=False, type=int, default=10000, help="Rows of the synthetic store"
+    )
+    parser.add_argument(
+        "--embeddings_size", required=False, type=int, default=1536, help="Synthetic embeddings size"
+    )
+    parser.add_argument(
+        "--max_import_ms",
+        required=False,
+        type=float,
+        help="Import time budget of answer_question.py, the exit code is 1 when the median exceeds it",
+    )
+    parser.add_argument(
+        "--skip_first_answer",
+        action="store_true",
+        help="Measure only the import time",
+    )
+    parser.add_argument(
+        "--work_dirpath",
+        required=False,
+        type=str,
+        default="./rag/data/benchmarks",
+        help="Directory of the synthetic store, reused by the next runs",
+    )
+    parser.add_argument(
+        "--output_results_filepath", required=False, type=str, help="JSON results output filepath"
+    )
+    parser.add_argument(
+        "--baseline_results_filepath",
+        required=False,
+        type=str,
+        help="Previous JSON results to compare with",
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = do_parsing()
+    print(args)
+
+    results = {"environment": get_environment(), "config": vars(args), "results": {}}
+    for module_name in args.modules:
+        module_results = measure_import_time(module_name, args.num_runs)
+        results["results"][f"import_{module_name}"] = module_results
+        print(
+            f"import {module_name}: {module_results['import_ms_median']:.1f} ms, "
+            f"heavy modules imported: {module_results['heavy_modules_imported']}"
+        )
+    if not args.skip_first_answer:
+        results["results"]["answer_question_first_answer"] = benchmark_first_answer(args)
+        print(
+            "answer_question.py first answer in "
+            f"{results['results']['answer_question_first_answer']['first_answer_s_median']:.2f} s"
+        )
+
+    if args.output_results_filepath:
+        os.makedirs(os.path.dirname(args.output_results_filepath) or ".", exist_ok=True)
+        with open(args.output_results_filepath, "w") as out_fp:
+            json.dump(results, out_fp, indent=2)
+        print(f"Results saved to '{args.output_results_filepath}'")
+    if args.baseline_results_filepath:
+        with open(args.baseline_results_filepath, "r") as in_fp:
+            print_comparison(json.load(in_fp), results)
+
+    answer_question_import_ms: Optional[float] = results["results"].get(
+        "import_answer_question", {}
+    ).get("import_ms_median")
+    if args.max_import_ms is not None and answer_question_import_ms is not None:
+        if answer_question_import_ms > args.max_import_ms:
+            print(
+                f"ERROR: answer_question import time {answer_question_import_ms:.1f} ms "
+                f"over the budget of {args.max_import_ms:.1f} ms"
+            )
+            sys.exit(1)
+        print(f"answer_question import time within the budget of {args.max_import_ms:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
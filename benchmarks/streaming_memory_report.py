@@ -0,0 +1,218 @@
+"""
+Peak memory of create_embeddings.py for growing inputs, with and without --stream_chunk_rows
+
+Each run is a new create_embeddings.py process against the local fake OpenAI server, its peak resident set size
+is read from /proc (Linux only) when it exits. With the streaming mode the peak memory should stay flat as the
+input grows, while the whole input mode grows with the number of rows. The streaming peak still depends on the
+responses parsed at the same time (up to --max_concurrent_requests of --request_size rows each), more chunks
+make the worst overlap more likely: lower --max_concurrent_requests to make the measure less noisy.
+
+Pass --max_stream_rss_growth_mb to fail (exit code 1) when the streaming peak memory of the largest input
+exceeds the one of the smallest input by more than the given MB.
+
+Example (run this from the repository root):
+    python -m benchmarks.streaming_memory_report --num_rows 20000 80000 320000 --max_concurrent_requests 1 \
+    --max_stream_rss_growth_mb 30 --output_report_filepath ./rag/data/streaming_memory_report.json
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from typing import List
+
+import numpy as np
+
+from benchmarks.fake_openai_server import get_api_base, start_fake_openai_server
+from benchmarks.run_benchmarks import REPOSITORY_DIRPATH
+from benchmarks.synthetic_data import make_synthetic_texts
+
+# Run a script as __main__ and write the peak memory of the process (VmHWM, in KB) to the file of the first
+# argument when it exits. VmHWM is reset by the exec, unlike ru_maxrss
+PEAK_RSS_LAUNCHER = """
+import atexit, os, runpy, sys
+
+peak_rss_filepath = sys.argv[1]
+sys.argv = sys.argv[2:]
+sys.path[0] = os.path.dirname(os.path.abspath(sys.argv[0]))
+
+
+def write_peak_rss():
+    with open("/proc/self/status", "r") as in_fp:
+        peak_rss_kb = next(line.split()[1] for line in in_fp if line.startswith("VmHWM:"))
+    with open(peak_rss_filepath, "w") as out_fp:
+        out_fp.write(peak_rss_kb)
+
+
+atexit.register(write_peak_rss)
+runpy.run_path(sys.argv[0], run_name="__main__")
+"""
+
+
+def write_synthetic_csv(csv_filepath: str, num_rows: int, chunk_rows: int = 100000):
+    """
+    Write an input CSV with placeholder sentences, in chunks of rows
+    """
+    with open(csv_filepath, "w") as out_fp:
+        out_fp.write(",text\n")
+        for start in range(0, num_rows, chunk_rows):
+            row_ids = np.arange(start, min(start + chunk_rows, num_rows))
+            out_fp.writelines(
+                f"{row_id},{text}\n" for row_id, text in zip(row_ids, make_synthetic_texts(row_ids, row_ids % 100))
+            )
+
+
+def measure_peak_rss_mb(script_args: List[str], env: dict) -> dict:
+    """
+    Run a repository script in a new process
+
+    The ru_maxrss of a child process also counts the memory of the parent when it was started (the parent
+    memory is shared until the exec), so the script runs in PEAK_RSS_LAUNCHER that reports its own peak.
+
+    Returns:
+        the peak resident set size in MB of the process and the wall time in seconds
+    """
+    start = time.perf_counter()
+    with tempfile.TemporaryDirectory() as tmp_dirpath:
+        peak_rss_filepath = os.path.join(tmp_dirpath, "peak_rss_kb")
+        completed = subprocess.run(
+            [sys.executable, "-c", PEAK_RSS_LAUNCHER, peak_rss_filepath] + script_args,
+            cwd=REPOSITORY_DIRPATH,
+            env=env,
+            stdout=subprocess.DEVNULL,
+        )
+        if completed.returncode != 0:
+            raise RuntimeError(f"{script_args[0]} failed with exit code {completed.returncode}")
+        with open(peak_rss_filepath, "r") as in_fp:
+            peak_rss_kb = int(in_fp.read())
+    return {
+        "peak_rss_mb": peak_rss_kb / 1024.0,
+        "time_s": time.perf_counter() - start,
+    }
+
+
+def do_parsing():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description="Measure the peak memory of create_embeddings.py with and without the streaming mode",
+    )
+    parser.add_argument(
+        "--num_rows",
+        required=False,
+        nargs="+",
+        type=int,
+        default=[20000, 80000, 320000],
+        help="Numbers of rows of the synthetic inputs, the smallest one should have a few chunks",
+    )
+    parser.add_argument(
+        "--embeddings_size", required=False, type=int, default=256, help="Embeddings size of the fake server"
+    )
+    parser.add_argument(
+        "--stream_chunk_rows",
+        required=False,
+        type=int,
+        default=5000,
+        help="Chunk size of the streaming mode runs",
+    )
+    parser.add_argument(
+        "--max_concurrent_requests",
+        required=False,
+        type=int,
+        default=4,
+        help="Embeddings requests in flight of create_embeddings.py",
+    )
+    parser.add_argument(
+        "--skip_full_mode",
+        action="store_true",
+        help="Run only the streaming mode, the whole input mode needs memory proportional to the rows",
+    )
+    parser.add_argument(
+        "--max_stream_rss_growth_mb",
+        required=False,
+        type=float,
+        help="Streaming peak memory growth budget from the smallest to the largest input, "
+        "the exit code is 1 when it is exceeded",
+    )
+    parser.add_argument(
+        "--work_dirpath",
+        required=False,
+        type=str,
+        default="./rag/data/benchmarks/streaming_memory",
+        help="Directory of the synthetic inputs and of the output stores",
+    )
+    parser.add_argument(
+        "--output_report_filepath",
+        required=False,
+        type=str,
+        help="Pass it to save the report as JSON",
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = do_parsing()
+    print(args)
+
+    # The scripts run in the repository root, the relative paths are resolved from the current directory
+    args.work_dirpath = os.path.abspath(args.work_dirpath)
+    os.makedirs(args.work_dirpath, exist_ok=True)
+    modes = ["stream"] if args.skip_full_mode else ["stream", "full"]
+    server = start_fake_openai_server(embeddings_size=args.embeddings_size)
+    env = dict(os.environ, OPENAI_API_BASE=get_api_base(server), OPENAI_API_KEY="fake")
+    report = {"embeddings_size": args.embeddings_size, "stream_chunk_rows": args.stream_chunk_rows, "runs": []}
+    try:
+        for num_rows in args.num_rows:
+            data_filepath = os.path.join(args.work_dirpath, f"data_{num_rows}.csv")
+            if not os.path.exists(data_filepath):
+                write_synthetic_csv(data_filepath, num_rows)
+            for mode in modes:
+                script_args = [
+                    "create_embeddings.py",
+                    "--input_data_filepath", data_filepath,
+                    "--output_embeddings_filepath", os.path.join(args.work_dirpath, f"embeddings_{mode}"),
+                    "--max_concurrent_requests", str(args.max_concurrent_requests),
+                    "--no_embedding_cache",
+                    "--no_reuse",
+                ]
+                if mode == "stream":
+                    script_args += ["--stream_chunk_rows", str(args.stream_chunk_rows)]
+                run = {"mode": mode, "num_rows": num_rows, **measure_peak_rss_mb(script_args, env)}
+                run["store_mb"] = num_rows * args.embeddings_size * 4 / 1024**2
+                report["runs"].append(run)
+                print(
+                    f"{mode} {num_rows} rows: peak RSS {run['peak_rss_mb']:.1f} MB "
+                    f"(embeddings matrix {run['store_mb']:.1f} MB), {run['time_s']:.1f} s"
+                )
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    stream_runs = sorted(
+        (run for run in report["runs"] if run["mode"] == "stream"), key=lambda run: run["num_rows"]
+    )
+    report["stream_rss_growth_mb"] = stream_runs[-1]["peak_rss_mb"] - stream_runs[0]["peak_rss_mb"]
+    print(
+        f"Streaming peak RSS growth from {stream_runs[0]['num_rows']} to {stream_runs[-1]['num_rows']} rows: "
+        f"{report['stream_rss_growth_mb']:.1f} MB"
+    )
+
+    if args.output_report_filepath:
+        os.makedirs(os.path.dirname(args.output_report_filepath) or ".", exist_ok=True)
+        with open(args.output_report_filepath, "w") as out_fp:
+            json.dump(report, out_fp, indent=2)
+        print(f"Report saved to '{args.output_report_filepath}'")
+
+    if args.max_stream_rss_growth_mb is not None:
+        if report["stream_rss_growth_mb"] > args.max_stream_rss_growth_mb:
+            print(
+                f"ERROR: streaming peak RSS growth {report['stream_rss_growth_mb']:.1f} MB "
+                f"over the budget of {args.max_stream_rss_growth_mb:.1f} MB"
+            )
+            sys.exit(1)
+        print(f"Streaming peak RSS growth within the budget of {args.max_stream_rss_growth_mb:.1f} MB")
+
+
+if __name__ == "__main__":
+    main()
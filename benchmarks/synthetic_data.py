@@ -0,0 +1,118 @@
+"""
+Synthetic embeddings to benchmark the retrieval without calling the OpenAI API
+
+The rows are sampled around random cluster centers, like sentences about a few topics,
+so approximate indexes behave similarly to real text embeddings.
+
+write_synthetic_store writes a whole embedding store in chunks, so corpora bigger than the memory
+(e.g. 10M rows) can be created.
+"""
+import json
+import os
+from typing import Tuple
+
+import numpy as np
+import pandas as pd
+
+from utils.context_packing import TOKEN_COUNT_COLUMN
+from utils.embedding_store import (
+    EMBEDDINGS_FILENAME,
+    METADATA_FILENAME,
+    STORE_DTYPE,
+    STORE_INFO_FILENAME,
+)
+from utils.retrieval import normalize_rows
+
+
+def make_clustered_embeddings(
+    num_rows: int,
+    embeddings_size: int = 1536,
+    num_clusters: int = 100,
+    noise_scale: float = 0.5,
+    seed: int = 0,
+) -> np.ndarray:
+    """
+    Returns:
+        (num_rows, embeddings_size) L2 normalized float32 matrix
+    """
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((num_clusters, embeddings_size), dtype=np.float32)
+    cluster_ids = rng.integers(0, num_clusters, size=num_rows)
+    noise = rng.standard_normal((num_rows, embeddings_size), dtype=np.float32)
+    return normalize_rows(centers[cluster_ids] + noise_scale * noise)
+
+
+def make_queries(
+    embeddings: np.ndarray, num_queries: int, noise_scale: float = 0.3, seed: int = 1
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Sample queries close to random corpus rows
+
+    Returns:
+        (num_queries, embeddings_size) L2 normalized queries and the ids of the rows they were sampled from
+    """
+    rng = np.random.default_rng(seed)
+    source_ids = rng.integers(0, len(embeddings), size=num_queries)
+    noise = rng.standard_normal((num_queries, embeddings.shape[1]), dtype=np.float32)
+    # Divide the noise by sqrt(embeddings_size) to have a noise norm independent of the size
+    queries = np.asarray(embeddings[source_ids], dtype=np.float32) + noise_scale * noise / np.sqrt(
+        embeddings.shape[1]
+    )
+    return normalize_rows(queries), source_ids
+
+
+def make_synthetic_texts(row_ids: np.ndarray, cluster_ids: np.ndarray) -> list:
+    return [
+        f"Topic {cluster_id} - synthetic sentence {row_id} about topic {cluster_id}"
+        for row_id, cluster_id in zip(row_ids, cluster_ids)
+    ]
+
+
+def write_synthetic_store(
+    store_dirpath: str,
+    num_rows: int,
+    embeddings_size: int = 1536,
+    num_clusters: int = 100,
+    noise_scale: float = 0.5,
+    chunk_rows: int = 100000,
+    seed: int = 0,
+):
+    """
+    Write an embedding store with clustered embeddings, placeholder texts and token counts
+    sampled between 10 and 60. The memory usage is bounded by chunk_rows.
+    """
+    os.makedirs(store_dirpath, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((num_clusters, embeddings_size), dtype=np.float32)
+    embeddings = np.lib.format.open_memmap(
+        os.path.join(store_dirpath, EMBEDDINGS_FILENAME),
+        mode="w+",
+        dtype=STORE_DTYPE,
+        shape=(num_rows, embeddings_size),
+    )
+    metadata_filepath = os.path.join(store_dirpath, METADATA_FILENAME)
+    for start in range(0, num_rows, chunk_rows):
+        end = min(start + chunk_rows, num_rows)
+        cluster_ids = rng.integers(0, num_clusters, size=end - start)
+        noise = rng.standard_normal((end - start, embeddings_size), dtype=np.float32)
+        embeddings[start:end] = normalize_rows(centers[cluster_ids] + noise_scale * noise)
+        row_ids = np.arange(start, end)
+        pd.DataFrame(
+            {
+                "row_id": row_ids,
+                "text": make_synthetic_texts(row_ids, cluster_ids),
+                TOKEN_COUNT_COLUMN: rng.integers(10, 61, size=end - start),
+            }
+        ).to_csv(metadata_filepath, mode="w" if start == 0 else "a", header=start == 0, index=False)
+    embeddings.flush()
+    del embeddings
+
+    info = {
+        "embedding_model_name": "synthetic",
+        "num_rows": num_rows,
+        "embeddings_size": embeddings_size,
+        "dtype": np.dtype(STORE_DTYPE).name,
+        "normalized": True,
+    }
+    with open(os.path.join(store_dirpath, STORE_INFO_FILENAME), "w") as out_fp:
+        json.dump(info, out_fp, indent=2)
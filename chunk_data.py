@@ -0,0 +1,152 @@
+"""
+Chunk the sentences CSV before creating the embeddings
+
+The rows of the same page and section are merged up to --chunk_tokens tokens, the heading prefix is written
+once for each chunk, and the rows longer than --chunk_tokens are split at the sentence boundaries with
+--chunk_overlap_tokens overlap (see utils/chunking.py). Fewer, denser rows mean fewer embedding requests,
+a smaller embedding store and more content in the same prompt tokens.
+
+Requirements:
+- Extract the data in the input CSV format, e.g. using get_wikipedia_page.py. The rows are grouped by
+  the "page_id" and "section" columns when available, otherwise by the text prefix before " - " (or " – ",
+  the date of the 2022 events)
+
+Example (run this from the repository root):
+    python chunk_data.py \
+    --input_data_filepath ./rag/data/wiki_it_castelnuovo_garfagnana.csv \
+    --output_data_filepath ./rag/data/wiki_it_castelnuovo_garfagnana_chunks.csv
+    python create_embeddings.py \
+    --input_data_filepath ./rag/data/wiki_it_castelnuovo_garfagnana_chunks.csv \
+    --output_embeddings_filepath ./rag/data/wiki_it_castelnuovo_garfagnana_embeddings
+
+Output format: CSV file with "text" and "source_rows" (space separated index values of the input rows)
+columns, plus the "page_id", "title" and "section" columns of the input.
+"""
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+from utils.chunking import chunk_rows
+from utils.embedding_extraction import make_token_batches
+from utils.metrics import add_metrics_arguments, configure_metrics, timer
+from utils.openai_utils import count_tokens_batch
+
+SOURCE_ROWS_COLUMN = "source_rows"
+
+
+def get_rows_stats(texts, max_request_tokens: int, max_request_rows: int) -> dict:
+    """
+    Returns:
+        number of rows, tokens and embedding requests (sized as in create_embeddings.py)
+    """
+    token_counts = count_tokens_batch(list(texts))
+    return {
+        "rows": len(token_counts),
+        "tokens": int(np.sum(token_counts)),
+        "max_row_tokens": int(np.max(token_counts)) if token_counts else 0,
+        "mean_row_tokens": float(np.mean(token_counts)) if token_counts else 0.0,
+        "embedding_requests": len(
+            make_token_batches(token_counts, max_request_tokens, max_request_rows)
+        ),
+    }
+
+
+def do_parsing():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description="Merge the short rows and split the long rows of a sentences CSV in token sized chunks",
+    )
+    parser.add_argument(
+        "--input_data_filepath",
+        required=True,
+        type=str,
+        help="Input CSV with a \"text\" column, e.g. ./rag/data/wiki_page_data.csv",
+    )
+    parser.add_argument(
+        "--output_data_filepath",
+        required=True,
+        type=str,
+        help="Output chunks CSV, e.g. ./rag/data/wiki_page_data_chunks.csv",
+    )
+    parser.add_argument(
+        "--chunk_tokens",
+        required=False,
+        type=int,
+        default=256,
+        help="Maximum number of tokens of each chunk",
+    )
+    parser.add_argument(
+        "--chunk_overlap_tokens",
+        required=False,
+        type=int,
+        default=32,
+        help="Tokens of the last sentences repeated at the start of the next chunk when a long row is split",
+    )
+    parser.add_argument(
+        "--request_size",
+        type=int,
+        default=2048,
+        help="Maximum number of texts in a single embeddings request, to estimate the requests",
+    )
+    parser.add_argument(
+        "--max_request_tokens",
+        type=int,
+        default=50000,
+        help="Maximum number of tokens in a single embeddings request, to estimate the requests",
+    )
+    add_metrics_arguments(parser)
+    return parser.parse_args()
+
+
+def main():
+    args = do_parsing()
+    print(args)
+    configure_metrics(args)
+
+    df = pd.read_csv(args.input_data_filepath, index_col=0)
+    df = df[df["text"].notna()]
+    groups = df["page_id"].tolist() if "page_id" in df.columns else [None] * len(df)
+    sections = (
+        df["section"].where(df["section"].notna(), None).tolist() if "section" in df.columns else None
+    )
+    with timer("chunking"):
+        chunks = chunk_rows(
+            df["text"].tolist(),
+            df.index.tolist(),
+            groups,
+            sections=sections,
+            chunk_tokens=args.chunk_tokens,
+            overlap_tokens=args.chunk_overlap_tokens,
+        )
+
+    df_chunks = pd.DataFrame(
+        {
+            "text": [chunk["text"] for chunk in chunks],
+            SOURCE_ROWS_COLUMN: [
+                " ".join(str(row_id) for row_id in chunk["source_rows"]) for chunk in chunks
+            ],
+        }
+    )
+    if "page_id" in df.columns:
+        df_chunks["page_id"] = [chunk["group"] for chunk in chunks]
+        if "title" in df.columns:
+            titles = df.groupby("page_id")["title"].first()
+            df_chunks["title"] = titles.loc[df_chunks["page_id"]].values
+    if "section" in df.columns:
+        df_chunks["section"] = [chunk["section"] for chunk in chunks]
+
+    with timer("token_counting"):
+        input_stats = get_rows_stats(df["text"], args.max_request_tokens, args.request_size)
+        output_stats = get_rows_stats(df_chunks["text"], args.max_request_tokens, args.request_size)
+    for name in input_stats:
+        print(f"{name}: {input_stats[name]:g} -> {output_stats[name]:g}")
+
+    os.makedirs(os.path.dirname(args.output_data_filepath) or ".", exist_ok=True)
+    df_chunks.to_csv(args.output_data_filepath)
+    print(f"{len(df_chunks)} chunks saved to '{args.output_data_filepath}'")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+"""
+Convert a legacy embeddings CSV file to the binary embedding store format
+
+The legacy CSV has "text" and "embeddings" columns, the embeddings are stringified lists of floats.
+The output directory contains a float32 .npy matrix and a metadata CSV (see utils/embedding_store.py).
+
+Example:
+    python convert_embeddings_csv.py \
+    --input_embeddings_csv ./rag/data/wiki_2022_embeddings.csv \
+    --output_store_dirpath ./rag/data/wiki_2022_embeddings
+"""
+import argparse
+
+from utils.embedding_store import load_legacy_embeddings_csv, save_embedding_store
+
+
+def do_parsing():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description="Convert a legacy embeddings CSV to an embedding store directory",
+    )
+    parser.add_argument(
+        "--input_embeddings_csv",
+        required=True,
+        type=str,
+        help="Input embeddings CSV with 'text' and 'embeddings' columns",
+    )
+    parser.add_argument(
+        "--output_store_dirpath",
+        required=True,
+        type=str,
+        help="Output embedding store directory",
+    )
+    parser.add_argument(
+        "--embedding_model_name",
+        required=False,
+        type=str,
+        default="text-embedding-ada-002",
+        help="Embeddings model used to create the input CSV embeddings",
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = do_parsing()
+    print(args)
+
+    store = load_legacy_embeddings_csv(args.input_embeddings_csv)
+    df = store.metadata.set_index("row_id")
+    save_embedding_store(
+        args.output_store_dirpath,
+        df,
+        store.embeddings,
+        embedding_model_name=args.embedding_model_name,
+    )
+    print(
+        f"{len(store)} rows with embeddings size {store.embeddings.shape[1]} "
+        f"saved to '{args.output_store_dirpath}'"
+    )
+
+
+if __name__ == "__main__":
+    main()
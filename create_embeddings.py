@@ -11,24 +11,87 @@ The default arguments loads the Wikipedia 2022 events CSV file.
 Example (run this from the repository root to correctly load the OpenAI key):
     python rag/create_embeddings.py \
     --input_data_filepath ./rag/data/wiki_2022_data.csv \
-    --output_embeddings_filepath ./rag/data/wiki_2022_embeddings.csv
+    --output_embeddings_filepath ./rag/data/wiki_2022_embeddings
 
-The output CSV file will have "text" and "embeddings" columns.
+The output is an embedding store directory (see utils/embedding_store.py): a float32 embeddings matrix
+in .npy format and a metadata CSV with "row_id" and "text" columns.
+If the output path ends with ".csv" the legacy CSV format with "text" and "embeddings" columns is saved instead.
+
+The texts are sent in requests filled up to --max_request_tokens tokens, with up to --max_concurrent_requests
+requests in flight, client side requests/tokens per minute limits and retries with exponential backoff.
+
+Each row is identified by a hash of (embedding model name, normalized text): when the output already exists,
+only the new or changed rows are sent to the API. The new embeddings are checkpointed every --checkpoint_every
+requests next to the output, an interrupted run started again with the same arguments resumes from there.
+The embeddings are also kept in a persistent cache (--embedding_cache_filepath) shared with answer_question.py,
+so a text already embedded for any output is never sent again to the API.
+
+Pass --embedding_model_name local-hashing-<embeddings size> (e.g. local-hashing-1024) to embed the texts offline
+with the local CPU model of utils/embedding_backends.py instead of the OpenAI API, the batches are embedded by
+--max_concurrent_requests threads. answer_question.py must use the same --embedding_model_name.
+benchmarks/embedding_backends_report.py compares its throughput with the API.
+
+Pass --stream_chunk_rows to process corpora bigger than the memory: the input CSV is read in chunks of rows,
+each chunk is embedded and its rows are appended to the store files on disk, so the memory usage is bounded
+by the chunk size whatever the number of rows. The reuse and the resume of an interrupted run go through
+the persistent embeddings cache only (the previous output and the checkpoints are not loaded in memory).
+benchmarks/streaming_memory_report.py measures the peak memory for growing inputs.
+
+Pass --ivf_n_lists to also build the approximate nearest neighbour index inside the embedding store
+(a good starting value is about sqrt(number of rows), tune n_probe with benchmarks/ann_recall_report.py).
+
+Pass --num_shards to split the embedding store in shards, each one with its own matrix and metadata:
+the queries score the shards in parallel worker processes (see utils/sharded_retrieval.py).
+
+Pass --quantization to also save compressed codes of the embeddings (float16, int8 or product quantization,
+see utils/quantization.py): the queries score the codes and rescore a shortlist with the float32 rows.
+Compare memory and recall@k of the modes with benchmarks/quantization_report.py.
+
+Pass --lexical_index to also build a BM25 inverted index of the texts (see utils/lexical_index.py),
+answer_question.py --retrieval_mode uses it to prefilter the rows or to fuse the keyword and dense rankings.
 """
 
 import argparse
 import os
+from typing import List, Optional
 
-import openai
+import numpy as np
 import pandas as pd
 
-from utils.openai_utils import set_openai_vocareum_key
+from utils.ann_index import IVFIndex, remove_ivf_index
+from utils.embedding_backends import get_embedding_backend
+from utils.embedding_cache import EmbeddingCache
+from utils.embedding_extraction import extract_embeddings
+from utils.embedding_store import (
+    EmbeddingStoreWriter,
+    get_shard_dirpath,
+    is_legacy_csv,
+    load_embedding_store,
+    save_embedding_store,
+    save_legacy_embeddings_csv,
+)
+from utils.quantization import (
+    QUANTIZATION_MODES,
+    remove_quantized_codes,
+    save_quantized_codes,
+    train_quantizer,
+)
+from utils.incremental_embeddings import (
+    CONTENT_HASH_COLUMN,
+    EmbeddingsCheckpoint,
+    get_content_hash,
+    load_previous_embeddings,
+)
+from utils.context_packing import PREFIX_TOKEN_COUNT_COLUMN, TOKEN_COUNT_COLUMN, count_prefix_tokens
+from utils.lexical_index import LEXICAL_INDEX_FILENAME, LEXICAL_LANGUAGES, BM25Index
+from utils.metrics import add_metrics_arguments, configure_metrics, count, timer
+from utils.openai_utils import count_tokens_batch, set_openai_vocareum_key
 
 
 def do_parsing():
     parser = argparse.ArgumentParser(
         formatter_class=argparse.ArgumentDefaultsHelpFormatter,
-        description="Create text embeddings in CSV format from a CSV file with sentences",
+        description="Create text embeddings from a CSV file with sentences",
     )
     parser.add_argument(
         "--input_data_filepath",
@@ -40,8 +103,39 @@ def do_parsing():
     parser.add_argument(
         "--request_size",
         type=int,
-        default=100,
-        help="Text embeddings extraction single request size",
+        default=2048,
+        help="Maximum number of texts in a single embeddings extraction request",
+    )
+    parser.add_argument(
+        "--max_request_tokens",
+        type=int,
+        default=50000,
+        help="Maximum number of tokens in a single embeddings extraction request, "
+        "the requests are filled up to this limit",
+    )
+    parser.add_argument(
+        "--max_concurrent_requests",
+        type=int,
+        default=4,
+        help="Maximum number of embeddings extraction requests in flight, threads of a local embedding model",
+    )
+    parser.add_argument(
+        "--requests_per_minute",
+        type=float,
+        default=3000,
+        help="Requests per minute limit of the account, 0 to disable the client side limit",
+    )
+    parser.add_argument(
+        "--tokens_per_minute",
+        type=float,
+        default=1000000,
+        help="Tokens per minute limit of the account, 0 to disable the client side limit",
+    )
+    parser.add_argument(
+        "--max_retries",
+        type=int,
+        default=6,
+        help="Retries of a failed request (rate limit, timeout, server error) before giving up",
     )
     parser.add_argument(
         "--embedding_model_name",
@@ -49,50 +143,381 @@ def do_parsing():
         type=str,
         default="text-embedding-ada-002",  # embeddings size 1536
         help="Embeddings model used to create the dataset embeddings. "
-        "Check OpenAI documentation about available embedding models.",
+        "Check OpenAI documentation about available embedding models, or pass local-hashing-<embeddings size> "
+        "for the local CPU model (see utils/embedding_backends.py).",
     )
     parser.add_argument(
         "--output_embeddings_filepath",
         required=False,
         type=str,
-        default="./rag/data/wiki_2022_embeddings.csv",
-        help="Output dataset embeddings CSV",
+        default="./rag/data/wiki_2022_embeddings",
+        help="Output embedding store directory, or a .csv filepath to save the legacy CSV format",
+    )
+    parser.add_argument(
+        "--ivf_n_lists",
+        required=False,
+        type=int,
+        default=0,
+        help="Number of lists of the IVF approximate nearest neighbour index saved in the embedding store, "
+        "0 to skip the index creation (exact search only). With --num_shards each shard has its own index "
+        "with this number of lists",
+    )
+    parser.add_argument(
+        "--num_shards",
+        required=False,
+        type=int,
+        default=1,
+        help="Split the embedding store in this number of shards, the queries search them in parallel processes",
+    )
+    parser.add_argument(
+        "--quantization",
+        required=False,
+        type=str,
+        choices=QUANTIZATION_MODES,
+        default="none",
+        help="Save also quantized codes of the embeddings, the queries score them and rescore the best rows "
+        "at full precision. With --num_shards each shard has its own codes",
+    )
+    parser.add_argument(
+        "--pq_num_subspaces",
+        required=False,
+        type=int,
+        default=96,
+        help="Sub-vectors of the product quantization (--quantization pq), bytes per row. "
+        "It must divide the embeddings size",
+    )
+    parser.add_argument(
+        "--lexical_index",
+        action="store_true",
+        help="Build also a BM25 inverted index of the texts, for the prefilter and hybrid retrieval modes",
+    )
+    parser.add_argument(
+        "--lexical_language",
+        required=False,
+        type=str,
+        choices=LEXICAL_LANGUAGES,
+        default="multi",
+        help="Stopwords of the BM25 index tokenization, multi removes both the Italian and the English ones",
     )
+    parser.add_argument(
+        "--stream_chunk_rows",
+        type=int,
+        default=0,
+        help="Read, embed and write the input rows in chunks of this size to bound the memory usage, "
+        "0 to process all the rows at once. It requires an embedding store directory output",
+    )
+    parser.add_argument(
+        "--checkpoint_every",
+        type=int,
+        default=10,
+        help="Save the new embeddings every N requests, to resume an interrupted run",
+    )
+    parser.add_argument(
+        "--embedding_cache_filepath",
+        type=str,
+        default="./rag/data/embeddings_cache.sqlite",
+        help="Persistent embeddings cache SQLite file, shared with answer_question.py",
+    )
+    parser.add_argument(
+        "--embedding_cache_max_mb",
+        type=float,
+        default=1024,
+        help="Maximum size of the embeddings cache, the least recently used embeddings are evicted",
+    )
+    parser.add_argument(
+        "--no_embedding_cache",
+        action="store_true",
+        help="Don't use the persistent embeddings cache",
+    )
+    parser.add_argument(
+        "--no_reuse",
+        action="store_true",
+        help="Embed all the rows, without reusing the embeddings of the existing output",
+    )
+    add_metrics_arguments(parser)
     return parser.parse_args()
 
 
+def get_embeddings_incrementally(
+    args: argparse.Namespace,
+    texts: List[str],
+    token_counts: List[int],
+    hashes: List[str],
+    checkpoint: Optional[EmbeddingsCheckpoint],
+    embedding_cache: Optional[EmbeddingCache] = None,
+) -> np.ndarray:
+    """
+    Reuse the embeddings of the previous output, of the checkpoint and of the cache, embed only the missing texts.
+    Without checkpoint (streaming mode) only the cache is used.
+
+    Returns:
+        (number of texts, embeddings size) float32 matrix
+    """
+    known_embeddings = {}
+    if not args.no_reuse and checkpoint is not None:
+        known_embeddings.update(
+            load_previous_embeddings(args.output_embeddings_filepath, args.embedding_model_name)
+        )
+        known_embeddings.update(checkpoint.load())
+
+    # Embed each missing text once, even if it is repeated in the input
+    missing_positions = {}
+    for position, content_hash in enumerate(hashes):
+        if content_hash not in known_embeddings and content_hash not in missing_positions:
+            missing_positions[content_hash] = position
+    if embedding_cache is not None and missing_positions:
+        cached_embeddings = embedding_cache.get_many(
+            args.embedding_model_name,
+            [texts[position] for position in missing_positions.values()],
+        )
+        for content_hash, vector in zip(list(missing_positions.keys()), cached_embeddings):
+            if vector is not None:
+                known_embeddings[content_hash] = vector
+                del missing_positions[content_hash]
+    print(
+        f"{len(texts) - len(missing_positions)} rows reused, {len(missing_positions)} rows to embed"
+    )
+
+    if missing_positions:
+        missing_hashes = list(missing_positions.keys())
+        missing_texts = [texts[position] for position in missing_positions.values()]
+        missing_token_counts = [token_counts[position] for position in missing_positions.values()]
+        batches_done = 0
+
+        def on_batch_done(start: int, end: int, batch_embeddings: np.ndarray):
+            nonlocal batches_done
+            if embedding_cache is not None:
+                embedding_cache.put_many(
+                    args.embedding_model_name, missing_texts[start:end], batch_embeddings
+                )
+            if checkpoint is None:
+                return
+            checkpoint.add(missing_hashes[start:end], batch_embeddings)
+            batches_done += 1
+            if batches_done % args.checkpoint_every == 0:
+                checkpoint.flush()
+
+        # In order to avoid a `RateLimitError` the data is sent in batches to the `Embedding.create` function,
+        # the batches are sized by number of tokens and sent concurrently within the rate limits
+        try:
+            new_embeddings = extract_embeddings(
+                missing_texts,
+                token_counts=missing_token_counts,
+                embedding_model_name=args.embedding_model_name,
+                max_request_tokens=args.max_request_tokens,
+                max_request_rows=args.request_size,
+                max_concurrent_requests=args.max_concurrent_requests,
+                requests_per_minute=args.requests_per_minute or None,
+                tokens_per_minute=args.tokens_per_minute or None,
+                max_retries=args.max_retries,
+                on_batch_done=on_batch_done,
+            )
+        finally:
+            # Keep the completed batches also when the run fails or is interrupted
+            if checkpoint is not None:
+                checkpoint.flush()
+        known_embeddings.update(zip(missing_hashes, new_embeddings))
+
+    return np.array(
+        [known_embeddings[content_hash] for content_hash in hashes], dtype=np.float32
+    )
+
+
+def build_store_indexes(args: argparse.Namespace):
+    """
+    Build the optional indexes of the saved embedding store (IVF, quantized codes, BM25),
+    the matrix is memory-mapped
+    """
+    store_dirpaths = (
+        [get_shard_dirpath(args.output_embeddings_filepath, shard_id) for shard_id in range(args.num_shards)]
+        if args.num_shards > 1
+        else [args.output_embeddings_filepath]
+    )
+    # The indexes not rebuilt now were built for the rows of a previous run, the loaders would use them
+    if args.ivf_n_lists == 0 or args.num_shards > 1:
+        remove_ivf_index(args.output_embeddings_filepath)
+    if args.ivf_n_lists == 0:
+        for store_dirpath in store_dirpaths:
+            remove_ivf_index(store_dirpath)
+    if args.ivf_n_lists == 0 and args.quantization == "none" and not args.lexical_index:
+        # Nothing to build, only remove the indexes of a previous run without loading the store
+        for store_dirpath in store_dirpaths:
+            remove_quantized_codes(store_dirpath)
+        if os.path.exists(os.path.join(args.output_embeddings_filepath, LEXICAL_INDEX_FILENAME)):
+            os.remove(os.path.join(args.output_embeddings_filepath, LEXICAL_INDEX_FILENAME))
+        return
+    store = load_embedding_store(args.output_embeddings_filepath)
+    if args.ivf_n_lists > 0:
+        with timer("ivf_build"):
+            if store.is_sharded:
+                for shard_id, shard in enumerate(store.shards):
+                    ivf_index = IVFIndex.build(shard.embeddings, n_lists=args.ivf_n_lists)
+                    ivf_index.save(get_shard_dirpath(args.output_embeddings_filepath, shard_id))
+            else:
+                ivf_index = IVFIndex.build(store.embeddings, n_lists=args.ivf_n_lists)
+                ivf_index.save(args.output_embeddings_filepath)
+        print(f"IVF index with {ivf_index.n_lists} lists saved")
+    shard_dirpaths_and_matrices = (
+        [
+            (get_shard_dirpath(args.output_embeddings_filepath, shard_id), shard.embeddings)
+            for shard_id, shard in enumerate(store.shards)
+        ]
+        if store.is_sharded
+        else [(args.output_embeddings_filepath, store.embeddings)]
+    )
+    with timer("quantization"):
+        for store_dirpath, matrix in shard_dirpaths_and_matrices:
+            if args.quantization == "none":
+                remove_quantized_codes(store_dirpath)
+            else:
+                quantizer = train_quantizer(
+                    matrix, args.quantization, pq_num_subspaces=args.pq_num_subspaces
+                )
+                save_quantized_codes(store_dirpath, quantizer, matrix)
+    if args.quantization != "none":
+        print(f"Embeddings quantized with {args.quantization}")
+    # The BM25 index covers all the rows of a sharded store, its row ids are the global ones
+    if args.lexical_index:
+        with timer("lexical_index_build"):
+            lexical_index = BM25Index.build(store.texts, language=args.lexical_language)
+            lexical_index.save(args.output_embeddings_filepath)
+        print(f"BM25 index with {len(lexical_index.terms)} terms saved")
+    elif os.path.exists(os.path.join(args.output_embeddings_filepath, LEXICAL_INDEX_FILENAME)):
+        os.remove(os.path.join(args.output_embeddings_filepath, LEXICAL_INDEX_FILENAME))
+
+
+def get_sections(df: pd.DataFrame) -> Optional[List[Optional[str]]]:
+    """
+    Returns:
+        the headings key of each row (None for the missing ones), None when the input has no "section" column
+    """
+    if "section" not in df.columns:
+        return None
+    return df["section"].where(df["section"].notna(), None).tolist()
+
+
+def count_csv_rows(csv_filepath: str, chunk_rows: int) -> int:
+    with timer("count_rows"):
+        return sum(len(df) for df in pd.read_csv(csv_filepath, index_col=0, chunksize=chunk_rows))
+
+
+def create_embeddings_streaming(args: argparse.Namespace, embedding_cache: Optional[EmbeddingCache]):
+    """
+    Read the input CSV in chunks of --stream_chunk_rows rows, embed each chunk and append it to the store,
+    only one chunk of texts and embeddings is in memory at a time
+    """
+    # A first pass counts the rows, the store files are written with their final size
+    num_rows = count_csv_rows(args.input_data_filepath, args.stream_chunk_rows)
+    count("rows", num_rows)
+    print(f"{num_rows} rows to process in chunks of {args.stream_chunk_rows} rows")
+    writer = EmbeddingStoreWriter(
+        args.output_embeddings_filepath,
+        num_rows,
+        embedding_model_name=args.embedding_model_name,
+        num_shards=args.num_shards,
+    )
+    for df in pd.read_csv(args.input_data_filepath, index_col=0, chunksize=args.stream_chunk_rows):
+        texts = df["text"].tolist()
+        with timer("content_hash"):
+            hashes = [get_content_hash(args.embedding_model_name, text) for text in texts]
+        with timer("token_counting"):
+            token_counts = count_tokens_batch(texts)
+            prefix_token_counts = count_prefix_tokens(texts, get_sections(df))
+        with timer("embeddings"):
+            embeddings = get_embeddings_incrementally(
+                args, texts, token_counts, hashes, None, embedding_cache
+            )
+        df[CONTENT_HASH_COLUMN] = hashes
+        df[TOKEN_COUNT_COLUMN] = token_counts
+        df[PREFIX_TOKEN_COUNT_COLUMN] = prefix_token_counts
+        with timer("save"):
+            writer.append(df, embeddings)
+        print(f"{writer.rows_written}/{num_rows} rows saved")
+    with timer("save"):
+        writer.close()
+    print(f"Embeddings space size using {args.embedding_model_name}: {writer.embeddings_size}")
+
+
 def main():
     args = do_parsing()
     print(args)
+    configure_metrics(args)
+    if args.stream_chunk_rows > 0 and is_legacy_csv(args.output_embeddings_filepath):
+        raise ValueError("--stream_chunk_rows requires an embedding store directory output, not a CSV file")
 
-    set_openai_vocareum_key()
-
-    df = pd.read_csv(args.input_data_filepath, index_col=0)
+    if not get_embedding_backend(args.embedding_model_name).is_local:
+        set_openai_vocareum_key()
 
-    # Get the embeddings
-    # In order to avoid a `RateLimitError` the data is sent in batches to the `Embedding.create` function
-    embeddings = []
-    for i in range(0, len(df), args.request_size):
-        # Send text data to OpenAI model to get embeddings, the embeddings are at sentence level, not word
-        response = openai.Embedding.create(
-            input=df.iloc[i : i + args.request_size]["text"].tolist(),
-            engine=args.embedding_model_name,
+    embedding_cache = None
+    if not args.no_embedding_cache:
+        embedding_cache = EmbeddingCache(
+            args.embedding_cache_filepath,
+            max_disk_bytes=int(args.embedding_cache_max_mb * 1024**2),
         )
+    if args.stream_chunk_rows > 0:
+        try:
+            create_embeddings_streaming(args, embedding_cache)
+        finally:
+            if embedding_cache is not None:
+                print(f"Embeddings cache: {embedding_cache.stats()}")
+                embedding_cache.close()
+        if args.num_shards > 1:
+            print(f"Embedding store split in {args.num_shards} shards")
+        build_store_indexes(args)
+        print(f"Embeddings saved to {args.output_embeddings_filepath}")
+        return
 
-        # Add embeddings to list
-        embeddings.extend([data["embedding"] for data in response["data"]])
+    with timer("read_csv"):
+        df = pd.read_csv(args.input_data_filepath, index_col=0)
 
-    # Add embeddings list to dataframe
-    df["embeddings"] = embeddings
+    # Get the embeddings, the embeddings are at sentence level, not word
+    texts = df["text"].tolist()
+    count("rows", len(texts))
+    with timer("content_hash"):
+        hashes = [get_content_hash(args.embedding_model_name, text) for text in texts]
+    # Count the tokens once: they size the requests and they are saved for the query time context packing
+    with timer("token_counting"):
+        token_counts = count_tokens_batch(texts)
+        prefix_token_counts = count_prefix_tokens(texts, get_sections(df))
+    checkpoint = EmbeddingsCheckpoint(
+        args.output_embeddings_filepath.rstrip("/") + "_checkpoint"
+    )
+    with timer("embeddings"):
+        embeddings = get_embeddings_incrementally(
+            args, texts, token_counts, hashes, checkpoint, embedding_cache
+        )
+    if embedding_cache is not None:
+        print(f"Embeddings cache: {embedding_cache.stats()}")
+        embedding_cache.close()
+    df[CONTENT_HASH_COLUMN] = hashes
+    df[TOKEN_COUNT_COLUMN] = token_counts
+    df[PREFIX_TOKEN_COUNT_COLUMN] = prefix_token_counts
 
     print(
         f"Embeddings space size using {args.embedding_model_name}: {len(embeddings[0])}"
     )
 
-    os.makedirs(os.path.dirname(args.output_embeddings_filepath), exist_ok=True)
-    df.to_csv(args.output_embeddings_filepath)
+    if is_legacy_csv(args.output_embeddings_filepath):
+        os.makedirs(os.path.dirname(args.output_embeddings_filepath), exist_ok=True)
+        with timer("save"):
+            save_legacy_embeddings_csv(args.output_embeddings_filepath, df, embeddings)
+    else:
+        with timer("save"):
+            save_embedding_store(
+                args.output_embeddings_filepath,
+                df,
+                embeddings,
+                embedding_model_name=args.embedding_model_name,
+                num_shards=args.num_shards,
+            )
+        if args.num_shards > 1:
+            print(f"Embedding store split in {args.num_shards} shards")
+        build_store_indexes(args)
     print(f"Embeddings saved to {args.output_embeddings_filepath}")
 
+    # The checkpoint is not needed anymore once the output is saved
+    checkpoint.remove()
+
 
 if __name__ == "__main__":
     main()
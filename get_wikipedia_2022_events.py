@@ -8,11 +8,14 @@ Output format: CSV file with "text" column, each row is an event.
 
 import argparse
 import os
+import time
 
 import pandas as pd
 import requests
 from dateutil.parser import parse as date_parser
 
+from utils.metrics import add_metrics_arguments, add_timing, configure_metrics, count, timer
+
 
 def do_parsing():
     parser = argparse.ArgumentParser(
@@ -26,12 +29,14 @@ def do_parsing():
         default="./rag/data/wiki_2022_data.csv",
         help="Output text dataset in CSV format",
     )
+    add_metrics_arguments(parser)
     return parser.parse_args()
 
 
 def main():
     args = do_parsing()
     print(args)
+    configure_metrics(args)
 
     # Get the Wikipedia page for "2022" since OpenAI's models stop in 2021
     params = {
@@ -43,11 +48,15 @@ def main():
         "formatversion": 2,
         "format": "json",
     }
-    resp = requests.get("https://en.wikipedia.org/w/api.php", params=params)
+    with timer("wikipedia_request"):
+        resp = requests.get("https://en.wikipedia.org/w/api.php", params=params)
+    count("api_calls.wikipedia")
+    count("bytes_received.wikipedia", len(resp.content))
     response_dict = resp.json()
     response_sentences = response_dict["query"]["pages"][0]["extract"].split("\n")
     print(f"{len(response_sentences)} sentences found")
 
+    cleaning_start = time.perf_counter()
     df = pd.DataFrame()
     df["text"] = response_sentences
 
@@ -73,6 +82,7 @@ def main():
                 # If the row's text isn't a date, add the prefix
                 row["text"] = prefix + " – " + row["text"]
     df = df[df["text"].str.contains(" – ")].reset_index(drop=True)
+    add_timing("cleaning", time.perf_counter() - cleaning_start)
     print(f"{len(df)} sentences after cleaning")
 
     os.makedirs(os.path.dirname(args.output_data_filepath), exist_ok=True)
@@ -0,0 +1,142 @@
+"""
+Script to extract the data from a local Wikipedia XML dump, without API calls and corpus size limits.
+
+The dump (e.g. https://dumps.wikimedia.org/itwiki/latest/itwiki-latest-pages-articles1.xml-p1p316052.bz2)
+is read as a stream, the pages are parsed by a process pool with the same headings and sentences logic of
+get_wikipedia_page.py and the sentences are appended to the CSV while the dump is read.
+
+Example:
+    python get_wikipedia_dump.py \
+    --dump_filepath ./rag/data/itwiki-latest-pages-articles1.xml-p1p316052.bz2 \
+    --skip_sections "Collegamenti_esterni" "Altri_progetti" "Note" "Bibliografia" \
+    --output_data_filepath ./rag/data/wiki_it_dump.csv
+
+Example with the sample dump:
+    python get_wikipedia_dump.py \
+    --dump_filepath ./benchmarks/data/sample-pages-articles.xml.bz2 \
+    --output_data_filepath ./rag/data/wiki_sample_dump.csv
+
+Output format: CSV file with "text", "page_id", "title" and "section" (headings key) columns,
+each row is a sentence.
+"""
+import argparse
+import csv
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from typing import Iterator, List, Tuple
+
+from utils.metrics import add_metrics_arguments, configure_metrics, count
+from utils.wikipedia_dump import iter_dump_pages, parse_dump_pages
+
+
+def iter_batches(pages: Iterator[Tuple[int, str, str]], batch_size: int) -> Iterator[list]:
+    while True:
+        batch = list(islice(pages, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def do_parsing():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description="Extract text from a Wikipedia XML dump and save it to a CSV",
+    )
+    parser.add_argument(
+        "--dump_filepath",
+        required=True,
+        type=str,
+        help="Wikipedia pages-articles dump, .xml.bz2 or .xml",
+    )
+    parser.add_argument(
+        "--output_data_filepath",
+        required=True,
+        type=str,
+        help="Output text dataset in CSV format, e.g. ./rag/data/wiki_dump_data.csv",
+    )
+    parser.add_argument(
+        "--skip_sections",
+        required=False,
+        default=[],
+        nargs="+",
+        type=str,
+        help="Section names to skip",
+    )
+    parser.add_argument(
+        "--num_workers",
+        required=False,
+        type=int,
+        default=os.cpu_count(),
+        help="Processes parsing the pages, 0 to parse them in the main process",
+    )
+    parser.add_argument(
+        "--pages_per_task",
+        required=False,
+        type=int,
+        default=64,
+        help="Pages sent to a worker process at once",
+    )
+    parser.add_argument(
+        "--max_pages",
+        required=False,
+        type=int,
+        help="Stop after this number of articles, e.g. to try the settings on a large dump",
+    )
+    add_metrics_arguments(parser)
+    return parser.parse_args()
+
+
+def main():
+    args = do_parsing()
+    print(args)
+    configure_metrics(args)
+
+    pages = islice(iter_dump_pages(args.dump_filepath), args.max_pages)
+    batches = iter_batches(pages, args.pages_per_task)
+    os.makedirs(os.path.dirname(args.output_data_filepath), exist_ok=True)
+
+    num_pages = 0
+    num_sentences = 0
+    start = time.perf_counter()
+    with open(args.output_data_filepath, "w", newline="") as out_fp:
+        # Same layout of DataFrame.to_csv, the first column is the index
+        writer = csv.writer(out_fp)
+        writer.writerow(["", "text", "page_id", "title", "section"])
+
+        def write_pages(pages_texts: List[Tuple[int, str, List[Tuple[str, str]]]]):
+            nonlocal num_pages, num_sentences
+            for page_id, title, sections_texts in pages_texts:
+                for section, text in sections_texts:
+                    writer.writerow([num_sentences, text, page_id, title, section])
+                    num_sentences += 1
+                num_pages += 1
+            count("pages", len(pages_texts))
+
+        if args.num_workers == 0:
+            for batch in batches:
+                write_pages(parse_dump_pages(batch, args.skip_sections))
+        else:
+            with ProcessPoolExecutor(max_workers=args.num_workers) as executor:
+                # Bounded number of batches in flight: the dump is read as fast as the workers parse it
+                # and the sentences are written in the dump order
+                pending = deque()
+                for batch in batches:
+                    pending.append(executor.submit(parse_dump_pages, batch, args.skip_sections))
+                    if len(pending) >= 2 * args.num_workers:
+                        write_pages(pending.popleft().result())
+                while pending:
+                    write_pages(pending.popleft().result())
+
+    elapsed_s = time.perf_counter() - start
+    print(
+        f"{num_sentences} sentences obtained from {num_pages} pages in {elapsed_s:.2f} s "
+        f"({num_pages / max(elapsed_s, 1e-9):.1f} pages/s)"
+    )
+    print(f"CSV file saved to '{args.output_data_filepath}'")
+
+
+if __name__ == "__main__":
+    main()
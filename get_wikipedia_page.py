@@ -8,38 +8,22 @@ Example:
     --skip_sections "Collegamenti_esterni" "Altri_progetti" \
     --output_data_filepath ./rag/data/wiki_it_castelnuovo_garfagnana.csv
 
-Output format: CSV file with "text" column, each row is an event.
+Output format: CSV file with "text" and "section" (headings key) columns, each row is a sentence.
 """
 
 import argparse
 import os
-from collections import defaultdict
-from typing import Optional
 
-import bs4
 import pandas as pd
-import requests
-from bs4 import BeautifulSoup
 
-
-def get_dict_key_from_headings(
-    last_h2_level_paragraph: str,
-    last_h3_level_paragraph: Optional[str] = None,
-    last_h4_level_paragraph: Optional[str] = None,
-) -> str:
-    key = f"{last_h2_level_paragraph}"
-    if last_h3_level_paragraph is not None:
-        key += f" - {last_h3_level_paragraph}"
-    if last_h4_level_paragraph is not None:
-        key += f" - {last_h4_level_paragraph}"
-    return key
-
-
-def get_cleaned_text(element) -> str:
-    """
-    Strip text and remove '\n' inside the paragraph
-    """
-    return element.get_text().strip().replace(u"\xa0"," ").replace("\n", " ")
+from utils.metrics import add_metrics_arguments, configure_metrics, timer
+from utils.wikipedia_utils import (
+    WikipediaClient,
+    fetch_titles_extracts,
+    get_api_url,
+    get_page_sections_texts,
+    parse_page_html,
+)
 
 
 def do_parsing():
@@ -62,6 +46,13 @@ def do_parsing():
         default="en",
         help="Wikipedia site language, language code to build the url, <wikipedia_lang>.wikipedia.org",
     )
+    parser.add_argument(
+        "--api_url",
+        required=False,
+        type=str,
+        help="MediaWiki API url overriding the Wikipedia one, "
+        "e.g. http://127.0.0.1:8767/w/api.php of benchmarks/fake_mediawiki_server.py",
+    )
     parser.add_argument(
         "--output_data_filepath",
         required=True,
@@ -76,136 +67,33 @@ def do_parsing():
         type=str,
         help="Section names to skip",
     )
+    add_metrics_arguments(parser)
     return parser.parse_args()
 
 
 def main():
     args = do_parsing()
     print(args)
+    configure_metrics(args)
 
-    # "query" action documentation: https://en.wikipedia.org/w/api.php?action=help&modules=query
-    # Don't pass "explaintext": 1 to get the text in HTML format. It is a bit more complex to parse, but we have
-    # all the information to understand when a list is present
-    params = {
-        "action": "query",
-        "prop": "extracts",
-        "exlimit": 1,
-        "titles": args.page_title,
-        "exsectionformat": "wiki",
-        "format": "json",
-    }
-
-    resp = requests.get(
-        f"https://{args.wikipedia_lang}.wikipedia.org/w/api.php", params=params
-    )
-    response_dict = resp.json()
-
-    page_dict = next(iter(response_dict["query"]["pages"].values()))
+    client = WikipediaClient(get_api_url(args.wikipedia_lang, args.api_url))
+    pages = fetch_titles_extracts(client, [args.page_title])
+    if not pages:
+        raise ValueError(f"Page '{args.page_title}' not found")
+    page_dict = pages[0]
     title = page_dict["title"]
     html_text = page_dict["extract"]
-    soup = BeautifulSoup(html_text, "html.parser")
-    print(soup.prettify())
 
-    # Use BeatifulSoap the go element by element
-    # headings -> new sectopm level
-    # <p>...</p> sentences
-    # <ul><li>..</li><li>...</li>...</ul> <li> elements to merge
-    sentences_dict = defaultdict(list)
-    last_h2_level_paragraph = None
-    last_h3_level_paragraph = None
-    last_h4_level_paragraph = None
-    for element in soup:
-        if type(element) == bs4.Tag:
-            if element.name == "p" and last_h2_level_paragraph is None:
-                # Intro before the first headings
-                sentences_dict[title].append(get_cleaned_text(element))
-            elif element.name == "h2":
-                # First level paragraph
-                last_h2_level_paragraph = element.attrs["data-mw-anchor"]
-                last_h3_level_paragraph = None
-                last_h4_level_paragraph = None
-                building_list = False
-            elif element.name == "h3":
-                # Second level paragraph
-                last_h3_level_paragraph = element.attrs["data-mw-anchor"]
-                last_h4_level_paragraph = None
-                building_list = False
-            elif element.name == "h4":
-                # Third level paragraph
-                last_h4_level_paragraph = element.attrs["data-mw-anchor"]
-                building_list = False
-            elif element.name == "p":
-                # Sentence of a paragraph
-                # Concatenate the headings to provide context
-                key = get_dict_key_from_headings(
-                    last_h2_level_paragraph,
-                    last_h3_level_paragraph,
-                    last_h4_level_paragraph,
-                )
-                # Search for <ul> inside <p>
-                for p_children in element.children:
-                    if type(p_children) == bs4.Tag and p_children.name == "ul":
-                        raise ValueError("List <ul> inside a <p> not supported")
-                sentences_dict[key].append(get_cleaned_text(element))
+    with timer("html_parsing"):
+        sentences_dict = parse_page_html(html_text, title)
 
-            elif element.name == "ul" or element.name == "dl":
-                # Get the list elements and merge them when necessary
-                # DO NOT MERGE when there is no sentence before ending with ":"
-                # MERGE when the previous sentence ends with ":" or when another list element is preceding
-
-                # Logic to merge the list elements
-                list_content_str = ""
-                for list_element in element.children:
-                    if (
-                        list_element.name == "li"
-                        or list_element.name == "dd"
-                        or list_element.name == "dt"
-                    ):
-                        list_text = get_cleaned_text(list_element)
-                        list_content_str += list_text + "\n"
-                list_content_str = (
-                    list_content_str.replace("\n", "; ")
-                    .replace(",;", ";")
-                    .replace(";;", ";")
-                    .replace(".;", ";")[: -len(", ")]
-                )
-                key = get_dict_key_from_headings(
-                    last_h2_level_paragraph,
-                    last_h3_level_paragraph,
-                    last_h4_level_paragraph,
-                )
-                last_sentence_for_key = (
-                    sentences_dict[key][-1] if len(sentences_dict[key]) > 0 else ""
-                )
-                if last_sentence_for_key.endswith(":"):
-                    # Concatenate the list elements with the previous sentence which explains the list content,
-                    sentences_dict[key][-1] += " " + list_content_str
-                elif last_element_type == "ul" or last_element_type == "dl":
-                    # The list could already been started with a different ul or dl element,
-                    # in this case we don't support nesting and we simply concatenate
-                    print(
-                        f"WARNING: probably there is a nested list; it will be squashed into a single level, list element content: '{list_content_str}'"
-                    )
-                    sentences_dict[key][-1] += "; " + list_content_str
-                else:
-                    # The list is probably part of an entire section and not introduce with ":",
-                    # so it does worth keeping split
-                    sentences_dict[key].extend(list_content_str.split("; "))
-            else:
-                raise ValueError(f"Tag {element.name} not supported")
-            last_element_type = element.name
-
-    df_content = {"text": []}
-    skip_keys_start = tuple(
-        [skip_section + " - " for skip_section in args.skip_sections]
+    sections_texts = get_page_sections_texts(sentences_dict, args.skip_sections)
+    df = pd.DataFrame(
+        {
+            "text": [text for _, text in sections_texts],
+            "section": [section for section, _ in sections_texts],
+        }
     )
-    for key, key_sentences in sentences_dict.items():
-        if key not in args.skip_sections and key.startswith(skip_keys_start) is False:
-            for key_sentence in key_sentences:
-                if key_sentence != "":
-                    df_content["text"].append(f"{key} - {key_sentence}")
-
-    df = pd.DataFrame.from_dict(df_content)
     print(f"{len(df)} sentences obtained from the page '{args.page_title}'")
 
     os.makedirs(os.path.dirname(args.output_data_filepath), exist_ok=True)
@@ -0,0 +1,173 @@
+"""
+Script to extract the data from many Wikipedia pages using the API, the pages are saved in a single corpus.
+
+The pages are a list of titles or the articles of a category. The extracts are fetched with one request
+per page sent concurrently on a pooled HTTP session, the API responses are cached on disk so the re-runs
+(e.g. after a parser change) don't fetch the pages again. The cached category listings expire after
+--category_cache_ttl_hours, so the pages added to the category are found.
+
+Example with a list of titles:
+    python get_wikipedia_pages.py \
+    --titles "Castelnuovo di Garfagnana" "Barga" "Lucca" \
+    --wikipedia_lang it \
+    --skip_sections "Collegamenti_esterni" "Altri_progetti" "Note" \
+    --output_data_filepath ./rag/data/wiki_it_garfagnana.csv
+
+Example with a category (or a file with one title per line with --titles_filepath):
+    python get_wikipedia_pages.py \
+    --category "Comuni della provincia di Lucca" \
+    --wikipedia_lang it \
+    --output_data_filepath ./rag/data/wiki_it_provincia_lucca.csv
+
+Example against the local mock of the MediaWiki API:
+    python -m benchmarks.fake_mediawiki_server --port 8767
+    python get_wikipedia_pages.py --category "Fake 100" --api_url http://127.0.0.1:8767/w/api.php \
+    --output_data_filepath ./rag/data/wiki_fake.csv
+
+Output format: CSV file with "text", "page_id", "title" and "section" (headings key) columns,
+each row is a sentence.
+"""
+import argparse
+import os
+import time
+
+import pandas as pd
+
+from utils.metrics import add_metrics_arguments, configure_metrics, count, timer
+from utils.wikipedia_utils import (
+    WikipediaClient,
+    fetch_page_extracts,
+    get_api_url,
+    get_category_titles,
+    get_page_sections_texts,
+    parse_page_html,
+)
+
+
+def do_parsing():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description="Extract text from many Wikipedia pages and save them to a single CSV",
+    )
+    titles_group = parser.add_mutually_exclusive_group(required=True)
+    titles_group.add_argument("--titles", nargs="+", type=str, help="Wikipedia page titles")
+    titles_group.add_argument(
+        "--titles_filepath", type=str, help="Text file with one Wikipedia page title per line"
+    )
+    titles_group.add_argument(
+        "--category", type=str, help="Wikipedia category, its articles are extracted"
+    )
+    parser.add_argument(
+        "--wikipedia_lang",
+        required=False,
+        default="en",
+        help="Wikipedia site language, language code to build the url, <wikipedia_lang>.wikipedia.org",
+    )
+    parser.add_argument(
+        "--api_url",
+        required=False,
+        type=str,
+        help="MediaWiki API url overriding the Wikipedia one, "
+        "e.g. http://127.0.0.1:8767/w/api.php of benchmarks/fake_mediawiki_server.py",
+    )
+    parser.add_argument(
+        "--output_data_filepath",
+        required=True,
+        type=str,
+        help="Output text dataset in CSV format, e.g. ./rag/data/wiki_pages_data.csv",
+    )
+    parser.add_argument(
+        "--skip_sections",
+        required=False,
+        default=[],
+        nargs="+",
+        type=str,
+        help="Section names to skip",
+    )
+    parser.add_argument(
+        "--max_concurrent_requests",
+        required=False,
+        type=int,
+        default=4,
+        help="Maximum number of API requests in flight",
+    )
+    parser.add_argument(
+        "--http_cache_dirpath",
+        required=False,
+        type=str,
+        default="./rag/data/wikipedia_http_cache",
+        help="Directory of the cached API responses",
+    )
+    parser.add_argument(
+        "--http_cache_ttl_hours",
+        required=False,
+        type=float,
+        help="Lifetime of the cached page extracts, they are kept forever when not passed",
+    )
+    parser.add_argument(
+        "--category_cache_ttl_hours",
+        required=False,
+        type=float,
+        default=24,
+        help="Lifetime of the cached category listings",
+    )
+    parser.add_argument(
+        "--no_http_cache",
+        action="store_true",
+        help="Don't read or write the cached API responses",
+    )
+    add_metrics_arguments(parser)
+    return parser.parse_args()
+
+
+def main():
+    args = do_parsing()
+    print(args)
+    configure_metrics(args)
+
+    client = WikipediaClient(
+        get_api_url(args.wikipedia_lang, args.api_url),
+        cache_dirpath=None if args.no_http_cache else args.http_cache_dirpath,
+        max_concurrent_requests=args.max_concurrent_requests,
+        cache_ttl_s=None if args.http_cache_ttl_hours is None else args.http_cache_ttl_hours * 3600,
+        listing_cache_ttl_s=args.category_cache_ttl_hours * 3600,
+    )
+
+    if args.category:
+        titles = get_category_titles(client, args.category)
+        print(f"{len(titles)} pages found in the category '{args.category}'")
+    elif args.titles_filepath:
+        with open(args.titles_filepath, "r") as in_fp:
+            titles = [line.strip() for line in in_fp if line.strip()]
+    else:
+        titles = args.titles
+
+    start = time.perf_counter()
+    pages = fetch_page_extracts(client, titles)
+    print(f"{len(pages)} pages fetched in {time.perf_counter() - start:.2f} s")
+
+    df_content = {"text": [], "page_id": [], "title": [], "section": []}
+    for page_dict in pages:
+        try:
+            with timer("html_parsing"):
+                sentences_dict = parse_page_html(page_dict["extract"], page_dict["title"])
+        except ValueError as error:
+            print(f"WARNING: page '{page_dict['title']}' skipped: {error}")
+            count("skipped_pages")
+            continue
+        sections_texts = get_page_sections_texts(sentences_dict, args.skip_sections)
+        df_content["text"].extend([text for _, text in sections_texts])
+        df_content["page_id"].extend([page_dict["pageid"]] * len(sections_texts))
+        df_content["title"].extend([page_dict["title"]] * len(sections_texts))
+        df_content["section"].extend([section for section, _ in sections_texts])
+
+    df = pd.DataFrame.from_dict(df_content)
+    print(f"{len(df)} sentences obtained from {len(pages)} pages")
+
+    os.makedirs(os.path.dirname(args.output_data_filepath), exist_ok=True)
+    df.to_csv(args.output_data_filepath)
+    print(f"CSV file saved to '{args.output_data_filepath}'")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,474 @@
+"""
+Resident query service: load the embeddings once and answer many questions over HTTP
+
+The service avoids reloading the embeddings, the index and the caches for every question:
+- the questions arriving close together are embedded with a single Embedding.create request
+- the embeddings are hot-reloaded when the embedding files change (e.g. after a create_embeddings.py run),
+  the questions in flight complete with the previous embeddings, which are closed after the last one
+
+Start it (run this from the repository root to correctly load the OpenAI key):
+    python query_service.py --input_embeddings ./rag/data/wiki_2022_embeddings --port 8080
+
+Ask a question with answer_question.py as a thin client:
+    python answer_question.py --service_url http://127.0.0.1:8080 --question "Who is the owner of Twitter?"
+
+or with any HTTP client:
+    curl -X POST http://127.0.0.1:8080/answer -d '{"question": "Who is the owner of Twitter?"}'
+
+Endpoints:
+- POST /answer with JSON {"question": "..."}: answers, context row ids and timings.
+  An optional "options" object overrides the service answer settings for the question, e.g.
+  {"question": "...", "options": {"top_k": 20}} (see SERVICE_REQUEST_OPTIONS in answer_question.py)
+  With {"question": "...", "stream": true} the RAG answer chunks are streamed as JSON lines {"token": "..."}
+  followed by a last line {"result": {...}}
+- GET /stats: questions counters, reloads and caches statistics, stage timings and API usage with --metrics
+- GET /health: embeddings version and number of rows
+"""
+import argparse
+import json
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from answer_question import (
+    SERVICE_REQUEST_OPTIONS,
+    add_query_arguments,
+    answer_question,
+    check_embedding_model_name,
+    get_questions_embeddings,
+    get_retriever,
+    open_answer_cache,
+    open_embedding_cache,
+)
+from utils.embedding_cache import EmbeddingCache
+from utils.embedding_store import get_embeddings_version, load_embeddings
+from utils.metrics import METRICS, add_metrics_arguments, configure_metrics, metrics_enabled
+from utils.openai_utils import set_openai_vocareum_key
+from utils.sharded_retrieval import ShardedRetriever
+
+
+class QuestionEmbeddingBatcher:
+    """
+    Collect the questions for up to max_wait_ms (or max_batch_size questions)
+    and embed them with a single request from a background thread
+    """
+
+    def __init__(
+        self,
+        embedding_model_name: str,
+        max_batch_size: int = 100,
+        max_wait_ms: float = 10.0,
+        embedding_cache: Optional[EmbeddingCache] = None,
+    ):
+        self.embedding_model_name = embedding_model_name
+        self.max_batch_size = max_batch_size
+        self.max_wait_s = max_wait_ms / 1000.0
+        self.embedding_cache = embedding_cache
+        self.pending: "queue.Queue[Tuple[str, Future]]" = queue.Queue()
+        self.num_batches = 0
+        self.num_questions = 0
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def embed(self, question: str) -> np.ndarray:
+        """
+        Block until the question embeddings are available
+        """
+        future: Future = Future()
+        self.pending.put((question, future))
+        return future.result()
+
+    def _collect_batch(self) -> List[Tuple[str, Future]]:
+        batch = [self.pending.get()]
+        deadline = time.monotonic() + self.max_wait_s
+        while len(batch) < self.max_batch_size:
+            remaining_s = deadline - time.monotonic()
+            if remaining_s <= 0:
+                break
+            try:
+                batch.append(self.pending.get(timeout=remaining_s))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect_batch()
+            try:
+                embeddings = get_questions_embeddings(
+                    [question for question, _ in batch],
+                    self.embedding_model_name,
+                    request_size=self.max_batch_size,
+                    embedding_cache=self.embedding_cache,
+                )
+            except Exception as error:
+                for _, future in batch:
+                    future.set_exception(error)
+                continue
+            self.num_batches += 1
+            self.num_questions += len(batch)
+            for (_, future), question_embeddings in zip(batch, embeddings):
+                future.set_result(question_embeddings)
+
+    def stats(self) -> dict:
+        return {
+            "batches": self.num_batches,
+            "questions": self.num_questions,
+            "mean_batch_size": self.num_questions / self.num_batches if self.num_batches else 0.0,
+        }
+
+
+class QueryState:
+    """
+    Embeddings, retriever and answer cache of one embeddings version, replaced as a whole on reload.
+    The requests using the state are counted, a replaced state is closed when its last request completes
+    """
+
+    def __init__(self, args: argparse.Namespace):
+        self.version = get_embeddings_version(args.input_embeddings)
+        self.store = load_embeddings(args.input_embeddings)
+        check_embedding_model_name(self.store, args.embedding_model_name)
+        self.retriever = get_retriever(
+            self.store,
+            args.input_embeddings,
+            n_probe=args.n_probe,
+            exact_search=args.exact_search,
+            num_shard_workers=args.num_shard_workers,
+            rescore_factor=args.rescore_factor,
+            retrieval_mode=args.retrieval_mode,
+            lexical_candidates=args.lexical_candidates,
+        )
+        # The answer cache version includes the embeddings version,
+        # the answers of the previous embeddings are invalidated
+        self.answer_cache = open_answer_cache(args)
+        self.active_requests = 0
+        self.retired = False
+        self.closed = False
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            self.active_requests += 1
+
+    def release(self):
+        with self.lock:
+            self.active_requests -= 1
+            close = self.retired and self.active_requests == 0
+        if close:
+            self.close()
+
+    def retire(self):
+        """
+        Mark the state as replaced, it is closed now or when the last request using it completes
+        """
+        with self.lock:
+            self.retired = True
+            close = self.active_requests == 0
+        if close:
+            self.close()
+
+    def close(self):
+        """
+        Close the answer cache connection and stop the worker processes of a sharded store retriever
+        """
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+        if self.answer_cache is not None:
+            self.answer_cache.close()
+        # The hybrid retriever wraps the dense one
+        dense_retriever = getattr(self.retriever, "dense_retriever", self.retriever)
+        if isinstance(dense_retriever, ShardedRetriever):
+            dense_retriever.close()
+
+
+class QueryService:
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.embedding_cache = open_embedding_cache(args)
+        self.batcher = QuestionEmbeddingBatcher(
+            args.embedding_model_name,
+            max_batch_size=args.max_batch_size,
+            max_wait_ms=args.batch_window_ms,
+            embedding_cache=self.embedding_cache,
+        )
+        self.state = QueryState(args)
+        # Makes the read of the current state and its acquire atomic with respect to the swap on reload
+        self.state_lock = threading.Lock()
+        self.counters = {"questions": 0, "errors": 0, "reloads": 0, "failed_reloads": 0}
+        self.counters_lock = threading.Lock()
+        print(f"Loaded {len(self.state.store)} rows from '{args.input_embeddings}'")
+        if args.reload_interval_s > 0:
+            threading.Thread(target=self._watch_embeddings, daemon=True).start()
+
+    def count(self, name: str):
+        with self.counters_lock:
+            self.counters[name] += 1
+
+    @contextmanager
+    def use_state(self) -> Iterator[QueryState]:
+        """
+        The current state, kept open until the end of the with block even if it is replaced meanwhile
+        """
+        with self.state_lock:
+            state = self.state
+            state.acquire()
+        try:
+            yield state
+        finally:
+            state.release()
+
+    def _watch_embeddings(self):
+        """
+        Poll the embedding files and swap the state when they change
+        """
+        while True:
+            time.sleep(self.args.reload_interval_s)
+            try:
+                self.reload()
+            except Exception as error:
+                # E.g. the files are being written, retry at the next check
+                self.count("failed_reloads")
+                print(f"WARNING: embeddings reload failed: {error}")
+
+    def reload(self) -> bool:
+        """
+        Load the embeddings again if their files changed
+
+        Returns:
+            True if the state was replaced
+        """
+        if get_embeddings_version(self.args.input_embeddings) == self.state.version:
+            return False
+        new_state = QueryState(self.args)
+        # The requests in flight keep the previous state, it is closed after the last one
+        with self.state_lock:
+            old_state = self.state
+            self.state = new_state
+        old_state.retire()
+        self.count("reloads")
+        print(f"Reloaded {len(new_state.store)} rows, version {new_state.version[:12]}")
+        return True
+
+    def get_request_args(self, options: dict) -> Tuple[argparse.Namespace, bool]:
+        """
+        The service arguments with the answer settings of the request
+
+        Returns:
+            the arguments and whether they are the service ones (the answer cache is valid only for those)
+        """
+        unknown_options = sorted(set(options) - set(SERVICE_REQUEST_OPTIONS))
+        if unknown_options:
+            raise ValueError(
+                f"Unknown options {unknown_options}, the supported ones are {list(SERVICE_REQUEST_OPTIONS)}"
+            )
+        request_args = vars(self.args).copy()
+        for name, value in options.items():
+            service_value = getattr(self.args, name)
+            if isinstance(service_value, bool) and not isinstance(value, bool):
+                raise ValueError(f"Option {name} must be a boolean")
+            request_args[name] = type(service_value)(value)
+        is_service_args = all(request_args[name] == getattr(self.args, name) for name in options)
+        return argparse.Namespace(**request_args), is_service_args
+
+    def answer(
+        self,
+        question: str,
+        on_rag_token: Optional[Callable[[str], None]] = None,
+        request_args: Optional[argparse.Namespace] = None,
+    ) -> dict:
+        """
+        Args:
+            request_args: answer settings of the question (see get_request_args), the service ones if None.
+                The answer cache is used only with the service settings
+        """
+        with self.use_state() as state:
+            start = time.perf_counter()
+            question_embeddings = self.batcher.embed(question)
+            embedding_time_s = time.perf_counter() - start
+            result = answer_question(
+                question,
+                question_embeddings,
+                state.store,
+                state.retriever,
+                request_args or self.args,
+                answer_cache=state.answer_cache if request_args is None else None,
+                on_rag_token=on_rag_token,
+            )
+        result["timings"] = {"embedding_s": embedding_time_s, **result["timings"]}
+        result.pop("prompt", None)
+        self.count("questions")
+        return result
+
+    def health(self) -> dict:
+        state = self.state
+        return {"status": "ok", "embeddings_version": state.version, "num_rows": len(state.store)}
+
+    def stats(self) -> dict:
+        with self.counters_lock:
+            stats = dict(self.counters)
+        stats["embedding_batches"] = self.batcher.stats()
+        if self.embedding_cache is not None:
+            stats["embedding_cache"] = self.embedding_cache.stats()
+        with self.use_state() as state:
+            if state.answer_cache is not None:
+                stats["answer_cache"] = state.answer_cache.stats()
+        if metrics_enabled():
+            stats["metrics"] = METRICS.summary()
+        return stats
+
+
+class QueryServiceHandler(BaseHTTPRequestHandler):
+    # Set by make_query_server on the handler subclass
+    service: Optional[QueryService] = None
+    # Needed for the chunked transfer encoding of the streamed answers
+    protocol_version = "HTTP/1.1"
+    # Send each small chunk immediately
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        # The service prints only the reloads and the errors
+        pass
+
+    def send_json(self, status: int, payload: dict):
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.rstrip("/") == "/health":
+            self.send_json(200, self.service.health())
+        elif self.path.rstrip("/") == "/stats":
+            self.send_json(200, self.service.stats())
+        else:
+            self.send_json(404, {"error": f"Unknown path {self.path}"})
+
+    def do_POST(self):
+        if self.path.rstrip("/") != "/answer":
+            self.send_json(404, {"error": f"Unknown path {self.path}"})
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            question = request["question"]
+        except (ValueError, KeyError):
+            self.send_json(400, {"error": "Expected a JSON body with a 'question' field"})
+            return
+        try:
+            request_args, is_service_args = self.service.get_request_args(request.get("options") or {})
+        except (TypeError, ValueError) as error:
+            self.send_json(400, {"error": str(error)})
+            return
+        if is_service_args:
+            request_args = None
+        if request.get("stream"):
+            self.stream_answer(question, request_args)
+            return
+        try:
+            self.send_json(200, self.service.answer(question, request_args=request_args))
+        except Exception as error:
+            self.service.count("errors")
+            print(f"ERROR: {type(error).__name__}: {error}")
+            self.send_json(500, {"error": f"{type(error).__name__}: {error}"})
+
+    def write_json_line(self, payload: dict):
+        # One HTTP chunk per line, so the client reads each line as soon as it is sent
+        line = (json.dumps(payload, ensure_ascii=False) + "\n").encode("utf-8")
+        self.wfile.write(f"{len(line):x}\r\n".encode("ascii") + line + b"\r\n")
+        self.wfile.flush()
+
+    def stream_answer(self, question: str, request_args: Optional[argparse.Namespace] = None):
+        """
+        JSON lines response with chunked transfer encoding:
+        {"token": ...} for each RAG answer chunk, then {"result": ...} with the full answer
+        """
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        try:
+            result = self.service.answer(
+                question,
+                on_rag_token=lambda token: self.write_json_line({"token": token}),
+                request_args=request_args,
+            )
+            self.write_json_line({"result": result})
+        except Exception as error:
+            self.service.count("errors")
+            print(f"ERROR: {type(error).__name__}: {error}")
+            self.write_json_line({"error": f"{type(error).__name__}: {error}"})
+        # Last empty chunk
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+
+def make_query_server(service: QueryService, host: str, port: int) -> ThreadingHTTPServer:
+    handler_class = type("ConfiguredQueryServiceHandler", (QueryServiceHandler,), {"service": service})
+    server = ThreadingHTTPServer((host, port), handler_class)
+    server.daemon_threads = True
+    return server
+
+
+def do_parsing():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description="Resident query service answering questions on text embeddings",
+    )
+    parser.add_argument("--host", required=False, type=str, default="127.0.0.1", help="Host")
+    parser.add_argument("--port", required=False, type=int, default=8080, help="Port")
+    parser.add_argument(
+        "--batch_window_ms",
+        required=False,
+        type=float,
+        default=10.0,
+        help="Time to wait for other questions to embed them with the same request",
+    )
+    parser.add_argument(
+        "--max_batch_size",
+        required=False,
+        type=int,
+        default=100,
+        help="Maximum number of questions embedded with a single request",
+    )
+    parser.add_argument(
+        "--reload_interval_s",
+        required=False,
+        type=float,
+        default=5.0,
+        help="Interval between the checks of the embedding files to hot-reload them, 0 to disable",
+    )
+    add_query_arguments(parser)
+    add_metrics_arguments(parser)
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    args = do_parsing()
+    print(args)
+    configure_metrics(args)
+
+    # Init OpenAI
+    set_openai_vocareum_key()
+
+    service = QueryService(args)
+    server = make_query_server(service, args.host, args.port)
+    print(f"Query service listening on http://{args.host}:{server.server_address[1]}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,42 @@
+"""
+Shared fixtures of the tests, run them from the repository root with:
+    python -m pytest tests
+"""
+import os
+import sys
+
+import pytest
+
+# The scripts and the utils modules are imported from the repository root
+REPOSITORY_DIRPATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPOSITORY_DIRPATH not in sys.path:
+    sys.path.insert(0, REPOSITORY_DIRPATH)
+
+
+@pytest.fixture
+def fake_openai_server(monkeypatch):
+    """
+    Start benchmarks/fake_openai_server.py with the given settings and point the OpenAI client to it
+
+    Returns:
+        a function taking the make_fake_openai_server arguments and returning the running server
+    """
+    import openai
+
+    from benchmarks.fake_openai_server import get_api_base, start_fake_openai_server
+
+    servers = []
+
+    def start(**kwargs):
+        server = start_fake_openai_server(**kwargs)
+        servers.append(server)
+        monkeypatch.setenv("OPENAI_API_BASE", get_api_base(server))
+        monkeypatch.setenv("OPENAI_API_KEY", "fake")
+        monkeypatch.setattr(openai, "api_base", get_api_base(server))
+        monkeypatch.setattr(openai, "api_key", "fake")
+        return server
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,80 @@
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from create_embeddings import build_store_indexes
+from utils.ann_index import IVF_INDEX_FILENAME, IVFIndex
+from utils.embedding_store import get_shard_dirpath, load_embedding_store, save_embedding_store
+from utils.retrieval import ExactRetriever, normalize_rows
+
+
+def save_random_store(store_dirpath: str, num_rows: int, num_shards: int = 1, seed: int = 0):
+    embeddings = normalize_rows(np.random.default_rng(seed).standard_normal((num_rows, 16)))
+    df = pd.DataFrame({"text": [f"row {row_id}" for row_id in range(num_rows)]})
+    save_embedding_store(store_dirpath, df, embeddings, "text-embedding-ada-002", num_shards=num_shards)
+
+
+def get_index_args(store_dirpath: str, ivf_n_lists: int, num_shards: int = 1) -> argparse.Namespace:
+    return argparse.Namespace(
+        output_embeddings_filepath=store_dirpath,
+        ivf_n_lists=ivf_n_lists,
+        num_shards=num_shards,
+        quantization="none",
+        pq_num_subspaces=8,
+        lexical_index=False,
+        lexical_language="multi",
+    )
+
+
+def test_search_batch_matches_search():
+    matrix = normalize_rows(np.random.default_rng(0).standard_normal((2000, 16)))
+    index = IVFIndex.build(matrix, n_lists=16, n_probe=4)
+    queries = normalize_rows(np.random.default_rng(1).standard_normal((20, 16)))
+    indices, scores = index.search_batch(queries, top_k=10)
+    for query, query_indices, query_scores in zip(queries, indices, scores):
+        rows, similarities = index.search(query, 10)
+        np.testing.assert_array_equal(query_indices, rows)
+        np.testing.assert_allclose(query_scores, similarities, atol=1e-6)
+    # All the lists probed: the exact results
+    index.n_probe = index.n_lists
+    indices, _ = index.search_batch(queries, top_k=10)
+    np.testing.assert_array_equal(indices, ExactRetriever(matrix, normalized=True).search_batch(queries, 10)[0])
+
+
+@pytest.mark.parametrize("num_shards", [1, 2])
+def test_index_removed_when_not_rebuilt(tmp_path, num_shards):
+    store_dirpath = str(tmp_path / "store")
+    save_random_store(store_dirpath, 200, num_shards=num_shards)
+    build_store_indexes(get_index_args(store_dirpath, ivf_n_lists=4, num_shards=num_shards))
+    index_dirpaths = (
+        [get_shard_dirpath(store_dirpath, shard_id) for shard_id in range(num_shards)]
+        if num_shards > 1
+        else [store_dirpath]
+    )
+    assert all(os.path.exists(os.path.join(dirpath, IVF_INDEX_FILENAME)) for dirpath in index_dirpaths)
+
+    save_random_store(store_dirpath, 300, num_shards=num_shards, seed=1)
+    build_store_indexes(get_index_args(store_dirpath, ivf_n_lists=0, num_shards=num_shards))
+    assert not any(os.path.exists(os.path.join(dirpath, IVF_INDEX_FILENAME)) for dirpath in index_dirpaths)
+
+
+def test_load_refuses_an_index_of_other_rows(tmp_path):
+    store_dirpath = str(tmp_path / "store")
+    save_random_store(store_dirpath, 200)
+    build_store_indexes(get_index_args(store_dirpath, ivf_n_lists=4))
+    store = load_embedding_store(store_dirpath)
+    assert len(IVFIndex.load(store_dirpath, store.embeddings)) == 200
+
+    # A different number of rows
+    with pytest.raises(ValueError, match="200 rows"):
+        IVFIndex.load(store_dirpath, store.embeddings[:150])
+    # Same number of rows, the matrix was rewritten after the index was built
+    index_filepath = os.path.join(store_dirpath, IVF_INDEX_FILENAME)
+    os.rename(index_filepath, index_filepath + ".bak")
+    save_random_store(store_dirpath, 200, seed=1)
+    os.rename(index_filepath + ".bak", index_filepath)
+    with pytest.raises(ValueError, match="previous version"):
+        IVFIndex.load(store_dirpath, load_embedding_store(store_dirpath).embeddings)
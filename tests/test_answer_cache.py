@@ -0,0 +1,73 @@
+import numpy as np
+
+from utils.answer_cache import AnswerCache
+
+
+def test_answer_cache_near_duplicate_hit(tmp_path):
+    cache = AnswerCache(str(tmp_path / "answers_cache.sqlite"), corpus_version="v1", similarity_threshold=0.9)
+    cache.put("question", np.array([1.0, 0.0, 0.0]), {"answer": "yes"})
+    answer = cache.get(np.array([1.0, 0.1, 0.0]))
+    assert answer["answer"] == "yes"
+    assert answer["cached_question"] == "question"
+    assert cache.get(np.array([0.0, 1.0, 0.0])) is None
+    cache.close()
+
+    # A different corpus version invalidates the entries
+    cache = AnswerCache(str(tmp_path / "answers_cache.sqlite"), corpus_version="v2", similarity_threshold=0.9)
+    assert cache.stats()["invalidated"] == 1
+    assert cache.get(np.array([1.0, 0.0, 0.0])) is None
+    cache.close()
+
+
+def test_answer_cache_settings_share_the_file(tmp_path):
+    cache_filepath = str(tmp_path / "answers_cache.sqlite")
+    first = AnswerCache(cache_filepath, corpus_version="v1", settings_version="top_k=5", similarity_threshold=0.9)
+    first.put("question", np.array([1.0, 0.0, 0.0]), {"answer": "top 5"})
+    # Other settings on the same corpus: the entries are kept but not read
+    second = AnswerCache(cache_filepath, corpus_version="v1", settings_version="top_k=9", similarity_threshold=0.9)
+    assert second.stats()["invalidated"] == 0
+    assert second.get(np.array([1.0, 0.0, 0.0])) is None
+    second.put("question", np.array([1.0, 0.0, 0.0]), {"answer": "top 9"})
+    assert first.get(np.array([1.0, 0.0, 0.0]))["answer"] == "top 5"
+    assert second.get(np.array([1.0, 0.0, 0.0]))["answer"] == "top 9"
+    first.close()
+    second.close()
+
+    # A new embeddings version invalidates the entries of all the settings
+    cache = AnswerCache(cache_filepath, corpus_version="v2", settings_version="top_k=5", similarity_threshold=0.9)
+    assert cache.stats()["invalidated"] == 2
+    cache.close()
+
+
+def test_answer_cache_skips_expired_best_match(tmp_path):
+    cache = AnswerCache(str(tmp_path / "answers_cache.sqlite"), corpus_version="v1", similarity_threshold=0.9)
+    cache.put("old question", np.array([1.0, 0.0, 0.0]), {"answer": "old"})
+    cache.put("new question", np.array([1.0, 0.2, 0.0]), {"answer": "new"})
+    cache.connection.execute("UPDATE answers SET created_at = 0 WHERE question = 'old question'")
+    answer = cache.get(np.array([1.0, 0.0, 0.0]))
+    assert answer["answer"] == "new"
+    assert cache.stats()["expired"] == 1
+    assert cache.stats()["entries"] == 1
+    cache.close()
+
+
+def test_answer_cache_growth_and_eviction(tmp_path):
+    rng = np.random.default_rng(0)
+    embeddings = rng.standard_normal((100, 8))
+    cache = AnswerCache(
+        str(tmp_path / "answers_cache.sqlite"), corpus_version="v1", similarity_threshold=0.999, max_entries=60
+    )
+    for i, question_embeddings in enumerate(embeddings):
+        cache.put(f"question {i}", question_embeddings, {"answer": str(i)})
+    assert cache.stats()["entries"] == 60
+    assert cache.stats()["evicted"] == 40
+    # The last entries are kept, whatever their position in the buffer
+    for i in range(40, 100):
+        assert cache.get(embeddings[i])["answer"] == str(i)
+    assert cache.get(embeddings[0]) is None
+    cache.close()
+
+    # The entries are loaded again from the SQLite file
+    cache = AnswerCache(str(tmp_path / "answers_cache.sqlite"), corpus_version="v1", similarity_threshold=0.999)
+    assert cache.get(embeddings[99])["answer"] == "99"
+    cache.close()
@@ -0,0 +1,9 @@
+from answer_question import RAGAnswerPrinter
+
+
+def test_rag_answer_printer_strips_the_leading_whitespace(capsys):
+    printer = RAGAnswerPrinter()
+    for token in ("\n\n", " Elon", " Musk"):
+        printer(token)
+    assert capsys.readouterr().out == "RAG answer: Elon Musk"
+    assert printer.started
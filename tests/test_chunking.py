@@ -0,0 +1,30 @@
+from utils.chunking import add_section_prefix, chunk_rows, split_section_prefix
+
+
+def test_split_and_add_section_prefix_round_trip():
+    for text, section in [
+        ("Storia - Il borgo è citato per la prima volta nel XII secolo.", None),
+        ("1 gennaio – La Croazia entra nell'eurozona.", None),
+        ("Storia - Età_moderna - Nel XVI secolo il paese contava tre parrocchie.", "Storia - Età_moderna"),
+        ("Una frase senza prefisso.", None),
+    ]:
+        prefix, separator, sentence = split_section_prefix(text, section)
+        assert add_section_prefix(prefix, sentence, separator) == text
+    assert split_section_prefix("1 gennaio – Evento.") == ("1 gennaio", " – ", "Evento.")
+
+
+def test_chunk_rows_keeps_the_en_dash_separator():
+    texts = [
+        "1 gennaio – La Croazia entra nell'eurozona.",
+        "1 gennaio – La Croazia entra nello spazio Schengen.",
+        "2 gennaio – Un altro evento.",
+    ]
+    chunks = chunk_rows(texts, row_ids=[0, 1, 2], groups=[0, 0, 0], chunk_tokens=64)
+    assert [chunk["text"] for chunk in chunks] == [
+        "1 gennaio – La Croazia entra nell'eurozona. La Croazia entra nello spazio Schengen.",
+        "2 gennaio – Un altro evento.",
+    ]
+    assert [chunk["source_rows"] for chunk in chunks] == [[0, 1], [2]]
+    # A single row chunk is the row text itself, the embeddings cache keys don't change
+    chunks = chunk_rows(texts[2:], row_ids=[2], groups=[0], chunk_tokens=64)
+    assert chunks[0]["text"] == texts[2]
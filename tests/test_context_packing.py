@@ -0,0 +1,65 @@
+import numpy as np
+import pytest
+
+import utils.context_packing
+from utils.context_packing import count_prefix_tokens, pack_context, pack_grouped_context
+from utils.openai_utils import count_tokens, count_tokens_batch
+
+# Wikipedia rows: the headings keys contain the " - " separator too
+TEXTS = [
+    "Storia - Età_moderna - Nel XVI secolo il paese contava tre parrocchie.",
+    "Storia - Il_Novecento - Durante la seconda guerra mondiale il paese si trovava lungo la Linea Gotica.",
+    "Storia - Età_moderna - Nel Seicento fu costruita la chiesa di San Michele.",
+    "Il paese sorge sulla riva destra del fiume Serchio.",
+]
+SECTIONS = ["Storia - Età_moderna", "Storia - Il_Novecento", "Storia - Età_moderna", None]
+
+
+def test_pack_context_modes():
+    assert pack_context([5, 10, 3], budget=15, mode="truncate") == [0, 1]
+    assert pack_context([5, 20, 3], budget=15, mode="truncate") == [0]
+    assert pack_context([5, 20, 3], budget=15, mode="fill") == [0, 2]
+    with pytest.raises(ValueError):
+        pack_context([5], budget=15, mode="other")
+
+
+def test_count_prefix_tokens():
+    prefix_token_counts = count_prefix_tokens(TEXTS, SECTIONS)
+    assert prefix_token_counts[0] == prefix_token_counts[2] == count_tokens("Storia - Età_moderna - ")
+    assert prefix_token_counts[1] == count_tokens("Storia - Il_Novecento - ")
+    assert prefix_token_counts[3] == 0
+    # Without the sections the prefix is the text before the first separator
+    assert count_prefix_tokens(TEXTS)[0] == count_tokens("Storia - ")
+
+
+def test_pack_grouped_context_uses_the_sections():
+    token_counts = np.array(count_tokens_batch(TEXTS))
+    blocks, positions = pack_grouped_context(TEXTS, token_counts, budget=10**6, sections=SECTIONS)
+    assert positions == [0, 1, 2, 3]
+    assert blocks == [
+        "Storia - Età_moderna:\nNel XVI secolo il paese contava tre parrocchie.\n"
+        "Nel Seicento fu costruita la chiesa di San Michele.",
+        TEXTS[1],
+        TEXTS[3],
+    ]
+    # Without the sections all the rows of the "Storia" subsections are in the same group
+    blocks, _ = pack_grouped_context(TEXTS, token_counts, budget=10**6)
+    assert blocks[0].startswith("Storia:\nEtà_moderna - Nel XVI secolo")
+
+
+def test_pack_grouped_context_precomputed_prefix_tokens(monkeypatch):
+    token_counts = np.array(count_tokens_batch(TEXTS))
+    prefix_token_counts = np.array(count_prefix_tokens(TEXTS, SECTIONS))
+    expected = pack_grouped_context(TEXTS, token_counts, budget=40, sections=SECTIONS)
+
+    def fail(text):
+        raise AssertionError(f"'{text}' tokenized at query time")
+
+    # With the precomputed counts no prefix is tokenized while packing
+    monkeypatch.setattr(utils.context_packing, "count_tokens", fail)
+    assert (
+        pack_grouped_context(
+            TEXTS, token_counts, budget=40, sections=SECTIONS, prefix_token_counts=prefix_token_counts
+        )
+        == expected
+    )
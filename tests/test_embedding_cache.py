@@ -0,0 +1,60 @@
+import time
+
+import numpy as np
+
+from utils.embedding_cache import EmbeddingCache
+
+MODEL_NAME = "text-embedding-ada-002"
+
+
+def test_embedding_cache_hits_and_persistence(tmp_path):
+    cache_filepath = str(tmp_path / "embeddings_cache.sqlite")
+    cache = EmbeddingCache(cache_filepath)
+    vectors = np.arange(8, dtype=np.float32).reshape(2, 4)
+    cache.put_many(MODEL_NAME, ["first", "second"], vectors)
+    results = cache.get_many(MODEL_NAME, ["first", "missing", "second"])
+    np.testing.assert_array_equal(results[0], vectors[0])
+    assert results[1] is None
+    np.testing.assert_array_equal(results[2], vectors[1])
+    assert cache.get("other-model", "first") is None
+    cache.close()
+
+    # A new process finds the vectors on disk
+    cache = EmbeddingCache(cache_filepath)
+    np.testing.assert_array_equal(cache.get(MODEL_NAME, "second"), vectors[1])
+    assert cache.stats()["disk_hits"] == 1
+    cache.close()
+
+
+def test_embedding_cache_memory_hits_refresh_disk_access(tmp_path):
+    vector = np.ones((1, 16), dtype=np.float32)
+    # Room for 3 vectors on disk
+    cache = EmbeddingCache(str(tmp_path / "embeddings_cache.sqlite"), max_disk_bytes=3 * vector.nbytes)
+    for text in ("hot", "cold", "warm"):
+        cache.put_many(MODEL_NAME, [text], vector)
+        time.sleep(0.01)
+    # Served from memory, it must not be the least recently used on disk
+    assert cache.get(MODEL_NAME, "hot") is not None
+    assert cache.stats()["memory_hits"] == 1
+    cache.put_many(MODEL_NAME, ["new"], vector)
+    cache.memory.clear()
+    assert cache.get(MODEL_NAME, "hot") is not None
+    assert cache.get(MODEL_NAME, "cold") is None
+    cache.close()
+
+
+def test_embedding_cache_evicts_down_to_the_low_watermark(tmp_path):
+    vector = np.ones((1, 16), dtype=np.float32)
+    cache = EmbeddingCache(str(tmp_path / "embeddings_cache.sqlite"), max_disk_bytes=20 * vector.nbytes)
+    for i in range(21):
+        cache.put_many(MODEL_NAME, [f"text {i}"], vector)
+    # Over the limit at the 21st vector: the oldest are evicted down to 90% of the limit
+    assert cache.stats()["evicted"] == 3
+    assert cache.stats()["stored"] == 18
+    cache.memory.clear()
+    assert cache.get(MODEL_NAME, "text 2") is None
+    assert cache.get(MODEL_NAME, "text 3") is not None
+    # The next puts fit under the limit without evictions
+    cache.put_many(MODEL_NAME, ["text 21", "text 22"], np.repeat(vector, 2, axis=0))
+    assert cache.stats()["evicted"] == 3
+    cache.close()
@@ -0,0 +1,80 @@
+import numpy as np
+
+from benchmarks.fake_openai_server import count_fake_tokens, get_fake_embedding
+from utils.embedding_extraction import extract_embeddings, make_token_batches
+
+EMBEDDINGS_SIZE = 16
+MODEL_NAME = "text-embedding-ada-002"
+
+
+def make_texts(num_texts: int):
+    return [f"sentence {i} of the test" for i in range(num_texts)]
+
+
+def expected_embeddings(texts):
+    return np.array([get_fake_embedding(text, EMBEDDINGS_SIZE) for text in texts], dtype=np.float32)
+
+
+def test_make_token_batches():
+    assert make_token_batches([3, 3, 3, 10, 1], max_request_tokens=6, max_request_rows=10) == [
+        (0, 2),
+        (2, 3),
+        (3, 4),
+        (4, 5),
+    ]
+    assert make_token_batches([1] * 5, max_request_tokens=100, max_request_rows=2) == [(0, 2), (2, 4), (4, 5)]
+
+
+def test_extract_embeddings_batches_in_order(fake_openai_server):
+    server = fake_openai_server(embeddings_size=EMBEDDINGS_SIZE, latency_ms=5)
+    texts = make_texts(50)
+    embeddings = extract_embeddings(
+        texts,
+        token_counts=[5] * len(texts),
+        embedding_model_name=MODEL_NAME,
+        max_request_tokens=1000,
+        max_request_rows=8,
+        max_concurrent_requests=4,
+    )
+    np.testing.assert_allclose(embeddings, expected_embeddings(texts), atol=1e-6)
+    assert server.RequestHandlerClass.stats["requests"] == 7
+
+
+def test_extract_embeddings_retries_server_errors(fake_openai_server):
+    server = fake_openai_server(embeddings_size=EMBEDDINGS_SIZE, failure_rate=0.3)
+    texts = make_texts(40)
+    embeddings = extract_embeddings(
+        texts,
+        token_counts=[5] * len(texts),
+        embedding_model_name=MODEL_NAME,
+        max_request_rows=2,
+        max_concurrent_requests=4,
+        max_retries=10,
+    )
+    np.testing.assert_allclose(embeddings, expected_embeddings(texts), atol=1e-6)
+    stats = server.RequestHandlerClass.stats
+    assert stats["failed"] > 0
+    assert stats["requests"] == 20 + stats["failed"]
+
+
+def test_extract_embeddings_rate_limits(fake_openai_server):
+    # 600 tokens against a server limit of 570 tokens per minute (refilled at 9.5 tokens/s): the last requests
+    # wait a few seconds, after the server Retry-After without a client limit, on the client with a lower limit
+    texts = [f"word{i} word word word" for i in range(150)]
+    token_counts = [count_fake_tokens([text]) for text in texts]
+    for client_tokens_per_minute in (None, 540):
+        server = fake_openai_server(embeddings_size=EMBEDDINGS_SIZE, tokens_per_minute=570)
+        embeddings = extract_embeddings(
+            texts,
+            token_counts=token_counts,
+            embedding_model_name=MODEL_NAME,
+            max_request_rows=10,
+            max_concurrent_requests=4,
+            tokens_per_minute=client_tokens_per_minute,
+        )
+        np.testing.assert_allclose(embeddings, expected_embeddings(texts), atol=1e-6)
+        rate_limited = server.RequestHandlerClass.stats.get("rate_limited", 0)
+        if client_tokens_per_minute is None:
+            assert rate_limited > 0
+        else:
+            assert rate_limited == 0
@@ -0,0 +1,79 @@
+"""
+create_embeddings.py and answer_question.py run in new processes against the fake OpenAI server
+"""
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from benchmarks.fake_openai_server import get_fake_embedding
+from benchmarks.run_benchmarks import run_script
+from benchmarks.synthetic_data import make_synthetic_texts
+from utils.context_packing import count_prefix_tokens
+from utils.embedding_store import load_embeddings
+from utils.openai_utils import count_tokens_batch
+
+EMBEDDINGS_SIZE = 16
+
+
+def test_scripts_batching_and_caches(tmp_path, fake_openai_server):
+    server = fake_openai_server(embeddings_size=EMBEDDINGS_SIZE, completion_tokens=3)
+    stats = server.RequestHandlerClass.stats
+    env = dict(os.environ)
+
+    row_ids = np.arange(50)
+    texts = make_synthetic_texts(row_ids, row_ids % 10)
+    data_filepath = str(tmp_path / "data.csv")
+    pd.DataFrame({"text": texts}).to_csv(data_filepath)
+    create_args = [
+        "create_embeddings.py",
+        "--input_data_filepath", data_filepath,
+        "--request_size", "10",
+        "--embedding_cache_filepath", str(tmp_path / "embeddings_cache.sqlite"),
+    ]
+    store_dirpath = str(tmp_path / "embeddings")
+    run_script(create_args + ["--output_embeddings_filepath", store_dirpath], env)
+    assert stats["requests"] == 5
+    store = load_embeddings(store_dirpath)
+    assert list(store.texts) == list(texts)
+    np.testing.assert_allclose(
+        store.embeddings[7], get_fake_embedding(texts[7], EMBEDDINGS_SIZE), atol=1e-6
+    )
+    # The token counts of the rows and of their prefixes are saved for the context packing
+    assert store.metadata["n_tokens"].tolist() == count_tokens_batch(list(texts))
+    assert store.metadata["n_prefix_tokens"].tolist() == count_prefix_tokens(list(texts))
+
+    # Same input again: the rows are reused from the previous output
+    run_script(create_args + ["--output_embeddings_filepath", store_dirpath], env)
+    assert stats["requests"] == 5
+    # New output without reuse: the rows are found in the embeddings cache
+    run_script(create_args + ["--output_embeddings_filepath", str(tmp_path / "copy"), "--no_reuse"], env)
+    assert stats["requests"] == 5
+
+    # Batch mode: the unique questions are embedded with a single request, one completion for each question
+    questions_filepath = str(tmp_path / "questions.jsonl")
+    with open(questions_filepath, "w") as out_fp:
+        for i in range(6):
+            out_fp.write(json.dumps({"id": i, "question": texts[i % 3]}) + "\n")
+    answers_filepath = str(tmp_path / "answers.jsonl")
+    run_script(
+        [
+            "answer_question.py",
+            "--questions_file", questions_filepath,
+            "--output_answers_filepath", answers_filepath,
+            "--input_embeddings", store_dirpath,
+            "--embedding_cache_filepath", str(tmp_path / "questions_cache.sqlite"),
+            "--no_answer_cache",
+            "--skip_initial_answer",
+            "--top_k", "5",
+        ],
+        env,
+    )
+    assert stats["requests"] == 5 + 1 + 6
+    assert stats["completions"] == 6
+    with open(answers_filepath, "r") as in_fp:
+        answers = [json.loads(line) for line in in_fp]
+    assert [answer["id"] for answer in answers] == list(range(6))
+    # The question is one of the rows, it is the most similar one
+    assert [answer["context_row_ids"][0] for answer in answers] == [i % 3 for i in range(6)]
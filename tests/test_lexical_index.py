@@ -0,0 +1,57 @@
+import numpy as np
+import pytest
+
+from benchmarks.lexical_retrieval_report import make_place_name, make_synthetic_corpus
+from benchmarks.synthetic_data import make_queries
+from utils.lexical_index import BM25Index, HybridRetriever
+from utils.retrieval import ExactRetriever
+
+TOP_K = 5
+
+
+@pytest.fixture(scope="module")
+def corpus():
+    store = make_synthetic_corpus(500, 32)
+    dense_retriever = ExactRetriever(store.embeddings, normalized=True)
+    queries, source_ids = make_queries(dense_retriever.matrix, 8)
+    return store, dense_retriever, BM25Index.build(store.texts), queries, source_ids
+
+
+def test_prefilter_fills_few_matches_with_dense_rows(corpus):
+    store, dense_retriever, lexical_index, queries, source_ids = corpus
+    retriever = HybridRetriever(dense_retriever, lexical_index, store, mode="prefilter")
+    # The place name of another row matches only that row: it comes first, the dense rows fill the rest
+    other_row = int((source_ids[0] + 1) % len(store))
+    rows, similarities = retriever.search(queries[0], TOP_K, make_place_name(other_row))
+    dense_rows, dense_similarities = dense_retriever.search(queries[0], TOP_K)
+    assert rows[0] == other_row
+    assert similarities[0] == pytest.approx(float(dense_retriever.matrix[other_row] @ queries[0]), abs=1e-5)
+    expected_fill = [row for row in dense_rows.tolist() if row != other_row][: TOP_K - 1]
+    assert rows[1:].tolist() == expected_fill
+    # No keyword matches: the dense results
+    rows, similarities = retriever.search(queries[0], TOP_K, "")
+    np.testing.assert_array_equal(rows, dense_rows)
+    np.testing.assert_allclose(similarities, dense_similarities, atol=1e-6)
+
+
+def test_prefilter_scores_only_the_matches(corpus):
+    store, dense_retriever, lexical_index, queries, source_ids = corpus
+    retriever = HybridRetriever(dense_retriever, lexical_index, store, mode="prefilter")
+    # The common words match all the rows, the top_k of all the rows are the dense results
+    rows, _ = retriever.search(queries[0], TOP_K, "synthetic place")
+    np.testing.assert_array_equal(rows, dense_retriever.search(queries[0], TOP_K)[0])
+
+
+@pytest.mark.parametrize("mode", ["prefilter", "hybrid"])
+def test_search_batch_matches_search(corpus, mode):
+    store, dense_retriever, lexical_index, queries, source_ids = corpus
+    retriever = HybridRetriever(dense_retriever, lexical_index, store, mode=mode, num_candidates=20)
+    # Rare keywords, common keywords and no keywords
+    query_texts = [make_place_name(int(source_id)) for source_id in source_ids[:4]]
+    query_texts += ["synthetic place", "", "unknown words", make_place_name(3)]
+    indices, scores = retriever.search_batch(queries, TOP_K, query_texts)
+    assert indices.shape == (len(queries), TOP_K)
+    for i, (query, query_text) in enumerate(zip(queries, query_texts)):
+        rows, similarities = retriever.search(query, TOP_K, query_text)
+        np.testing.assert_array_equal(indices[i], rows)
+        np.testing.assert_allclose(scores[i], similarities, atol=1e-6)
@@ -0,0 +1,110 @@
+import sqlite3
+import sys
+import threading
+
+import pandas as pd
+import pytest
+import requests
+
+import answer_question
+import query_service
+from utils.embedding_backends import get_embedding_backend
+from utils.embedding_store import save_embedding_store
+
+MODEL_NAME = "local-hashing-64"
+
+
+def write_store(store_dirpath: str, num_rows: int, num_shards: int = 1):
+    df = pd.DataFrame({"text": [f"Sentence {i} about the town number {i}" for i in range(num_rows)]})
+    embeddings = get_embedding_backend(MODEL_NAME).embed(df["text"].tolist())
+    save_embedding_store(store_dirpath, df, embeddings, MODEL_NAME, num_shards=num_shards)
+
+
+@pytest.fixture
+def service(tmp_path, monkeypatch, fake_openai_server):
+    fake_openai_server(completion_tokens=5)
+    store_dirpath = str(tmp_path / "embeddings")
+    write_store(store_dirpath, num_rows=20, num_shards=2)
+    monkeypatch.setattr(
+        sys,
+        "argv",
+        [
+            "query_service.py",
+            "--input_embeddings", store_dirpath,
+            "--embedding_model_name", MODEL_NAME,
+            "--embedding_cache_filepath", str(tmp_path / "embeddings_cache.sqlite"),
+            "--answer_cache_filepath", str(tmp_path / "answers_cache.sqlite"),
+            "--reload_interval_s", "0",
+            "--num_shard_workers", "1",
+            "--skip_initial_answer",
+        ],
+    )
+    service = query_service.QueryService(query_service.do_parsing())
+    yield service
+    service.state.close()
+
+
+def is_closed(state: query_service.QueryState) -> bool:
+    try:
+        state.answer_cache.connection.execute("SELECT 1")
+    except sqlite3.ProgrammingError:
+        return True
+    return False
+
+
+def test_reload_closes_the_previous_state_after_its_requests(service):
+    first_state = service.state
+    assert not service.reload()
+
+    with service.use_state() as state_in_flight:
+        write_store(service.args.input_embeddings, num_rows=30, num_shards=2)
+        assert service.reload()
+        # The request in flight still uses the previous embeddings
+        assert len(state_in_flight.store) == 20
+        assert not is_closed(first_state)
+    assert is_closed(first_state)
+    assert first_state.retriever.executor._shutdown_thread
+
+    second_state = service.state
+    assert len(second_state.store) == 30
+    write_store(service.args.input_embeddings, num_rows=40, num_shards=2)
+    # No requests in flight: closed immediately
+    assert service.reload()
+    assert is_closed(second_state)
+    assert service.stats()["reloads"] == 2
+
+
+def test_answer_request_options(service):
+    server = query_service.make_query_server(service, "127.0.0.1", 0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    service_url = f"http://127.0.0.1:{server.server_address[1]}"
+    try:
+        result = answer_question.ask_service(service_url, "Sentence 3 about the town", options={"top_k": 2})
+        assert len(result["context_row_ids"]) <= 2
+        assert result["context_row_ids"][0] == 3
+        # Streamed, with the service settings
+        tokens = []
+        result = answer_question.ask_service(service_url, "Sentence 3 about the town", on_token=tokens.append)
+        assert "".join(tokens).strip() == result["rag_answer"]
+
+        response = requests.post(f"{service_url}/answer", json={"question": "?", "options": {"n_probe": 1}})
+        assert response.status_code == 400
+        response = requests.post(
+            f"{service_url}/answer", json={"question": "?", "options": {"skip_initial_answer": "no"}}
+        )
+        assert response.status_code == 400
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_service_client_rejects_service_arguments(monkeypatch):
+    monkeypatch.setattr(
+        sys, "argv", ["answer_question.py", "--service_url", "http://127.0.0.1:1", "--question", "?", "--top_k", "5"]
+    )
+    assert answer_question.do_parsing().top_k == 5
+    monkeypatch.setattr(
+        sys, "argv", ["answer_question.py", "--service_url", "http://127.0.0.1:1", "--question", "?", "--n_probe", "2"]
+    )
+    with pytest.raises(SystemExit):
+        answer_question.do_parsing()
@@ -0,0 +1,39 @@
+"""
+benchmarks/streaming_memory_report.py on small inputs, the peak memory of the streaming mode must stay flat
+"""
+import json
+import os
+import subprocess
+import sys
+
+from benchmarks.run_benchmarks import REPOSITORY_DIRPATH
+
+
+def test_streaming_peak_memory_is_flat(tmp_path):
+    python_path = [REPOSITORY_DIRPATH] + ([os.environ["PYTHONPATH"]] if os.environ.get("PYTHONPATH") else [])
+    # Relative work directory: the report resolves it before running the scripts in the repository root
+    completed = subprocess.run(
+        [
+            sys.executable, "-m", "benchmarks.streaming_memory_report",
+            "--num_rows", "1000", "8000",
+            "--stream_chunk_rows", "250",
+            "--max_concurrent_requests", "1",
+            "--work_dirpath", "work",
+            "--output_report_filepath", "report.json",
+            "--max_stream_rss_growth_mb", "5",
+        ],
+        cwd=str(tmp_path),
+        env=dict(os.environ, PYTHONPATH=os.pathsep.join(python_path)),
+        stdout=subprocess.PIPE,
+        universal_newlines=True,
+    )
+    assert completed.returncode == 0, completed.stdout
+    assert os.path.isdir(tmp_path / "work" / "embeddings_stream")
+    with open(tmp_path / "report.json", "r") as in_fp:
+        report = json.load(in_fp)
+    peak_rss_mb = {(run["mode"], run["num_rows"]): run["peak_rss_mb"] for run in report["runs"]}
+    assert report["stream_rss_growth_mb"] == peak_rss_mb[("stream", 8000)] - peak_rss_mb[("stream", 1000)]
+    assert report["stream_rss_growth_mb"] < 5
+    # The whole input mode holds at least the 7000 more embeddings
+    store_growth_mb = 7000 * report["embeddings_size"] * 4 / 1024**2
+    assert peak_rss_mb[("full", 8000)] - peak_rss_mb[("full", 1000)] > store_growth_mb
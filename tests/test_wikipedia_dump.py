@@ -0,0 +1,90 @@
+"""
+get_wikipedia_dump.py on the sample dump in benchmarks/data
+"""
+import os
+
+import pandas as pd
+import pytest
+
+from benchmarks.run_benchmarks import REPOSITORY_DIRPATH, run_script
+
+SAMPLE_DUMP_FILEPATH = os.path.join(REPOSITORY_DIRPATH, "benchmarks", "data", "sample-pages-articles.xml.bz2")
+
+EXPECTED_SENTENCES = [
+    (
+        1001,
+        "Borgo di Prova",
+        "Borgo di Prova - Borgo di Prova è un comune italiano di 1 520 abitanti della provincia di Lucca, "
+        "in Toscana.",
+    ),
+    (1001, "Borgo di Prova", "Borgo di Prova - Il paese sorge sulla riva destra del fiume Serchio."),
+    (1001, "Storia", "Storia - Il borgo è citato per la prima volta in un documento del XII secolo."),
+    (1001, "Storia", "Storia - Nel Trecento passò sotto il dominio di Lucca."),
+    (
+        1001,
+        "Storia - Età_moderna",
+        "Storia - Età_moderna - Nel XVI secolo il paese contava tre parrocchie: San Michele; San Pietro; "
+        "Santa Maria",
+    ),
+    (
+        1001,
+        "Storia - Età_moderna - Il_Novecento",
+        "Storia - Età_moderna - Il_Novecento - Durante la seconda guerra mondiale il paese si trovava lungo "
+        "la Linea Gotica.",
+    ),
+    # The nested list is squashed into a single level, the table is skipped
+    (
+        1001,
+        "Geografia",
+        "Geografia - Le frazioni sono: Colle Colle di Sopra; Piano; Clima; temperato; Altitudine; 300 m",
+    ),
+    (1001, "Collegamenti_esterni", "Collegamenti_esterni - Sito ufficiale"),
+    (
+        1004,
+        "Torrente Esempio",
+        "Torrente Esempio - Il Torrente Esempio è un corso d'acqua della Garfagnana, affluente del Serchio.",
+    ),
+    (
+        1004,
+        "Percorso",
+        "Percorso - Nasce dalle Alpi Apuane a 1 200 m di altitudine e dopo 14 km si getta nel Serchio.",
+    ),
+]
+
+
+@pytest.mark.parametrize("num_workers", [0, 2])
+def test_sample_dump(tmp_path, num_workers):
+    output_filepath = str(tmp_path / "wiki_sample_dump.csv")
+    run_script(
+        [
+            "get_wikipedia_dump.py",
+            "--dump_filepath", SAMPLE_DUMP_FILEPATH,
+            "--output_data_filepath", output_filepath,
+            "--num_workers", str(num_workers),
+            "--pages_per_task", "1",
+        ],
+        dict(os.environ),
+    )
+    df = pd.read_csv(output_filepath, index_col=0)
+    assert list(df.columns) == ["text", "page_id", "title", "section"]
+    assert list(df.index) == list(range(10))
+    assert list(zip(df["page_id"], df["section"], df["text"])) == EXPECTED_SENTENCES
+    assert list(df["title"].unique()) == ["Borgo di Prova", "Torrente Esempio"]
+
+
+def test_sample_dump_skip_sections_and_max_pages(tmp_path):
+    output_filepath = str(tmp_path / "wiki_sample_dump.csv")
+    run_script(
+        [
+            "get_wikipedia_dump.py",
+            "--dump_filepath", SAMPLE_DUMP_FILEPATH,
+            "--output_data_filepath", output_filepath,
+            "--num_workers", "0",
+            "--skip_sections", "Collegamenti_esterni", "Storia",
+            "--max_pages", "1",
+        ],
+        dict(os.environ),
+    )
+    df = pd.read_csv(output_filepath, index_col=0)
+    assert set(df["page_id"]) == {1001}
+    assert list(df["section"]) == ["Borgo di Prova", "Borgo di Prova", "Geografia"]
@@ -0,0 +1,97 @@
+"""
+Golden comparison of the streaming sectionizer (utils/wikipedia_sectionizer.py) with the BeautifulSoup
+parser it replaced (parse_page_html_reference of benchmarks/sectionizer_report.py)
+"""
+import pytest
+
+from benchmarks.fake_mediawiki_server import make_fake_page_html
+from benchmarks.sectionizer_report import parse_page_html_reference
+from utils.wikipedia_utils import get_page_texts, parse_page_html
+
+# Corner cases of the real extracts: entities, inline tags, nested lists, definition lists,
+# consecutive lists, lists before the first heading, comments, void elements and unclosed tags
+CORNER_CASES_PAGES = {
+    "Entities and inline tags": (
+        "<p><b>Barga</b> is a <a href=\"/wiki/Comune\">comune</a> &amp; town&nbsp;in Tuscany.\n"
+        "It has 10&#160;000 inhabitants.</p>\n"
+        '<h2 data-mw-anchor="History">History</h2>\n'
+        "<p>\n  The castle<!-- a comment --> was built in the <i>XI</i> century.<br>It was restored.\n</p>"
+    ),
+    "Lists": (
+        "<p>Intro:</p><ul><li>one</li><li>two</li></ul>\n"
+        '<h2 data-mw-anchor="Geography">Geography</h2>\n'
+        "<p>The frazioni are:</p>\n"
+        "<ul><li>Albiano,</li>\n<li>Catagnana;</li><li>Fornaci.</li></ul>\n"
+        "<ul><li>Ponte all'Ania</li></ul>\n"
+        '<h3 data-mw-anchor="Climate">Climate</h3>\n'
+        "<ul><li>Mild <ul><li>nested item</li></ul></li><li>Rainy</li></ul>\n"
+        "<dl><dt>Term</dt><dd>Definition\non two lines</dd></dl>\n"
+        '<h4 data-mw-anchor="Winter">Winter</h4>\n'
+        "<p>Snow.</p><ul></ul>"
+    ),
+    "Unclosed tags": (
+        '<h2 data-mw-anchor="Economy">Economy</h2>\n'
+        "<p>Tourism <b>and industry</p>\n"
+        "<ul><li>first<li>second</ul>\n"
+        "<p>Last paragraph"
+    ),
+}
+
+
+GOLDEN_TEXTS = {
+    "Entities and inline tags": [
+        "Entities and inline tags - Barga is a comune & town in Tuscany. It has 10 000 inhabitants.",
+        "History - The castle was built in the XI century.It was restored.",
+    ],
+    "Lists": [
+        "Lists - Intro:",
+        "None - one",
+        "None - two",
+        "Geography - The frazioni are: Albiano; Catagnana; Fornaci; Ponte all'Ania",
+        "Geography - Climate - Mild nested item",
+        "Geography - Climate - Rainy; Term; Definition on two lines",
+        "Geography - Climate - Winter - Snow.",
+    ],
+    "Unclosed tags": [
+        "Economy - Tourism and industry",
+        "Economy - firstsecond",
+        "Economy - Last paragraph",
+    ],
+}
+
+
+def run_parser(parse_fn, html_text: str, title: str):
+    """
+    Returns:
+        the page texts or the error message
+    """
+    try:
+        return get_page_texts(parse_fn(html_text, title), skip_sections=[])
+    except (ValueError, KeyError) as error:
+        return f"{type(error).__name__}: {error}"
+
+
+@pytest.mark.parametrize("title", list(CORNER_CASES_PAGES))
+def test_corner_cases_golden(title):
+    html_text = CORNER_CASES_PAGES[title]
+    assert run_parser(parse_page_html, html_text, title) == GOLDEN_TEXTS[title]
+    assert run_parser(parse_page_html_reference, html_text, title) == GOLDEN_TEXTS[title]
+
+
+@pytest.mark.parametrize("num_sections,paragraphs_per_section", [(0, 0), (1, 1), (5, 3), (10, 50)])
+def test_fake_pages_match_the_reference(num_sections, paragraphs_per_section):
+    for i in range(5):
+        title = f"Fake page {i}"
+        html_text = make_fake_page_html(
+            title, num_sections=num_sections, paragraphs_per_section=paragraphs_per_section
+        )
+        assert run_parser(parse_page_html, html_text, title) == run_parser(
+            parse_page_html_reference, html_text, title
+        )
+
+
+def test_list_inside_paragraph_errors_match():
+    html_text = '<h2 data-mw-anchor="A">A</h2><p>Text <ul><li>item</li></ul></p>'
+    assert run_parser(parse_page_html, html_text, "Page") == run_parser(
+        parse_page_html_reference, html_text, "Page"
+    )
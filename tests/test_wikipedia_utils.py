@@ -0,0 +1,54 @@
+import os
+import time
+
+import pytest
+
+from benchmarks.fake_mediawiki_server import get_api_url, start_fake_mediawiki_server
+from utils.wikipedia_utils import WikipediaClient, fetch_page_extracts, get_category_titles, parse_page_html
+
+
+@pytest.fixture
+def fake_mediawiki_server():
+    server = start_fake_mediawiki_server(num_sections=2, paragraphs_per_section=1, category_page_size=50)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_fetch_page_extracts_concurrent_and_cached(tmp_path, fake_mediawiki_server):
+    stats = fake_mediawiki_server.RequestHandlerClass.stats
+    titles = [f"Fake page {i}" for i in range(30)] + ["Missing page", "Fake page 3"]
+    client = WikipediaClient(
+        get_api_url(fake_mediawiki_server), cache_dirpath=str(tmp_path / "cache"), max_concurrent_requests=4
+    )
+    pages = fetch_page_extracts(client, titles)
+    assert [page["title"] for page in pages] == titles[:30]
+    # One request per title, the duplicated title is read from the cache
+    assert stats["requests"] == 31
+    sentences_dict = parse_page_html(pages[0]["extract"], pages[0]["title"])
+    assert "Section_0" in sentences_dict
+    assert "Section_1 - Section_1_details" in sentences_dict
+
+    # A new client on the same cache directory doesn't send requests
+    client = WikipediaClient(get_api_url(fake_mediawiki_server), cache_dirpath=str(tmp_path / "cache"))
+    assert fetch_page_extracts(client, titles) == pages
+    assert stats["requests"] == 31
+
+
+def test_category_listing_cache_expires(tmp_path, fake_mediawiki_server):
+    stats = fake_mediawiki_server.RequestHandlerClass.stats
+    cache_dirpath = str(tmp_path / "cache")
+    client = WikipediaClient(get_api_url(fake_mediawiki_server), cache_dirpath=cache_dirpath)
+    # Paginated by 50 members
+    assert get_category_titles(client, "Fake 120") == [f"Fake page {i}" for i in range(120)]
+    assert stats["requests"] == 3
+    assert len(get_category_titles(client, "Category:Fake 120")) == 120
+    assert stats["requests"] == 3
+
+    # Make the cached listing older than the TTL
+    old_time = time.time() - 2 * client.listing_cache_ttl_s
+    for dirpath, _, filenames in os.walk(cache_dirpath):
+        for filename in filenames:
+            os.utime(os.path.join(dirpath, filename), (old_time, old_time))
+    assert len(get_category_titles(client, "Fake 120")) == 120
+    assert stats["requests"] == 6
@@ -0,0 +1,314 @@
+"""
+Approximate nearest neighbour search with an inverted file index (IVF)
+
+The L2 normalized embeddings are clustered with spherical k-means, each row is assigned to
+the list of its closest centroid. At query time only the rows of the n_probe lists with the
+closest centroids are scored, so the cost depends on n_probe / n_lists instead of the corpus size.
+
+The index is saved next to the embedding store files as ivf_index.npz, with the number of rows and the version
+of the matrix it was built for: loading it for a different matrix raises an error instead of returning wrong rows.
+"""
+import os
+from typing import Optional, Tuple
+
+import numpy as np
+
+from utils.embedding_store import get_matrix_version
+from utils.retrieval import normalize_rows, select_top_k
+
+IVF_INDEX_FILENAME = "ivf_index.npz"
+
+
+def assign_to_centroids(
+    data: np.ndarray, centroids: np.ndarray, chunk_size: int = 65536, spherical: bool = True
+) -> np.ndarray:
+    """
+    Assign each row to the centroid with the highest cosine similarity (normalized rows and centroids)
+    or, when not spherical, to the closest centroid in euclidean distance
+
+    The rows are processed in chunks to keep the similarity matrix small on large corpora.
+    """
+    # argmin ||x - c||^2 = argmax x.c - ||c||^2 / 2
+    half_norms = None if spherical else 0.5 * np.einsum("ij,ij->i", centroids, centroids)
+    assignments = np.empty(len(data), dtype=np.int64)
+    for start in range(0, len(data), chunk_size):
+        chunk = np.asarray(data[start : start + chunk_size], dtype=np.float32)
+        similarities = chunk @ centroids.T
+        if half_norms is not None:
+            similarities -= half_norms
+        assignments[start : start + chunk_size] = np.argmax(similarities, axis=1)
+    return assignments
+
+
+def kmeans(
+    data: np.ndarray,
+    n_clusters: int,
+    n_iter: int = 20,
+    sample_size: Optional[int] = None,
+    seed: int = 0,
+    spherical: bool = True,
+) -> np.ndarray:
+    """
+    Cluster the rows with k-means, spherical k-means maximizes the cosine similarity of L2 normalized rows
+    with the centroids
+
+    Args:
+        data: (num_rows, embeddings_size) matrix, L2 normalized for spherical k-means, it can be memory-mapped
+        n_clusters: number of centroids
+        n_iter: number of k-means iterations
+        sample_size: train on a random sample of rows (all the rows if None)
+        seed: random seed for the initialization and the sampling
+        spherical: normalize the centroids and assign by cosine similarity, otherwise by euclidean distance
+
+    Returns:
+        (n_clusters, embeddings_size) centroids, L2 normalized if spherical
+    """
+    rng = np.random.default_rng(seed)
+    if sample_size is not None and sample_size < len(data):
+        sample_ids = np.sort(rng.choice(len(data), size=sample_size, replace=False))
+        train = np.asarray(data[sample_ids], dtype=np.float32)
+    else:
+        train = np.asarray(data, dtype=np.float32)
+    if n_clusters > len(train):
+        raise ValueError(
+            f"Number of clusters ({n_clusters}) greater than the training rows ({len(train)})"
+        )
+
+    centroids = train[rng.choice(len(train), size=n_clusters, replace=False)].copy()
+    for _ in range(n_iter):
+        assignments = assign_to_centroids(train, centroids, spherical=spherical)
+        counts = np.bincount(assignments, minlength=n_clusters)
+        # Sum the rows of each cluster with a single reduceat over the rows sorted by cluster
+        order = np.argsort(assignments, kind="stable")
+        non_empty = np.flatnonzero(counts)
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])[non_empty]
+        sums = np.zeros_like(centroids)
+        sums[non_empty] = np.add.reduceat(train[order], starts, axis=0)
+        # Empty clusters are re-seeded with random training rows
+        empty = np.flatnonzero(counts == 0)
+        if len(empty) > 0:
+            sums[empty] = train[rng.choice(len(train), size=len(empty), replace=False)]
+            counts[empty] = 1
+        if spherical:
+            centroids = normalize_rows(sums)
+        else:
+            centroids = sums / counts[:, np.newaxis].astype(np.float32)
+    return centroids
+
+
+def spherical_kmeans(
+    data: np.ndarray,
+    n_clusters: int,
+    n_iter: int = 20,
+    sample_size: Optional[int] = None,
+    seed: int = 0,
+) -> np.ndarray:
+    """
+    Cluster L2 normalized rows maximizing the cosine similarity with the centroids
+
+    Returns:
+        (n_clusters, embeddings_size) L2 normalized centroids
+    """
+    return kmeans(data, n_clusters, n_iter=n_iter, sample_size=sample_size, seed=seed, spherical=True)
+
+
+class IVFIndex:
+    """
+    Inverted file index over an L2 normalized embeddings matrix
+    """
+
+    def __init__(
+        self,
+        centroids: np.ndarray,
+        list_offsets: np.ndarray,
+        list_row_ids: np.ndarray,
+        matrix: np.ndarray,
+        n_probe: int = 8,
+    ):
+        """
+        Args:
+            centroids: (n_lists, embeddings_size) L2 normalized centroids
+            list_offsets: (n_lists + 1,) start offset of each list in list_row_ids
+            list_row_ids: row ids sorted by list
+            matrix: L2 normalized embeddings matrix, it can be memory-mapped
+            n_probe: number of lists scored for each query
+        """
+        self.centroids = centroids
+        self.list_offsets = list_offsets
+        self.list_row_ids = list_row_ids
+        self.matrix = matrix
+        self.n_probe = n_probe
+
+    def __len__(self) -> int:
+        return len(self.matrix)
+
+    @property
+    def n_lists(self) -> int:
+        return len(self.centroids)
+
+    @classmethod
+    def build(
+        cls,
+        matrix: np.ndarray,
+        n_lists: int,
+        n_iter: int = 20,
+        train_sample_size: Optional[int] = 100000,
+        n_probe: int = 8,
+        seed: int = 0,
+    ) -> "IVFIndex":
+        """
+        Train the centroids with spherical k-means and assign every row to its list
+        """
+        centroids = spherical_kmeans(
+            matrix,
+            n_clusters=n_lists,
+            n_iter=n_iter,
+            sample_size=train_sample_size,
+            seed=seed,
+        )
+        assignments = assign_to_centroids(matrix, centroids)
+        list_row_ids = np.argsort(assignments, kind="stable")
+        list_offsets = np.zeros(n_lists + 1, dtype=np.int64)
+        list_offsets[1:] = np.cumsum(np.bincount(assignments, minlength=n_lists))
+        return cls(centroids, list_offsets, list_row_ids, matrix, n_probe=n_probe)
+
+    def save(self, store_dirpath: str):
+        index_filepath = os.path.join(store_dirpath, IVF_INDEX_FILENAME)
+        # np.savez adds the .npz extension when missing, keep it in the temporary filename
+        tmp_filepath = index_filepath + ".tmp.npz"
+        np.savez(
+            tmp_filepath,
+            centroids=self.centroids,
+            list_offsets=self.list_offsets,
+            list_row_ids=self.list_row_ids,
+            num_rows=len(self.matrix),
+            matrix_version=get_matrix_version(store_dirpath),
+        )
+        os.replace(tmp_filepath, index_filepath)
+
+    @classmethod
+    def load(cls, store_dirpath: str, matrix: np.ndarray, n_probe: int = 8) -> "IVFIndex":
+        """
+        Raises:
+            ValueError: the index was built for a different number of rows or a different version of the matrix
+        """
+        with np.load(os.path.join(store_dirpath, IVF_INDEX_FILENAME)) as index_data:
+            # The indexes saved before the rows count was stored have one row id for each row
+            num_rows = (
+                int(index_data["num_rows"]) if "num_rows" in index_data.files else len(index_data["list_row_ids"])
+            )
+            matrix_version = str(index_data["matrix_version"]) if "matrix_version" in index_data.files else ""
+            if num_rows != len(matrix):
+                raise ValueError(
+                    f"IVF index of '{store_dirpath}' built for {num_rows} rows, the store has {len(matrix)} rows: "
+                    "rebuild it with create_embeddings.py --ivf_n_lists or use the exact search"
+                )
+            if matrix_version and matrix_version != get_matrix_version(store_dirpath):
+                raise ValueError(
+                    f"IVF index of '{store_dirpath}' built for a previous version of the embeddings: "
+                    "rebuild it with create_embeddings.py --ivf_n_lists or use the exact search"
+                )
+            return cls(
+                centroids=index_data["centroids"],
+                list_offsets=index_data["list_offsets"],
+                list_row_ids=index_data["list_row_ids"],
+                matrix=matrix,
+                n_probe=n_probe,
+            )
+
+
+    def get_candidates(self, query: np.ndarray) -> np.ndarray:
+        """
+        Row ids of the n_probe lists closest to the normalized query
+        """
+        probed_lists, _ = select_top_k(self.centroids @ query, self.n_probe)
+        return np.concatenate(
+            [
+                self.list_row_ids[self.list_offsets[i] : self.list_offsets[i + 1]]
+                for i in probed_lists
+            ]
+        )
+
+    def search(
+        self, query_embeddings: np.ndarray, top_k: int
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Find the rows most similar to one query embeddings vector among the probed lists
+
+        Returns:
+            row indices and cosine similarities, sorted by descending similarity
+        """
+        query = normalize_rows(query_embeddings)
+        # Sorted candidates read the memory-mapped matrix sequentially
+        candidates = np.sort(self.get_candidates(query))
+        positions, scores = select_top_k(self.matrix[candidates] @ query, top_k)
+        return candidates[positions], scores
+
+    def search_batch(
+        self, queries_embeddings: np.ndarray, top_k: int
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Search all the queries together: the centroids are scored with one matrix-matrix product and each
+        probed list is scored once for all the queries probing it. The results are padded with -1 indices
+        (and -inf scores) when the probed lists have less than top_k rows
+
+        Returns:
+            (num_queries, top_k) row indices and cosine similarities
+        """
+        queries = normalize_rows(queries_embeddings)
+        num_queries = len(queries)
+        top_k = min(top_k, len(self.matrix))
+        indices = np.full((num_queries, top_k), -1, dtype=np.int64)
+        scores = np.full((num_queries, top_k), -np.inf, dtype=np.float32)
+        if num_queries == 0 or top_k == 0:
+            return indices, scores
+
+        # Centroid scores of all the queries with one matrix-matrix product
+        probed_lists, _ = select_top_k(queries @ self.centroids.T, self.n_probe)
+        # (query, list) pairs grouped by list: each probed list is scored once for all its queries
+        pair_lists = probed_lists.ravel()
+        pair_queries = np.repeat(np.arange(num_queries), probed_lists.shape[1])
+        order = np.argsort(pair_lists, kind="stable")
+        pair_lists, pair_queries = pair_lists[order], pair_queries[order]
+        group_starts = np.flatnonzero(np.r_[True, pair_lists[1:] != pair_lists[:-1]])
+        group_ends = np.r_[group_starts[1:], len(pair_lists)]
+
+        result_queries, result_rows, result_scores = [], [], []
+        for start, end in zip(group_starts, group_ends):
+            list_id = pair_lists[start]
+            # Sorted rows read the memory-mapped matrix sequentially
+            list_rows = np.sort(self.list_row_ids[self.list_offsets[list_id] : self.list_offsets[list_id + 1]])
+            if len(list_rows) == 0:
+                continue
+            list_queries = pair_queries[start:end]
+            # (number of queries, list rows) scores, only the top_k of each query are kept for the merge
+            positions, list_scores = select_top_k(
+                queries[list_queries] @ np.asarray(self.matrix[list_rows]).T, top_k
+            )
+            result_queries.append(np.repeat(list_queries, positions.shape[1]))
+            result_rows.append(list_rows[positions].ravel())
+            result_scores.append(list_scores.ravel())
+        if not result_queries:
+            return indices, scores
+
+        # Merge the results of the probed lists of each query: sort by query, then by descending score
+        result_queries = np.concatenate(result_queries)
+        result_rows = np.concatenate(result_rows)
+        result_scores = np.concatenate(result_scores)
+        order = np.lexsort((-result_scores, result_queries))
+        result_queries, result_rows, result_scores = (
+            result_queries[order],
+            result_rows[order],
+            result_scores[order],
+        )
+        query_starts = np.searchsorted(result_queries, np.arange(num_queries))
+        ranks = np.arange(len(result_queries)) - query_starts[result_queries]
+        kept = ranks < top_k
+        indices[result_queries[kept], ranks[kept]] = result_rows[kept]
+        scores[result_queries[kept], ranks[kept]] = result_scores[kept]
+        return indices, scores
+
+
+def remove_ivf_index(store_dirpath: str):
+    if os.path.exists(os.path.join(store_dirpath, IVF_INDEX_FILENAME)):
+        os.remove(os.path.join(store_dirpath, IVF_INDEX_FILENAME))
@@ -0,0 +1,231 @@
+"""
+Semantic answer cache for near-duplicate questions
+
+The answers are stored in a SQLite file together with the question embeddings. A new question
+gets the cached answer (and retrieved context) of the most similar cached question when their
+cosine similarity is above a threshold, so rephrased or translated questions don't pay
+for the completions again.
+
+The entries are valid only for the corpus version they were created with: when the embedding
+store changes, the entries of the previous versions are deleted. They are also keyed by the answer
+settings (model, top_k, context size...): the clients with different settings share the file, each one
+reads only its own entries. The entries expire after a TTL and the least recently used are evicted
+above a maximum number of entries in the file.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+import numpy as np
+
+from utils.retrieval import normalize_rows
+
+
+class AnswerCache:
+    def __init__(
+        self,
+        cache_filepath: str,
+        corpus_version: str,
+        settings_version: str = "",
+        similarity_threshold: float = 0.97,
+        ttl_s: Optional[float] = 7 * 24 * 3600,
+        max_entries: int = 10000,
+    ):
+        """
+        Args:
+            cache_filepath: SQLite file, created if it doesn't exist
+            corpus_version: identifier of the embedding store, the entries with a different version are invalidated
+            settings_version: identifier of the answer settings, only the entries with the same settings are read
+            similarity_threshold: minimum cosine similarity between the questions embeddings to reuse an answer
+            ttl_s: entries lifetime in seconds, None to keep them until evicted
+            max_entries: maximum number of entries of all the settings, the least recently used are evicted
+        """
+        if os.path.dirname(cache_filepath):
+            os.makedirs(os.path.dirname(cache_filepath), exist_ok=True)
+        self.corpus_version = corpus_version
+        self.settings_version = settings_version
+        self.similarity_threshold = similarity_threshold
+        self.ttl_s = ttl_s
+        self.max_entries = max_entries
+        self.counters = {"hits": 0, "misses": 0, "expired": 0, "evicted": 0, "invalidated": 0}
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(cache_filepath, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS answers ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, corpus_version TEXT NOT NULL, "
+            "settings_version TEXT NOT NULL DEFAULT '', "
+            "question TEXT NOT NULL, question_embeddings BLOB NOT NULL, answer TEXT NOT NULL, "
+            "created_at REAL NOT NULL, last_access REAL NOT NULL)"
+        )
+        columns = {row[1] for row in self.connection.execute("PRAGMA table_info(answers)").fetchall()}
+        if "settings_version" not in columns:
+            # Cache file created before the entries were keyed by the settings
+            self.connection.execute("ALTER TABLE answers ADD COLUMN settings_version TEXT NOT NULL DEFAULT ''")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS answers_last_access ON answers (last_access)")
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS answers_versions ON answers (corpus_version, settings_version)"
+        )
+        # Invalidate the entries created with a different corpus, the other settings are kept
+        self.counters["invalidated"] = self.connection.execute(
+            "DELETE FROM answers WHERE corpus_version != ?", (corpus_version,)
+        ).rowcount
+        if ttl_s is not None:
+            self.counters["expired"] = self.connection.execute(
+                "DELETE FROM answers WHERE created_at < ?", (time.time() - ttl_s,)
+            ).rowcount
+        self.connection.commit()
+        self.num_rows = self.connection.execute("SELECT COUNT(*) FROM answers").fetchone()[0]
+        self._load_embeddings()
+
+    def _load_embeddings(self):
+        """
+        Keep the normalized questions embeddings in memory to score a question with one matrix-vector product.
+        The embeddings are in a preallocated buffer doubled when full, the first num_entries rows are used
+        """
+        rows = self.connection.execute(
+            "SELECT id, question_embeddings FROM answers WHERE corpus_version = ? AND settings_version = ? "
+            "ORDER BY id",
+            (self.corpus_version, self.settings_version),
+        ).fetchall()
+        self.num_entries = len(rows)
+        self.entry_ids_buffer = np.array([entry_id for entry_id, _ in rows], dtype=np.int64)
+        if rows:
+            self.embeddings_buffer = np.stack(
+                [np.frombuffer(embeddings_bytes, dtype=np.float32) for _, embeddings_bytes in rows]
+            )
+        else:
+            self.embeddings_buffer = None
+
+    @property
+    def entry_ids(self) -> np.ndarray:
+        return self.entry_ids_buffer[: self.num_entries]
+
+    @property
+    def embeddings(self) -> Optional[np.ndarray]:
+        if self.embeddings_buffer is None:
+            return None
+        return self.embeddings_buffer[: self.num_entries]
+
+    def _append(self, entry_id: int, query: np.ndarray):
+        """
+        Add an entry in amortized constant time, the buffers are copied only when their capacity doubles
+        """
+        if self.embeddings_buffer is None:
+            self.embeddings_buffer = np.empty((16, len(query)), dtype=np.float32)
+            self.entry_ids_buffer = np.empty(16, dtype=np.int64)
+        elif self.num_entries == len(self.embeddings_buffer):
+            capacity = 2 * len(self.embeddings_buffer)
+            embeddings_buffer = np.empty((capacity, self.embeddings_buffer.shape[1]), dtype=np.float32)
+            embeddings_buffer[: self.num_entries] = self.embeddings
+            entry_ids_buffer = np.empty(capacity, dtype=np.int64)
+            entry_ids_buffer[: self.num_entries] = self.entry_ids
+            self.embeddings_buffer, self.entry_ids_buffer = embeddings_buffer, entry_ids_buffer
+        self.embeddings_buffer[self.num_entries] = query
+        self.entry_ids_buffer[self.num_entries] = entry_id
+        self.num_entries += 1
+
+    def _delete(self, entry_ids):
+        """
+        Delete the entries from the file, and from memory those of these settings
+        """
+        for entry_id in entry_ids:
+            self.num_rows -= self.connection.execute("DELETE FROM answers WHERE id = ?", (int(entry_id),)).rowcount
+        # Move the last entries in the deleted positions, the order of the entries doesn't matter
+        for position in sorted(np.flatnonzero(np.isin(self.entry_ids, entry_ids)), reverse=True):
+            last = self.num_entries - 1
+            self.embeddings_buffer[position] = self.embeddings_buffer[last]
+            self.entry_ids_buffer[position] = self.entry_ids_buffer[last]
+            self.num_entries -= 1
+
+    def get(self, question_embeddings: np.ndarray) -> Optional[dict]:
+        """
+        Returns:
+            the cached answer dict of the most similar question above the threshold, None otherwise.
+            The expired entries are deleted and the next most similar questions are checked
+        """
+        query = normalize_rows(question_embeddings)
+        with self.lock:
+            if self.num_entries == 0 or self.embeddings.shape[1] != query.shape[0]:
+                self.counters["misses"] += 1
+                return None
+            similarities = self.embeddings @ query
+            candidates = np.flatnonzero(similarities >= self.similarity_threshold)
+            now = time.time()
+            expired_ids = []
+            hit = None
+            for position in candidates[np.argsort(-similarities[candidates], kind="stable")]:
+                entry_id = int(self.entry_ids[position])
+                question, answer_json, created_at = self.connection.execute(
+                    "SELECT question, answer, created_at FROM answers WHERE id = ?", (entry_id,)
+                ).fetchone()
+                if self.ttl_s is not None and now - created_at > self.ttl_s:
+                    expired_ids.append(entry_id)
+                    continue
+                hit = (entry_id, question, answer_json, float(similarities[position]))
+                break
+            if expired_ids:
+                self._delete(expired_ids)
+                self.counters["expired"] += len(expired_ids)
+            if hit is None:
+                self.connection.commit()
+                self.counters["misses"] += 1
+                return None
+            entry_id, question, answer_json, similarity = hit
+            self.connection.execute(
+                "UPDATE answers SET last_access = ? WHERE id = ?", (now, entry_id)
+            )
+            self.connection.commit()
+            self.counters["hits"] += 1
+        answer = json.loads(answer_json)
+        answer["cached_question"] = question
+        answer["cache_similarity"] = similarity
+        return answer
+
+    def put(self, question: str, question_embeddings: np.ndarray, answer: dict):
+        """
+        Cache the answer dict (any JSON serializable content, e.g. answers and retrieved context)
+        """
+        query = normalize_rows(question_embeddings)
+        now = time.time()
+        with self.lock:
+            entry_id = self.connection.execute(
+                "INSERT INTO answers (corpus_version, settings_version, question, question_embeddings, answer, "
+                "created_at, last_access) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    self.corpus_version,
+                    self.settings_version,
+                    question,
+                    query.tobytes(),
+                    json.dumps(answer, ensure_ascii=False),
+                    now,
+                    now,
+                ),
+            ).lastrowid
+            self._append(entry_id, query)
+            self.num_rows += 1
+            num_exceeding = self.num_rows - self.max_entries
+            if num_exceeding > 0:
+                lru_ids = [
+                    entry_id
+                    for entry_id, in self.connection.execute(
+                        "SELECT id FROM answers ORDER BY last_access ASC LIMIT ?", (num_exceeding,)
+                    ).fetchall()
+                ]
+                self._delete(lru_ids)
+                self.counters["evicted"] += len(lru_ids)
+            self.connection.commit()
+
+    def stats(self) -> dict:
+        with self.lock:
+            stats = dict(self.counters)
+            stats["entries"] = self.num_entries
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+        return stats
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,216 @@
+"""
+Token-aware chunking of the sentences rows before the embeddings
+
+The rows of the same page and heading section are processed in order:
+- the short rows are merged with the next ones while the chunk stays within chunk_tokens,
+  the section prefix ("<headings key> - ") is written once at the chunk start
+- the long rows are split at the sentence boundaries in chunks of up to chunk_tokens, consecutive chunks
+  share the last sentences (up to overlap_tokens) so a sentence is never separated from its context.
+  A single sentence longer than a chunk is split by tokens
+
+Each chunk keeps the ids of its source rows.
+"""
+import re
+from typing import Dict, List, Optional, Tuple
+
+from utils.openai_utils import get_tokenizer
+
+# Separator of the heading (or date) prefix and the sentence: " - " of the Wikipedia pages
+# and " – " of the Wikipedia 2022 events
+SECTION_PREFIX_RE = re.compile(r" [-–] ")
+DEFAULT_SEPARATOR = " - "
+SENTENCE_END_RE = re.compile(r"(?<=[.!?;])\s+(?=\S)")
+
+
+def split_section_prefix(text: str, section: Optional[str] = None) -> Tuple[str, str, str]:
+    """
+    Args:
+        text: row text "<section> - <sentence>" (or "<date> – <sentence>")
+        section: the section of the row when known, otherwise the text before the first separator
+
+    Returns:
+        the section (empty if the text has no prefix), the separator found after it (the default " - "
+        when the text doesn't start with the known section) and the sentence
+    """
+    if section:
+        for separator in (" - ", " – "):
+            if text.startswith(section + separator):
+                return section, separator, text[len(section) + len(separator) :]
+        return section, DEFAULT_SEPARATOR, text
+    match = SECTION_PREFIX_RE.search(text)
+    if match is None:
+        return "", DEFAULT_SEPARATOR, text
+    return text[: match.start()], match.group(), text[match.end() :]
+
+
+def add_section_prefix(section: str, text: str, separator: str = DEFAULT_SEPARATOR) -> str:
+    """
+    Inverse of split_section_prefix: pass the separator it returned to rebuild the same text
+    """
+    return f"{section}{separator}{text}" if section else text
+
+
+def split_sentences(text: str) -> List[str]:
+    return [sentence for sentence in SENTENCE_END_RE.split(text) if sentence]
+
+
+def split_long_sentence(
+    sentence_tokens: List[int], max_tokens: int, overlap_tokens: int, encoding: str
+) -> List[str]:
+    """
+    Split a sentence longer than max_tokens in windows of max_tokens tokens with overlap_tokens overlap
+    """
+    tokenizer = get_tokenizer(encoding)
+    step = max(max_tokens - overlap_tokens, 1)
+    return [
+        tokenizer.decode(sentence_tokens[start : start + max_tokens])
+        for start in range(0, max(len(sentence_tokens) - overlap_tokens, 1), step)
+    ]
+
+
+def split_long_text(
+    text: str, max_tokens: int, overlap_tokens: int, encoding: str
+) -> List[Tuple[str, int]]:
+    """
+    Split a text at the sentence boundaries in pieces of up to max_tokens tokens,
+    each piece starts with the last sentences of the previous one up to overlap_tokens
+
+    Returns:
+        (piece, number of tokens) of each piece
+    """
+    tokenizer = get_tokenizer(encoding)
+    sentences = []
+    for sentence in split_sentences(text):
+        sentence_tokens = tokenizer.encode(sentence)
+        if len(sentence_tokens) <= max_tokens:
+            sentences.append((sentence, len(sentence_tokens)))
+        else:
+            sentences.extend(
+                (window, len(tokenizer.encode(window)))
+                for window in split_long_sentence(
+                    sentence_tokens, max_tokens, overlap_tokens, encoding
+                )
+            )
+
+    pieces = []
+    start = 0
+    while start < len(sentences):
+        end = start
+        piece_tokens = 0
+        while end < len(sentences) and (
+            end == start or piece_tokens + 1 + sentences[end][1] <= max_tokens
+        ):
+            piece_tokens += sentences[end][1] + (1 if end > start else 0)
+            end += 1
+        pieces.append((" ".join(sentence for sentence, _ in sentences[start:end]), piece_tokens))
+        if end == len(sentences):
+            break
+        # The next piece starts with the last sentences of this one, at least one new sentence is added
+        overlap_start = end
+        overlap = 0
+        while (
+            overlap_start - 1 > start
+            and overlap + sentences[overlap_start - 1][1] <= overlap_tokens
+        ):
+            overlap_start -= 1
+            overlap += sentences[overlap_start][1]
+        start = overlap_start
+    return pieces
+
+
+def chunk_rows(
+    texts: List[str],
+    row_ids: List,
+    groups: List,
+    sections: Optional[List[Optional[str]]] = None,
+    chunk_tokens: int = 256,
+    overlap_tokens: int = 32,
+    encoding: str = "cl100k_base",
+) -> List[Dict]:
+    """
+    Args:
+        texts: row texts "<section> - <sentence>" in the document order
+        row_ids: id of each row, the chunks refer to them
+        groups: document of each row (e.g. the page id), the chunks never span two documents
+        sections: section of each row, None to take it from the text prefix
+        chunk_tokens: maximum number of tokens of a chunk (a long row is split, short rows are merged)
+        overlap_tokens: tokens repeated at the start of the next chunk when a long row is split
+        encoding: tiktoken encoding of the embedding model
+
+    Returns:
+        one dict for each chunk with "text", "source_rows" (list of row ids), "group" and "section"
+    """
+    tokenizer = get_tokenizer(encoding)
+    sections = sections if sections is not None else [None] * len(texts)
+    rows = [split_section_prefix(text, section) for text, section in zip(texts, sections)]
+    sentences_tokens = [
+        len(tokens) for tokens in tokenizer.encode_batch([sentence for _, _, sentence in rows])
+    ]
+    prefixes_tokens = {}
+
+    chunks = []
+    current = None
+
+    def new_chunk(group, section: str, separator: str) -> dict:
+        return {
+            "group": group,
+            "section": section,
+            "separator": separator,
+            "sentences": [],
+            "source_rows": [],
+            "tokens": 0,
+        }
+
+    def flush():
+        if current is not None and current["sentences"]:
+            chunks.append(
+                {
+                    "text": add_section_prefix(
+                        current["section"], " ".join(current["sentences"]), current["separator"]
+                    ),
+                    "source_rows": current["source_rows"],
+                    "group": current["group"],
+                    "section": current["section"],
+                }
+            )
+
+    for (section, separator, sentence), num_tokens, row_id, group in zip(
+        rows, sentences_tokens, row_ids, groups
+    ):
+        # The separator of the source rows is kept, e.g. the " – " of the 2022 events dates
+        if (section, separator) not in prefixes_tokens:
+            prefixes_tokens[(section, separator)] = len(tokenizer.encode(add_section_prefix(section, "", separator)))
+        # Tokens available for the sentences after the section prefix
+        max_tokens = max(chunk_tokens - prefixes_tokens[(section, separator)], chunk_tokens // 2)
+        if current is None or (current["group"], current["section"], current["separator"]) != (
+            group,
+            section,
+            separator,
+        ):
+            flush()
+            current = new_chunk(group, section, separator)
+
+        if num_tokens > max_tokens:
+            # A long row gets chunks on its own
+            flush()
+            for piece, _ in split_long_text(sentence, max_tokens, overlap_tokens, encoding):
+                chunks.append(
+                    {
+                        "text": add_section_prefix(section, piece, separator),
+                        "source_rows": [row_id],
+                        "group": group,
+                        "section": section,
+                    }
+                )
+            current = new_chunk(group, section, separator)
+            continue
+
+        # The sentences are joined with a space, at most one more token
+        if current["sentences"] and current["tokens"] + 1 + num_tokens > max_tokens:
+            flush()
+            current = new_chunk(group, section, separator)
+        current["tokens"] += num_tokens + (1 if current["sentences"] else 0)
+        current["sentences"].append(sentence)
+        current["source_rows"].append(row_id)
+    flush()
+    return chunks
@@ -0,0 +1,159 @@
+"""
+Context packing with precomputed token counts
+
+create_embeddings.py stores the number of tokens of each row in the "n_tokens" metadata column,
+and the number of tokens of its heading (or date) prefix in the "n_prefix_tokens" column,
+so at query time the context is selected with arithmetic on the counts, without tokenizing the rows again.
+
+Packing modes:
+- truncate: add the rows in relevance order and stop at the first row exceeding the budget
+- fill: skip the rows exceeding the remaining budget and keep filling with the next ones
+
+The rows of the Wikipedia pages start with their headings key ("h2 - h3 - ") and the rows of the 2022 events
+with their date: pack_grouped_context groups the selected rows by this prefix and writes it once for each group,
+dedup_rows drops the rows almost identical to a more relevant one, so more distinct facts fit the same budget.
+"""
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from utils.chunking import add_section_prefix, split_section_prefix
+from utils.openai_utils import count_tokens, count_tokens_batch
+
+TOKEN_COUNT_COLUMN = "n_tokens"
+PREFIX_TOKEN_COUNT_COLUMN = "n_prefix_tokens"
+PACKING_MODES = ("truncate", "fill")
+
+
+def count_prefix_tokens(texts: List[str], sections: Optional[List[Optional[str]]] = None) -> List[int]:
+    """
+    Number of tokens of the "<prefix> - " of each row, each distinct prefix is tokenized once
+
+    Args:
+        texts: row texts "<prefix> - <sentence>"
+        sections: the section of each row when known (e.g. the "section" column of the Wikipedia pages),
+            otherwise the prefix is the text before the first separator
+
+    Returns:
+        the number of tokens of the prefix of each row, 0 for the rows without prefix
+    """
+    sections = sections if sections is not None else [None] * len(texts)
+    prefixes = [split_section_prefix(text, section)[:2] for text, section in zip(texts, sections)]
+    unique_prefixes = list(dict.fromkeys(prefix for prefix in prefixes if prefix[0]))
+    prefixes_tokens = dict(
+        zip(
+            unique_prefixes,
+            count_tokens_batch([add_section_prefix(prefix, "", separator) for prefix, separator in unique_prefixes]),
+        )
+    )
+    return [prefixes_tokens[prefix] if prefix[0] else 0 for prefix in prefixes]
+
+
+def pack_context(token_counts: np.ndarray, budget: int, mode: str = "truncate") -> List[int]:
+    """
+    Select the rows to add to the context
+
+    Args:
+        token_counts: number of tokens of each row, rows sorted by relevance
+        budget: number of tokens available for the context rows
+        mode: "truncate" or "fill"
+
+    Returns:
+        positions of the selected rows, in relevance order
+    """
+    token_counts = np.asarray(token_counts, dtype=np.int64)
+    if mode == "truncate":
+        # Number of rows whose cumulative count fits the budget
+        num_rows = int(np.searchsorted(np.cumsum(token_counts), budget, side="right"))
+        return list(range(num_rows))
+    if mode == "fill":
+        positions = []
+        remaining = budget
+        for position in np.flatnonzero(token_counts <= budget):
+            if token_counts[position] <= remaining:
+                positions.append(int(position))
+                remaining -= token_counts[position]
+        return positions
+    raise ValueError(f"Packing mode {mode} not supported, choose one of {PACKING_MODES}")
+
+
+def dedup_rows(embeddings: np.ndarray, threshold: float) -> List[int]:
+    """
+    Drop the near-duplicate rows, a row is kept when its cosine similarity with every row kept before it
+    is below threshold
+
+    Args:
+        embeddings: L2 normalized embeddings of the rows, rows sorted by relevance
+        threshold: cosine similarity from which a row is a duplicate of a more relevant one
+
+    Returns:
+        positions of the kept rows, in relevance order
+    """
+    similarities = embeddings @ embeddings.T
+    kept_positions = []
+    for position in range(len(embeddings)):
+        if not kept_positions or similarities[position, kept_positions].max() < threshold:
+            kept_positions.append(position)
+    return kept_positions
+
+
+def pack_grouped_context(
+    texts: List[str],
+    token_counts: np.ndarray,
+    budget: int,
+    mode: str = "truncate",
+    sections: Optional[List[Optional[str]]] = None,
+    prefix_token_counts: Optional[np.ndarray] = None,
+) -> Tuple[List[str], List[int]]:
+    """
+    Select the rows like pack_context, with the rows grouped by their heading (or date) prefix:
+    the prefix tokens are counted once for each group instead of once for each row
+
+    Args:
+        texts: row texts "<prefix> - <sentence>", rows sorted by relevance
+        token_counts: number of tokens of each row, prefix included
+        budget: number of tokens available for the context
+        mode: "truncate" or "fill"
+        sections: the section of each row when known, the headings keys contain the separator too
+        prefix_token_counts: number of tokens of the prefix of each row (count_prefix_tokens),
+            the prefixes are tokenized now when missing
+
+    Returns:
+        the context blocks, one for each prefix with the prefix followed by the sentences of its rows,
+        in the order of their most relevant row, and the positions of the selected rows in relevance order
+    """
+    if mode not in PACKING_MODES:
+        raise ValueError(f"Packing mode {mode} not supported, choose one of {PACKING_MODES}")
+    prefixes_tokens = {}
+    # Group key (the prefix, or the position of a row without prefix) -> prefix, separator and sentences
+    groups = {}
+    positions = []
+    remaining = budget
+    for position, (text, num_tokens) in enumerate(zip(texts, token_counts)):
+        prefix, separator, sentence = split_section_prefix(
+            text, sections[position] if sections is not None else None
+        )
+        if prefix not in prefixes_tokens:
+            if prefix_token_counts is not None:
+                prefixes_tokens[prefix] = int(prefix_token_counts[position])
+            else:
+                prefixes_tokens[prefix] = count_tokens(add_section_prefix(prefix, "", separator)) if prefix else 0
+        group_key = prefix if prefix else position
+        row_tokens = max(int(num_tokens) - prefixes_tokens[prefix], 1)
+        if group_key not in groups:
+            row_tokens += prefixes_tokens[prefix]
+        if row_tokens > remaining:
+            if mode == "truncate":
+                break
+            continue
+        remaining -= row_tokens
+        positions.append(position)
+        groups.setdefault(group_key, (prefix, separator, []))[2].append(sentence)
+
+    blocks = []
+    for prefix, separator, sentences in groups.values():
+        if len(sentences) == 1:
+            blocks.append(add_section_prefix(prefix, sentences[0], separator))
+        else:
+            blocks.append(f"{prefix}:\n" + "\n".join(sentences))
+    return blocks, positions
@@ -0,0 +1,133 @@
+"""
+Embedding backends selected by the embedding model name
+
+- OpenAI Embedding API: any model name not matching a local backend, e.g. text-embedding-ada-002
+- local hashing vectorizer "local-hashing-<embeddings size>", e.g. local-hashing-1024: the character 3, 4 and 5-grams
+  of the lowercased text are hashed in the embeddings dimensions with a random sign (feature hashing), the vector
+  is L2 normalized. It runs on the CPU without network and API quotas, it matches texts sharing words and word
+  parts (names, typos, inflections), not synonyms or translations
+
+The backends embed a batch of texts with embed(texts), the batches are sent concurrently by
+utils/embedding_extraction.py: the numpy operations of the hashing vectorizer release the GIL,
+so a thread pool uses more cores. The model name is saved in the embedding store and it is part
+of the embeddings cache keys, the embeddings of different backends are never mixed.
+"""
+from functools import lru_cache
+from typing import List, Tuple, Union
+
+import numpy as np
+
+from utils.metrics import count
+from utils.retrieval import normalize_rows
+
+HASHING_MODEL_PREFIX = "local-hashing-"
+HASHING_NGRAM_SIZES = (3, 4, 5)
+# Separator of the texts concatenated in a batch, the n-grams across two texts are discarded
+TEXTS_SEPARATOR = "\x00"
+
+
+class OpenAIEmbeddingBackend:
+    """
+    OpenAI Embedding API, one request for each batch
+    """
+
+    is_local = False
+
+    def __init__(self, model_name: str):
+        self.model_name = model_name
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        """
+        Returns:
+            (number of texts, embeddings size) float32 matrix in the texts order
+        """
+        import openai
+
+        response = openai.Embedding.create(input=texts, engine=self.model_name)
+        count("api_calls.embeddings")
+        count("tokens_sent.embeddings", response.get("usage", {}).get("prompt_tokens", 0))
+        # The response data have an "index" field, don't rely on their order
+        return np.array(
+            [data["embedding"] for data in sorted(response["data"], key=lambda data: data["index"])],
+            dtype=np.float32,
+        )
+
+
+class HashingEmbeddingBackend:
+    """
+    Hashed character n-grams vectorizer, computed with numpy on the whole batch
+    """
+
+    is_local = True
+
+    def __init__(
+        self, model_name: str, embeddings_size: int, ngram_sizes: Tuple[int, ...] = HASHING_NGRAM_SIZES
+    ):
+        self.model_name = model_name
+        self.embeddings_size = embeddings_size
+        self.ngram_sizes = ngram_sizes
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        """
+        Returns:
+            (number of texts, embeddings size) L2 normalized float32 matrix in the texts order
+        """
+        # Lowercase, whitespace collapsed and a space around the words, so the first and last n-grams mark the word edges
+        documents = [f" {' '.join(text.lower().replace(TEXTS_SEPARATOR, ' ').split())} " for text in texts]
+        codepoints = np.frombuffer(
+            TEXTS_SEPARATOR.join(documents).encode("utf-32-le"), dtype=np.uint32
+        ).astype(np.uint64)
+        # Number of separators before each position: the text of each n-gram and, by difference, the n-grams
+        # containing a separator
+        separators_before = np.concatenate(
+            [[0], np.cumsum(codepoints == ord(TEXTS_SEPARATOR))]
+        )
+        flat_buckets = []
+        signs = []
+        for ngram_size in self.ngram_sizes:
+            num_ngrams = len(codepoints) - ngram_size + 1
+            if num_ngrams <= 0:
+                continue
+            # Polynomial rolling hash of the n-grams, the uint64 overflow wraps around
+            hashes = np.full(num_ngrams, ngram_size, dtype=np.uint64)
+            for offset in range(ngram_size):
+                hashes = hashes * np.uint64(1000003) + codepoints[offset : offset + num_ngrams]
+            # Murmur3 finalizer, to spread the hashes over all the bits
+            hashes ^= hashes >> np.uint64(33)
+            hashes *= np.uint64(0xFF51AFD7ED558CCD)
+            hashes ^= hashes >> np.uint64(33)
+            valid = separators_before[ngram_size:] == separators_before[:num_ngrams]
+            hashes = hashes[valid]
+            text_ids = separators_before[:num_ngrams][valid]
+            flat_buckets.append(
+                text_ids * self.embeddings_size + (hashes % np.uint64(self.embeddings_size)).astype(np.int64)
+            )
+            signs.append(np.where(hashes >> np.uint64(63), -1.0, 1.0))
+        embeddings = np.zeros(len(texts) * self.embeddings_size)
+        if flat_buckets:
+            embeddings = np.bincount(
+                np.concatenate(flat_buckets),
+                weights=np.concatenate(signs),
+                minlength=len(texts) * self.embeddings_size,
+            )
+        return normalize_rows(embeddings.reshape(len(texts), self.embeddings_size))
+
+
+EmbeddingBackend = Union[OpenAIEmbeddingBackend, HashingEmbeddingBackend]
+
+
+@lru_cache(maxsize=None)
+def get_embedding_backend(model_name: str) -> EmbeddingBackend:
+    """
+    Returns:
+        the backend of the embedding model, the OpenAI API when the name doesn't match a local model
+    """
+    if model_name.startswith(HASHING_MODEL_PREFIX):
+        embeddings_size = model_name[len(HASHING_MODEL_PREFIX) :]
+        if not embeddings_size.isdigit() or int(embeddings_size) == 0:
+            raise ValueError(
+                f"Embedding model {model_name} not supported, the local hashing model name is "
+                f"{HASHING_MODEL_PREFIX}<embeddings size>, e.g. {HASHING_MODEL_PREFIX}1024"
+            )
+        return HashingEmbeddingBackend(model_name, int(embeddings_size))
+    return OpenAIEmbeddingBackend(model_name)
@@ -0,0 +1,182 @@
+"""
+Persistent embeddings cache shared by create_embeddings.py and answer_question.py
+
+The cache is keyed by the content hash of (embedding model name, normalized text):
+- an in-process LRU dict in front of
+- a SQLite file with the float32 vectors: when they exceed max_disk_bytes, the least recently accessed ones
+  are evicted down to 90% of it.
+  The access time is written for the hits of both levels, so the vectors served from memory stay on disk
+
+Hits and misses are counted to check the cache effectiveness.
+"""
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from utils.incremental_embeddings import get_content_hash
+
+# The eviction deletes the vectors down to this fraction of max_disk_bytes, so it runs again only after
+# many puts instead of at every put once the cache is full
+EVICTION_LOW_WATERMARK = 0.9
+EVICTION_BATCH_SIZE = 1000
+
+
+class EmbeddingCache:
+    def __init__(
+        self,
+        cache_filepath: str,
+        max_memory_items: int = 10000,
+        max_disk_bytes: int = 1024**3,
+    ):
+        """
+        Args:
+            cache_filepath: SQLite file, created if it doesn't exist
+            max_memory_items: maximum number of vectors in the in-process LRU
+            max_disk_bytes: maximum size of the stored vectors, the least recently used are evicted
+        """
+        if os.path.dirname(cache_filepath):
+            os.makedirs(os.path.dirname(cache_filepath), exist_ok=True)
+        self.max_memory_items = max_memory_items
+        self.max_disk_bytes = max_disk_bytes
+        self.memory: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self.counters = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "evicted": 0}
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(cache_filepath, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings "
+            "(key TEXT PRIMARY KEY, vector BLOB NOT NULL, last_access REAL NOT NULL)"
+        )
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS embeddings_last_access ON embeddings (last_access)"
+        )
+        self.connection.commit()
+        # Running estimate of the stored bytes, recomputed exactly only when it exceeds the limit
+        self.disk_bytes = self._get_disk_bytes()
+
+    def _get_disk_bytes(self) -> int:
+        return self.connection.execute(
+            "SELECT COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings"
+        ).fetchone()[0]
+
+    def _remember(self, key: str, vector: np.ndarray):
+        self.memory[key] = vector
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_memory_items:
+            self.memory.popitem(last=False)
+
+    def get_many(self, embedding_model_name: str, texts: List[str]) -> List[Optional[np.ndarray]]:
+        """
+        Returns:
+            the cached vector of each text, None for the texts not in the cache
+        """
+        keys = [get_content_hash(embedding_model_name, text) for text in texts]
+        results: List[Optional[np.ndarray]] = [None] * len(keys)
+        with self.lock:
+            disk_positions: Dict[str, List[int]] = {}
+            # Keys of all the hits, the memory hits too: their disk last_access keeps them from the eviction
+            accessed_keys = set()
+            for position, key in enumerate(keys):
+                if key in self.memory:
+                    self.memory.move_to_end(key)
+                    results[position] = self.memory[key]
+                    accessed_keys.add(key)
+                    self.counters["memory_hits"] += 1
+                else:
+                    disk_positions.setdefault(key, []).append(position)
+
+            disk_keys = list(disk_positions.keys())
+            # Stay below the SQLite limit of variables in a single query
+            for start in range(0, len(disk_keys), 500):
+                chunk_keys = disk_keys[start : start + 500]
+                rows = self.connection.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(chunk_keys))})",
+                    chunk_keys,
+                ).fetchall()
+                for key, vector_bytes in rows:
+                    vector = np.frombuffer(vector_bytes, dtype=np.float32)
+                    self._remember(key, vector)
+                    accessed_keys.add(key)
+                    for position in disk_positions.pop(key):
+                        results[position] = vector
+                        self.counters["disk_hits"] += 1
+            if accessed_keys:
+                now = time.time()
+                self.connection.executemany(
+                    "UPDATE embeddings SET last_access = ? WHERE key = ?",
+                    [(now, key) for key in accessed_keys],
+                )
+                self.connection.commit()
+            self.counters["misses"] += sum(len(positions) for positions in disk_positions.values())
+        return results
+
+    def get(self, embedding_model_name: str, text: str) -> Optional[np.ndarray]:
+        return self.get_many(embedding_model_name, [text])[0]
+
+    def put_many(self, embedding_model_name: str, texts: List[str], vectors: np.ndarray):
+        now = time.time()
+        rows = []
+        with self.lock:
+            for text, vector in zip(texts, vectors):
+                key = get_content_hash(embedding_model_name, text)
+                vector = np.asarray(vector, dtype=np.float32)
+                self._remember(key, vector)
+                rows.append((key, vector.tobytes(), now))
+                self.disk_bytes += vector.nbytes
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector, last_access) VALUES (?, ?, ?)",
+                rows,
+            )
+            self.connection.commit()
+            self._evict()
+
+    def put(self, embedding_model_name: str, text: str, vector: np.ndarray):
+        self.put_many(embedding_model_name, [text], np.asarray([vector]))
+
+    def _evict(self):
+        """
+        When the stored size exceeds max_disk_bytes, delete the least recently used vectors
+        until it is below EVICTION_LOW_WATERMARK of it
+        """
+        if self.disk_bytes <= self.max_disk_bytes:
+            return
+        # The estimate counts the replaced vectors twice
+        disk_bytes = self._get_disk_bytes()
+        target_bytes = int(EVICTION_LOW_WATERMARK * self.max_disk_bytes)
+        evicted = 0
+        while disk_bytes > target_bytes:
+            # Oldest vectors in batches, read from the last_access index
+            rows = self.connection.execute(
+                "SELECT key, LENGTH(vector) FROM embeddings ORDER BY last_access ASC LIMIT ?",
+                (EVICTION_BATCH_SIZE,),
+            ).fetchall()
+            if not rows:
+                break
+            evicted_keys = []
+            for key, num_bytes in rows:
+                if disk_bytes <= target_bytes:
+                    break
+                evicted_keys.append((key,))
+                self.memory.pop(key, None)
+                disk_bytes -= num_bytes
+            self.connection.executemany("DELETE FROM embeddings WHERE key = ?", evicted_keys)
+            evicted += len(evicted_keys)
+        self.connection.commit()
+        self.disk_bytes = disk_bytes
+        self.counters["evicted"] += evicted
+
+    def stats(self) -> dict:
+        with self.lock:
+            stats = dict(self.counters)
+            stats["stored"] = self.connection.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        lookups = stats["memory_hits"] + stats["disk_hits"] + stats["misses"]
+        stats["hit_rate"] = (stats["memory_hits"] + stats["disk_hits"]) / lookups if lookups else 0.0
+        return stats
+
+    def close(self):
+        self.connection.close()
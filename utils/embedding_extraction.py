@@ -0,0 +1,107 @@
+"""
+Concurrent embeddings extraction with the OpenAI Embedding API or a local embedding backend
+
+The texts are grouped in batches filled up to a maximum number of tokens (and rows) per request,
+the batches are sent by a pool of threads that respects the requests per minute and tokens per minute
+limits, transient errors are retried with exponential backoff and the embeddings are returned
+in the same order of the input texts. The batches of a local backend (see utils/embedding_backends.py)
+are embedded by the same pool of threads, without the API limits.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Optional, Tuple
+
+import numpy as np
+
+from utils.embedding_backends import get_embedding_backend
+from utils.metrics import timer
+from utils.rate_limit import RateLimiter, call_with_retry
+
+
+def make_token_batches(
+    token_counts: List[int], max_request_tokens: int, max_request_rows: int
+) -> List[Tuple[int, int]]:
+    """
+    Split consecutive rows in batches with at most max_request_tokens tokens and max_request_rows rows.
+    A single row with more than max_request_tokens tokens gets its own batch.
+
+    Returns:
+        list of (start, end) row ranges, end excluded
+    """
+    batches = []
+    start = 0
+    batch_tokens = 0
+    for i, num_tokens in enumerate(token_counts):
+        batch_rows = i - start
+        if batch_rows > 0 and (
+            batch_tokens + num_tokens > max_request_tokens or batch_rows >= max_request_rows
+        ):
+            batches.append((start, i))
+            start = i
+            batch_tokens = 0
+        batch_tokens += num_tokens
+    if start < len(token_counts):
+        batches.append((start, len(token_counts)))
+    return batches
+
+
+def request_embeddings(texts: List[str], embedding_model_name: str) -> np.ndarray:
+    with timer("embeddings_request"):
+        return get_embedding_backend(embedding_model_name).embed(texts)
+
+
+def extract_embeddings(
+    texts: List[str],
+    token_counts: List[int],
+    embedding_model_name: str,
+    max_request_tokens: int = 50000,
+    max_request_rows: int = 2048,
+    max_concurrent_requests: int = 4,
+    requests_per_minute: Optional[float] = None,
+    tokens_per_minute: Optional[float] = None,
+    max_retries: int = 6,
+    on_batch_done: Optional[Callable[[int, int, np.ndarray], None]] = None,
+) -> np.ndarray:
+    """
+    Get the embeddings of all the texts with concurrent, rate limited and retried requests
+
+    Args:
+        texts: texts to embed
+        token_counts: number of tokens of each text, used to fill the requests
+        embedding_model_name: OpenAI embedding model or local model (see utils/embedding_backends.py)
+        max_request_tokens: maximum number of tokens in a single request
+        max_request_rows: maximum number of texts in a single request
+        max_concurrent_requests: maximum number of requests in flight, threads of a local model
+        requests_per_minute: requests per minute limit, None to disable it (ignored by a local model)
+        tokens_per_minute: tokens per minute limit, None to disable it (ignored by a local model)
+        max_retries: number of retries of a failed request before giving up
+        on_batch_done: called with (start, end, batch embeddings) for each batch, in the texts order
+
+    Returns:
+        (number of texts, embeddings size) float32 matrix in the texts order
+    """
+    batches = make_token_batches(token_counts, max_request_tokens, max_request_rows)
+    if get_embedding_backend(embedding_model_name).is_local:
+        requests_per_minute = tokens_per_minute = None
+    rate_limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+    print(f"{len(texts)} texts split in {len(batches)} requests")
+
+    def embed_batch(batch: Tuple[int, int]) -> np.ndarray:
+        start, end = batch
+        rate_limiter.acquire(sum(token_counts[start:end]))
+        return call_with_retry(
+            lambda: request_embeddings(texts[start:end], embedding_model_name),
+            max_retries=max_retries,
+        )
+
+    embeddings = None
+    with ThreadPoolExecutor(max_workers=max_concurrent_requests) as executor:
+        # map yields the results in the batches order, whatever the completion order
+        for (start, end), batch_embeddings in zip(batches, executor.map(embed_batch, batches)):
+            if embeddings is None:
+                embeddings = np.empty((len(texts), len(batch_embeddings[0])), dtype=np.float32)
+            embeddings[start:end] = batch_embeddings
+            if on_batch_done is not None:
+                on_batch_done(start, end, embeddings[start:end])
+    if embeddings is None:
+        raise ValueError("No texts to embed")
+    return embeddings
@@ -0,0 +1,475 @@
+"""
+Binary embedding store
+
+A store is a directory with:
+- embeddings.npy: contiguous float32 matrix (one row per text, L2 normalized), loaded memory-mapped
+- metadata.csv: "row_id" and "text" columns (plus any other column of the input data), same order of the matrix
+- store_info.json: embedding model name, number of rows, embeddings size and dtype
+
+A sharded store splits the rows in N contiguous shards: each shard_<i> subdirectory is a store with its own
+matrix and metadata, the store_info.json of the parent directory has the shard row offsets.
+The queries fan out to the shards with utils/sharded_retrieval.py.
+
+EmbeddingStoreWriter writes a store chunk by chunk when the whole matrix doesn't fit in memory.
+
+Loading a store does not copy the matrix: numpy maps the .npy file read-only,
+so many processes querying the same store share one copy in the page cache.
+
+The legacy CSV format ("text" column and "embeddings" column with stringified lists)
+is still readable with load_embeddings and can be converted with convert_embeddings_csv.py.
+"""
+import hashlib
+import json
+import os
+import shutil
+from typing import List, Optional, Union
+
+import numpy as np
+import pandas as pd
+
+from utils.metrics import timer
+from utils.retrieval import normalize_rows
+
+EMBEDDINGS_FILENAME = "embeddings.npy"
+METADATA_FILENAME = "metadata.csv"
+STORE_INFO_FILENAME = "store_info.json"
+STORE_DTYPE = np.float32
+SHARD_DIRNAME_TEMPLATE = "shard_{:03d}"
+
+
+class EmbeddingStore:
+    """
+    Embeddings matrix and the associated metadata (text and row id for each matrix row)
+    """
+
+    def __init__(
+        self,
+        embeddings: Optional[np.ndarray],
+        metadata: pd.DataFrame,
+        info: dict,
+        shards: Optional[List["EmbeddingStore"]] = None,
+    ):
+        """
+        Args:
+            embeddings: embeddings matrix, None for a sharded store
+            metadata: one row per embeddings row, the rows of all the shards for a sharded store
+            info: content of store_info.json
+            shards: the stores of the shards, in row order
+        """
+        if embeddings is not None and len(embeddings) != len(metadata):
+            raise ValueError(
+                f"Embeddings rows ({len(embeddings)}) and metadata rows ({len(metadata)}) mismatch"
+            )
+        self._embeddings = embeddings
+        self.metadata = metadata
+        self.info = info
+        self.shards = shards or []
+
+    def __len__(self) -> int:
+        return len(self.metadata)
+
+    @property
+    def embeddings(self) -> np.ndarray:
+        if self._embeddings is None:
+            # The shard matrices are concatenated in memory only when the whole matrix is needed
+            self._embeddings = np.concatenate([shard.embeddings for shard in self.shards])
+        return self._embeddings
+
+    @property
+    def is_sharded(self) -> bool:
+        return len(self.shards) > 0
+
+    @property
+    def shard_offsets(self) -> List[int]:
+        """
+        Start row of each shard and the number of rows as last element
+        """
+        return self.info.get("shard_offsets", [0, len(self)])
+
+    @property
+    def texts(self) -> np.ndarray:
+        return self.metadata["text"].values
+
+    @property
+    def normalized(self) -> bool:
+        return bool(self.info.get("normalized", False))
+
+    @property
+    def embedding_model_name(self) -> Optional[str]:
+        return self.info.get("embedding_model_name")
+
+
+def get_embeddings_rows(store: EmbeddingStore, rows: np.ndarray) -> np.ndarray:
+    """
+    Read some rows of the embeddings matrix, from the shard matrices for a sharded store
+    (without concatenating them)
+
+    Returns:
+        (len(rows), embeddings_size) embeddings in the rows order
+    """
+    if not store.is_sharded:
+        return np.asarray(store.embeddings[rows])
+    shard_ids = np.searchsorted(store.shard_offsets, rows, side="right") - 1
+    embeddings = np.empty((len(rows), store.shards[0].embeddings.shape[1]), dtype=STORE_DTYPE)
+    for shard_id in np.unique(shard_ids):
+        positions = np.flatnonzero(shard_ids == shard_id)
+        embeddings[positions] = store.shards[shard_id].embeddings[
+            rows[positions] - store.shard_offsets[shard_id]
+        ]
+    return embeddings
+
+
+def is_legacy_csv(path: str) -> bool:
+    return path.lower().endswith(".csv")
+
+
+def get_shard_dirpath(store_dirpath: str, shard_id: int) -> str:
+    return os.path.join(store_dirpath, SHARD_DIRNAME_TEMPLATE.format(shard_id))
+
+
+def write_store_info(store_dirpath: str, info: dict):
+    info_filepath = os.path.join(store_dirpath, STORE_INFO_FILENAME)
+    with open(info_filepath + ".tmp", "w") as out_fp:
+        json.dump(info, out_fp, indent=2)
+    os.replace(info_filepath + ".tmp", info_filepath)
+
+
+def remove_stale_files(store_dirpath: str, num_shards: int):
+    """
+    Remove the files of a previous layout of the store: the top-level matrix and metadata of an unsharded store
+    when saving a sharded one, the shards beyond num_shards
+    """
+    if num_shards > 1:
+        for filename in (EMBEDDINGS_FILENAME, METADATA_FILENAME):
+            if os.path.exists(os.path.join(store_dirpath, filename)):
+                os.remove(os.path.join(store_dirpath, filename))
+    shard_id = num_shards if num_shards > 1 else 0
+    while os.path.isdir(get_shard_dirpath(store_dirpath, shard_id)):
+        shutil.rmtree(get_shard_dirpath(store_dirpath, shard_id))
+        shard_id += 1
+
+
+def save_embedding_store(
+    store_dirpath: str,
+    df: pd.DataFrame,
+    embeddings: Union[np.ndarray, List[List[float]]],
+    embedding_model_name: str,
+    normalize: bool = True,
+    num_shards: int = 1,
+):
+    """
+    Save the embeddings matrix and the dataframe metadata as an embedding store
+
+    Args:
+        store_dirpath: output directory
+        df: dataframe with at least a "text" column, the index is saved as "row_id"
+        embeddings: one embeddings vector per dataframe row
+        embedding_model_name: model used to compute the embeddings
+        normalize: L2 normalize the rows, so the cosine similarity is a dot product at query time
+        num_shards: split the rows in this number of shards, each one saved as a store in a subdirectory
+    """
+    matrix = np.asarray(embeddings, dtype=STORE_DTYPE)
+    if normalize:
+        matrix = normalize_rows(matrix)
+    matrix = np.ascontiguousarray(matrix)
+    if matrix.ndim != 2 or len(matrix) != len(df):
+        raise ValueError(
+            f"Expected a ({len(df)}, embeddings size) matrix, got shape {matrix.shape}"
+        )
+    if not 1 <= num_shards <= len(df):
+        raise ValueError(f"Number of shards ({num_shards}) must be between 1 and the rows ({len(df)})")
+
+    os.makedirs(store_dirpath, exist_ok=True)
+    info = {
+        "embedding_model_name": embedding_model_name,
+        "num_rows": int(matrix.shape[0]),
+        "embeddings_size": int(matrix.shape[1]),
+        "dtype": np.dtype(STORE_DTYPE).name,
+        "normalized": normalize,
+    }
+    if num_shards > 1:
+        shard_offsets = np.linspace(0, len(df), num_shards + 1).astype(int)
+        for shard_id, (start, end) in enumerate(zip(shard_offsets[:-1], shard_offsets[1:])):
+            save_embedding_store(
+                get_shard_dirpath(store_dirpath, shard_id),
+                df.iloc[start:end],
+                matrix[start:end],
+                embedding_model_name,
+                normalize=False,
+            )
+        info["num_shards"] = num_shards
+        info["shard_offsets"] = shard_offsets.tolist()
+        # The shards are written before the parent info, a reader sees either the old or the new layout
+        write_store_info(store_dirpath, info)
+        remove_stale_files(store_dirpath, num_shards)
+        return
+
+    metadata = df.drop(columns=["embeddings"], errors="ignore")
+    metadata = metadata.rename_axis("row_id").reset_index()
+
+    # Write to temporary files and rename them, a reader never sees a partially written file
+    embeddings_filepath = os.path.join(store_dirpath, EMBEDDINGS_FILENAME)
+    with open(embeddings_filepath + ".tmp", "wb") as out_fp:
+        np.save(out_fp, matrix)
+    os.replace(embeddings_filepath + ".tmp", embeddings_filepath)
+
+    metadata_filepath = os.path.join(store_dirpath, METADATA_FILENAME)
+    metadata.to_csv(metadata_filepath + ".tmp", index=False)
+    os.replace(metadata_filepath + ".tmp", metadata_filepath)
+
+    write_store_info(store_dirpath, info)
+    remove_stale_files(store_dirpath, num_shards)
+
+
+class EmbeddingStoreWriter:
+    """
+    Write an embedding store chunk by chunk, the memory usage is bounded by the chunk size
+
+    The number of rows must be known in advance: the .npy header is written with the final shape and the rows
+    of each chunk are appended after it, the metadata rows are appended to the CSV. The files are renamed
+    when all the rows are written, a reader sees the previous store until close.
+    """
+
+    def __init__(
+        self,
+        store_dirpath: str,
+        num_rows: int,
+        embedding_model_name: str,
+        normalize: bool = True,
+        num_shards: int = 1,
+    ):
+        """
+        Args:
+            store_dirpath: output directory
+            num_rows: total number of rows that will be appended
+            embedding_model_name: model used to compute the embeddings
+            normalize: L2 normalize the rows, so the cosine similarity is a dot product at query time
+            num_shards: split the rows in this number of shards, each one written as a store in a subdirectory
+        """
+        if not 1 <= num_shards <= num_rows:
+            raise ValueError(f"Number of shards ({num_shards}) must be between 1 and the rows ({num_rows})")
+        self.store_dirpath = store_dirpath
+        self.num_rows = num_rows
+        self.embedding_model_name = embedding_model_name
+        self.normalize = normalize
+        self.num_shards = num_shards
+        self.rows_written = 0
+        self.embeddings_size = None
+        self.embeddings_fp = None
+        self.shard_offsets = np.linspace(0, num_rows, num_shards + 1).astype(int)
+        self.shard_writers = []
+        if num_shards > 1:
+            for shard_id, (start, end) in enumerate(zip(self.shard_offsets[:-1], self.shard_offsets[1:])):
+                self.shard_writers.append(
+                    EmbeddingStoreWriter(
+                        get_shard_dirpath(store_dirpath, shard_id),
+                        int(end - start),
+                        embedding_model_name,
+                        normalize=False,
+                    )
+                )
+        os.makedirs(store_dirpath, exist_ok=True)
+        self.embeddings_filepath = os.path.join(store_dirpath, EMBEDDINGS_FILENAME)
+        self.metadata_filepath = os.path.join(store_dirpath, METADATA_FILENAME)
+
+    def append(self, df: pd.DataFrame, embeddings: Union[np.ndarray, List[List[float]]]):
+        """
+        Args:
+            df: next rows with at least a "text" column, the index is saved as "row_id"
+            embeddings: one embeddings vector per dataframe row
+        """
+        matrix = np.asarray(embeddings, dtype=STORE_DTYPE)
+        if self.normalize:
+            matrix = normalize_rows(matrix)
+        if matrix.ndim != 2 or len(matrix) != len(df):
+            raise ValueError(
+                f"Expected a ({len(df)}, embeddings size) matrix, got shape {matrix.shape}"
+            )
+        if self.rows_written + len(df) > self.num_rows:
+            raise ValueError(f"More rows than the {self.num_rows} rows of the store")
+        if self.embeddings_size is None:
+            self.embeddings_size = int(matrix.shape[1])
+
+        if self.shard_writers:
+            start = self.rows_written
+            for shard_id, shard_writer in enumerate(self.shard_writers):
+                shard_start = max(start, self.shard_offsets[shard_id])
+                shard_end = min(start + len(df), self.shard_offsets[shard_id + 1])
+                if shard_start < shard_end:
+                    shard_writer.append(
+                        df.iloc[shard_start - start : shard_end - start],
+                        matrix[shard_start - start : shard_end - start],
+                    )
+            self.rows_written += len(df)
+            return
+
+        if self.embeddings_fp is None:
+            self.embeddings_fp = open(self.embeddings_filepath + ".tmp", "wb")
+            np.lib.format.write_array_header_1_0(
+                self.embeddings_fp,
+                {
+                    "descr": np.lib.format.dtype_to_descr(np.dtype(STORE_DTYPE)),
+                    "fortran_order": False,
+                    "shape": (self.num_rows, self.embeddings_size),
+                },
+            )
+        self.embeddings_fp.write(np.ascontiguousarray(matrix).tobytes())
+        metadata = df.drop(columns=["embeddings"], errors="ignore")
+        metadata = metadata.rename_axis("row_id").reset_index()
+        # The CSV header is written with the first chunk only
+        metadata.to_csv(
+            self.metadata_filepath + ".tmp",
+            mode="w" if self.rows_written == 0 else "a",
+            header=self.rows_written == 0,
+            index=False,
+        )
+        self.rows_written += len(df)
+
+    def close(self):
+        """
+        Rename the written files and write store_info.json, all the rows must have been appended
+        """
+        if self.rows_written != self.num_rows:
+            raise ValueError(f"{self.rows_written} rows written, the store has {self.num_rows} rows")
+        info = {
+            "embedding_model_name": self.embedding_model_name,
+            "num_rows": self.num_rows,
+            "embeddings_size": self.embeddings_size,
+            "dtype": np.dtype(STORE_DTYPE).name,
+            "normalized": self.normalize,
+        }
+        if self.shard_writers:
+            for shard_writer in self.shard_writers:
+                shard_writer.close()
+            info["num_shards"] = self.num_shards
+            info["shard_offsets"] = self.shard_offsets.tolist()
+        else:
+            self.embeddings_fp.close()
+            os.replace(self.embeddings_filepath + ".tmp", self.embeddings_filepath)
+            os.replace(self.metadata_filepath + ".tmp", self.metadata_filepath)
+        write_store_info(self.store_dirpath, info)
+        remove_stale_files(self.store_dirpath, self.num_shards)
+
+
+def load_embedding_store(store_dirpath: str, mmap: bool = True) -> EmbeddingStore:
+    """
+    Load an embedding store
+
+    Args:
+        store_dirpath: directory created by save_embedding_store
+        mmap: map the embeddings matrix read-only instead of reading it into memory
+
+    Returns:
+        the EmbeddingStore, with the embeddings matrix memory-mapped by default.
+        The matrix of a sharded store is not loaded, each shard has its own store
+    """
+    with open(os.path.join(store_dirpath, STORE_INFO_FILENAME), "r") as in_fp:
+        info = json.load(in_fp)
+    if info.get("num_shards", 1) > 1:
+        shards = [
+            load_embedding_store(get_shard_dirpath(store_dirpath, shard_id), mmap=mmap)
+            for shard_id in range(info["num_shards"])
+        ]
+        metadata = pd.concat([shard.metadata for shard in shards], ignore_index=True)
+        return EmbeddingStore(embeddings=None, metadata=metadata, info=info, shards=shards)
+    embeddings = np.load(
+        os.path.join(store_dirpath, EMBEDDINGS_FILENAME),
+        mmap_mode="r" if mmap else None,
+    )
+    metadata = pd.read_csv(
+        os.path.join(store_dirpath, METADATA_FILENAME), keep_default_na=False
+    )
+    return EmbeddingStore(embeddings=embeddings, metadata=metadata, info=info)
+
+
+def load_legacy_embeddings_csv(csv_filepath: str) -> EmbeddingStore:
+    """
+    Load a CSV with "text" and "embeddings" columns, the embeddings are stringified lists of floats
+
+    Returns:
+        the EmbeddingStore with the L2 normalized embeddings matrix in memory
+    """
+    with timer("read_embeddings_csv"):
+        df = pd.read_csv(csv_filepath, index_col=0)
+    # The stringified lists are valid JSON, much faster and safer to parse than eval
+    with timer("parse_embeddings"):
+        embeddings = normalize_rows(
+            [json.loads(embeddings_str) for embeddings_str in df["embeddings"].values]
+        )
+    metadata = df.drop(columns=["embeddings"]).rename_axis("row_id").reset_index()
+    info = {
+        "embedding_model_name": None,
+        "num_rows": int(embeddings.shape[0]),
+        "embeddings_size": int(embeddings.shape[1]),
+        "dtype": np.dtype(STORE_DTYPE).name,
+        "normalized": True,
+    }
+    return EmbeddingStore(embeddings=embeddings, metadata=metadata, info=info)
+
+
+def save_legacy_embeddings_csv(
+    csv_filepath: str,
+    df: pd.DataFrame,
+    embeddings: Union[np.ndarray, List[List[float]]],
+):
+    """
+    Save the dataframe with an additional "embeddings" column in the legacy CSV format
+    """
+    df = df.copy()
+    df["embeddings"] = [list(map(float, vector)) for vector in embeddings]
+    df.to_csv(csv_filepath)
+
+
+def load_embeddings(path: str, mmap: bool = True) -> EmbeddingStore:
+    """
+    Load an embedding store directory or a legacy embeddings CSV file
+    """
+    if is_legacy_csv(path):
+        return load_legacy_embeddings_csv(path)
+    return load_embedding_store(path, mmap=mmap)
+
+
+def get_matrix_version(store_dirpath: str) -> str:
+    """
+    Fingerprint of the matrix file of a store (or shard) directory, it changes when the matrix is rewritten
+
+    Returns:
+        the file size and modification time, an empty string when the directory has no matrix file
+    """
+    matrix_filepath = os.path.join(store_dirpath, EMBEDDINGS_FILENAME)
+    if not os.path.exists(matrix_filepath):
+        return ""
+    file_stat = os.stat(matrix_filepath)
+    return f"{file_stat.st_size}:{file_stat.st_mtime_ns}"
+
+
+def get_embeddings_version(path: str) -> str:
+    """
+    Fingerprint of an embedding store directory or legacy CSV, it changes when the files are rewritten
+
+    Returns:
+        hex digest of the files names, sizes and modification times
+    """
+    if is_legacy_csv(path):
+        base_dirpath = os.path.dirname(path)
+        filenames = [os.path.basename(path)]
+    else:
+        base_dirpath = path
+        store_filenames = [STORE_INFO_FILENAME, EMBEDDINGS_FILENAME, METADATA_FILENAME]
+        with open(os.path.join(path, STORE_INFO_FILENAME), "r") as in_fp:
+            num_shards = json.load(in_fp).get("num_shards", 1)
+        if num_shards > 1:
+            filenames = [STORE_INFO_FILENAME] + [
+                os.path.join(SHARD_DIRNAME_TEMPLATE.format(shard_id), filename)
+                for shard_id in range(num_shards)
+                for filename in store_filenames
+            ]
+        else:
+            filenames = store_filenames
+    fingerprint = hashlib.sha256()
+    for filename in filenames:
+        file_stat = os.stat(os.path.join(base_dirpath, filename))
+        fingerprint.update(
+            f"{filename}:{file_stat.st_size}:{file_stat.st_mtime_ns};".encode("utf-8")
+        )
+    return fingerprint.hexdigest()
@@ -0,0 +1,112 @@
+"""
+Incremental and resumable embeddings extraction
+
+Each row is identified by a content hash of (embedding model name, normalized text):
+- the rows already present in a previous output are reused instead of being embedded again
+- the new embeddings are checkpointed every N requests, so an interrupted run resumes
+  from the last checkpoint instead of starting from scratch
+"""
+import glob
+import hashlib
+import os
+import re
+import shutil
+import unicodedata
+from typing import Dict, List
+
+import numpy as np
+
+from utils.embedding_store import load_embeddings
+
+CONTENT_HASH_COLUMN = "content_hash"
+
+
+def normalize_text(text: str) -> str:
+    """
+    Unicode NFC normalization, whitespace collapsed and stripped
+    """
+    return re.sub(r"\s+", " ", unicodedata.normalize("NFC", text)).strip()
+
+
+def get_content_hash(embedding_model_name: str, text: str) -> str:
+    return hashlib.sha256(
+        f"{embedding_model_name}\x00{normalize_text(text)}".encode("utf-8")
+    ).hexdigest()
+
+
+def load_previous_embeddings(
+    embeddings_path: str, embedding_model_name: str
+) -> Dict[str, np.ndarray]:
+    """
+    Load the embeddings of a previous run, if any, keyed by content hash
+
+    The previous output is ignored when it was created with a different embedding model.
+
+    Returns:
+        dict content hash -> embeddings vector
+    """
+    if not os.path.exists(embeddings_path):
+        return {}
+    store = load_embeddings(embeddings_path)
+    if store.embedding_model_name not in (None, embedding_model_name):
+        print(
+            f"Previous embeddings created with {store.embedding_model_name}, "
+            f"they can't be reused with {embedding_model_name}"
+        )
+        return {}
+    if CONTENT_HASH_COLUMN in store.metadata.columns:
+        hashes = store.metadata[CONTENT_HASH_COLUMN].values
+    else:
+        hashes = [get_content_hash(embedding_model_name, text) for text in store.texts]
+    return {content_hash: store.embeddings[i] for i, content_hash in enumerate(hashes)}
+
+
+class EmbeddingsCheckpoint:
+    """
+    Append-only checkpoint directory with one .npz part (content hashes and embeddings) per flush
+    """
+
+    def __init__(self, checkpoint_dirpath: str):
+        self.checkpoint_dirpath = checkpoint_dirpath
+        self.pending_hashes: List[str] = []
+        self.pending_embeddings: List[np.ndarray] = []
+        self.num_parts = len(self.get_part_filepaths())
+
+    def get_part_filepaths(self) -> List[str]:
+        return sorted(glob.glob(os.path.join(self.checkpoint_dirpath, "part_*.npz")))
+
+    def load(self) -> Dict[str, np.ndarray]:
+        """
+        Returns:
+            dict content hash -> embeddings vector of all the checkpointed parts
+        """
+        embeddings_by_hash = {}
+        for part_filepath in self.get_part_filepaths():
+            with np.load(part_filepath) as part:
+                for content_hash, vector in zip(part["hashes"], part["embeddings"]):
+                    embeddings_by_hash[str(content_hash)] = vector
+        return embeddings_by_hash
+
+    def add(self, hashes: List[str], embeddings: np.ndarray):
+        self.pending_hashes.extend(hashes)
+        self.pending_embeddings.append(np.asarray(embeddings, dtype=np.float32))
+
+    def flush(self):
+        if not self.pending_hashes:
+            return
+        os.makedirs(self.checkpoint_dirpath, exist_ok=True)
+        part_filepath = os.path.join(self.checkpoint_dirpath, f"part_{self.num_parts:06d}.npz")
+        # Rename after writing, an interrupted flush doesn't leave a corrupted part
+        tmp_filepath = part_filepath + ".tmp.npz"
+        np.savez(
+            tmp_filepath,
+            hashes=np.array(self.pending_hashes),
+            embeddings=np.concatenate(self.pending_embeddings),
+        )
+        os.replace(tmp_filepath, part_filepath)
+        self.num_parts += 1
+        self.pending_hashes = []
+        self.pending_embeddings = []
+
+    def remove(self):
+        shutil.rmtree(self.checkpoint_dirpath, ignore_errors=True)
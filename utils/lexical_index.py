@@ -0,0 +1,404 @@
+"""
+BM25 inverted index over the texts of an embedding store, for keyword matching of rare terms (e.g. proper nouns)
+
+The index is built at ingest time (create_embeddings.py --lexical_index) and saved as bm25_index.npz in the
+store directory: the vocabulary and, for each term, the rows containing it with the term frequencies
+(compressed sparse rows layout). A query reads only the postings of its terms.
+
+The tokenization lowercases the text, removes the accents, splits the Italian elisions (e.g. "dell'Aquila")
+and removes the stopwords of the index language ("multi" removes both the Italian and the English ones).
+
+HybridRetriever combines it with a dense retriever:
+- prefilter: only the BM25 candidates are scored with the embeddings, the dense retriever fills the rest
+  of the results when the query terms match less than top_k rows
+- hybrid: the dense and the BM25 rankings are merged with reciprocal rank fusion
+"""
+import os
+import re
+import unicodedata
+from array import array
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from utils.embedding_store import EmbeddingStore, get_embeddings_rows
+from utils.metrics import timer
+from utils.retrieval import normalize_rows, select_top_k
+
+LEXICAL_INDEX_FILENAME = "bm25_index.npz"
+LEXICAL_LANGUAGES = ("multi", "it", "en")
+RETRIEVAL_MODES = ("dense", "prefilter", "hybrid")
+# Reciprocal rank fusion constant, it reduces the weight of the first positions of each ranking
+RRF_K = 60
+
+ENGLISH_STOPWORDS = frozenset(
+    """
+    a about after all also an and any are as at be been before but by can could did do does during
+    each for from had has have he her his how i if in into is it its more most my no not of on one
+    only or other our out over she so some such than that the their them then there these they this
+    those through to under up was we were what when where which while who whom why will with would you your
+    """.split()
+)
+ITALIAN_STOPWORDS = frozenset(
+    """
+    a ad agli ai al alla alle allo anche c che chi ci col come con contro cui d da dagli dai dal dall
+    dalla dalle dallo degli dei del dell della delle dello di dov dove e ed era erano essere fra gli ha
+    hanno i il in l la le lo loro ma mi ne negli nei nel nell nella nelle nello noi non o per perche
+    piu po qual quale quali quando quanto quella quelle quelli quello questa queste questi questo se si sono su
+    sua sue sugli sui sul sull sulla sulle sullo suo suoi tra tu un una uno vi
+    """.split()
+)
+STOPWORDS = {
+    "multi": ENGLISH_STOPWORDS | ITALIAN_STOPWORDS,
+    "it": ITALIAN_STOPWORDS,
+    "en": ENGLISH_STOPWORDS,
+}
+# Apostrophes of the elisions and the English possessives, replaced by a space before the split
+APOSTROPHES_RE = re.compile(r"['’`]")
+WORD_RE = re.compile(r"\w+")
+
+
+def strip_accents(text: str) -> str:
+    return "".join(
+        char for char in unicodedata.normalize("NFKD", text) if not unicodedata.combining(char)
+    )
+
+
+def tokenize(text: str, language: str = "multi") -> List[str]:
+    """
+    Returns:
+        the lowercase terms of the text without accents and stopwords, single letters are removed
+    """
+    stopwords = STOPWORDS[language]
+    text = strip_accents(APOSTROPHES_RE.sub(" ", text.lower()))
+    return [
+        term
+        for term in WORD_RE.findall(text)
+        if term not in stopwords and (len(term) > 1 or term.isdigit())
+    ]
+
+
+class BM25Index:
+    def __init__(
+        self,
+        terms: np.ndarray,
+        term_offsets: np.ndarray,
+        posting_rows: np.ndarray,
+        posting_frequencies: np.ndarray,
+        row_lengths: np.ndarray,
+        language: str = "multi",
+        k1: float = 1.2,
+        b: float = 0.75,
+    ):
+        """
+        Args:
+            terms: vocabulary, the position is the term id
+            term_offsets: (num_terms + 1,) start offset of the postings of each term
+            posting_rows: rows of each term sorted by term id
+            posting_frequencies: occurrences of the term in each posting row
+            row_lengths: number of terms of each row
+            language: tokenization language of the texts, the queries are tokenized the same way
+            k1: term frequency saturation
+            b: row length normalization
+        """
+        self.terms = terms
+        self.term_ids = {term: term_id for term_id, term in enumerate(terms.tolist())}
+        self.term_offsets = term_offsets
+        self.posting_rows = posting_rows
+        self.posting_frequencies = posting_frequencies
+        self.row_lengths = row_lengths
+        self.language = language
+        self.k1 = k1
+        self.b = b
+        document_frequencies = np.diff(term_offsets)
+        self.idf = np.log1p(
+            (len(row_lengths) - document_frequencies + 0.5) / (document_frequencies + 0.5)
+        ).astype(np.float32)
+        # Denominator term of each row, computed once: k1 * (1 - b + b * length / average length)
+        average_length = max(float(row_lengths.mean()), 1.0) if len(row_lengths) > 0 else 1.0
+        self.length_norms = (k1 * (1.0 - b + b * row_lengths / average_length)).astype(np.float32)
+
+    def __len__(self) -> int:
+        return len(self.row_lengths)
+
+    @classmethod
+    def build(cls, texts, language: str = "multi", **kwargs) -> "BM25Index":
+        term_ids = {}
+        # Compact buffer of the term ids of all the rows, a list of lists would not fit in memory on large corpora
+        all_term_ids = array("q")
+        row_lengths = np.zeros(len(texts), dtype=np.int32)
+        for row, text in enumerate(texts):
+            row_term_ids = [
+                term_ids.setdefault(term, len(term_ids))
+                for term in tokenize(text if isinstance(text, str) else "", language)
+            ]
+            row_lengths[row] = len(row_term_ids)
+            all_term_ids.extend(row_term_ids)
+        all_term_ids = np.frombuffer(all_term_ids, dtype=np.int64)
+        all_rows = np.repeat(np.arange(len(texts), dtype=np.int64), row_lengths)
+        # One posting for each distinct (term, row) pair, sorted by term and row
+        postings, posting_frequencies = np.unique(
+            all_term_ids * len(texts) + all_rows, return_counts=True
+        )
+        posting_term_ids = postings // max(len(texts), 1)
+        term_offsets = np.zeros(len(term_ids) + 1, dtype=np.int64)
+        term_offsets[1:] = np.cumsum(np.bincount(posting_term_ids, minlength=len(term_ids)))
+        return cls(
+            np.array(list(term_ids), dtype=str),
+            term_offsets,
+            (postings % max(len(texts), 1)).astype(np.int32),
+            posting_frequencies.astype(np.float32),
+            row_lengths,
+            language=language,
+            **kwargs,
+        )
+
+    def save(self, store_dirpath: str):
+        index_filepath = os.path.join(store_dirpath, LEXICAL_INDEX_FILENAME)
+        # np.savez adds the .npz extension when missing, keep it in the temporary filename
+        tmp_filepath = index_filepath + ".tmp.npz"
+        np.savez(
+            tmp_filepath,
+            terms=self.terms,
+            term_offsets=self.term_offsets,
+            posting_rows=self.posting_rows,
+            posting_frequencies=self.posting_frequencies,
+            row_lengths=self.row_lengths,
+            language=self.language,
+            k1=self.k1,
+            b=self.b,
+        )
+        os.replace(tmp_filepath, index_filepath)
+
+    @classmethod
+    def load(cls, store_dirpath: str) -> "BM25Index":
+        with np.load(os.path.join(store_dirpath, LEXICAL_INDEX_FILENAME)) as index_data:
+            return cls(
+                terms=index_data["terms"],
+                term_offsets=index_data["term_offsets"],
+                posting_rows=index_data["posting_rows"],
+                posting_frequencies=index_data["posting_frequencies"],
+                row_lengths=index_data["row_lengths"],
+                language=str(index_data["language"]),
+                k1=float(index_data["k1"]),
+                b=float(index_data["b"]),
+            )
+
+    def score(self, query_text: str) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Returns:
+            the rows matching at least one query term and their BM25 scores
+        """
+        query_term_ids = {
+            self.term_ids[term]
+            for term in tokenize(query_text, self.language)
+            if term in self.term_ids
+        }
+        if not query_term_ids:
+            return np.empty(0, dtype=np.int32), np.empty(0, dtype=np.float32)
+        rows = []
+        weights = []
+        for term_id in query_term_ids:
+            start, end = self.term_offsets[term_id], self.term_offsets[term_id + 1]
+            term_rows = self.posting_rows[start:end]
+            frequencies = self.posting_frequencies[start:end]
+            rows.append(term_rows)
+            weights.append(
+                self.idf[term_id]
+                * frequencies
+                * (self.k1 + 1.0)
+                / (frequencies + self.length_norms[term_rows])
+            )
+        rows = np.concatenate(rows)
+        weights = np.concatenate(weights)
+        if len(rows) > len(self) // 8:
+            # Common terms: a dense accumulator over all the rows is cheaper than sorting the postings
+            scores = np.bincount(rows, weights=weights, minlength=len(self))
+            matched_rows = np.flatnonzero(scores)
+            return matched_rows.astype(np.int32), scores[matched_rows].astype(np.float32)
+        matched_rows, positions = np.unique(rows, return_inverse=True)
+        return matched_rows, np.bincount(positions, weights=weights).astype(np.float32)
+
+    def search(self, query_text: str, top_k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Returns:
+            up to top_k row indices and BM25 scores, sorted by descending score
+        """
+        matched_rows, scores = self.score(query_text)
+        positions, top_scores = select_top_k(scores, top_k)
+        return matched_rows[positions].astype(np.int64), top_scores
+
+
+class HybridRetriever:
+    """
+    Dense retrieval combined with the BM25 index, the queries need both the embeddings and the text
+    """
+
+    def __init__(
+        self,
+        dense_retriever,
+        lexical_index: BM25Index,
+        store: EmbeddingStore,
+        mode: str = "hybrid",
+        num_candidates: int = 1000,
+    ):
+        """
+        Args:
+            dense_retriever: retriever of the store embeddings (exact, IVF, quantized or sharded)
+            lexical_index: BM25 index of the store texts
+            store: embedding store, its rows score the BM25 candidates
+            mode: "prefilter" or "hybrid"
+            num_candidates: BM25 rows scored with the embeddings (prefilter)
+                or merged with the same number of dense rows (hybrid)
+        """
+        if mode not in RETRIEVAL_MODES[1:]:
+            raise ValueError(f"Retrieval mode {mode} not supported, choose one of {RETRIEVAL_MODES[1:]}")
+        self.dense_retriever = dense_retriever
+        self.lexical_index = lexical_index
+        self.store = store
+        self.mode = mode
+        self.num_candidates = num_candidates
+
+    def __len__(self) -> int:
+        return len(self.store)
+
+    def get_similarities(self, rows: np.ndarray, query: np.ndarray) -> np.ndarray:
+        # Sorted rows read the memory-mapped matrix sequentially
+        order = np.argsort(rows)
+        embeddings = get_embeddings_rows(self.store, rows[order])
+        if not self.store.normalized:
+            embeddings = normalize_rows(embeddings)
+        similarities = np.empty(len(rows), dtype=np.float32)
+        similarities[order] = embeddings @ query
+        return similarities
+
+    def get_num_dense_results(self, top_k: int) -> int:
+        # Prefilter: top_k dense rows always include the rows missing from less than top_k BM25 matches
+        return top_k if self.mode == "prefilter" else max(self.num_candidates, top_k)
+
+    def needs_dense_search(self, lexical_rows: np.ndarray, top_k: int) -> bool:
+        return self.mode == "hybrid" or len(lexical_rows) < top_k
+
+    def combine(
+        self,
+        query: np.ndarray,
+        top_k: int,
+        lexical_rows: np.ndarray,
+        dense_rows: Optional[np.ndarray] = None,
+        dense_similarities: Optional[np.ndarray] = None,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Combine the BM25 candidates of a normalized query with the dense results, padded with -1 rows or not
+
+        Returns:
+            row indices and cosine similarities, sorted by descending relevance
+        """
+        if self.mode == "prefilter":
+            with timer("retrieval.dense"):
+                if len(lexical_rows) > 0:
+                    positions, similarities = select_top_k(
+                        self.get_similarities(lexical_rows, query), top_k
+                    )
+                    rows = lexical_rows[positions]
+                else:
+                    rows = np.empty(0, dtype=np.int64)
+                    similarities = np.empty(0, dtype=np.float32)
+                if dense_rows is not None and len(rows) < top_k:
+                    # Too few keyword matches: the matches come first, the most similar other rows fill the rest
+                    fill = np.flatnonzero((dense_rows >= 0) & ~np.isin(dense_rows, rows))[: top_k - len(rows)]
+                    rows = np.concatenate([rows, dense_rows[fill]])
+                    similarities = np.concatenate([similarities, dense_similarities[fill]])
+            return rows, similarities.astype(np.float32)
+
+        with timer("retrieval.fusion"):
+            found = dense_rows >= 0
+            dense_rows, dense_similarities = dense_rows[found], dense_similarities[found]
+            fused_scores = {}
+            for ranking in (dense_rows, lexical_rows):
+                for rank, row in enumerate(ranking.tolist()):
+                    fused_scores[row] = fused_scores.get(row, 0.0) + 1.0 / (RRF_K + rank + 1)
+            rows = np.fromiter(fused_scores, dtype=np.int64, count=len(fused_scores))
+            positions, _ = select_top_k(
+                np.fromiter(fused_scores.values(), dtype=np.float64, count=len(fused_scores)),
+                top_k,
+            )
+            rows = rows[positions]
+            # The cosine similarities of the dense rows are known, only the BM25 only rows are scored
+            known_similarities = dict(zip(dense_rows.tolist(), dense_similarities.tolist()))
+            missing = np.array(
+                [row for row in rows.tolist() if row not in known_similarities], dtype=np.int64
+            )
+            if len(missing) > 0:
+                known_similarities.update(
+                    zip(missing.tolist(), self.get_similarities(missing, query).tolist())
+                )
+            similarities = np.array(
+                [known_similarities[row] for row in rows.tolist()], dtype=np.float32
+            )
+        return rows, similarities
+
+    def search(
+        self, query_embeddings: np.ndarray, top_k: int, query_text: str = ""
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Find the rows most relevant to one query
+
+        Returns:
+            row indices and cosine similarities, sorted by descending relevance
+        """
+        query = normalize_rows(query_embeddings)
+        with timer("retrieval.lexical"):
+            lexical_rows, _ = self.lexical_index.search(
+                query_text, max(self.num_candidates, top_k)
+            )
+        if not self.needs_dense_search(lexical_rows, top_k):
+            return self.combine(query, top_k, lexical_rows)
+        with timer("retrieval.dense"):
+            dense_rows, dense_similarities = self.dense_retriever.search(
+                query, self.get_num_dense_results(top_k)
+            )
+        return self.combine(query, top_k, lexical_rows, dense_rows, dense_similarities)
+
+    def search_batch(
+        self,
+        queries_embeddings: np.ndarray,
+        top_k: int,
+        query_texts: Optional[List[str]] = None,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Search all the queries, the dense retriever searches together the queries that need it.
+        The results are padded with -1 indices (and -inf scores) when less than top_k rows are found
+
+        Returns:
+            (num_queries, top_k) row indices and cosine similarities
+        """
+        queries = normalize_rows(queries_embeddings)
+        query_texts = query_texts or [""] * len(queries)
+        top_k = min(top_k, len(self))
+        indices = np.full((len(queries), top_k), -1, dtype=np.int64)
+        scores = np.full((len(queries), top_k), -np.inf, dtype=np.float32)
+        with timer("retrieval.lexical"):
+            all_lexical_rows = [
+                self.lexical_index.search(query_text, max(self.num_candidates, top_k))[0]
+                for query_text in query_texts
+            ]
+        dense_queries = [
+            i for i, lexical_rows in enumerate(all_lexical_rows) if self.needs_dense_search(lexical_rows, top_k)
+        ]
+        dense_results = {}
+        if dense_queries:
+            with timer("retrieval.dense"):
+                dense_indices, dense_scores = self.dense_retriever.search_batch(
+                    queries[dense_queries], self.get_num_dense_results(top_k)
+                )
+            dense_results = {
+                i: (dense_indices[position], dense_scores[position])
+                for position, i in enumerate(dense_queries)
+            }
+        for i, (query, lexical_rows) in enumerate(zip(queries, all_lexical_rows)):
+            query_indices, query_scores = self.combine(
+                query, top_k, lexical_rows, *dense_results.get(i, (None, None))
+            )
+            indices[i, : len(query_indices)] = query_indices
+            scores[i, : len(query_indices)] = query_scores
+        return indices, scores
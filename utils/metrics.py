@@ -0,0 +1,197 @@
+"""
+Lightweight per-stage timers and counters for the RAG pipeline
+
+The metrics are collected by a process-wide Metrics object, disabled by default. When it is disabled,
+timer() returns a shared no-op context manager and count() returns immediately, so the instrumentation
+stays in the hot paths at almost no cost.
+
+- timer(stage): wall time of each stage (calls, total, mean and max seconds)
+- count(name, amount): counters, e.g. API calls and tokens sent and received
+- the events can be written as JSON lines while they happen, the summary is printed
+  (and written as the last JSON line) at exit
+- opt-in cProfile of the whole run saved to a .prof file (read it with pstats or snakeviz).
+  Sampling profilers like py-spy don't need any hook, the stages are plain function calls
+"""
+import argparse
+import atexit
+import contextlib
+import cProfile
+import json
+import threading
+import time
+from typing import ContextManager, Optional
+
+# Shared no-op context manager returned by timer() when the metrics are disabled
+NULL_TIMER = contextlib.nullcontext()
+
+
+class StageTimer:
+    def __init__(self, metrics: "Metrics", stage: str):
+        self.metrics = metrics
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.add_timing(self.stage, time.perf_counter() - self.start)
+        return False
+
+
+class Metrics:
+    def __init__(self):
+        self.enabled = False
+        self.timings = {}
+        self.counters = {}
+        self.lock = threading.Lock()
+        self.events_fp = None
+        self.profiler: Optional[cProfile.Profile] = None
+        self.profile_filepath = None
+
+    def configure(
+        self,
+        enabled: bool = True,
+        events_filepath: Optional[str] = None,
+        profile_filepath: Optional[str] = None,
+    ):
+        """
+        Args:
+            enabled: collect the timers and the counters
+            events_filepath: JSON lines file with one line per timed stage and the summary at the end
+            profile_filepath: cProfile output of the whole run
+        """
+        self.enabled = enabled or events_filepath is not None
+        if events_filepath is not None:
+            self.events_fp = open(events_filepath, "a")
+        if profile_filepath is not None:
+            self.profile_filepath = profile_filepath
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        if self.enabled or self.profiler is not None:
+            atexit.register(self.close)
+
+    def timer(self, stage: str) -> ContextManager:
+        if not self.enabled:
+            return NULL_TIMER
+        return StageTimer(self, stage)
+
+    def add_timing(self, stage: str, duration_s: float):
+        with self.lock:
+            calls, total_s, max_s = self.timings.get(stage, (0, 0.0, 0.0))
+            self.timings[stage] = (calls + 1, total_s + duration_s, max(max_s, duration_s))
+            if self.events_fp is not None:
+                self.events_fp.write(
+                    json.dumps(
+                        {"event": "timer", "stage": stage, "duration_s": duration_s, "time": time.time()}
+                    )
+                    + "\n"
+                )
+
+    def count(self, name: str, amount: int = 1):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def summary(self) -> dict:
+        with self.lock:
+            return {
+                "timings": {
+                    stage: {
+                        "calls": calls,
+                        "total_s": total_s,
+                        "mean_s": total_s / calls,
+                        "max_s": max_s,
+                    }
+                    for stage, (calls, total_s, max_s) in self.timings.items()
+                },
+                "counters": dict(self.counters),
+            }
+
+    def close(self):
+        """
+        Print and write the summary, save the profile
+        """
+        if self.profiler is not None:
+            self.profiler.disable()
+            self.profiler.dump_stats(self.profile_filepath)
+            print(f"Profile saved to {self.profile_filepath}")
+            self.profiler = None
+        if not self.enabled:
+            return
+        summary = self.summary()
+        print("Metrics summary:")
+        for stage, stage_timings in sorted(
+            summary["timings"].items(), key=lambda item: -item[1]["total_s"]
+        ):
+            print(
+                f"  {stage}: {stage_timings['calls']} calls, total {stage_timings['total_s']:.4f} s, "
+                f"mean {stage_timings['mean_s']:.4f} s, max {stage_timings['max_s']:.4f} s"
+            )
+        for name, value in sorted(summary["counters"].items()):
+            print(f"  {name}: {value}")
+        if self.events_fp is not None:
+            self.events_fp.write(json.dumps({"event": "summary", **summary}) + "\n")
+            self.events_fp.close()
+            self.events_fp = None
+        self.enabled = False
+
+
+METRICS = Metrics()
+
+
+def timer(stage: str) -> ContextManager:
+    """
+    Time a stage, e.g.:
+        with timer("retrieval"):
+            ...
+    """
+    return METRICS.timer(stage)
+
+
+def add_timing(stage: str, duration_s: float):
+    """
+    Add a duration measured by the caller, e.g. the time to the first token of a stream
+    """
+    if METRICS.enabled:
+        METRICS.add_timing(stage, duration_s)
+
+
+def count(name: str, amount: int = 1):
+    METRICS.count(name, amount)
+
+
+def metrics_enabled() -> bool:
+    """
+    Check it before computing a value needed only by the metrics (e.g. counting the prompt tokens)
+    """
+    return METRICS.enabled
+
+
+def add_metrics_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument(
+        "--metrics",
+        action="store_true",
+        help="Print the time spent in each stage, the API calls and the tokens sent and received at exit",
+    )
+    parser.add_argument(
+        "--metrics_filepath",
+        required=False,
+        type=str,
+        help="Append the metrics as JSON lines to this file (one line per timed stage and the summary)",
+    )
+    parser.add_argument(
+        "--profile_filepath",
+        required=False,
+        type=str,
+        help="Save a cProfile of the whole run to this file",
+    )
+
+
+def configure_metrics(args: argparse.Namespace):
+    METRICS.configure(
+        enabled=args.metrics,
+        events_filepath=args.metrics_filepath,
+        profile_filepath=args.profile_filepath,
+    )
@@ -1,8 +1,27 @@
-import openai
-import tiktoken
+"""
+OpenAI client settings and tiktoken token counting
+
+openai (with aiohttp) and tiktoken are imported on the first use: the query paths that don't call the API
+or count tokens (e.g. a cached answer, the query service client) start without importing them.
+"""
+import os
+from functools import lru_cache
+from typing import TYPE_CHECKING, List
+
+if TYPE_CHECKING:
+    import tiktoken
 
 
 def set_openai_vocareum_key():
+    import openai
+
+    # OPENAI_API_BASE and OPENAI_API_KEY environment variables override the course settings,
+    # e.g. to run the scripts against benchmarks/fake_openai_server.py
+    if "OPENAI_API_BASE" in os.environ:
+        openai.api_base = os.environ["OPENAI_API_BASE"]
+        openai.api_key = os.environ.get("OPENAI_API_KEY", "")
+        return
+
     # Load the vocareum API key provided for the course
     vocareum_key_filepath = "./keys/openai_voc_key.txt"
     with open(vocareum_key_filepath, "r") as in_fp:
@@ -11,6 +30,16 @@ def set_openai_vocareum_key():
         openai.api_key = vocareum_key_str
 
 
+@lru_cache(maxsize=None)
+def get_tokenizer(encoding: str = "cl100k_base") -> "tiktoken.Encoding":
+    """
+    Load the tokenizer once per encoding name
+    """
+    import tiktoken
+
+    return tiktoken.get_encoding(encoding)
+
+
 def count_tokens(text: str, encoding: str = "cl100k_base"):
     """
     Count the number of tokens before calculating the embeddings
@@ -22,5 +51,17 @@ def count_tokens(text: str, encoding: str = "cl100k_base"):
     Returns:
         the number of tokens to represent the text
     """
-    tokenizer = tiktoken.get_encoding(encoding)
-    return len(tokenizer.encode(text))
+    return len(get_tokenizer(encoding).encode(text))
+
+
+def count_tokens_batch(
+    texts: List[str], encoding: str = "cl100k_base", num_threads: int = 8
+) -> List[int]:
+    """
+    Count the number of tokens of many texts, the texts are encoded in parallel by tiktoken
+
+    Returns:
+        the number of tokens of each text
+    """
+    tokens = get_tokenizer(encoding).encode_batch(texts, num_threads=num_threads)
+    return [len(text_tokens) for text_tokens in tokens]
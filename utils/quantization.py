@@ -0,0 +1,316 @@
+"""
+Quantized embeddings storage with full precision rescoring
+
+A quantized store keeps compact codes of the L2 normalized rows next to the float32 matrix:
+- float16: half precision copy of the rows, 2 bytes per dimension
+- int8: scalar quantization with the range of each dimension mapped to 256 levels, 1 byte per dimension
+- pq: product quantization, the rows are split in sub-vectors encoded by the closest of 256 k-means centroids
+  of their subspace, 1 byte per sub-vector
+
+At query time the first pass scores all the codes (the only matrix read in full), then a shortlist of
+rescore_factor * top_k rows is rescored with the float32 rows. The float32 matrix is memory-mapped,
+only the shortlist rows are read, so the resident memory is about the codes size.
+
+float16 halves the memory but numpy converts the codes to float32 to score them, so its first pass is slower
+than the float32 exact search. The int8 and pq first passes are faster, they read 4x (or more) fewer bytes.
+
+The codes are saved in the embedding store directory as quantized_codes.npy and the quantizer
+parameters as quantizer.npz.
+"""
+import os
+from typing import Tuple
+
+import numpy as np
+
+from utils.ann_index import assign_to_centroids, kmeans
+from utils.metrics import timer
+from utils.retrieval import normalize_rows, select_top_k
+
+QUANTIZATION_MODES = ("none", "float16", "int8", "pq")
+QUANTIZER_FILENAME = "quantizer.npz"
+QUANTIZED_CODES_FILENAME = "quantized_codes.npy"
+# Centroids of each product quantization subspace, the codes are uint8
+PQ_NUM_CENTROIDS = 256
+
+
+class Float16Quantizer:
+    mode = "float16"
+    codes_dtype = np.float16
+
+    @classmethod
+    def train(cls, matrix: np.ndarray, **kwargs) -> "Float16Quantizer":
+        return cls()
+
+    def get_params(self) -> dict:
+        return {}
+
+    def encode(self, vectors: np.ndarray) -> np.ndarray:
+        return np.asarray(vectors, dtype=np.float32).astype(np.float16)
+
+    def score(self, codes: np.ndarray, queries: np.ndarray) -> np.ndarray:
+        """
+        Returns:
+            (num_codes, num_queries) approximate cosine similarities
+        """
+        return codes.astype(np.float32) @ queries.T
+
+
+class Int8Quantizer:
+    mode = "int8"
+    codes_dtype = np.int8
+
+    def __init__(self, minimums: np.ndarray, scales: np.ndarray):
+        """
+        Args:
+            minimums: minimum value of each dimension, mapped to the code -128
+            scales: step of each dimension between two consecutive codes
+        """
+        self.minimums = minimums
+        self.scales = scales
+
+    @classmethod
+    def train(cls, matrix: np.ndarray, chunk_size: int = 65536, **kwargs) -> "Int8Quantizer":
+        minimums = np.full(matrix.shape[1], np.inf, dtype=np.float32)
+        maximums = np.full(matrix.shape[1], -np.inf, dtype=np.float32)
+        for start in range(0, len(matrix), chunk_size):
+            chunk = np.asarray(matrix[start : start + chunk_size], dtype=np.float32)
+            minimums = np.minimum(minimums, chunk.min(axis=0))
+            maximums = np.maximum(maximums, chunk.max(axis=0))
+        scales = (maximums - minimums) / 255.0
+        scales[scales == 0.0] = 1.0
+        return cls(minimums, scales.astype(np.float32))
+
+    def get_params(self) -> dict:
+        return {"minimums": self.minimums, "scales": self.scales}
+
+    def encode(self, vectors: np.ndarray) -> np.ndarray:
+        codes = np.rint((np.asarray(vectors, dtype=np.float32) - self.minimums) / self.scales) - 128
+        return np.clip(codes, -128, 127).astype(np.int8)
+
+    def score(self, codes: np.ndarray, queries: np.ndarray) -> np.ndarray:
+        # x ~= (code + 128) * scale + minimum, so x.q = code.(q * scale) + (128 * scale + minimum).q
+        scaled_queries = queries * self.scales
+        biases = queries @ (128.0 * self.scales + self.minimums)
+        return codes.astype(np.float32) @ scaled_queries.T + biases
+
+
+class ProductQuantizer:
+    mode = "pq"
+    codes_dtype = np.uint8
+
+    def __init__(self, codebooks: np.ndarray):
+        """
+        Args:
+            codebooks: (num_subspaces, PQ_NUM_CENTROIDS, subspace size) centroids of each subspace
+        """
+        self.codebooks = codebooks
+
+    @property
+    def num_subspaces(self) -> int:
+        return self.codebooks.shape[0]
+
+    @classmethod
+    def train(
+        cls,
+        matrix: np.ndarray,
+        pq_num_subspaces: int = 96,
+        n_iter: int = 20,
+        train_sample_size: int = 100000,
+        seed: int = 0,
+        **kwargs,
+    ) -> "ProductQuantizer":
+        embeddings_size = matrix.shape[1]
+        if embeddings_size % pq_num_subspaces != 0:
+            raise ValueError(
+                f"Embeddings size {embeddings_size} not divisible in {pq_num_subspaces} subspaces"
+            )
+        rng = np.random.default_rng(seed)
+        if train_sample_size < len(matrix):
+            sample_ids = np.sort(rng.choice(len(matrix), size=train_sample_size, replace=False))
+            train = np.asarray(matrix[sample_ids], dtype=np.float32)
+        else:
+            train = np.asarray(matrix, dtype=np.float32)
+        subspaces = train.reshape(len(train), pq_num_subspaces, -1)
+        num_centroids = min(PQ_NUM_CENTROIDS, len(train))
+        codebooks = np.zeros(
+            (pq_num_subspaces, PQ_NUM_CENTROIDS, subspaces.shape[2]), dtype=np.float32
+        )
+        for subspace in range(pq_num_subspaces):
+            codebooks[subspace, :num_centroids] = kmeans(
+                np.ascontiguousarray(subspaces[:, subspace]),
+                num_centroids,
+                n_iter=n_iter,
+                seed=seed + subspace,
+                spherical=False,
+            )
+        return cls(codebooks)
+
+    def get_params(self) -> dict:
+        return {"codebooks": self.codebooks}
+
+    def encode(self, vectors: np.ndarray) -> np.ndarray:
+        subspaces = np.asarray(vectors, dtype=np.float32).reshape(len(vectors), self.num_subspaces, -1)
+        codes = np.empty((len(vectors), self.num_subspaces), dtype=np.uint8)
+        for subspace in range(self.num_subspaces):
+            codes[:, subspace] = assign_to_centroids(
+                subspaces[:, subspace], self.codebooks[subspace], spherical=False
+            )
+        return codes
+
+    def score(self, codes: np.ndarray, queries: np.ndarray) -> np.ndarray:
+        # Asymmetric distance: a lookup table with the dot products of the query sub-vectors and the centroids,
+        # the score of a row is the sum of the table values of its codes
+        lookup_tables = np.einsum(
+            "mkd,qmd->qmk", self.codebooks, queries.reshape(len(queries), self.num_subspaces, -1)
+        ).reshape(len(queries), -1)
+        table_positions = codes.astype(np.intp) + np.arange(self.num_subspaces) * PQ_NUM_CENTROIDS
+        return np.stack(
+            [lookup_table[table_positions].sum(axis=1) for lookup_table in lookup_tables], axis=1
+        )
+
+
+QUANTIZER_CLASSES = {
+    quantizer_class.mode: quantizer_class
+    for quantizer_class in (Float16Quantizer, Int8Quantizer, ProductQuantizer)
+}
+
+
+def train_quantizer(matrix: np.ndarray, mode: str, **kwargs):
+    """
+    Args:
+        matrix: L2 normalized embeddings matrix, it can be memory-mapped
+        mode: "float16", "int8" or "pq"
+        kwargs: pq_num_subspaces, n_iter, train_sample_size and seed of the product quantizer
+
+    Returns:
+        the quantizer of the mode
+    """
+    if mode not in QUANTIZER_CLASSES:
+        raise ValueError(f"Quantization mode {mode} not supported, choose one of {list(QUANTIZER_CLASSES)}")
+    return QUANTIZER_CLASSES[mode].train(matrix, **kwargs)
+
+
+def save_quantized_codes(store_dirpath: str, quantizer, matrix: np.ndarray, chunk_size: int = 65536):
+    """
+    Encode the matrix in chunks directly into the codes file and save the quantizer parameters
+    """
+    codes_filepath = os.path.join(store_dirpath, QUANTIZED_CODES_FILENAME)
+    num_code_columns = quantizer.encode(np.asarray(matrix[:1], dtype=np.float32)).shape[1]
+    codes = np.lib.format.open_memmap(
+        codes_filepath + ".tmp",
+        mode="w+",
+        dtype=quantizer.codes_dtype,
+        shape=(len(matrix), num_code_columns),
+    )
+    for start in range(0, len(matrix), chunk_size):
+        codes[start : start + chunk_size] = quantizer.encode(matrix[start : start + chunk_size])
+    codes.flush()
+    del codes
+    os.replace(codes_filepath + ".tmp", codes_filepath)
+
+    quantizer_filepath = os.path.join(store_dirpath, QUANTIZER_FILENAME)
+    # np.savez adds the .npz extension when missing, keep it in the temporary filename
+    tmp_filepath = quantizer_filepath + ".tmp.npz"
+    np.savez(tmp_filepath, mode=quantizer.mode, **quantizer.get_params())
+    os.replace(tmp_filepath, quantizer_filepath)
+
+
+def load_quantized_codes(store_dirpath: str) -> Tuple[object, np.ndarray]:
+    """
+    Returns:
+        the quantizer and the codes matrix, read into memory
+    """
+    with np.load(os.path.join(store_dirpath, QUANTIZER_FILENAME)) as quantizer_data:
+        params = {key: quantizer_data[key] for key in quantizer_data.files if key != "mode"}
+        quantizer = QUANTIZER_CLASSES[str(quantizer_data["mode"])](**params)
+    codes = np.load(os.path.join(store_dirpath, QUANTIZED_CODES_FILENAME))
+    return quantizer, codes
+
+
+def remove_quantized_codes(store_dirpath: str):
+    for filename in (QUANTIZER_FILENAME, QUANTIZED_CODES_FILENAME):
+        if os.path.exists(os.path.join(store_dirpath, filename)):
+            os.remove(os.path.join(store_dirpath, filename))
+
+
+class QuantizedRetriever:
+    """
+    Cosine similarity search scoring the quantized codes, the shortlist is rescored with the float32 rows
+    """
+
+    def __init__(
+        self,
+        quantizer,
+        codes: np.ndarray,
+        matrix: np.ndarray,
+        rescore_factor: int = 4,
+        chunk_size: int = 4096,
+    ):
+        """
+        Args:
+            quantizer: quantizer of the codes
+            codes: quantized rows
+            matrix: L2 normalized float32 embeddings matrix, usually memory-mapped
+            rescore_factor: rows rescored at full precision for each result, 0 to return the approximate scores
+            chunk_size: codes decoded at once, small chunks keep the decoded rows in the CPU cache
+        """
+        self.quantizer = quantizer
+        self.codes = codes
+        self.matrix = matrix
+        self.rescore_factor = rescore_factor
+        self.chunk_size = chunk_size
+
+    def __len__(self) -> int:
+        return len(self.codes)
+
+    def score(self, queries: np.ndarray) -> np.ndarray:
+        """
+        Returns:
+            (num_queries, num_rows) approximate cosine similarities
+        """
+        scores = np.empty((len(queries), len(self.codes)), dtype=np.float32)
+        for start in range(0, len(self.codes), self.chunk_size):
+            chunk_codes = self.codes[start : start + self.chunk_size]
+            scores[:, start : start + len(chunk_codes)] = self.quantizer.score(chunk_codes, queries).T
+        return scores
+
+    def search(
+        self, query_embeddings: np.ndarray, top_k: int
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Find the rows most similar to one query embeddings vector
+
+        Returns:
+            row indices and cosine similarities, sorted by descending similarity
+        """
+        indices, scores = self.search_batch(query_embeddings[np.newaxis], top_k)
+        return indices[0], scores[0]
+
+    def search_batch(
+        self, queries_embeddings: np.ndarray, top_k: int
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Find the rows most similar to each query, all the queries are scored in a single pass on the codes
+
+        Returns:
+            (num_queries, top_k) row indices and cosine similarities, sorted by descending similarity
+        """
+        queries = normalize_rows(queries_embeddings)
+        with timer("retrieval.scores"):
+            scores = self.score(queries)
+        if self.rescore_factor <= 0:
+            with timer("retrieval.top_k"):
+                return select_top_k(scores, top_k)
+
+        with timer("retrieval.top_k"):
+            shortlists, _ = select_top_k(scores, self.rescore_factor * top_k)
+        top_k = min(top_k, shortlists.shape[1])
+        indices = np.empty((len(queries), top_k), dtype=np.int64)
+        top_scores = np.empty((len(queries), top_k), dtype=np.float32)
+        with timer("retrieval.rescoring"):
+            for i, (query, shortlist) in enumerate(zip(queries, shortlists)):
+                # Sorted rows read the memory-mapped matrix sequentially
+                shortlist = np.sort(shortlist)
+                positions, top_scores[i] = select_top_k(self.matrix[shortlist] @ query, top_k)
+                indices[i] = shortlist[positions]
+        return indices, top_scores
@@ -0,0 +1,140 @@
+"""
+Client side rate limiting and retries for the OpenAI API requests
+
+- TokenBucket: thread-safe token bucket refilled continuously at a per minute rate
+- RateLimiter: requests per minute and tokens per minute buckets acquired together
+- call_with_retry: retry transient errors with exponential backoff and full jitter
+"""
+import random
+import threading
+import time
+from typing import Callable, Optional, Tuple, Type, TypeVar
+
+import openai
+
+from utils.metrics import count
+
+T = TypeVar("T")
+
+# Errors worth retrying: rate limits, timeouts and server side failures
+RETRYABLE_OPENAI_ERRORS = (
+    openai.error.RateLimitError,
+    openai.error.Timeout,
+    openai.error.APIError,
+    openai.error.APIConnectionError,
+    openai.error.ServiceUnavailableError,
+    openai.error.TryAgain,
+)
+
+
+class TokenBucket:
+    """
+    Bucket with capacity per_minute_limit refilled at per_minute_limit / 60 per second
+    """
+
+    def __init__(self, per_minute_limit: float):
+        self.capacity = float(per_minute_limit)
+        self.refill_rate_per_s = self.capacity / 60.0
+        self.available = self.capacity
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.available = min(
+            self.capacity,
+            self.available + (now - self.last_refill) * self.refill_rate_per_s,
+        )
+        self.last_refill = now
+
+    def try_acquire(self, amount: float) -> float:
+        """
+        Take amount from the bucket if available
+
+        Returns:
+            0 if acquired, otherwise the seconds to wait before it could be available
+        """
+        # A request bigger than the capacity waits for a full bucket and then drains it
+        amount = min(amount, self.capacity)
+        with self.lock:
+            self._refill()
+            if self.available >= amount:
+                self.available -= amount
+                return 0.0
+            return (amount - self.available) / self.refill_rate_per_s
+
+    def acquire(self, amount: float = 1.0):
+        """
+        Block until amount is available and take it
+        """
+        while True:
+            wait_s = self.try_acquire(amount)
+            if wait_s == 0.0:
+                return
+            time.sleep(wait_s)
+
+
+class RateLimiter:
+    """
+    Requests per minute and tokens per minute limits, a None limit is not enforced
+    """
+
+    def __init__(
+        self,
+        requests_per_minute: Optional[float] = None,
+        tokens_per_minute: Optional[float] = None,
+    ):
+        self.requests_bucket = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.tokens_bucket = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+
+    def acquire(self, num_tokens: int):
+        """
+        Block until one request with num_tokens tokens can be sent
+        """
+        if self.requests_bucket is not None:
+            self.requests_bucket.acquire(1)
+        if self.tokens_bucket is not None:
+            self.tokens_bucket.acquire(num_tokens)
+
+
+def get_backoff_delay(
+    attempt: int, initial_delay_s: float, max_delay_s: float
+) -> float:
+    """
+    Exponential backoff with full jitter: uniform in [0, min(max_delay, initial_delay * 2^attempt)]
+    """
+    return random.uniform(0.0, min(max_delay_s, initial_delay_s * 2**attempt))
+
+
+def call_with_retry(
+    fn: Callable[[], T],
+    max_retries: int = 6,
+    initial_delay_s: float = 1.0,
+    max_delay_s: float = 60.0,
+    retryable_errors: Tuple[Type[Exception], ...] = RETRYABLE_OPENAI_ERRORS,
+) -> T:
+    """
+    Call fn and retry it when it raises one of retryable_errors
+
+    When the error carries a Retry-After header, the delay is at least that value.
+    """
+    attempt = 0
+    while True:
+        try:
+            return fn()
+        except retryable_errors as error:
+            if attempt >= max_retries:
+                raise
+            delay_s = get_backoff_delay(attempt, initial_delay_s, max_delay_s)
+            headers = getattr(error, "headers", None) or {}
+            retry_after = headers.get("retry-after") or headers.get("Retry-After")
+            if retry_after is not None:
+                try:
+                    delay_s = max(delay_s, float(retry_after))
+                except ValueError:
+                    pass
+            count(f"api_retries.{type(error).__name__}")
+            message = getattr(error, "user_message", None) or str(error)
+            print(f"WARNING: {type(error).__name__}: {message}, retry in {delay_s:.2f} s")
+            time.sleep(delay_s)
+            attempt += 1
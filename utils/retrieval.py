@@ -0,0 +1,102 @@
+"""
+Exact cosine similarity retrieval over an embeddings matrix
+
+The matrix rows are L2 normalized once, then the cosine similarity with a query is a single
+matrix-vector product and only the top-k rows are selected with a partial sort (np.argpartition).
+"""
+from typing import Tuple
+
+import numpy as np
+
+from utils.metrics import timer
+
+
+def normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    """
+    L2 normalize each row of a 1D or 2D array, zero rows are left untouched
+
+    Returns:
+        a new float32 array
+    """
+    matrix = np.asarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    norms[norms == 0.0] = 1.0
+    return matrix / norms
+
+
+def select_top_k(scores: np.ndarray, top_k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Select the top_k highest scores along the last axis without sorting all of them
+
+    Args:
+        scores: 1D scores array or 2D array (one row of scores for each query)
+        top_k: number of results to keep, clipped to the number of scores
+
+    Returns:
+        indices and scores of the top_k results sorted by descending score
+    """
+    num_scores = scores.shape[-1]
+    top_k = min(top_k, num_scores)
+    if top_k <= 0:
+        empty_shape = scores.shape[:-1] + (0,)
+        return np.empty(empty_shape, dtype=np.int64), np.empty(empty_shape, dtype=scores.dtype)
+    if top_k < num_scores:
+        candidates = np.argpartition(-scores, top_k - 1, axis=-1)[..., :top_k]
+    else:
+        candidates = np.broadcast_to(np.arange(num_scores), scores.shape)
+    candidate_scores = np.take_along_axis(scores, candidates, axis=-1)
+    order = np.argsort(-candidate_scores, axis=-1, kind="stable")
+    return (
+        np.take_along_axis(candidates, order, axis=-1),
+        np.take_along_axis(candidate_scores, order, axis=-1),
+    )
+
+
+class ExactRetriever:
+    """
+    Brute force cosine similarity search on a pre-normalized embeddings matrix
+    """
+
+    def __init__(self, embeddings: np.ndarray, normalized: bool = False):
+        """
+        Args:
+            embeddings: (num_rows, embeddings_size) matrix, it can be memory-mapped
+            normalized: the rows are already L2 normalized, so the matrix is used as it is without copies
+        """
+        self.matrix = embeddings if normalized else normalize_rows(embeddings)
+
+    def __len__(self) -> int:
+        return len(self.matrix)
+
+    def search(
+        self, query_embeddings: np.ndarray, top_k: int
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Find the rows most similar to one query embeddings vector
+
+        Returns:
+            row indices and cosine similarities, sorted by descending similarity
+        """
+        query = normalize_rows(query_embeddings)
+        with timer("retrieval.scores"):
+            scores = self.matrix @ query
+        with timer("retrieval.top_k"):
+            return select_top_k(scores, top_k)
+
+    def search_batch(
+        self, queries_embeddings: np.ndarray, top_k: int
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Find the rows most similar to each query with a single matrix-matrix product
+
+        Args:
+            queries_embeddings: (num_queries, embeddings_size) matrix
+
+        Returns:
+            (num_queries, top_k) row indices and cosine similarities, sorted by descending similarity
+        """
+        queries = normalize_rows(queries_embeddings)
+        with timer("retrieval.scores"):
+            scores = queries @ self.matrix.T
+        with timer("retrieval.top_k"):
+            return select_top_k(scores, top_k)
@@ -0,0 +1,157 @@
+"""
+Query fan-out over the shards of a sharded embedding store
+
+Each query is scored on all the shards in parallel by a pool of worker processes: every worker maps the shard
+matrices read-only (the pages are shared through the page cache, not copied) and returns the top-k of a shard,
+the shard results are merged into the global top-k. The scoring uses all the cores and the matrix of a single
+shard is the largest array a process touches.
+"""
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Tuple, Union
+
+import numpy as np
+
+from utils.ann_index import IVF_INDEX_FILENAME, IVFIndex
+from utils.embedding_store import EMBEDDINGS_FILENAME, get_shard_dirpath
+from utils.metrics import timer
+from utils.quantization import QUANTIZER_FILENAME, QuantizedRetriever, load_quantized_codes
+from utils.retrieval import ExactRetriever, normalize_rows, select_top_k
+
+# Retrievers of the shards in a worker process, created by init_shard_worker
+_shard_retrievers: Dict[int, Union[ExactRetriever, IVFIndex, QuantizedRetriever]] = {}
+
+
+def load_shard_retriever(
+    shard_dirpath: str, n_probe: int, exact_search: bool, rescore_factor: int = 4
+) -> Union[ExactRetriever, IVFIndex, QuantizedRetriever]:
+    """
+    Map the shard matrix (the metadata is not needed to score) and load its IVF index if available,
+    otherwise its quantized codes if available
+    """
+    matrix = np.load(os.path.join(shard_dirpath, EMBEDDINGS_FILENAME), mmap_mode="r")
+    retriever = ExactRetriever(matrix, normalized=True)
+    if not exact_search and os.path.exists(os.path.join(shard_dirpath, IVF_INDEX_FILENAME)):
+        return IVFIndex.load(shard_dirpath, matrix, n_probe=n_probe)
+    if not exact_search and os.path.exists(os.path.join(shard_dirpath, QUANTIZER_FILENAME)):
+        quantizer, codes = load_quantized_codes(shard_dirpath)
+        return QuantizedRetriever(quantizer, codes, matrix, rescore_factor=rescore_factor)
+    return retriever
+
+
+def init_shard_worker(
+    shard_dirpaths: List[str], n_probe: int, exact_search: bool, rescore_factor: int
+):
+    for shard_id, shard_dirpath in enumerate(shard_dirpaths):
+        _shard_retrievers[shard_id] = load_shard_retriever(
+            shard_dirpath, n_probe, exact_search, rescore_factor
+        )
+
+
+def search_shard(
+    shard_id: int, queries: np.ndarray, top_k: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Run in a worker process
+
+    Returns:
+        (num_queries, top_k) shard row indices and cosine similarities, padded with -1 (and -inf)
+    """
+    indices, scores = _shard_retrievers[shard_id].search_batch(queries, top_k)
+    return indices, scores.astype(np.float32, copy=False)
+
+
+class ShardedRetriever:
+    """
+    Cosine similarity search over the shards of a sharded embedding store, same interface of ExactRetriever
+    """
+
+    def __init__(
+        self,
+        store_dirpath: str,
+        shard_offsets: List[int],
+        num_workers: int = 0,
+        n_probe: int = 8,
+        exact_search: bool = False,
+        rescore_factor: int = 4,
+    ):
+        """
+        Args:
+            store_dirpath: sharded embedding store directory, or an unsharded one (a single shard)
+            shard_offsets: start row of each shard and the number of rows as last element
+            num_workers: worker processes, 0 for one per shard up to the number of cores
+            n_probe: number of IVF lists to search in each shard with an IVF index
+            exact_search: score all the rows even if the shards have an IVF index or quantized codes
+            rescore_factor: rows rescored at full precision for each result in the shards with quantized codes
+        """
+        self.shard_offsets = np.asarray(shard_offsets, dtype=np.int64)
+        self.num_shards = len(self.shard_offsets) - 1
+        # An unsharded store is searched as a single shard
+        shard_dirpaths = (
+            [get_shard_dirpath(store_dirpath, shard_id) for shard_id in range(self.num_shards)]
+            if self.num_shards > 1
+            else [store_dirpath]
+        )
+        self.num_workers = num_workers or min(self.num_shards, os.cpu_count())
+        # The workers are started from a clean process: forking a process with threads (e.g. query_service.py)
+        # could copy locks held by other threads
+        self.executor = ProcessPoolExecutor(
+            max_workers=self.num_workers,
+            mp_context=multiprocessing.get_context("forkserver"),
+            initializer=init_shard_worker,
+            initargs=(shard_dirpaths, n_probe, exact_search, rescore_factor),
+        )
+        # Start the workers now, the first query doesn't wait for them
+        embeddings_size = np.load(
+            os.path.join(shard_dirpaths[0], EMBEDDINGS_FILENAME), mmap_mode="r"
+        ).shape[1]
+        self.search_batch(np.ones((1, embeddings_size), dtype=np.float32), top_k=1)
+
+    def __len__(self) -> int:
+        return int(self.shard_offsets[-1])
+
+    def search(
+        self, query_embeddings: np.ndarray, top_k: int
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Find the rows most similar to one query embeddings vector
+
+        Returns:
+            row indices and cosine similarities, sorted by descending similarity
+        """
+        indices, scores = self.search_batch(query_embeddings[np.newaxis], top_k)
+        found = indices[0] >= 0
+        return indices[0][found], scores[0][found]
+
+    def search_batch(
+        self, queries_embeddings: np.ndarray, top_k: int
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Find the rows most similar to each query, the results are padded with -1 indices (and -inf scores)
+        when the shard IVF indexes return less than top_k rows
+
+        Returns:
+            (num_queries, top_k) row indices and cosine similarities, sorted by descending similarity
+        """
+        queries = normalize_rows(queries_embeddings)
+        with timer("retrieval.shards"):
+            futures = [
+                self.executor.submit(search_shard, shard_id, queries, top_k)
+                for shard_id in range(self.num_shards)
+            ]
+            shard_results = [future.result() for future in futures]
+        with timer("retrieval.merge"):
+            indices = np.concatenate(
+                [
+                    np.where(shard_indices >= 0, shard_indices + self.shard_offsets[shard_id], -1)
+                    for shard_id, (shard_indices, _) in enumerate(shard_results)
+                ],
+                axis=1,
+            )
+            scores = np.concatenate([shard_scores for _, shard_scores in shard_results], axis=1)
+            positions, top_scores = select_top_k(scores, top_k)
+            return np.take_along_axis(indices, positions, axis=1), top_scores
+
+    def close(self):
+        self.executor.shutdown()
@@ -0,0 +1,200 @@
+"""
+Streaming reader of the Wikipedia XML dumps (pages-articles*.xml.bz2) and sectionizer of the page wikitext
+
+- iter_dump_pages: the articles of a dump read with iterparse, the processed pages are released,
+  so the memory doesn't grow with the dump size
+- sectionize_wikitext: the wikitext markup (templates, references, tables, links, formatting) is removed and
+  the headings, paragraphs and lists drive the same SentencesBuilder of the HTML extracts
+- parse_dump_pages: sentences of a batch of pages, run by the process pool of get_wikipedia_dump.py
+"""
+import bz2
+import html
+import re
+import xml.etree.ElementTree as ET
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+from utils.wikipedia_sectionizer import SentencesBuilder
+from utils.wikipedia_utils import get_page_sections_texts
+
+COMMENT_RE = re.compile(r"<!--.*?-->", re.DOTALL)
+REF_RE = re.compile(r"<ref[^>]*/>|<ref[^>]*>.*?</ref>", re.DOTALL | re.IGNORECASE)
+# Tags whose content is not text
+REMOVED_TAGS_RE = re.compile(
+    r"<(gallery|math|score|syntaxhighlight|timeline|imagemap|chem)\b[^>]*>.*?</\1>",
+    re.DOTALL | re.IGNORECASE,
+)
+# Innermost templates and tables, removed until none is left
+TEMPLATE_RE = re.compile(r"\{\{[^{}]*\}\}")
+TABLE_RE = re.compile(r"\{\|(?:(?!\{\|).)*?\|\}", re.DOTALL)
+# Innermost internal links, [[target]] or [[target|label]]
+LINK_RE = re.compile(r"\[\[([^\[\]|]*)(?:\|([^\[\]]*))?\]\]")
+EXTERNAL_LINK_RE = re.compile(r"\[(?:https?:)?//[^\s\]]+\s*([^\]]*)\]")
+TAG_RE = re.compile(r"</?[a-zA-Z][^>]*>")
+FORMATTING_RE = re.compile(r"'{2,}")
+MAGIC_WORD_RE = re.compile(r"__[A-Z]+__")
+HEADING_RE = re.compile(r"^(={1,6})\s*(.+?)\s*\1\s*$")
+LIST_MARKER_RE = re.compile(r"^[*#:;]+")
+# Namespaces of the links without text (english and italian names)
+NON_TEXT_LINK_NAMESPACES = {"file", "image", "media", "category", "immagine", "categoria"}
+
+
+def replace_link(match: re.Match) -> str:
+    target, label = match.group(1), match.group(2)
+    if ":" in target and not target.startswith(":"):
+        namespace = target.split(":", 1)[0].strip().lower()
+        # Files, categories and interlanguage links (e.g. [[en:Barga]])
+        if namespace in NON_TEXT_LINK_NAMESPACES or len(namespace) in (2, 3):
+            return ""
+    return label if label is not None else target.lstrip(":")
+
+
+def remove_nested(pattern: re.Pattern, text: str, replacement="") -> str:
+    """
+    Apply the substitution of the innermost pattern until nothing changes
+    """
+    while True:
+        text, num_substitutions = pattern.subn(replacement, text)
+        if num_substitutions == 0:
+            return text
+
+
+def clean_wikitext(wikitext: str) -> str:
+    """
+    Returns:
+        the wikitext without markup, the lines (headings, lists and paragraphs) are kept
+    """
+    text = COMMENT_RE.sub("", wikitext)
+    text = REF_RE.sub("", text)
+    text = REMOVED_TAGS_RE.sub("", text)
+    text = remove_nested(TEMPLATE_RE, text)
+    text = remove_nested(TABLE_RE, text)
+    text = remove_nested(LINK_RE, text, replace_link)
+    text = EXTERNAL_LINK_RE.sub(r"\1", text)
+    text = TAG_RE.sub("", text)
+    text = FORMATTING_RE.sub("", text)
+    text = MAGIC_WORD_RE.sub("", text)
+    return html.unescape(text)
+
+
+def get_heading_anchor(heading: str) -> str:
+    """
+    The anchor of the HTML extracts heading (data-mw-anchor), e.g. "Collegamenti esterni" -> "Collegamenti_esterni"
+    """
+    return heading.strip().replace(" ", "_")
+
+
+def sectionize_wikitext(
+    wikitext: str, title: str, on_sentence: Optional[Callable[[str, str], None]] = None
+) -> Dict[str, List[str]]:
+    """
+    Group the sentences of a page wikitext by headings, like utils.wikipedia_utils.parse_page_html
+    does with the HTML extract of the same page
+
+    Returns:
+        dict headings key (e.g. "History - Middle_Ages") -> sentences, the intro is under the page title
+    """
+    builder = SentencesBuilder(title, on_sentence=on_sentence)
+    paragraph_lines = []
+    list_items = []
+    list_type = None
+
+    def flush_paragraph():
+        if paragraph_lines:
+            builder.add_paragraph("\n".join(paragraph_lines))
+            paragraph_lines.clear()
+
+    def flush_list():
+        if list_items:
+            builder.add_list(list_items, element_type=list_type)
+            list_items.clear()
+
+    for line in clean_wikitext(wikitext).split("\n"):
+        heading_match = HEADING_RE.match(line)
+        list_marker_match = LIST_MARKER_RE.match(line)
+        if heading_match:
+            flush_paragraph()
+            flush_list()
+            # The extracts have only h2-h4 headings
+            level = min(max(len(heading_match.group(1)), 2), 4)
+            builder.add_heading(f"h{level}", get_heading_anchor(heading_match.group(2)))
+        elif list_marker_match:
+            flush_paragraph()
+            marker = list_marker_match.group(0)
+            item_list_type = "dl" if marker[0] in ";:" else "ul"
+            if item_list_type != list_type:
+                flush_list()
+                list_type = item_list_type
+            content = line[len(marker):].strip()
+            if marker[-1] == ";" and " : " in content:
+                # Definition term and description on the same line
+                list_items.extend(content.split(" : ", 1))
+            elif len(marker) > 1 and list_items:
+                # Nested list, squashed into the parent element like in the HTML extracts
+                list_items[-1] += "\n" + content
+            else:
+                list_items.append(content)
+        elif line.strip() == "":
+            flush_paragraph()
+            flush_list()
+        else:
+            flush_list()
+            paragraph_lines.append(line)
+    flush_paragraph()
+    flush_list()
+    return builder.close()
+
+
+def open_dump(dump_filepath: str):
+    if dump_filepath.endswith(".bz2"):
+        return bz2.open(dump_filepath, "rb")
+    return open(dump_filepath, "rb")
+
+
+def iter_dump_pages(
+    dump_filepath: str, namespaces: Tuple[int, ...] = (0,)
+) -> Iterator[Tuple[int, str, str]]:
+    """
+    Stream the pages of a MediaWiki XML dump, the redirects are skipped
+
+    Args:
+        dump_filepath: .xml or .xml.bz2 dump, e.g. itwiki-latest-pages-articles1.xml-p1p316052.bz2
+        namespaces: page namespaces to return, 0 are the articles
+
+    Returns:
+        iterator on (page id, title, wikitext)
+    """
+    with open_dump(dump_filepath) as in_fp:
+        context = ET.iterparse(in_fp, events=("start", "end"))
+        _, root = next(context)
+        # The tags are qualified with the export schema namespace, e.g. "{http://www.mediawiki.org/xml/export-0.10/}page"
+        schema = root.tag[: root.tag.index("}") + 1] if root.tag.startswith("{") else ""
+        for event, element in context:
+            if event != "end" or element.tag != f"{schema}page":
+                continue
+            if (
+                int(element.findtext(f"{schema}ns", "0")) in namespaces
+                and element.find(f"{schema}redirect") is None
+            ):
+                yield (
+                    int(element.findtext(f"{schema}id")),
+                    element.findtext(f"{schema}title"),
+                    element.findtext(f"{schema}revision/{schema}text") or "",
+                )
+            # Release the processed pages
+            root.clear()
+
+
+def parse_dump_pages(
+    pages: List[Tuple[int, str, str]], skip_sections: List[str]
+) -> List[Tuple[int, str, List[Tuple[str, str]]]]:
+    """
+    Returns:
+        (page id, title, (headings key, text "<headings key> - <sentence>") pairs) of each page,
+        the pages without text are skipped
+    """
+    pages_texts = []
+    for page_id, title, wikitext in pages:
+        sections_texts = get_page_sections_texts(sectionize_wikitext(wikitext, title), skip_sections)
+        if sections_texts:
+            pages_texts.append((page_id, title, sections_texts))
+    return pages_texts
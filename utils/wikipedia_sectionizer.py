@@ -0,0 +1,288 @@
+"""
+Event-driven sectionizer of the Wikipedia pages
+
+The page structure (h2/h3/h4 headings, paragraphs and lists) is turned into (heading path, sentence) records
+with the sentence merging rules of the ingestion scripts:
+- the paragraphs before the first heading are under the page title
+- a list is appended to the previous sentence when it ends with ":"
+- a list following another list is squashed into the last sentence
+- otherwise each list element is a sentence
+
+SentencesBuilder implements the rules on structure events, so any parser can drive it:
+WikipediaHTMLSectionizer feeds it while parsing the HTML extracts with html.parser,
+without building a document tree.
+"""
+from collections import defaultdict
+from html.parser import HTMLParser
+from typing import Callable, Dict, List, Optional, Tuple
+
+HEADING_LEVELS = {"h2": 2, "h3": 3, "h4": 4}
+LIST_TAGS = ("ul", "dl")
+LIST_ITEM_TAGS = ("li", "dd", "dt")
+# Elements without end tag, like in the BeautifulSoup tree builder
+VOID_ELEMENTS = frozenset(
+    [
+        "area", "base", "br", "col", "embed", "hr", "img", "input", "keygen", "link", "menuitem",
+        "meta", "param", "source", "track", "wbr", "basefont", "bgsound", "command", "frame",
+        "image", "isindex", "nextid", "spacer",
+    ]
+)
+# Their content is not text
+SKIPPED_CONTENT_TAGS = ("script", "style", "template")
+
+
+def get_dict_key_from_headings(
+    last_h2_level_paragraph: str,
+    last_h3_level_paragraph: Optional[str] = None,
+    last_h4_level_paragraph: Optional[str] = None,
+) -> str:
+    key = f"{last_h2_level_paragraph}"
+    if last_h3_level_paragraph is not None:
+        key += f" - {last_h3_level_paragraph}"
+    if last_h4_level_paragraph is not None:
+        key += f" - {last_h4_level_paragraph}"
+    return key
+
+
+def clean_text(text: str) -> str:
+    """
+    Strip text and remove '\n' inside the paragraph
+    """
+    return text.strip().replace(u"\xa0", " ").replace("\n", " ")
+
+
+def merge_list_items(items: List[str]) -> str:
+    """
+    Join the cleaned list elements with "; "
+    """
+    list_content_str = "".join(item + "\n" for item in items)
+    return (
+        list_content_str.replace("\n", "; ")
+        .replace(",;", ";")
+        .replace(";;", ";")
+        .replace(".;", ";")[: -len(", ")]
+    )
+
+
+class SentencesBuilder:
+    """
+    Sentences of a page grouped by headings key, built from the page structure events
+    """
+
+    def __init__(
+        self, title: str, on_sentence: Optional[Callable[[str, str], None]] = None
+    ):
+        """
+        Args:
+            title: page title, the key of the intro sentences
+            on_sentence: called with (headings key, sentence) as soon as the sentence can't be merged anymore
+        """
+        self.title = title
+        self.on_sentence = on_sentence
+        self.sentences_dict: Dict[str, List[str]] = defaultdict(list)
+        self.last_h2_level_paragraph = None
+        self.last_h3_level_paragraph = None
+        self.last_h4_level_paragraph = None
+        self.last_element_type = None
+        # Keys whose last sentence is not emitted yet, a following list can still be merged into it
+        self.pending_keys: Dict[str, None] = {}
+
+    def get_key(self) -> str:
+        return get_dict_key_from_headings(
+            self.last_h2_level_paragraph,
+            self.last_h3_level_paragraph,
+            self.last_h4_level_paragraph,
+        )
+
+    def emit_pending(self):
+        if self.on_sentence is not None:
+            for key in self.pending_keys:
+                self.on_sentence(key, self.sentences_dict[key][-1])
+        self.pending_keys.clear()
+
+    def append(self, key: str, sentence: str):
+        if key in self.pending_keys:
+            # The previous sentence of the key is final
+            if self.on_sentence is not None:
+                self.on_sentence(key, self.sentences_dict[key][-1])
+            del self.pending_keys[key]
+        self.sentences_dict[key].append(sentence)
+        self.pending_keys[key] = None
+
+    def add_heading(self, element_type: str, anchor: str):
+        """
+        Args:
+            element_type: "h2", "h3" or "h4"
+            anchor: section anchor, e.g. "Storia"
+        """
+        self.emit_pending()
+        level = HEADING_LEVELS[element_type]
+        if level == 2:
+            # First level paragraph
+            self.last_h2_level_paragraph = anchor
+            self.last_h3_level_paragraph = None
+            self.last_h4_level_paragraph = None
+        elif level == 3:
+            # Second level paragraph
+            self.last_h3_level_paragraph = anchor
+            self.last_h4_level_paragraph = None
+        else:
+            # Third level paragraph
+            self.last_h4_level_paragraph = anchor
+        self.last_element_type = element_type
+
+    def add_paragraph(self, text: str, has_nested_list: bool = False):
+        if self.last_h2_level_paragraph is None:
+            # Intro before the first headings
+            self.append(self.title, clean_text(text))
+        else:
+            # Sentence of a paragraph, the headings provide the context
+            if has_nested_list:
+                raise ValueError("List <ul> inside a <p> not supported")
+            self.append(self.get_key(), clean_text(text))
+        self.last_element_type = "p"
+
+    def add_list(self, items: List[str], element_type: str = "ul"):
+        """
+        Merge the list elements with the previous sentence when it introduces the list (it ends with ":")
+        or when the list continues a previous one, otherwise each element is a sentence
+
+        Args:
+            items: raw text of each list element
+            element_type: "ul" or "dl"
+        """
+        list_content_str = merge_list_items([clean_text(item) for item in items])
+        key = self.get_key()
+        sentences = self.sentences_dict[key]
+        last_sentence_for_key = sentences[-1] if len(sentences) > 0 else ""
+        if last_sentence_for_key.endswith(":"):
+            # Concatenate the list elements with the previous sentence which explains the list content
+            sentences[-1] += " " + list_content_str
+        elif self.last_element_type in LIST_TAGS:
+            # The list could already been started with a different ul or dl element,
+            # in this case we don't support nesting and we simply concatenate
+            print(
+                f"WARNING: probably there is a nested list; it will be squashed into a single level, list element content: '{list_content_str}'"
+            )
+            sentences[-1] += "; " + list_content_str
+        else:
+            # The list is probably part of an entire section and not introduce with ":",
+            # so it does worth keeping split
+            for sentence in list_content_str.split("; "):
+                self.append(key, sentence)
+        self.last_element_type = element_type
+
+    def close(self) -> Dict[str, List[str]]:
+        """
+        Returns:
+            dict headings key -> sentences
+        """
+        self.emit_pending()
+        return self.sentences_dict
+
+
+class WikipediaHTMLSectionizer(HTMLParser):
+    """
+    Streaming parser of the Wikipedia HTML extracts, the top-level elements drive a SentencesBuilder:
+    h2/h3/h4 with the "data-mw-anchor" attribute, p (all the nested text) and ul/dl
+    (the text of each li/dd/dt child). The tags are matched like the BeautifulSoup html.parser tree builder.
+    """
+
+    def __init__(self, builder: SentencesBuilder):
+        super().__init__(convert_charrefs=True)
+        self.builder = builder
+        # Open elements, stack[0] is the current top-level element
+        self.stack: List[str] = []
+        self.text_parts: List[str] = []
+        self.in_list_item = False
+        self.list_items: List[str] = []
+        self.has_nested_list = False
+        self.skipped_content_depth = 0
+
+    def start_top_level(self, tag: str, attrs: List[Tuple[str, Optional[str]]]):
+        if tag in HEADING_LEVELS:
+            self.builder.add_heading(tag, dict(attrs)["data-mw-anchor"])
+        elif tag == "p":
+            self.text_parts = []
+            self.has_nested_list = False
+        elif tag in LIST_TAGS:
+            self.list_items = []
+            self.in_list_item = False
+        else:
+            raise ValueError(f"Tag {tag} not supported")
+
+    def end_element(self, tag: str, depth: int):
+        if tag in SKIPPED_CONTENT_TAGS:
+            self.skipped_content_depth -= 1
+        if depth == 0:
+            if tag == "p":
+                self.builder.add_paragraph("".join(self.text_parts), self.has_nested_list)
+            elif tag in LIST_TAGS:
+                self.builder.add_list(self.list_items, element_type=tag)
+        elif depth == 1 and self.in_list_item:
+            self.list_items.append("".join(self.text_parts))
+            self.in_list_item = False
+
+    def handle_starttag(self, tag: str, attrs: List[Tuple[str, Optional[str]]]):
+        if not self.stack:
+            self.start_top_level(tag, attrs)
+        elif len(self.stack) == 1:
+            if self.stack[0] == "p" and tag == "ul":
+                self.has_nested_list = True
+            elif self.stack[0] in LIST_TAGS and tag in LIST_ITEM_TAGS:
+                self.text_parts = []
+                self.in_list_item = True
+        if tag in VOID_ELEMENTS:
+            if not self.stack:
+                self.end_element(tag, depth=0)
+            return
+        if tag in SKIPPED_CONTENT_TAGS:
+            self.skipped_content_depth += 1
+        self.stack.append(tag)
+
+    def handle_endtag(self, tag: str):
+        # Close the most recent open element with the same tag and the ones opened after it,
+        # an end tag without an open element is ignored
+        if tag not in self.stack:
+            return
+        while True:
+            closed_tag = self.stack.pop()
+            self.end_element(closed_tag, depth=len(self.stack))
+            if closed_tag == tag:
+                return
+
+    def handle_data(self, data: str):
+        if not self.stack or self.skipped_content_depth > 0:
+            # The text between the top-level elements is ignored
+            return
+        if self.stack[0] == "p" or self.in_list_item:
+            self.text_parts.append(data)
+
+    def close(self) -> Dict[str, List[str]]:
+        """
+        Returns:
+            dict headings key -> sentences
+        """
+        super().close()
+        # Close the elements left open at the end of the document
+        while self.stack:
+            closed_tag = self.stack.pop()
+            self.end_element(closed_tag, depth=len(self.stack))
+        return self.builder.close()
+
+
+def sectionize_html(
+    html_text: str, title: str, on_sentence: Optional[Callable[[str, str], None]] = None
+) -> Dict[str, List[str]]:
+    """
+    Group the sentences of a page HTML extract by headings
+
+    Args:
+        on_sentence: called with (headings key, sentence) as soon as each sentence is final
+
+    Returns:
+        dict headings key (e.g. "History - Middle_Ages") -> sentences, the intro is under the page title
+    """
+    sectionizer = WikipediaHTMLSectionizer(SentencesBuilder(title, on_sentence=on_sentence))
+    sectionizer.feed(html_text)
+    return sectionizer.close()
@@ -0,0 +1,242 @@
+"""
+Wikipedia API client and page parsing shared by the Wikipedia ingestion scripts
+
+- WikipediaClient: pooled requests.Session, bounded concurrency and an on-disk cache of the API responses,
+  so the re-runs (e.g. after a parser change) don't fetch the pages again. The cached category listings
+  expire after a TTL, so the new pages of a category are found
+- fetch_page_extracts: HTML extracts of many titles with one request per title, sent concurrently
+- get_category_titles: titles of the pages of a category
+- parse_page_html / get_page_sections_texts: sentences of a page HTML extract grouped by headings
+  (see utils/wikipedia_sectionizer.py)
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import requests
+
+from utils.metrics import count, timer
+from utils.wikipedia_sectionizer import sectionize_html
+
+WIKIPEDIA_API_URL_TEMPLATE = "https://{wikipedia_lang}.wikipedia.org/w/api.php"
+USER_AGENT = "LLM_exercises-rag-ingestion/1.0 (https://github.com/SlipknotTN/LLM_exercises)"
+
+
+def get_api_url(wikipedia_lang: str, api_url: Optional[str] = None) -> str:
+    """
+    The api_url override is used to point to a mirror or to benchmarks/fake_mediawiki_server.py
+    """
+    return api_url or WIKIPEDIA_API_URL_TEMPLATE.format(wikipedia_lang=wikipedia_lang)
+
+
+class WikipediaClient:
+    def __init__(
+        self,
+        api_url: str,
+        cache_dirpath: Optional[str] = None,
+        max_concurrent_requests: int = 4,
+        cache_ttl_s: Optional[float] = None,
+        listing_cache_ttl_s: Optional[float] = 24 * 3600,
+    ):
+        """
+        Args:
+            api_url: MediaWiki API endpoint, e.g. https://en.wikipedia.org/w/api.php
+            cache_dirpath: directory of the cached responses, None to disable the cache
+            max_concurrent_requests: maximum number of requests in flight, also the connection pool size
+            cache_ttl_s: lifetime of the cached page extracts, None to keep them
+            listing_cache_ttl_s: lifetime of the cached category listings, None to keep them
+        """
+        self.api_url = api_url
+        self.cache_dirpath = cache_dirpath
+        self.cache_ttl_s = cache_ttl_s
+        self.listing_cache_ttl_s = listing_cache_ttl_s
+        self.max_concurrent_requests = max_concurrent_requests
+        # One session keeps the connections (and the TLS handshakes) alive across the requests
+        self.session = requests.Session()
+        self.session.headers["User-Agent"] = USER_AGENT
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=1, pool_maxsize=max_concurrent_requests, max_retries=3
+        )
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.semaphore = threading.BoundedSemaphore(max_concurrent_requests)
+
+    def get_cache_filepath(self, params: dict) -> str:
+        key = hashlib.sha256(
+            json.dumps([self.api_url, params], sort_keys=True).encode("utf-8")
+        ).hexdigest()
+        return os.path.join(self.cache_dirpath, key[:2], f"{key}.json")
+
+    def get(self, params: dict, cache_ttl_s: Optional[float] = None) -> dict:
+        """
+        GET the API with params, the response is read from the cache when available
+
+        Args:
+            cache_ttl_s: maximum age of the cached response, None to use it whatever its age
+
+        Returns:
+            the JSON response
+        """
+        cache_filepath = None
+        if self.cache_dirpath is not None:
+            cache_filepath = self.get_cache_filepath(params)
+            try:
+                cache_age_s = time.time() - os.path.getmtime(cache_filepath)
+            except FileNotFoundError:
+                cache_age_s = None
+            if cache_age_s is not None and (cache_ttl_s is None or cache_age_s <= cache_ttl_s):
+                count("http_cache_hits.wikipedia")
+                with open(cache_filepath, "r") as in_fp:
+                    return json.load(in_fp)
+            if cache_age_s is not None:
+                count("http_cache_expired.wikipedia")
+
+        with self.semaphore, timer("wikipedia_request"):
+            response = self.session.get(self.api_url, params=params)
+        response.raise_for_status()
+        count("api_calls.wikipedia")
+        count("bytes_received.wikipedia", len(response.content))
+        response_dict = response.json()
+        if "error" in response_dict:
+            raise RuntimeError(f"Wikipedia API error: {response_dict['error']}")
+
+        if cache_filepath is not None:
+            os.makedirs(os.path.dirname(cache_filepath), exist_ok=True)
+            # Rename after writing, a concurrent reader never sees a partial file
+            tmp_filepath = f"{cache_filepath}.{threading.get_ident()}.tmp"
+            with open(tmp_filepath, "w") as out_fp:
+                json.dump(response_dict, out_fp)
+            os.replace(tmp_filepath, cache_filepath)
+        return response_dict
+
+    def get_with_continue(self, params: dict, cache_ttl_s: Optional[float] = None) -> Iterator[dict]:
+        """
+        Follow the API continuation until all the results of the query are returned
+
+        Returns:
+            iterator on the JSON responses
+        """
+        continue_params = {}
+        while True:
+            response_dict = self.get({**params, **continue_params}, cache_ttl_s=cache_ttl_s)
+            yield response_dict
+            if "continue" not in response_dict:
+                return
+            continue_params = response_dict["continue"]
+
+
+def fetch_titles_extracts(client: WikipediaClient, titles: List[str]) -> List[dict]:
+    """
+    Fetch the HTML extracts of the titles with a single query.
+    The API returns only one full page extract per response, the others are returned by the continuations:
+    a multi-title query doesn't save requests, fetch_page_extracts sends one query per title concurrently.
+
+    Returns:
+        page dicts with "pageid", "title" and "extract", the missing pages are skipped
+    """
+    # "query" action documentation: https://en.wikipedia.org/w/api.php?action=help&modules=query
+    # Don't pass "explaintext": 1 to get the text in HTML format. It is a bit more complex to parse, but we have
+    # all the information to understand when a list is present
+    params = {
+        "action": "query",
+        "prop": "extracts",
+        "exlimit": "max",
+        "titles": "|".join(titles),
+        "exsectionformat": "wiki",
+        "redirects": 1,
+        "format": "json",
+        "formatversion": 2,
+    }
+    pages = {}
+    missing_titles = set()
+    for response_dict in client.get_with_continue(params, cache_ttl_s=client.cache_ttl_s):
+        for page_dict in response_dict["query"].get("pages", []):
+            if page_dict.get("missing") or page_dict.get("invalid"):
+                missing_titles.add(page_dict["title"])
+            elif page_dict.get("extract"):
+                pages[page_dict["pageid"]] = page_dict
+    for title in sorted(missing_titles):
+        print(f"WARNING: page '{title}' not found")
+    return list(pages.values())
+
+
+def fetch_page_extracts(client: WikipediaClient, titles: List[str]) -> List[dict]:
+    """
+    Fetch the HTML extracts of many titles, one request per title (the API returns one full extract
+    per response) sent concurrently up to the client max_concurrent_requests
+
+    Returns:
+        page dicts with "pageid", "title" and "extract" in the titles order, the duplicates are removed
+    """
+    pages = {}
+    with ThreadPoolExecutor(max_workers=client.max_concurrent_requests) as executor:
+        for title_pages in executor.map(lambda title: fetch_titles_extracts(client, [title]), titles):
+            for page_dict in title_pages:
+                # Different titles can redirect to the same page
+                pages.setdefault(page_dict["pageid"], page_dict)
+    return list(pages.values())
+
+
+def get_category_titles(client: WikipediaClient, category: str) -> List[str]:
+    """
+    Returns:
+        the titles of the articles in the category (subcategories are not expanded)
+    """
+    if not category.startswith("Category:"):
+        category = f"Category:{category}"
+    params = {
+        "action": "query",
+        "list": "categorymembers",
+        "cmtitle": category,
+        "cmnamespace": 0,
+        "cmlimit": "max",
+        "format": "json",
+        "formatversion": 2,
+    }
+    titles = []
+    # The listing changes when pages are added to the category, its cached responses expire
+    for response_dict in client.get_with_continue(params, cache_ttl_s=client.listing_cache_ttl_s):
+        titles.extend(member["title"] for member in response_dict["query"]["categorymembers"])
+    return titles
+
+
+def parse_page_html(html_text: str, title: str) -> Dict[str, List[str]]:
+    """
+    Group the sentences of a page HTML extract by headings, the page is parsed in a single streaming pass
+
+    Returns:
+        dict headings key (e.g. "History - Middle Ages") -> sentences, the intro is under the page title
+    """
+    return sectionize_html(html_text, title)
+
+
+def get_page_sections_texts(
+    sentences_dict: Dict[str, List[str]], skip_sections: List[str]
+) -> List[Tuple[str, str]]:
+    """
+    Returns:
+        (headings key, text "<headings key> - <sentence>") of the sections not skipped,
+        empty sentences are removed
+    """
+    sections_texts = []
+    skip_keys_start = tuple(
+        [skip_section + " - " for skip_section in skip_sections]
+    )
+    for key, key_sentences in sentences_dict.items():
+        if key not in skip_sections and key.startswith(skip_keys_start) is False:
+            for key_sentence in key_sentences:
+                if key_sentence != "":
+                    sections_texts.append((key, f"{key} - {key_sentence}"))
+    return sections_texts
+
+
+def get_page_texts(sentences_dict: Dict[str, List[str]], skip_sections: List[str]) -> List[str]:
+    """
+    Returns:
+        the texts "<headings key> - <sentence>" of the sections not skipped, empty sentences are removed
+    """
+    return [text for _, text in get_page_sections_texts(sentences_dict, skip_sections)]